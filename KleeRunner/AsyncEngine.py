@@ -0,0 +1,205 @@
+# vim: set sw=4 ts=4 softtabstop=4 expandtab:
+"""
+  Execution engine that runs the tasks of a batch run from a single
+  asyncio event loop (the loop of the ``AsyncSupervisor``) rather than
+  from a pool thread per running task.
+
+  Jobs whose runner implements ``toolInvocations()`` and whose backend
+  ``supportsAsync`` (e.g. ``NativeReplay`` with the ``Asyncio`` backend)
+  are awaited on the event loop so thousands of short lived processes can
+  run concurrently without a thread each. Any other job falls back to
+  calling ``run()`` in a thread so every runner and backend keeps working.
+
+  Requires Python >= 3.8.
+"""
+import asyncio
+import concurrent.futures
+import logging
+import traceback
+
+_logger = logging.getLogger(__name__)
+
+
+class AsyncTask:
+    """
+      A task (a list of invocation indices that must be run sequentially).
+      Has the parts of the interface of ``TaskHolder`` in
+      ``batch-runner.py`` that are used to record results.
+    """
+    def __init__(self, task_number, indices):
+        assert isinstance(indices, list)
+        assert len(indices) > 0
+        self._task_number = task_number
+        self._indices = indices
+        self._results = {}
+        self.runner = None
+
+    @property
+    def indices(self):
+        return self._indices
+
+    @property
+    def task_number(self):
+        return self._task_number
+
+    def results(self):
+        """
+        Returns a dictionary mapping invocation index to raw ResultInfo
+        for the jobs that were attempted.
+        """
+        return self._results
+
+
+class AsyncEngine:
+    """
+      Runs at most ``maxJobs`` tasks concurrently on the event loop of
+      ``supervisor``. The runners of a task are taken from ``lookahead``
+      (a ``LookaheadPreparer`` or ``InlinePreparer``) and ``preparer`` is
+      used to create error results. If ``metrics`` is not None it is told
+      when jobs start and stop running.
+    """
+    def __init__(self, supervisor, maxJobs, lookahead, preparer, metrics=None):
+        assert isinstance(maxJobs, int)
+        assert maxJobs > 0
+        self._supervisor = supervisor
+        self._maxJobs = maxJobs
+        self._lookahead = lookahead
+        self._preparer = preparer
+        self._metrics = metrics
+        self._stopped = False
+        self._running = dict() # Maps asyncio.Task to AsyncTask
+        # Tasks are taken in order by a single thread because ``take()``
+        # blocks until the runners of a task have been created.
+        self._takeExecutor = None
+        # For jobs that cannot be awaited. Threads are only created when
+        # they are needed.
+        self._runExecutor = None
+
+    @property
+    def stopped(self):
+        return self._stopped
+
+    def stop(self):
+        """
+          Stop starting new tasks and kill the running jobs. Can be called
+          from any thread (e.g. a signal handler).
+        """
+        self._stopped = True
+        self._supervisor.loop.call_soon_threadsafe(self._killRunning)
+
+    def _killRunning(self):
+        _logger.warning('Killing runners')
+        for task in self._running.values():
+            runner = task.runner
+            if runner is not None:
+                runner.kill()
+
+    def run(self, tasks, onTaskComplete):
+        """
+          Run ``tasks`` (an iterable of lists of invocation indices) blocking
+          until they have finished. ``onTaskComplete(task, excep)`` is called
+          on the event loop for every ``AsyncTask`` that was started where
+          ``excep`` is the exception that stopped it or None.
+
+          Returns an iterator over the ``AsyncTask`` objects for tasks that
+          were never started because ``stop()`` was called.
+        """
+        self._takeExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._runExecutor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self._maxJobs)
+        try:
+            return self._supervisor.submit(
+                self._runTasks(tasks, onTaskComplete)).result()
+        finally:
+            self._takeExecutor.shutdown()
+            self._runExecutor.shutdown()
+
+    async def _runTasks(self, tasks, onTaskComplete):
+        numberedTasks = enumerate(tasks)
+        exhausted = False
+        while True:
+            while (not self._stopped and not exhausted and
+                   len(self._running) < self._maxJobs):
+                try:
+                    task_number, indices = next(numberedTasks)
+                except StopIteration:
+                    exhausted = True
+                    break
+                task = AsyncTask(task_number, indices)
+                if len(indices) > 1:
+                    _logger.info('Forcing indicies "{}" to run sequentially'.format(indices))
+                self._running[asyncio.ensure_future(self._runTask(task))] = task
+            if len(self._running) == 0:
+                break
+            done, _ = await asyncio.wait(
+                list(self._running.keys()),
+                return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                task = self._running.pop(future)
+                excep = future.exception()
+                if excep is not None:
+                    _logger.error('Task {} hit exception:\n{}'.format(
+                        task.indices,
+                        "\n".join(traceback.format_exception(
+                            type(excep), excep, None))))
+                onTaskComplete(task, excep)
+        if exhausted:
+            return iter([])
+        return (AsyncTask(task_number, indices)
+                for task_number, indices in numberedTasks)
+
+    async def _runTask(self, task):
+        loop = asyncio.get_event_loop()
+        jobs = await loop.run_in_executor(
+            self._takeExecutor, self._lookahead.take, task.task_number)
+        if jobs is None:
+            _logger.warning('Runners for task {} were never created'.format(
+                task.task_number))
+            return
+        for position, job in enumerate(jobs):
+            if self._stopped:
+                _logger.warning('Sequential loop killed')
+                break
+            if job.error is not None:
+                task.results()[job.index] = self._preparer.errorResult(
+                    job.index, job.error)
+                continue
+            if len(jobs) > 1:
+                _logger.info('Doing sequential run {}/{} with runner "{}"'.format(
+                    position+1,
+                    len(jobs),
+                    job.runner.programPathArgument))
+            task.runner = job.runner
+            if self._metrics is not None:
+                self._metrics.jobStarted()
+            try:
+                await self._runJob(job.runner)
+                task.results()[job.index] = job.runner.getResults()
+            except BaseException:
+                task.results()[job.index] = self._preparer.errorResult(
+                    job.index, traceback.format_exc())
+                raise
+            finally:
+                task.runner = None
+                if self._metrics is not None:
+                    self._metrics.jobStopped()
+
+    async def _runJob(self, runner):
+        invocations = None
+        if runner.backend.supportsAsync:
+            invocations = runner.toolInvocations()
+        if invocations is None:
+            await asyncio.get_event_loop().run_in_executor(
+                self._runExecutor, runner.run)
+            return
+        try:
+            request = next(invocations)
+            while True:
+                cmdLine, envExtra = request
+                backendResult = await runner.backend.runAsync(
+                    cmdLine, runner.logFile, runner.toolEnvironment(envExtra))
+                request = invocations.send(backendResult)
+        except StopIteration:
+            pass
+        finally:
+            invocations.close()
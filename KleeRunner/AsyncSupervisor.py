@@ -0,0 +1,349 @@
+# vim: set sw=4 ts=4 softtabstop=4 expandtab:
+"""
+  Supervision of tool processes from a single asyncio event loop.
+
+  Rather than blocking a thread for every running tool, processes are
+  waited for from the event loop (using a pidfd where the kernel supports
+  it) and time limits are enforced by the loop. Memory limits are enforced
+  by the ``MemoryMonitor`` shared with the other backends. As with
+  ``PythonPsUtil`` each tool leads its own process group which is killed
+  when the tool finishes or reaches a limit and the tool is reaped with
+  ``os.wait4()`` so its resource usage is reported.
+
+  The event loop runs in a dedicated thread that is started when it is
+  first needed. Coroutines can be run on it from any thread with
+  ``submit()`` and ``runProcessAsync()`` can be awaited directly by other
+  coroutines running on the loop.
+
+  Requires Python >= 3.8.
+"""
+import asyncio
+import logging
+import os
+import pprint
+import signal
+import subprocess
+import sys
+import threading
+import time
+from .Backends.BackendBase import BackendResult
+from .Backends.PythonPsUtil import (ProcessGroup, liveProcessesInGroup,
+                                    resourceUsageFromRusage, waitForProcess)
+
+_logger = logging.getLogger(__name__)
+
+_CONTEXT_OBJECT_NAME = 'AsyncSupervisor'
+
+
+class AsyncSupervisorException(Exception):
+    def __init__(self, msg):
+        # pylint: disable=super-init-not-called
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+
+class SupervisedProcess:
+    """
+      Handle for a single run of a tool by the supervisor. ``memoryLimit``
+      is in MiB (zero implies unlimited) and is enforced by
+      ``memoryMonitor`` (a ``MemoryMonitor.MemoryMonitor``) which must be
+      given if there is a limit.
+    """
+    def __init__(self, memoryLimit, memoryMonitor=None):
+        assert isinstance(memoryLimit, int) and memoryLimit >= 0
+        assert memoryLimit == 0 or memoryMonitor is not None
+        self.memoryLimit = memoryLimit
+        self.memoryMonitor = memoryMonitor
+        # ``PythonPsUtil.ProcessGroup`` once the process has been started
+        self.processGroup = None
+        # ``MemoryMonitor.MonitoredTree`` whilst the process is monitored
+        self.monitoredTree = None
+        self.outOfMemory = False
+        self.killed = False
+
+
+def _setStackLimit(stackLimit):
+    """
+      Designed to be called by the child process after fork. Note do not
+      try to use the _logger here.
+    """
+    import resource
+    if stackLimit == 0:
+        resource.setrlimit(resource.RLIMIT_STACK,
+                           (resource.RLIM_INFINITY, resource.RLIM_INFINITY))
+    else:
+        resource.setrlimit(resource.RLIMIT_STACK, (stackLimit, stackLimit))
+
+
+async def _waitUntilExited(pid, timeout):
+    """
+      Wait up to ``timeout`` seconds (None implies wait forever) for the
+      child ``pid`` to exit without reaping it. Returns True if it exited.
+    """
+    pidfd = None
+    if hasattr(os, 'pidfd_open'):
+        # Linux >= 5.3. The pidfd becomes readable when the process exits.
+        try:
+            pidfd = os.pidfd_open(pid)
+        except OSError:
+            pidfd = None
+    if pidfd is not None:
+        loop = asyncio.get_event_loop()
+        exited = loop.create_future()
+        def onReadable():
+            if not exited.done():
+                exited.set_result(True)
+        loop.add_reader(pidfd, onReadable)
+        try:
+            await asyncio.wait_for(exited, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            loop.remove_reader(pidfd)
+            os.close(pidfd)
+    endTime = time.perf_counter() + (timeout if timeout is not None else float('inf'))
+    delay = 0.0005
+    while os.waitid(os.P_PID, pid, os.WEXITED | os.WNOHANG | os.WNOWAIT) is None:
+        remaining = endTime - time.perf_counter()
+        if remaining <= 0.0:
+            return False
+        delay = min(delay * 2, remaining, 0.05)
+        await asyncio.sleep(delay)
+    return True
+
+
+def _logTaskException(task):
+    # Done callback for tasks that nothing awaits
+    if not task.cancelled() and task.exception() is not None:
+        _logger.error('Task {} failed'.format(task), exc_info=task.exception())
+
+
+def _processGroupExists(pgid):
+    try:
+        os.killpg(pgid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+
+class AsyncSupervisor:
+    """
+      Runs and supervises tool processes on an event loop.
+    """
+    def __init__(self):
+        if sys.version_info < (3, 8):
+            raise AsyncSupervisorException('The asyncio supervisor needs Python >= 3.8')
+        self._processes = set()
+        self._loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self):
+        """
+          The event loop (started if necessary).
+        """
+        self.start()
+        return self._loop
+
+    @property
+    def numRunning(self):
+        return len(self._processes)
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._loop = asyncio.new_event_loop()
+            started = threading.Event()
+            self._thread = threading.Thread(
+                target=self._runLoop, args=(started,), name='async_supervisor',
+                daemon=True)
+            self._thread.start()
+        started.wait()
+
+    def _runLoop(self, started):
+        asyncio.set_event_loop(self._loop)
+        self._loop.call_soon(started.set)
+        try:
+            self._loop.run_forever()
+        finally:
+            self._loop.close()
+
+    def stop(self):
+        """
+          Stop the event loop. Processes that are still running are not
+          waited for.
+        """
+        with self._lock:
+            thread = self._thread
+        if thread is None:
+            return
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        thread.join()
+
+    def submit(self, coroutine):
+        """
+          Run ``coroutine`` on the event loop from another thread. Returns a
+          ``concurrent.futures.Future`` for its result.
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def inLoopThread(self):
+        return self._thread is not None and threading.current_thread() is self._thread
+
+    def kill(self, supervised):
+        """
+          Kill the process group of ``supervised`` or prevent it from
+          starting. Can be called from any thread.
+        """
+        supervised.killed = True
+        processGroup = supervised.processGroup
+        if processGroup is not None:
+            processGroup.signal(signal.SIGTERM)
+            processGroup.signal(signal.SIGKILL)
+
+    def _memoryLimitExceeded(self, supervised, killGracePeriod, monitoredTree):
+        # Called from the memory monitor thread
+        processGroup = supervised.processGroup
+        _logger.warning('Memory limit reached (recorded {} MiB). Killing tool with PID {}'.format(
+            monitoredTree.virtualMiB, processGroup.pgid))
+        supervised.outOfMemory = True
+        # Give the tool a chance to clean up after itself before
+        # aggressively killing it. Nothing is sent once run() has reaped
+        # the tool.
+        processGroup.signal(signal.SIGTERM)
+        self._loop.call_soon_threadsafe(
+            self._loop.call_later, killGracePeriod, processGroup.signal, signal.SIGKILL)
+
+    async def runProcessAsync(self, supervised, cmdLine, workingDirectory,
+                              logFilePath, envVars, timeLimit, stackLimit=None,
+                              killGracePeriod=1.0):
+        """
+          Run ``cmdLine`` in ``workingDirectory`` writing its output to
+          ``logFilePath``. ``timeLimit`` is in seconds (zero implies
+          unlimited) and ``stackLimit`` is in KiB (zero implies unlimited,
+          None implies do not set). When a limit is reached the process
+          group of the tool is sent SIGTERM followed by SIGKILL after
+          ``killGracePeriod`` seconds.
+
+          Returns a ``BackendResult``.
+        """
+        assert isinstance(supervised, SupervisedProcess)
+        _logger.info('Running:\n{}\nwith env:{}'.format(
+            pprint.pformat(cmdLine),
+            pprint.pformat(envVars)))
+        preExecFn = None
+        if stackLimit is not None:
+            preExecFn = lambda: _setStackLimit(stackLimit)
+        exitCode = None
+        rusage = None
+        outOfTime = False
+        startTime = time.perf_counter()
+        with open(logFilePath, 'w') as f:
+            # The tool leads a new session (and so process group) so that it
+            # and all its descendants can be killed at once.
+            popen = subprocess.Popen(cmdLine,
+                                     cwd=workingDirectory,
+                                     stdout=f,
+                                     stderr=f,
+                                     env=envVars,
+                                     preexec_fn=preExecFn,
+                                     start_new_session=True)
+        processGroup = ProcessGroup(popen.pid)
+        supervised.processGroup = processGroup
+        self._processes.add(supervised)
+        if supervised.memoryLimit > 0:
+            supervised.monitoredTree = supervised.memoryMonitor.register(
+                popen.pid, supervised.memoryLimit,
+                lambda tree: self._memoryLimitExceeded(supervised, killGracePeriod, tree))
+        try:
+            if supervised.killed:
+                self.kill(supervised)
+            exited = await _waitUntilExited(popen.pid, timeLimit if timeLimit > 0 else None)
+            if exited:
+                exitCode, rusage = waitForProcess(popen, beforeReap=processGroup.markReaped)
+            else:
+                _logger.info('Time limit of {} seconds reached. Killing process group:{}'.format(
+                    timeLimit, popen.pid))
+                outOfTime = True
+        except asyncio.CancelledError:
+            # Cancelled whilst the tool was running. Kill it without waiting
+            # for the task that is being cancelled.
+            task = self._loop.create_task(self._tearDown(popen, processGroup, None, 0.0))
+            task.add_done_callback(_logTaskException)
+            raise
+        finally:
+            if supervised.monitoredTree is not None:
+                supervised.memoryMonitor.unregister(supervised.monitoredTree)
+                supervised.monitoredTree = None
+            self._processes.discard(supervised)
+        teardownStartTime = time.perf_counter()
+        rusage = await self._tearDown(popen, processGroup, rusage, killGracePeriod)
+        endTime = time.perf_counter()
+        # Note the resource usage does not include descendants that were
+        # orphaned (and so not waited for by the tool).
+        return BackendResult(exitCode=exitCode,
+                             runTime=endTime - startTime,
+                             oot=outOfTime,
+                             oom=supervised.outOfMemory,
+                             userCpuTime=rusage.ru_utime,
+                             sysCpuTime=rusage.ru_stime,
+                             resourceUsage=resourceUsageFromRusage(rusage),
+                             teardownTime=endTime - teardownStartTime)
+
+    async def _tearDown(self, popen, processGroup, rusage, killGracePeriod):
+        """
+          Kill every process left in ``processGroup`` and reap ``popen`` if
+          that has not been done yet (i.e. ``rusage`` is None). Returns the
+          rusage of ``popen``. This follows
+          ``PythonPsUtilBackend._tearDown()`` without blocking the loop.
+        """
+        pgid = popen.pid
+        if rusage is None:
+            # Give the tool a chance to clean up after itself before
+            # aggressively killing it.
+            _logger.debug('Trying to terminate process group:{}'.format(pgid))
+            processGroup.signal(signal.SIGTERM)
+            if not await _waitUntilExited(pgid, killGracePeriod):
+                _logger.info('Trying to kill process group:{}'.format(pgid))
+                processGroup.signal(signal.SIGKILL)
+                await _waitUntilExited(pgid, None)
+            _, rusage = waitForProcess(popen, beforeReap=processGroup.markReaped)
+        # Kill any descendants that outlived the tool. The group cannot be
+        # reused whilst they are alive.
+        if _processGroupExists(pgid):
+            _logger.info('Killing processes left in process group:{}'.format(pgid))
+            try:
+                os.killpg(pgid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            endTime = time.perf_counter() + 1.0
+            stragglers = liveProcessesInGroup(pgid)
+            while len(stragglers) > 0:
+                if time.perf_counter() > endTime:
+                    _logger.error('Processes {} in process group {} survived SIGKILL'.format(
+                        stragglers, pgid))
+                    break
+                await asyncio.sleep(0.01)
+                stragglers = liveProcessesInGroup(pgid)
+        return rusage
+
+
+def fromContext(ctx):
+    """
+      Returns the supervisor shared by everything using the RunnerContext
+      ``ctx`` creating it if necessary.
+    """
+    supervisor, success = ctx.get_object(_CONTEXT_OBJECT_NAME)
+    if not success:
+        supervisor = AsyncSupervisor()
+        if not ctx.add_object(_CONTEXT_OBJECT_NAME, supervisor):
+            # Created by another thread first. Nothing was started.
+            supervisor, _ = ctx.get_object(_CONTEXT_OBJECT_NAME)
+    return supervisor
@@ -0,0 +1,75 @@
+# vim: set sw=4 ts=4 softtabstop=4 expandtab:
+from . BackendBase import *
+from . PythonPsUtil import PythonPsUtilBackend
+from .. import AsyncSupervisor
+import logging
+
+_logger = logging.getLogger(__name__)
+
+
+class AsyncioBackendException(BackendException):
+    pass
+
+
+class AsyncioBackend(PythonPsUtilBackend):
+    """
+      Runs the program directly on the host like ``PythonPsUtil`` but the
+      process is waited for by the ``AsyncSupervisor`` shared by all
+      runners. The ``asyncio`` engine of ``batch-runner.py`` awaits
+      ``runAsync()`` so no thread is blocked whilst the program runs.
+    """
+    def __init__(self, hostProgramPath, workingDirectory, timeLimit, memoryLimit, stackLimit, ctx, **kwargs):
+        super().__init__(hostProgramPath, workingDirectory,
+                         timeLimit, memoryLimit, stackLimit, ctx, **kwargs)
+        try:
+            self._supervisor = AsyncSupervisor.fromContext(ctx)
+        except AsyncSupervisor.AsyncSupervisorException as e:
+            raise AsyncioBackendException(str(e))
+        self._supervised = None
+
+    @property
+    def name(self):
+        return "Asyncio"
+
+    @property
+    def supportsAsync(self):
+        return True
+
+    def run(self, cmdLine, logFilePath, envVars):
+        if self._supervisor.inLoopThread():
+            raise AsyncioBackendException(
+                'run() cannot be called from the event loop. Use runAsync()')
+        return self._supervisor.submit(
+            self.runAsync(cmdLine, logFilePath, envVars)).result()
+
+    async def runAsync(self, cmdLine, logFilePath, envVars):
+        self._supervised = AsyncSupervisor.SupervisedProcess(
+            self.memoryLimit, self._memoryMonitor)
+        _logger.info('Running with timeout of {} seconds'.format(self.timeLimit))
+        try:
+            return await self._supervisor.runProcessAsync(
+                self._supervised,
+                cmdLine,
+                self.workingDirectory,
+                logFilePath,
+                envVars,
+                self.timeLimit,
+                self.stackLimit,
+                self.killGracePeriodInSeconds)
+        finally:
+            self._supervised = None
+
+    def kill(self):
+        supervised = self._supervised
+        if supervised is not None:
+            self._supervisor.kill(supervised)
+
+    def memoryUsage(self):
+        supervised = self._supervised
+        if supervised is None or supervised.monitoredTree is None:
+            return None
+        return supervised.monitoredTree.residentMiB
+
+
+def get():
+    return AsyncioBackend
@@ -10,15 +10,43 @@ class BackendException(Exception):
     pass
 
 
+# Keys of the optional ``resourceUsage`` of a BackendResult. These are
+# recorded as is in the result info.
+RESOURCE_USAGE_KEYS = [
+    'max_rss', # MiB
+    'minor_page_faults',
+    'major_page_faults',
+    'voluntary_context_switches',
+    'involuntary_context_switches',
+    'block_input_operations',
+    'block_output_operations',
+]
+
+
 class BackendResult:
 
-    def __init__(self, exitCode, runTime, oot, oom, userCpuTime=None, sysCpuTime=None):
+    def __init__(self, exitCode, runTime, oot, oom, userCpuTime=None, sysCpuTime=None,
+                 peakMemory=None, resourceUsage=None, teardownTime=None,
+                 logFilePath=None, logTruncated=None):
         self.exitCode = exitCode
         self.runTime = runTime
         self.outOfTime = oot
         self.outOfMemory = oom
         self.userCpuTime = userCpuTime
         self.sysCpuTime = sysCpuTime
+        # Peak memory usage in MiB (None if unknown)
+        self.peakMemory = peakMemory
+        # Dictionary mapping some of RESOURCE_USAGE_KEYS to numbers (None if
+        # not recorded)
+        self.resourceUsage = resourceUsage
+        # Seconds spent killing and reaping the tool after it exited or
+        # reached a limit (None if not recorded)
+        self.teardownTime = teardownTime
+        # Path the log was written to if it is not the path given to run()
+        # (e.g. because it was compressed)
+        self.logFilePath = logFilePath
+        # True if the log was truncated (None if no limit was applied)
+        self.logTruncated = logTruncated
 
         if not (isinstance(self.exitCode, int) or self.exitCode == None):
             msg = 'exitCode was expected to be an int or None but was a {}'.format(
@@ -50,6 +78,37 @@ class BackendResult:
                    ' {}'.format(self.sysCpuTime))
             _logger.error(msg)
             raise BackendException(msg)
+        if not (isinstance(self.peakMemory, float) or self.peakMemory == None):
+            msg = ('peakMemory was expected to be a float or None but was'
+                   ' {}'.format(self.peakMemory))
+            _logger.error(msg)
+            raise BackendException(msg)
+        if not (isinstance(self.teardownTime, float) or self.teardownTime == None):
+            msg = ('teardownTime was expected to be a float or None but was'
+                   ' {}'.format(self.teardownTime))
+            _logger.error(msg)
+            raise BackendException(msg)
+        if not (isinstance(self.logFilePath, str) or self.logFilePath == None):
+            msg = ('logFilePath was expected to be a str or None but was'
+                   ' {}'.format(self.logFilePath))
+            _logger.error(msg)
+            raise BackendException(msg)
+        if not (isinstance(self.logTruncated, bool) or self.logTruncated == None):
+            msg = ('logTruncated was expected to be a bool or None but was'
+                   ' {}'.format(self.logTruncated))
+            _logger.error(msg)
+            raise BackendException(msg)
+        if self.resourceUsage != None:
+            for key, value in self.resourceUsage.items():
+                if key not in RESOURCE_USAGE_KEYS:
+                    msg = 'resourceUsage has unknown key "{}"'.format(key)
+                    _logger.error(msg)
+                    raise BackendException(msg)
+                if not (isinstance(value, (int, float)) and value >= 0):
+                    msg = ('resourceUsage "{}" was expected to be a number >= 0'
+                           ' but was {}'.format(key, value))
+                    _logger.error(msg)
+                    raise BackendException(msg)
 
 
 class BackendBaseClass(metaclass=abc.ABCMeta):
@@ -145,6 +204,31 @@ class BackendBaseClass(metaclass=abc.ABCMeta):
         """
         pass
 
+    @property
+    def supportsAsync(self):
+        """
+          True if the backend also has a ``runAsync()`` coroutine that
+          behaves like ``run()`` but can be awaited on the event loop of the
+          ``AsyncSupervisor`` rather than blocking a thread.
+        """
+        return False
+
+    @property
+    def supportsPrepareRun(self):
+        """
+          True if ``prepareRun()`` does anything.
+        """
+        return False
+
+    def prepareRun(self, cmdLine, logFilePath, envVars):
+        """
+          Do the expensive set up for a later call to ``run()`` with the
+          same arguments ahead of time (e.g. in a background thread whilst
+          other jobs run). ``run()`` must still work if it is called with
+          different arguments.
+        """
+        pass
+
     @abc.abstractmethod
     def kill(self):
         """
@@ -152,6 +236,13 @@ class BackendBaseClass(metaclass=abc.ABCMeta):
         """
         pass
 
+    def memoryUsage(self):
+        """
+          Returns the memory in MiB currently used by the running tool or
+          None if it is not running or the backend cannot measure it.
+        """
+        return None
+
     @abc.abstractmethod
     def programPath(self):
         """
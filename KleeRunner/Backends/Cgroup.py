@@ -0,0 +1,302 @@
+# vim: set sw=4 ts=4 softtabstop=4 expandtab:
+from . BackendBase import *
+from . PythonPsUtil import PythonPsUtilBackend
+import itertools
+import logging
+import os
+import pprint
+import signal
+import subprocess
+import threading
+import time
+
+_logger = logging.getLogger(__name__)
+
+
+class CgroupBackendException(BackendException):
+    pass
+
+
+def readFlatKeyed(path):
+    """
+      Returns a dictionary for a cgroup file in the "flat keyed" format
+      (e.g. ``cpu.stat`` or ``memory.events``) where values are integers.
+    """
+    values = dict()
+    with open(path, 'r') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) == 2:
+                values[fields[0]] = int(fields[1])
+    return values
+
+
+class CgroupLeaf:
+    """
+      A cgroup v2 leaf at ``path`` that holds the processes of a single job.
+    """
+    def __init__(self, path):
+        assert os.path.isabs(path)
+        self.path = path
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _write(self, name, value):
+        with open(self._file(name), 'w') as f:
+            f.write(value)
+
+    def create(self, memoryLimit, swap=False, cpusetCpus=None, cpusetMems=None):
+        """
+          Create the leaf. ``memoryLimit`` is in MiB (zero implies
+          unlimited and the memory controller is not used).
+        """
+        os.mkdir(self.path)
+        try:
+            if memoryLimit > 0:
+                self._write('memory.max', str(memoryLimit * (2**20)))
+                if os.path.exists(self._file('memory.swap.max')):
+                    self._write('memory.swap.max', 'max' if swap else '0')
+                # Kill the whole job rather than a single process in it
+                self._write('memory.oom.group', '1')
+            if cpusetCpus is not None:
+                self._write('cpuset.cpus', cpusetCpus)
+            if cpusetMems is not None:
+                self._write('cpuset.mems', cpusetMems)
+        except OSError:
+            self.remove()
+            raise
+
+    def enter(self):
+        """
+          Move the calling process into the leaf. Designed to be called by
+          subprocess.Popen() after fork so do not use the _logger here.
+        """
+        self._write('cgroup.procs', str(os.getpid()))
+
+    def pids(self):
+        try:
+            with open(self._file('cgroup.procs'), 'r') as f:
+                return [int(line) for line in f if line.strip() != '']
+        except FileNotFoundError:
+            return []
+
+    def populated(self):
+        try:
+            return readFlatKeyed(self._file('cgroup.events')).get('populated', 0) != 0
+        except FileNotFoundError:
+            return False
+
+    def kill(self):
+        """
+          SIGKILL every process in the leaf.
+        """
+        try:
+            self._write('cgroup.kill', '1')
+            return
+        except FileNotFoundError:
+            if not os.path.isdir(self.path):
+                return
+        except OSError as e:
+            _logger.debug('Writing cgroup.kill failed: {}'.format(e))
+        # Kernels older than 5.14 do not have cgroup.kill. Processes forked
+        # whilst doing this are caught on the next iteration.
+        for pid in self.pids():
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+    def killAndWait(self, timeout=10.0):
+        """
+          Kill every process in the leaf and wait for it to become empty.
+          Returns True if it became empty.
+        """
+        endTime = time.perf_counter() + timeout
+        while self.populated():
+            self.kill()
+            if time.perf_counter() > endTime:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def cpuTimes(self):
+        """
+          Returns ``(userCpuTime, sysCpuTime)`` in seconds used by every
+          process that ran in the leaf.
+        """
+        stat = readFlatKeyed(self._file('cpu.stat'))
+        return (stat['user_usec'] / 1e6, stat['system_usec'] / 1e6)
+
+    def peakMemory(self):
+        """
+          Returns the peak memory usage in MiB or None if unknown.
+        """
+        try:
+            with open(self._file('memory.peak'), 'r') as f:
+                return int(f.read()) / (2**20)
+        except (OSError, ValueError):
+            return None
+
+    def currentMemory(self):
+        try:
+            with open(self._file('memory.current'), 'r') as f:
+                return int(f.read()) / (2**20)
+        except (OSError, ValueError):
+            return None
+
+    def oomKilled(self):
+        try:
+            return readFlatKeyed(self._file('memory.events')).get('oom_kill', 0) > 0
+        except FileNotFoundError:
+            return False
+
+    def remove(self):
+        try:
+            os.rmdir(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class CgroupBackend(PythonPsUtilBackend):
+    """
+      Runs the program directly on the host in its own cgroup v2 leaf
+      created inside a delegated ``parent_cgroup``. The kernel enforces the
+      memory limit and accounts for the CPU time of every process the
+      program creates so no polling thread is needed.
+    """
+    _leafCounter = itertools.count()
+    _leafCounterLock = threading.Lock()
+
+    def __init__(self, hostProgramPath, workingDirectory, timeLimit, memoryLimit, stackLimit, ctx, **kwargs):
+        self._parentCgroup = kwargs.pop('parent_cgroup', None)
+        self._cpusetCpus = kwargs.pop('cpuset_cpus', None)
+        self._cpusetMems = kwargs.pop('cpuset_mems', None)
+        self._swap = kwargs.pop('swap', False)
+        super().__init__(hostProgramPath, workingDirectory,
+                         timeLimit, memoryLimit, stackLimit, ctx, **kwargs)
+        self._leaf = None
+        self._checkConfig()
+
+    def _setupMemoryMonitor(self):
+        # The kernel enforces the memory limit
+        pass
+
+    def _checkConfig(self):
+        if not (isinstance(self._parentCgroup, str) and os.path.isabs(self._parentCgroup)):
+            raise CgroupBackendException(
+                '"parent_cgroup" must be the absolute path to a delegated cgroup v2 directory')
+        for key, value in [('cpuset_cpus', self._cpusetCpus),
+                           ('cpuset_mems', self._cpusetMems)]:
+            if not (value is None or isinstance(value, str)):
+                raise CgroupBackendException('"{}" must be a string'.format(key))
+        if not isinstance(self._swap, bool):
+            raise CgroupBackendException('"swap" must be a bool')
+        controllersFile = os.path.join(self._parentCgroup, 'cgroup.controllers')
+        try:
+            with open(controllersFile, 'r') as f:
+                available = f.read().split()
+        except OSError:
+            raise CgroupBackendException(
+                '"{}" is not a cgroup v2 directory'.format(self._parentCgroup))
+        needed = []
+        if self.memoryLimit > 0:
+            needed.append('memory')
+        if self._cpusetCpus is not None or self._cpusetMems is not None:
+            needed.append('cpuset')
+        for controller in needed:
+            if controller not in available:
+                raise CgroupBackendException(
+                    'The {} controller is not available in "{}"'.format(
+                        controller, self._parentCgroup))
+        if len(needed) > 0:
+            # Make the controllers available to the leaves. This is a no-op
+            # if they already are.
+            try:
+                with open(os.path.join(self._parentCgroup, 'cgroup.subtree_control'), 'w') as f:
+                    f.write(' '.join('+' + c for c in needed))
+            except OSError as e:
+                raise CgroupBackendException(
+                    'Failed to enable {} in "{}": {}'.format(
+                        needed, self._parentCgroup, e))
+
+    @property
+    def name(self):
+        return "Cgroup"
+
+    def _newLeaf(self):
+        with CgroupBackend._leafCounterLock:
+            number = next(CgroupBackend._leafCounter)
+        return CgroupLeaf(os.path.join(
+            self._parentCgroup, 'job-{}-{}'.format(os.getpid(), number)))
+
+    def kill(self):
+        leaf = self._leaf
+        if leaf is not None:
+            leaf.kill()
+
+    def memoryUsage(self):
+        leaf = self._leaf
+        if leaf is None:
+            return None
+        return leaf.currentMemory()
+
+    def run(self, cmdLine, logFilePath, envVars):
+        _logger.info('Running:\n{}\nwith env:{}'.format(
+            pprint.pformat(cmdLine),
+            pprint.pformat(envVars)))
+        leaf = self._newLeaf()
+        leaf.create(self.memoryLimit, self._swap, self._cpusetCpus, self._cpusetMems)
+        _logger.debug('Created cgroup "{}"'.format(leaf.path))
+
+        def preExecFn():
+            leaf.enter()
+            if self.stackLimit != None:
+                self._setStacksize()
+
+        exitCode = None
+        outOfTime = False
+        startTime = time.perf_counter()
+        self._leaf = leaf
+        try:
+            with open(logFilePath, 'w') as f:
+                process = subprocess.Popen(cmdLine,
+                                           cwd=self.workingDirectory,
+                                           stdout=f,
+                                           stderr=f,
+                                           env=envVars,
+                                           preexec_fn=preExecFn)
+            _logger.info(
+                'Running with timeout of {} seconds'.format(self.timeLimit))
+            try:
+                exitCode = process.wait(
+                    timeout=self.timeLimit if self.timeLimit > 0 else None)
+            except subprocess.TimeoutExpired:
+                outOfTime = True
+            finally:
+                # Anything left in the cgroup (including daemonised
+                # descendants) is killed.
+                if not leaf.killAndWait():
+                    _logger.error('Failed to kill every process in "{}"'.format(leaf.path))
+                process.wait()
+            runTime = time.perf_counter() - startTime
+            userCpuTime, sysCpuTime = leaf.cpuTimes()
+            peakMemory = leaf.peakMemory()
+            outOfMemory = leaf.oomKilled()
+        finally:
+            self._leaf = None
+            leaf.remove()
+        if outOfMemory:
+            _logger.warning('Memory limit reached (peak {} MiB)'.format(peakMemory))
+
+        return BackendResult(exitCode=exitCode,
+                             runTime=runTime,
+                             oot=outOfTime,
+                             oom=outOfMemory,
+                             userCpuTime=userCpuTime,
+                             sysCpuTime=sysCpuTime,
+                             peakMemory=peakMemory)
+
+
+def get():
+    return CgroupBackend
@@ -1,9 +1,16 @@
 # vim: set sw=4 ts=4 softtabstop=4 expandtab:
 from . BackendBase import *
+from .. import CpuTopology
+from .. import LogCapture
+import atexit
+import concurrent.futures
 import functools
+import itertools
 import logging
+import math
 import os
 import pprint
+import socket
 import time
 import psutil
 import threading
@@ -22,6 +29,350 @@ except ImportError:
     raise DockerBackendException(
         'Could not import docker module from docker-py')
 
+# Labels given to every container created by DockerBackend so that
+# containers leaked by a batch run that did not exit cleanly can be found.
+CONTAINER_PID_LABEL = 'klee-runner.pid'
+CONTAINER_HOST_LABEL = 'klee-runner.host'
+
+
+def _container_labels():
+    return {
+        CONTAINER_PID_LABEL: str(os.getpid()),
+        CONTAINER_HOST_LABEL: socket.gethostname(),
+    }
+
+
+class ContainerReaper:
+    """
+        Removes containers (and their volumes) using ``num_threads``
+        background threads so that it is not done on the critical path of a
+        job. Removal is retried up to ``max_attempts`` times.
+    """
+    def __init__(self, num_threads, max_attempts=5, retry_delay=1.0):
+        assert isinstance(num_threads, int)
+        assert num_threads > 0
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=num_threads)
+        self._max_attempts = max_attempts
+        self._retry_delay = retry_delay
+        # Each thread has its own client
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._num_pending = 0
+        self._num_removed = 0
+        self._num_failed = 0
+        self._shut_down = False
+
+    def _client(self):
+        if not hasattr(self._local, 'client'):
+            self._local.client = docker.APIClient(version='1.24')
+        return self._local.client
+
+    def remove(self, container_id):
+        """
+            Remove the container ``container_id`` in the background.
+        """
+        with self._lock:
+            self._num_pending += 1
+            shut_down = self._shut_down
+        if shut_down:
+            # Nothing will wait for a background removal now
+            self._remove(container_id)
+            return
+        self._executor.submit(self._remove, container_id)
+
+    def _remove(self, container_id):
+        removed = False
+        try:
+            for attempt in range(1, self._max_attempts + 1):
+                try:
+                    _logger.info('Destroying container:{}'.format(container_id))
+                    # Note setting `v=True` is very important. This removes
+                    # the volumes associated with the container. Otherwise
+                    # we'll leave loads of stray volumes lying around.
+                    self._client().remove_container(
+                        container=container_id, v=True, force=True)
+                    removed = True
+                    return
+                except docker.errors.NotFound:
+                    removed = True
+                    return
+                except (docker.errors.APIError, requests.exceptions.RequestException) as e:
+                    _logger.warning('Failed to remove container:"{}" (attempt {} of {}).\n{}'.format(
+                        container_id, attempt, self._max_attempts, str(e)))
+                    if attempt < self._max_attempts:
+                        time.sleep(self._retry_delay * attempt)
+            _logger.error('Giving up removing container:"{}"'.format(container_id))
+        finally:
+            with self._lock:
+                self._num_pending -= 1
+                if removed:
+                    self._num_removed += 1
+                else:
+                    self._num_failed += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pending': self._num_pending,
+                'removed': self._num_removed,
+                'failed': self._num_failed,
+            }
+
+    def shutdown(self):
+        """
+            Wait for every pending removal to finish. Later removals are
+            done in the calling thread.
+        """
+        with self._lock:
+            self._shut_down = True
+        self._executor.shutdown(wait=True)
+        _logger.info('Container reaper finished: {}'.format(self.stats()))
+
+
+class WorkerContainer:
+    """
+        A long lived container that runs the jobs of a single job slot using
+        ``exec``. ``config`` is the arguments it was created with (see
+        ``DockerBackend._containerConfig()``).
+    """
+    def __init__(self, container_id, config):
+        self.id = container_id
+        self.config = config
+        self.num_jobs = 0
+
+
+class TimerWheel:
+    """
+        Hashed timer wheel driven by a single thread. Callbacks are called
+        (in the wheel's thread) at most ``tick`` seconds after their
+        deadline. Scheduling and cancelling are O(1) so it copes with a
+        timer per running container.
+    """
+    def __init__(self, tick=0.1, num_slots=512):
+        assert tick > 0.0
+        assert isinstance(num_slots, int) and num_slots > 0
+        self._tick = tick
+        # Each slot maps a timer handle to [rounds left, callback]
+        self._slots = [dict() for _ in range(num_slots)]
+        # Maps a timer handle to its slot
+        self._timers = dict()
+        self._current = 0
+        self._handles = itertools.count()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def schedule(self, delay, callback):
+        """
+            Call ``callback()`` after ``delay`` seconds. Returns a handle
+            for ``cancel()``.
+        """
+        ticks = max(1, int(math.ceil(delay / self._tick)))
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='TimerWheel',
+                                                daemon=True)
+                self._thread.start()
+            handle = next(self._handles)
+            slot = (self._current + ticks) % len(self._slots)
+            self._slots[slot][handle] = [(ticks - 1) // len(self._slots), callback]
+            self._timers[handle] = slot
+            return handle
+
+    def cancel(self, handle):
+        """
+            Cancel the timer ``handle``. Returns False if it has already
+            fired.
+        """
+        with self._lock:
+            slot = self._timers.pop(handle, None)
+            if slot is None:
+                return False
+            del self._slots[slot][handle]
+            return True
+
+    def _advance(self):
+        # Returns the callbacks of the timers that have expired
+        expired = []
+        with self._lock:
+            self._current = (self._current + 1) % len(self._slots)
+            timers = self._slots[self._current]
+            for handle, timer in list(timers.items()):
+                if timer[0] > 0:
+                    timer[0] -= 1
+                    continue
+                del timers[handle]
+                del self._timers[handle]
+                expired.append(timer[1])
+        return expired
+
+    def _run(self):
+        nextTick = time.monotonic() + self._tick
+        while True:
+            delay = nextTick - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            nextTick += self._tick
+            for callback in self._advance():
+                try:
+                    callback()
+                except Exception as e:
+                    _logger.error('Timer callback failed:{}'.format(e))
+                    _logger.error(traceback.format_exc())
+
+
+class ContainerWaiter:
+    """
+        Completion of a container watched by ``CompletionWatcher``.
+        ``exit_code`` is set if the container exited and ``timed_out`` is
+        True if the time limit was reached first.
+    """
+    def __init__(self, container_id):
+        self.container_id = container_id
+        self.exit_code = None
+        self.oom = False
+        self.timed_out = False
+        self.timer = None
+        self._done = threading.Event()
+
+    def wait(self):
+        self._done.wait()
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+
+class CompletionWatcher:
+    """
+        Waits for the containers of every job using a single subscription
+        to the Docker events stream rather than a blocking ``wait()`` (and
+        hence a client) per job. ``die`` and ``oom`` events resolve the
+        ``ContainerWaiter`` returned by ``watch()``. Time limits are
+        enforced by ``timer_wheel``.
+    """
+    def __init__(self, timer_wheel, reconnect_delay=1.0):
+        self._timer_wheel = timer_wheel
+        self._reconnect_delay = reconnect_delay
+        self._waiters = dict() # Maps container id to ContainerWaiter
+        self._lock = threading.Lock()
+        self._client = docker.APIClient(version='1.24')
+        self._stream = None
+        self._stopped = False
+        # Events from before the subscription is made are replayed so
+        # that containers that die whilst (re)connecting are not missed.
+        self._since = int(time.time()) - 1
+        self._thread = threading.Thread(target=self._run, name='CompletionWatcher',
+                                        daemon=True)
+        self._thread.start()
+
+    def watch(self, container_id, timeout):
+        """
+            Start watching ``container_id``. This must be called before the
+            container is started. If ``timeout`` is > 0 the waiter is
+            resolved as timed out after ``timeout`` seconds.
+        """
+        waiter = ContainerWaiter(container_id)
+        with self._lock:
+            self._waiters[container_id] = waiter
+        if timeout > 0:
+            waiter.timer = self._timer_wheel.schedule(
+                timeout, functools.partial(self._timed_out, waiter))
+        return waiter
+
+    def unwatch(self, container_id):
+        with self._lock:
+            waiter = self._waiters.pop(container_id, None)
+        if waiter is not None and waiter.timer is not None:
+            self._timer_wheel.cancel(waiter.timer)
+
+    def _timed_out(self, waiter):
+        with self._lock:
+            if self._waiters.get(waiter.container_id) is not waiter:
+                return
+            del self._waiters[waiter.container_id]
+        waiter.timed_out = True
+        waiter._done.set()
+
+    def _resolve(self, container_id, exit_code):
+        with self._lock:
+            waiter = self._waiters.pop(container_id, None)
+        if waiter is None:
+            return
+        if waiter.timer is not None:
+            self._timer_wheel.cancel(waiter.timer)
+        waiter.exit_code = exit_code
+        waiter._done.set()
+
+    def _handle_event(self, event):
+        self._since = max(self._since, event.get('time', 0))
+        container_id = event.get('id') or event.get('Actor', {}).get('ID')
+        action = event.get('Action') or event.get('status')
+        if action == 'oom':
+            with self._lock:
+                waiter = self._waiters.get(container_id)
+            if waiter is not None:
+                waiter.oom = True
+        elif action == 'die':
+            exit_code = None
+            try:
+                exit_code = int(event['Actor']['Attributes']['exitCode'])
+            except (KeyError, TypeError, ValueError):
+                _logger.warning('No exit code in event:{}'.format(event))
+            self._resolve(container_id, exit_code)
+
+    def _reconcile(self):
+        # Resolve waiters whose container died whilst not subscribed
+        with self._lock:
+            container_ids = list(self._waiters.keys())
+        for container_id in container_ids:
+            try:
+                state = self._client.inspect_container(container_id)['State']
+            except docker.errors.NotFound:
+                self._resolve(container_id, None)
+                continue
+            except (docker.errors.APIError, requests.exceptions.RequestException) as e:
+                _logger.warning('Failed to inspect container:"{}".\n{}'.format(
+                    container_id, str(e)))
+                continue
+            if state['Status'] in ['exited', 'dead']:
+                self._resolve(container_id, state['ExitCode'])
+
+    def _run(self):
+        filters = {
+            'type': 'container',
+            'event': ['die', 'oom'],
+            'label': '{}={}'.format(CONTAINER_PID_LABEL, os.getpid()),
+        }
+        while not self._stopped:
+            try:
+                self._stream = self._client.events(
+                    since=self._since, filters=filters, decode=True)
+                for event in self._stream:
+                    self._handle_event(event)
+            except Exception as e:
+                if self._stopped:
+                    break
+                _logger.warning('Docker events stream failed:{}'.format(e))
+            if self._stopped:
+                break
+            time.sleep(self._reconnect_delay)
+            self._reconcile()
+
+    def stop(self):
+        self._stopped = True
+        if self._stream is not None:
+            try:
+                self._stream.close()
+            except Exception:
+                pass
+
+
+def _path_is_under(path, directory):
+    path = os.path.normpath(path)
+    directory = os.path.normpath(directory)
+    return path == directory or path.startswith(directory.rstrip('/') + '/')
+
+
 # Pool of resources.
 # FIXME: We need a way to close all the clients when all runners
 # finish.
@@ -32,10 +383,24 @@ class ResourcePool:
 
         * DockerClient
         * CPUs
+
+        It owns the ``ContainerReaper`` that removes containers once jobs
+        have finished with them.
+
+        It also caches information about Docker images and the tools in them
+        so that it is only looked up once rather than once per runner and
+        creates containers ahead of time for runners that ask for it.
+
+        When persistent containers are used it keeps the ``WorkerContainer``
+        of each job slot between jobs. A slot is identified by the Docker
+        client that its jobs use.
     """
-    def __init__(self, num_jobs, available_cpu_ids, cpus_per_job, use_memset_of_nearest_node):
+    def __init__(self, num_jobs, available_cpu_ids, cpus_per_job, use_memset_of_nearest_node,
+                 reaper_threads=2, num_clients=None, whole_cores=False,
+                 sysfs_root='/sys/devices/system'):
         assert isinstance(num_jobs, int)
         assert num_jobs > 0
+        assert num_clients is None or (isinstance(num_clients, int) and num_clients > 0)
         assert isinstance(available_cpu_ids, set) or available_cpu_ids is None
         assert isinstance(cpus_per_job, int) or cpus_per_job is None
         if cpus_per_job is not None:
@@ -44,19 +409,47 @@ class ResourcePool:
             assert len(available_cpu_ids) > 0
         assert isinstance(use_memset_of_nearest_node, bool) or use_memset_of_nearest_node is None
         self._num_jobs = num_jobs
+        self._num_clients = num_jobs if num_clients is None else num_clients
         self._available_cpu_ids = available_cpu_ids
         self._cpus_per_job = cpus_per_job
         self._use_memset_of_nearest_node = use_memset_of_nearest_node
+        self._whole_cores = whole_cores
+        self._sysfs_root = sysfs_root
 
         # Docker client data structures
         self._docker_clients = dict() # All created clients
         self._docker_client_pool = set() # Available clients
 
         # CPU and memset data structures
-        self._numa_nodes = dict() # Maps NUMA node to set of CPU ids
-        self._numa_node_pool = dict() # Maps NUMa node to set of available CPU ids
+        self._cpu_topology = None
+        self._cpu_allocator = None
 
         self._lock = threading.Lock()
+        self._client_released = threading.Condition(self._lock)
+
+        # Docker image cache. Maps image name to the image
+        self._images = dict()
+        self._image_lock = threading.Lock()
+
+        # Client that is not in the pool. It is used for lookups and to
+        # create containers ahead of time so that these never wait for a
+        # running job to release a client.
+        self._utility_client = None
+        self._utility_lock = threading.Lock()
+        # Maps (image id, tool path) to True if the tool exists in the image
+        self._tool_exists = dict()
+        # IDs of containers created ahead of time that no runner has claimed
+        self._precreated_containers = set()
+        self._registered_atexit = False
+        # Maps the id of a Docker client to the idle WorkerContainer of its
+        # job slot
+        self._worker_containers = dict()
+        self._registered_worker_atexit = False
+
+        self._reaper_threads = reaper_threads
+        self._reaper = None
+        self._timer_wheel = None
+        self._completion_watcher = None
 
         # Sanity check
         if cpus_per_job is not None and available_cpu_ids is not None:
@@ -68,7 +461,7 @@ class ResourcePool:
             # Init already happenend
             return
         # Create Docker clients
-        for index in range(0, self._num_jobs):
+        for index in range(0, self._num_clients):
             _logger.info('Creating DockerClient {}'.format(index))
             new_client = docker.APIClient(version='1.24')
             self._docker_clients[id(new_client)] = new_client
@@ -76,16 +469,86 @@ class ResourcePool:
             self._docker_client_pool.add(id(new_client))
 
         assert len(self._docker_clients) == len(self._docker_client_pool)
+        # Check once that we can talk to the Docker daemon rather than
+        # every time a backend is created.
+        try:
+            next(iter(self._docker_clients.values())).ping()
+        except Exception as e:
+            _logger.error('Failed to connect to the Docker daemon')
+            _logger.error(e)
+            self._docker_clients.clear()
+            self._docker_client_pool.clear()
+            raise DockerBackendException(
+                'Failed to connect to the Docker daemon')
+        self._reaper = ContainerReaper(self._reaper_threads)
+        # Make sure pending removals finish before Python exits
+        atexit.register(self._reaper.shutdown)
+        self._sweep_leaked_containers(next(iter(self._docker_clients.values())))
+
+    def _sweep_leaked_containers(self, dc):
+        """
+            Remove containers created on this host by batch runs whose
+            process no longer exists.
+        """
+        try:
+            containers = dc.containers(all=True, filters={'label': CONTAINER_PID_LABEL})
+        except docker.errors.APIError as e:
+            _logger.warning('Failed to list containers to sweep:{}'.format(e))
+            return
+        hostname = socket.gethostname()
+        for container in containers:
+            labels = container.get('Labels') or {}
+            try:
+                pid = int(labels.get(CONTAINER_PID_LABEL))
+            except (TypeError, ValueError):
+                continue
+            if labels.get(CONTAINER_HOST_LABEL) != hostname or psutil.pid_exists(pid):
+                continue
+            _logger.warning('Removing container "{}" leaked by PID {}'.format(
+                container['Id'], pid))
+            self._reaper.remove(container['Id'])
+
+    @property
+    def reaper(self):
+        with self._lock:
+            self._lazy_docker_client_init()
+            return self._reaper
+
+    @property
+    def timer_wheel(self):
+        """
+            The ``TimerWheel`` shared by all runners to enforce time limits.
+            It is created on first use.
+        """
+        with self._lock:
+            if self._timer_wheel is None:
+                self._timer_wheel = TimerWheel()
+            return self._timer_wheel
+
+    @property
+    def completion_watcher(self):
+        """
+            The ``CompletionWatcher`` shared by all runners. It is created
+            on first use.
+        """
+        timer_wheel = self.timer_wheel
+        with self._lock:
+            self._lazy_docker_client_init()
+            if self._completion_watcher is None:
+                self._completion_watcher = CompletionWatcher(timer_wheel)
+                atexit.register(self._completion_watcher.stop)
+            return self._completion_watcher
 
     def get_docker_client(self):
+        """
+            Returns a client from the pool. If there are fewer clients than
+            jobs this waits for one to be released.
+        """
         with self._lock:
             self._lazy_docker_client_init()
-            try:
-                docker_client_id = self._docker_client_pool.pop()
-            except Exception as e:
-                _logger.error('Failed to get client from pool')
-                _logger.error(e)
-                raise e
+            while len(self._docker_client_pool) == 0:
+                self._client_released.wait()
+            docker_client_id = self._docker_client_pool.pop()
             return self._docker_clients[docker_client_id]
 
     def release_docker_client(self, docker_client):
@@ -97,88 +560,190 @@ class ResourcePool:
                 raise DockerBackendException('Returned client is already in pool')
             # Put back in pool
             self._docker_client_pool.add(id(docker_client))
+            self._client_released.notify()
+
+    def get_image(self, image_name):
+        """
+            Returns the Docker image (as returned by ``APIClient.images()``)
+            with the tag ``image_name``. The result is cached.
+        """
+        with self._image_lock:
+            if image_name in self._images:
+                return self._images[image_name]
+            with self._utility_lock:
+                images = self._get_utility_client().images()
+            assert isinstance(images, list)
+            images = list(
+                filter(lambda i: (i['RepoTags'] is not None) and image_name in i['RepoTags'], images))
+            if len(images) == 0:
+                msg = 'Could not find docker image with name "{}"'.format(
+                    image_name)
+                raise DockerBackendException(msg)
+            if len(images) > 1:
+                msg = 'Found multiple docker images:\n{}'.format(
+                    pprint.pformat(images))
+                _logger.error(msg)
+                raise DockerBackendException(msg)
+            _logger.debug('Found Docker image:\n{}'.format(
+                pprint.pformat(images[0])))
+            self._images[image_name] = images[0]
+            return images[0]
+
+    def _get_utility_client(self):
+        # Implicitly assume self._utility_lock is already held
+        if self._utility_client is None:
+            with self._lock:
+                self._lazy_docker_client_init()
+            _logger.info('Creating utility DockerClient')
+            self._utility_client = docker.APIClient(version='1.24')
+        return self._utility_client
+
+    def tool_exists(self, image_id, tool_path):
+        """
+            Returns True if ``tool_path`` exists in the Docker image with
+            id ``image_id``. The result is cached.
+        """
+        with self._utility_lock:
+            key = (image_id, tool_path)
+            if key in self._tool_exists:
+                return self._tool_exists[key]
+            dc = self._get_utility_client()
+            # HACK: Is there a better way to do this?
+            _logger.debug('Checking tool "{}" exists in image'.format(tool_path))
+            temp_container = dc.create_container(image=image_id,
+                                                 command=['ls', tool_path],
+                                                 labels=_container_labels())
+            _logger.debug('Created temporary container: {}'.format(
+                temp_container['Id']))
+            try:
+                dc.start(container=temp_container['Id'])
+                exit_code = dc.wait(container=temp_container['Id'])
+            finally:
+                dc.remove_container(container=temp_container['Id'], force=True)
+            self._tool_exists[key] = (exit_code == 0)
+            return self._tool_exists[key]
+
+    def precreate_container(self, host_config_args, container_args):
+        """
+            Create (but do not start) a container ahead of time. Returns
+            the container (as returned by ``APIClient.create_container()``).
+            The runner that uses it must call ``claim_precreated_container()``.
+            Containers that are never claimed are removed when Python exits.
+        """
+        with self._utility_lock:
+            dc = self._get_utility_client()
+            host_config = dc.create_host_config(**host_config_args)
+            container = dc.create_container(host_config=host_config, **container_args)
+            _logger.debug('Created container ahead of time:{}'.format(container['Id']))
+            if not self._registered_atexit:
+                atexit.register(self.remove_precreated_containers)
+                self._registered_atexit = True
+            self._precreated_containers.add(container['Id'])
+            return container
+
+    def claim_precreated_container(self, container_id):
+        """
+            Take ownership of a container created by ``precreate_container()``.
+            Returns False if it has already been removed.
+        """
+        with self._utility_lock:
+            if container_id not in self._precreated_containers:
+                return False
+            self._precreated_containers.remove(container_id)
+            return True
+
+    def remove_precreated_containers(self):
+        """
+            Remove the containers created ahead of time that were never
+            claimed (e.g. because the batch run was interrupted).
+        """
+        with self._utility_lock:
+            for container_id in self._precreated_containers:
+                _logger.info('Removing unused container:{}'.format(container_id))
+                try:
+                    self._get_utility_client().remove_container(
+                        container=container_id, v=True, force=True)
+                except docker.errors.APIError as e:
+                    _logger.error('Failed to remove container:"{}".\n{}'.format(
+                        container_id, str(e)))
+            self._precreated_containers.clear()
+
+    def take_worker_container(self, docker_client):
+        """
+            Returns the ``WorkerContainer`` of the job slot that uses
+            ``docker_client`` or None if it does not have one. The caller
+            must either give it back with ``return_worker_container()`` or
+            remove it.
+        """
+        with self._lock:
+            return self._worker_containers.pop(id(docker_client), None)
+
+    def return_worker_container(self, docker_client, worker):
+        """
+            Keep ``worker`` for the next job of the slot that uses
+            ``docker_client``. Containers that are kept are removed when
+            Python exits.
+        """
+        with self._lock:
+            assert id(docker_client) not in self._worker_containers
+            if not self._registered_worker_atexit:
+                # This is registered after the reaper's shutdown so it
+                # runs first.
+                atexit.register(self.remove_worker_containers)
+                self._registered_worker_atexit = True
+            self._worker_containers[id(docker_client)] = worker
+
+    def remove_worker_containers(self):
+        """
+            Remove the containers kept by ``return_worker_container()``.
+        """
+        with self._lock:
+            workers = list(self._worker_containers.values())
+            self._worker_containers.clear()
+        for worker in workers:
+            _logger.info('Removing worker container:{} (ran {} jobs)'.format(
+                worker.id, worker.num_jobs))
+            self.reaper.remove(worker.id)
+
+    def kill_container(self, container_id):
+        """
+            Kill the container ``container_id``. This uses the utility client
+            so it can be called whilst the client running a job in the
+            container is busy.
+        """
+        with self._utility_lock:
+            self._get_utility_client().kill(container_id)
 
     def _lazy_cpu_and_mem_set_init(self):
         # Implicitly assume lock is already held
-        if len(self._numa_nodes) != 0:
+        if self._cpu_allocator is not None:
             # Init already happened
             return
         if (self._available_cpu_ids is None
             or self._cpus_per_job is None
             or self._use_memset_of_nearest_node is None):
             raise Exception('Cannot do init. One or more params were None')
-        import numa
-        if not numa.available():
-            raise Exception('NUMA not available')
-        numa_nodes = list(range(0, numa.get_max_node() + 1))
-        cpu_count = 0
-        for numa_node in numa_nodes:
-            cpus = numa.node_to_cpus(numa_node)
-            for cpu_id in cpus:
-                if cpu_id in self._available_cpu_ids:
-                    try:
-                        self._numa_nodes[numa_node].add(cpu_id)
-                    except KeyError:
-                        self._numa_nodes[numa_node] = set()
-                        self._numa_nodes[numa_node].add(cpu_id)
-                    try:
-                        self._numa_node_pool[numa_node].add(cpu_id)
-                    except KeyError:
-                        self._numa_node_pool[numa_node] = set()
-                        self._numa_node_pool[numa_node].add(cpu_id)
-                    _logger.info('Putting CPU {} in NUMA node {} in resource pool'.format(
-                        cpu_id, numa_node))
-                    cpu_count += 1
-                else:
-                    _logger.info('CPU {} in NUMA node {} is NOT IN resource pool'.format(
-                        cpu_id, numa_node))
-
-        if cpu_count == 0:
-            raise Exception('Found no available CPUs')
-        if cpu_count != len(self._available_cpu_ids):
+        self._cpu_topology = CpuTopology.CpuTopology(self._sysfs_root)
+        allocator = CpuTopology.CpuAllocator(
+            self._cpu_topology,
+            self._available_cpu_ids,
+            self._cpus_per_job,
+            wholeCores=self._whole_cores,
+            sameNode=self._use_memset_of_nearest_node)
+        if allocator.maxJobs < self._num_jobs:
             raise Exception(
-                'Mismatch between provided available CPU ids and what was found on system')
-        assert len(self._numa_node_pool) == len(self._numa_nodes)
+                'The available CPUs can only be used by {} jobs at a time'.format(
+                    allocator.maxJobs))
+        self._cpu_allocator = allocator
 
     def get_cpus(self):
         """
-            Returns a set of CPU ids for a single job
+            Returns a set of ``(CPU id, NUMA node)`` tuples for a single job
         """
         with self._lock:
             self._lazy_cpu_and_mem_set_init()
-            cpu_memset_tuples_to_return = set()
-            if self._use_memset_of_nearest_node:
-                for numa_node, available_cpus in sorted(
-                    self._numa_node_pool.items(), key=lambda x:x[0]):
-                    if len(available_cpus) >= self._cpus_per_job:
-                        for _ in range(0, self._cpus_per_job):
-                            cpu = available_cpus.pop()
-                            cpu_memset_tuples_to_return.add( (cpu, numa_node) )
-                        break # We are done
-            else:
-                # Grab any available CPU
-                available_cpus = set(functools.reduce(
-                    lambda a,b: a.union(b),
-                    self._numa_node_pool.values()))
-                cpus_to_grab = set()
-                if len(available_cpus) >= self._cpus_per_job:
-                    for _ in range(0, self._cpus_per_job):
-                        cpus_to_grab.add(available_cpus.pop())
-                    # Now remove from pool
-                    for numa_node, available_cpus_in_node in sorted(
-                        self._numa_node_pool.items(), key=lambda x:x[0]):
-                        for cpu_to_grab in cpus_to_grab:
-                            if cpu_to_grab in available_cpus_in_node:
-                                cpu_memset_tuples_to_return.add( (cpu_to_grab, numa_node) )
-                                available_cpus_in_node.remove(cpu_to_grab)
-
-
-            if len(cpu_memset_tuples_to_return) != self._cpus_per_job:
-                _logger.error('Failed to retrieve CPU resources required for job')
-                _logger.error('cpu_memset_tuples_to_return: {}'.format(cpu_memset_tuples_to_return))
-                _logger.error('cpus_per_job: {}'.format(self._cpus_per_job))
-                raise Exception('Failed to retrieve CPU resources required for job')
-            return cpu_memset_tuples_to_return
+            cpu_ids = self._cpu_allocator.allocate()
+            return set((cpu_id, self._cpu_topology.node[cpu_id]) for cpu_id in cpu_ids)
 
     def release_cpus(self, cpu_ids):
         """
@@ -189,15 +754,7 @@ class ResourcePool:
             assert isinstance(cpu_ids, set)
             for item in cpu_ids:
                 assert isinstance(item, int)
-            for cpu_to_release in cpu_ids:
-                released=False
-                for numa_node, available_cpu_ids in self._numa_node_pool.items():
-                    if cpu_to_release in self._numa_nodes[numa_node]:
-                        available_cpu_ids.add(cpu_to_release)
-                        released = True
-                        break
-                if not released:
-                    raise Exception('Failed to return CPU {} to pool'.format(cpu_to_release))
+            self._cpu_allocator.release(cpu_ids)
 
 class DockerBackend(BackendBaseClass):
 
@@ -214,6 +771,23 @@ class DockerBackend(BackendBaseClass):
         self._usedFileMapNames = set()  # HACK
         self._extra_volume_mounts = dict()
         self._grabbed_cpus = None
+        self._precreateContainers = False
+        self._preparedContainer = None
+        self._logMaxSize = None
+        self._logCompression = False
+        self._logTruncated = None
+        # Host directories mounted at the same path in persistent containers
+        # (None if persistent containers are not used)
+        self._persistentMounts = None
+        self._maxJobsPerContainer = 100
+        # Writable tmpfs directories of persistent containers (apart from
+        # image_work_dir) that are emptied between jobs
+        self._scratchDirs = ['/tmp', '/var/tmp']
+        self._worker = None
+        self._usingWorker = False
+        self._workerKilled = False
+        self._execOutOfTime = False
+        self._waitUsingEvents = False
         # handle required options
         if not 'image' in kwargs:
             raise DockerBackendException('"image" but be specified')
@@ -227,6 +801,9 @@ class DockerBackend(BackendBaseClass):
 
         available_cpu_ids = None
         cpus_per_job = None
+        reaperThreads = 2
+        numClients = None
+        wholeCores = False
         self._use_memset_of_nearest_node = None
         self.resource_pinning = False # No resource pinning by default
         requiredOptions = ['image']
@@ -328,6 +905,75 @@ class DockerBackend(BackendBaseClass):
                         'ro': read_only,
                     }
                 continue
+            if key == 'log_max_size':
+                self._logMaxSize = value
+                if not (isinstance(value, int) and value > 1):
+                    raise DockerBackendException(
+                        '"log_max_size" must be an integer > 1')
+                continue
+            if key == 'log_compression':
+                self._logCompression = value
+                if not isinstance(value, bool):
+                    raise DockerBackendException(
+                        '"log_compression" must map to a bool')
+                continue
+            if key == 'reaper_threads':
+                reaperThreads = value
+                if not (isinstance(value, int) and value > 0):
+                    raise DockerBackendException(
+                        '"reaper_threads" must be an integer > 0')
+                continue
+            if key == 'wait_using_events':
+                self._waitUsingEvents = value
+                if not isinstance(value, bool):
+                    raise DockerBackendException(
+                        '"wait_using_events" must map to a bool')
+                continue
+            if key == 'docker_clients':
+                numClients = value
+                if not (isinstance(value, int) and value > 0):
+                    raise DockerBackendException(
+                        '"docker_clients" must be an integer > 0')
+                continue
+            if key == 'precreate_containers':
+                self._precreateContainers = value
+                if not isinstance(value, bool):
+                    raise DockerBackendException(
+                        '"precreate_containers" must map to a bool')
+                continue
+            if key == 'persistent_containers':
+                if not isinstance(value, dict):
+                    raise DockerBackendException(
+                        '"persistent_containers" should map to a dictionary')
+                for subKey in value.keys():
+                    if subKey not in ['mounts', 'max_jobs', 'scratch_dirs']:
+                        raise DockerBackendException(
+                            '"{}" key is not a recognised option of "persistent_containers"'.format(
+                                subKey))
+                mounts = value.get('mounts', None)
+                if not (isinstance(mounts, list) and len(mounts) > 0):
+                    raise DockerBackendException(
+                        '"mounts" of "persistent_containers" must be a non empty list')
+                for mount in mounts:
+                    if not (isinstance(mount, str) and os.path.isabs(mount)):
+                        raise DockerBackendException(
+                            'Mount "{}" of "persistent_containers" must be an absolute path'.format(
+                                mount))
+                self._persistentMounts = [os.path.normpath(m) for m in mounts]
+                if 'max_jobs' in value:
+                    self._maxJobsPerContainer = value['max_jobs']
+                    if not (isinstance(self._maxJobsPerContainer, int) and
+                            self._maxJobsPerContainer > 0):
+                        raise DockerBackendException(
+                            '"max_jobs" of "persistent_containers" must be an integer > 0')
+                if 'scratch_dirs' in value:
+                    scratchDirs = value['scratch_dirs']
+                    if not (isinstance(scratchDirs, list) and
+                            all(isinstance(d, str) and os.path.isabs(d) for d in scratchDirs)):
+                        raise DockerBackendException(
+                            '"scratch_dirs" of "persistent_containers" must be a list of absolute paths')
+                    self._scratchDirs = [os.path.normpath(d) for d in scratchDirs]
+                continue
             if key == 'resource_pinning':
                 self.resource_pinning = True
                 if not isinstance(value, dict):
@@ -360,7 +1006,12 @@ class DockerBackend(BackendBaseClass):
                     self._use_memset_of_nearest_node = value['use_memset_of_nearest_node']
                     if not isinstance(self._use_memset_of_nearest_node, bool):
                         raise DockerBackendException(
-                        'cpus_per_job >= 1')
+                        'use_memset_of_nearest_node must be a boolean')
+                if 'whole_cores' in value:
+                    wholeCores = value['whole_cores']
+                    if not isinstance(wholeCores, bool):
+                        raise DockerBackendException(
+                        'whole_cores must be a boolean')
                 # Sanity check
                 if (self.ctx.num_parallel_jobs * cpus_per_job) > len(available_cpu_ids):
                         raise DockerBackendException(
@@ -371,10 +1022,36 @@ class DockerBackend(BackendBaseClass):
             raise DockerBackendException(
                 '"{}" key is not a recognised option'.format(key))
 
+        if self._persistentMounts is not None:
+            if self._precreateContainers:
+                raise DockerBackendException(
+                    '"persistent_containers" cannot be used with "precreate_containers"')
+            if self._dockerStatsOnExitShimBinary:
+                raise DockerBackendException(
+                    '"persistent_containers" cannot be used with "docker_stats_on_exit_shim"')
+            if numClients is not None and numClients < self.ctx.num_parallel_jobs:
+                # A job holds a client whilst it runs in a persistent container
+                raise DockerBackendException(
+                    '"docker_clients" must be at least the number of parallel jobs'
+                    ' when "persistent_containers" is used')
+            for mount in self._persistentMounts:
+                # The scratch directories in the container are emptied
+                # between jobs
+                for scratchDir in [self._workDirInsideContainer] + self._scratchDirs:
+                    if (_path_is_under(mount, scratchDir) or
+                        _path_is_under(scratchDir, mount)):
+                        raise DockerBackendException(
+                            'Mount "{}" of "persistent_containers" cannot overlap "{}".'
+                            ' Set "scratch_dirs" or "image_work_dir" to avoid it'.format(
+                                mount, scratchDir))
+
         # HACK: Try to prevent program path name being used in calls to addFileToBackend()
         if self.programPath().startswith('/tmp') and os.path.dirname(self.programPath()) == '/tmp':
             self._usedFileMapNames.add(os.path.basename(self.programPath()))
 
+        if self._dockerStatsOnExitShimBinary:
+            self.addFileToBackend(self._dockerStatsOnExitShimBinary, read_only=True)
+
         # Initialise global client pool. This is shared amoung all runners.
         self._resource_pool = None
         try:
@@ -385,7 +1062,10 @@ class DockerBackend(BackendBaseClass):
                     num_jobs=self.ctx.num_parallel_jobs,
                     available_cpu_ids=available_cpu_ids,
                     cpus_per_job=cpus_per_job,
-                    use_memset_of_nearest_node=self._use_memset_of_nearest_node
+                    use_memset_of_nearest_node=self._use_memset_of_nearest_node,
+                    reaper_threads=reaperThreads,
+                    num_clients=numClients,
+                    whole_cores=wholeCores
                 )
                 success = self.ctx.add_object('DockerBackend.ResourcePool', self._resource_pool)
                 # Handle race. If someone managed to make a resource pool before we did
@@ -400,47 +1080,52 @@ class DockerBackend(BackendBaseClass):
             raise DockerBackendException(
                 'Failed to get resource pool')
 
-        # Initialise the docker client
-        try:
-            self._dc = self._resource_pool.get_docker_client()
-            self._dc.ping()
-        except Exception as e:
-            _logger.error('Failed to connect to the Docker daemon')
-            _logger.error(e)
-            raise DockerBackendException(
-                'Failed to connect to the Docker daemon')
+        # The docker client is only acquired when running
+        self._dc = None
 
-        try:
-            # FIXME: Move this check into the resource pool so we can cache
-            # the result of this check amoung runners.
-            # Check we can find the docker image
-            images = self._dc.images()
-            assert isinstance(images, list)
-            images = list(
-                filter(lambda i: (i['RepoTags'] is not None) and self._dockerImageName in i['RepoTags'], images))
-            if len(images) == 0:
-                msg = 'Could not find docker image with name "{}"'.format(
-                    self._dockerImageName)
-                raise DockerBackendException(msg)
-            else:
-                if len(images) > 1:
-                    msg = 'Found multiple docker images:\n{}'.format(
-                        pprint.pformat(images))
-                    _logger.error(msg)
-                    raise DockerBackendException(msg)
-                self._dockerImage = images[0]
-                _logger.debug('Found Docker image:\n{}'.format(
-                    pprint.pformat(self._dockerImage)))
-        finally:
-            # HACK: To not exhaust the resource pool we need to
-            # return the client now.
-            self._resource_pool.release_docker_client(self._dc)
-            self._dc = None
+        # Check we can find the docker image. The resource pool
+        # caches this so it is only done once.
+        self._dockerImage = self._resource_pool.get_image(self._dockerImageName)
 
     @property
     def name(self):
         return "Docker"
 
+    @property
+    def supportsPrepareRun(self):
+        return self._precreateContainers
+
+    def prepareRun(self, cmdLine, logFilePath, envVars):
+        hostCfgArgs, containerArgs = self._containerConfig(cmdLine, envVars)
+        try:
+            container = self._resource_pool.precreate_container(
+                hostCfgArgs, containerArgs)
+        except (docker.errors.APIError, requests.exceptions.RequestException) as e:
+            # run() will create the container instead
+            _logger.warning('Failed to create container ahead of time: {}'.format(e))
+            return
+        self._preparedContainer = ((hostCfgArgs, containerArgs), container)
+
+    def _takePreparedContainer(self, hostCfgArgs, containerArgs):
+        """
+          Returns the container created by ``prepareRun()`` if it was
+          created with the same arguments, otherwise None.
+        """
+        prepared = self._preparedContainer
+        self._preparedContainer = None
+        if prepared is None:
+            return None
+        config, container = prepared
+        if not self._resource_pool.claim_precreated_container(container['Id']):
+            return None
+        if config != (hostCfgArgs, containerArgs):
+            _logger.info('Not using container "{}" created with different arguments'.format(
+                container['Id']))
+            self._resource_pool.reaper.remove(container['Id'])
+            return None
+        _logger.debug('Using container created ahead of time:{}'.format(container['Id']))
+        return container
+
     @property
     def dockerStatsOnExitShimPathInContainer(self):
         if self._dockerStatsOnExitShimBinary == None:
@@ -459,13 +1144,33 @@ class DockerBackend(BackendBaseClass):
     def dockerStatsLogFileInContainer(self):
         return os.path.join(self.workingDirectoryInternal, self.dockerStatsLogFileName)
 
-    def run(self, cmdLine, logFilePath, envVars):
-        # Grab a docker client
-        self._dc = self._resource_pool.get_docker_client()
+    def _jobBindings(self):
+        # Declare the volumes
+        programPathInsideContainer = self.programPath()
+        bindings = dict()
 
-        self._logFilePath = logFilePath
-        self._outOfMemory = False
-        outOfTime = False
+        # Add aditional volumes
+        for hostPath, (containerPath, read_only) in self._additionalHostContainerFileMaps.items():
+            bindings[hostPath] = {'bind': containerPath, 'ro': read_only}
+
+        # Try adding extra volumes
+        for hostPath, props in self._extra_volume_mounts.items():
+            bindings[hostPath] = props
+
+        # Mandatory bindings
+        bindings[self.workingDirectory] = {
+            'bind': self.workingDirectoryInternal, 'ro': False}
+        bindings[self.hostProgramPath] = {
+            'bind': programPathInsideContainer, 'ro': True}
+        return bindings
+
+    def _containerConfig(self, cmdLine, envVars, bindings=None):
+        """
+          Returns ``(hostCfgArgs, containerArgs)``, the arguments (apart from
+          CPU pinning) to pass to ``create_host_config()`` and
+          ``create_container()`` to run ``cmdLine``. If ``bindings`` is None
+          the volumes needed by the job are declared.
+        """
         ulimits = []
         if self.stackLimit != None:
             # FIXME: Setting stack size in Docker seems broken right now.
@@ -500,26 +1205,8 @@ class DockerBackend(BackendBaseClass):
         if len(ulimits) > 0:
             extraHostCfgArgs['ulimits'] = ulimits
 
-        # Declare the volumes
-        programPathInsideContainer = self.programPath()
-        bindings = dict()
-
-        if self._dockerStatsOnExitShimBinary:
-            self.addFileToBackend(self._dockerStatsOnExitShimBinary, read_only=True)
-
-        # Add aditional volumes
-        for hostPath, (containerPath, read_only) in self._additionalHostContainerFileMaps.items():
-            bindings[hostPath] = {'bind': containerPath, 'ro': read_only}
-
-        # Try adding extra volumes
-        for hostPath, props in self._extra_volume_mounts.items():
-            bindings[hostPath] = props
-
-        # Mandatory bindings
-        bindings[self.workingDirectory] = {
-            'bind': self.workingDirectoryInternal, 'ro': False}
-        bindings[self.hostProgramPath] = {
-            'bind': programPathInsideContainer, 'ro': True}
+        if bindings is None:
+            bindings = self._jobBindings()
 
         _logger.debug('Declaring bindings:\n{}'.format(
             pprint.pformat(bindings)))
@@ -541,30 +1228,7 @@ class DockerBackend(BackendBaseClass):
             _logger.info('Using user "{}" inside container'.format(
                 self._userToUseInsideContainer))
 
-        if self.resource_pinning:
-            cpu_memset_tuples = self._resource_pool.get_cpus()
-            self._grabbed_cpus = set(map(lambda t: t[0], cpu_memset_tuples))
-            grabbed_cpu_strs = set(map(lambda c:str(c), self._grabbed_cpus))
-            cpu_set_string=",".join(grabbed_cpu_strs)
-            extraHostCfgArgs['cpuset_cpus']=cpu_set_string
-            _logger.info('Using CPU pinning: {}'.format(cpu_set_string))
-            if self._use_memset_of_nearest_node:
-                mem_set_to_use = None
-                for _, mem_set in cpu_memset_tuples:
-                    mem_set_to_use = mem_set
-                    break
-                _logger.info('Using Memset pinning: {}'.format(mem_set_to_use))
-                assert isinstance(mem_set_to_use, int)
-                assert mem_set_to_use >= 0
-                mem_set_to_use_str=str(mem_set_to_use)
-                _logger.warning('FIXME Setting cpuset_mem is broken')
-                raise Exception('Setting cpuset_mem is broken')
-                # FIXME: Need to get this PR ( https://github.com/docker/docker-py/pull/1583 )
-                # accepted for this to work.
-                # extraHostCfgArgs['cpuset_mems'] = mem_set_to_use_str
-
-
-        hostCfg = self._dc.create_host_config(
+        hostCfgArgs = dict(
             binds=bindings,
             privileged=False,
             network_mode=None,
@@ -579,42 +1243,125 @@ class DockerBackend(BackendBaseClass):
         _logger.debug('Command line inside container:\n{}'.format(
             pprint.pformat(finalCmdLine)))
 
-        # Finally create the container
-        self._container = self._dc.create_container(
+        containerArgs = dict(
             image=self._dockerImage['Id'],
             command=finalCmdLine,
             environment=envVars,
             working_dir=self.workingDirectoryInternal,
             volumes=list(bindings.keys()),
-            host_config=hostCfg,
             # The default. When all containers are created this way they will all
             # get the same proportion of CPU cycles.
             cpu_shares=0,
+            labels=_container_labels(),
             **extraContainerArgs
         )
-        _logger.debug('Created container:\n{}'.format(
-            pprint.pformat(self._container['Id'])))
-        if self._container['Warnings'] != None:
-            _logger.warning('Warnings emitted when creating container:{}'.format(
-                self._container['Warnings']))
+        return (hostCfgArgs, containerArgs)
+
+    def _grabCpus(self):
+        """
+          Take the CPUs for a job from the resource pool. Returns the values
+          to use for ``cpuset_cpus`` and ``cpuset_mems`` (None if memory is
+          not pinned).
+        """
+        cpu_memset_tuples = self._resource_pool.get_cpus()
+        self._grabbed_cpus = set(map(lambda t: t[0], cpu_memset_tuples))
+        cpu_set_string = CpuTopology.formatCpuList(self._grabbed_cpus)
+        _logger.info('Using CPU pinning: {}'.format(cpu_set_string))
+        mem_set_string = None
+        if self._use_memset_of_nearest_node:
+            # The resource pool keeps the CPUs of a job in one NUMA node
+            mem_sets = set(map(lambda t: t[1], cpu_memset_tuples))
+            assert len(mem_sets) == 1
+            mem_set_string = str(mem_sets.pop())
+            _logger.info('Using Memset pinning: {}'.format(mem_set_string))
+        return (cpu_set_string, mem_set_string)
+
+    def _pinningArgs(self):
+        # Arguments for ``create_host_config()`` or ``update_container()``
+        cpu_set_string, mem_set_string = self._grabCpus()
+        pinningArgs = {'cpuset_cpus': cpu_set_string}
+        if mem_set_string is not None:
+            pinningArgs['cpuset_mems'] = mem_set_string
+        return pinningArgs
+
+    def run(self, cmdLine, logFilePath, envVars):
+        if self._persistentMounts is not None:
+            unmountedPaths = [p for p in self._pathsUsedByJob() if not any(
+                _path_is_under(p, m) for m in self._persistentMounts)]
+            if len(unmountedPaths) == 0:
+                return self._runInWorkerContainer(cmdLine, logFilePath, envVars)
+            _logger.warning(
+                'Using a new container because {} are not in the mounts of "persistent_containers"'.format(
+                    unmountedPaths))
+
+        # Grab a docker client
+        self._dc = self._resource_pool.get_docker_client()
+
+        self._logFilePath = logFilePath
+        if self._logCompression:
+            self._logFilePath += '.gz'
+        self._logTruncated = None
+        self._outOfMemory = False
+        outOfTime = False
+        hostCfgArgs, containerArgs = self._containerConfig(cmdLine, envVars)
+        container = self._takePreparedContainer(hostCfgArgs, containerArgs)
+
+        if self.resource_pinning:
+            pinningArgs = self._pinningArgs()
+            if container is None:
+                hostCfgArgs.update(pinningArgs)
+            else:
+                # The CPUs are only known now
+                self._dc.update_container(container['Id'], **pinningArgs)
+
+        if container is None:
+            hostCfg = self._dc.create_host_config(**hostCfgArgs)
+
+            # Finally create the container
+            container = self._dc.create_container(host_config=hostCfg, **containerArgs)
+            _logger.debug('Created container:\n{}'.format(
+                pprint.pformat(container['Id'])))
+            if container['Warnings'] != None:
+                _logger.warning('Warnings emitted when creating container:{}'.format(
+                    container['Warnings']))
+        self._container = container
 
         exitCode = None
+        waiter = None
         startTime = time.perf_counter()
         self._endTime = 0
         try:
-            self._dc.start(container=self._container['Id'])
-            timeoutArg = {}
             if self.timeLimit > 0:
-                timeoutArg['timeout'] = self.timeLimit
                 _logger.info('Using timeout {} seconds'.format(self.timeLimit))
-            exitCode = self._dc.wait(
-                container=self._container['Id'], **timeoutArg)
-            if exitCode == -1:
-                # FIXME: Does this even happen? Docker-py's documentation is
-                # unclear.
-                outOfTime = True
-                _logger.info('Timeout occurred')
-                exitCode = None
+            if self._waitUsingEvents:
+                watcher = self._resource_pool.completion_watcher
+                waiter = watcher.watch(self._container['Id'], self.timeLimit)
+                self._dc.start(container=self._container['Id'])
+                # The client is not needed whilst waiting. kill() gets
+                # another one.
+                with self._killLock:
+                    if self._dc is not None:
+                        self._resource_pool.release_docker_client(self._dc)
+                        self._dc = None
+                waiter.wait()
+                if waiter.timed_out:
+                    _logger.info('Timeout occurred')
+                    outOfTime = True
+                else:
+                    exitCode = waiter.exit_code
+            else:
+                self._dc.start(container=self._container['Id'])
+                timeoutArg = {}
+                if self.timeLimit > 0:
+                    timeoutArg['timeout'] = self.timeLimit
+                exitCode = self._dc.wait(
+                    container=self._container['Id'], **timeoutArg)
+                if exitCode == -1:
+                    # FIXME: Does this even happen? Docker-py's documentation is
+                    # unclear.
+                    outOfTime = True
+                    _logger.info('Timeout occurred')
+                    exitCode = None
         except requests.exceptions.ReadTimeout as e:
             _logger.info('Timeout occurred')
             outOfTime = True
@@ -622,7 +1369,11 @@ class DockerBackend(BackendBaseClass):
             _logger.error(
                 'Failed to start/wait on container "{}".\nReason: {}'.format(self._container['Id'], str(e)))
         finally:
+            if waiter is not None and not waiter.done:
+                watcher.unwatch(waiter.container_id)
             self.kill()
+        if waiter is not None and waiter.oom:
+            self._outOfMemory = True
 
         runTime = self._endTime - startTime
         userCPUTime = None
@@ -648,13 +1399,253 @@ class DockerBackend(BackendBaseClass):
                              oot=outOfTime,
                              oom=self._outOfMemory,
                              userCpuTime=userCPUTime,
-                             sysCpuTime=sysCPUTime)
+                             sysCpuTime=sysCPUTime,
+                             logFilePath=self._logFilePath if self._logCompression else None,
+                             logTruncated=self._logTruncated)
+
+    def _pathsUsedByJob(self):
+        return ([self.workingDirectory, self.hostProgramPath] +
+                list(self._additionalHostContainerFileMaps.keys()))
+
+    def _workerContainerConfig(self):
+        bindings = dict()
+        for mount in self._persistentMounts:
+            bindings[mount] = {'bind': mount, 'ro': False}
+        for hostPath, props in self._extra_volume_mounts.items():
+            bindings[hostPath] = props
+        # Jobs are run with exec so the container just has to stay running
+        hostCfgArgs, containerArgs = self._containerConfig(
+            ['/bin/sh', '-c', 'while :; do sleep 3600 & wait $!; done'], {}, bindings)
+        containerArgs['working_dir'] = self._workDirInsideContainer
+        # Nothing a job writes may be seen by the next job so the only
+        # writable paths (apart from the mounts) are tmpfs directories that
+        # are emptied between jobs.
+        hostCfgArgs['read_only'] = True
+        hostCfgArgs['tmpfs'] = {d: 'rw,exec' for d in self._workerScratchDirs()}
+        return (hostCfgArgs, containerArgs)
+
+    def _workerScratchDirs(self):
+        return [self._workDirInsideContainer] + self._scratchDirs
+
+    def _takeWorkerContainer(self):
+        """
+          Returns the ``WorkerContainer`` of the job slot, creating and
+          starting it if necessary.
+        """
+        hostCfgArgs, containerArgs = self._workerContainerConfig()
+        worker = self._resource_pool.take_worker_container(self._dc)
+        if worker is not None and worker.config != (hostCfgArgs, containerArgs):
+            _logger.info('Not using container "{}" created with different arguments'.format(
+                worker.id))
+            self._resource_pool.reaper.remove(worker.id)
+            worker = None
+        if worker is not None:
+            return worker
+
+        hostCfg = self._dc.create_host_config(**hostCfgArgs)
+        container = self._dc.create_container(host_config=hostCfg, **containerArgs)
+        _logger.info('Created worker container:{}'.format(container['Id']))
+        if container['Warnings'] != None:
+            _logger.warning('Warnings emitted when creating container:{}'.format(
+                container['Warnings']))
+        try:
+            self._dc.start(container=container['Id'])
+        except:
+            self._resource_pool.reaper.remove(container['Id'])
+            raise
+        return WorkerContainer(container['Id'], (hostCfgArgs, containerArgs))
+
+    def _execCommandLine(self, cmdLine, envVars):
+        # The API version used does not allow ``exec_create()`` to set the
+        # environment or working directory so the command line does it.
+        envArgs = ['{}={}'.format(k, v) for k, v in sorted(envVars.items())]
+        return (['/bin/sh', '-c', 'cd "$0" && exec env "$@"', self.workingDirectory] +
+                envArgs + cmdLine)
+
+    def _cleanUpWorkerContainer(self, worker):
+        """
+          Kill any processes left behind by the last job in ``worker`` and
+          empty its scratch directories (the only writable paths in the
+          container apart from the mounts). Returns False if this failed.
+        """
+        # ``kill -1`` does not signal PID 1 (the loop that keeps the
+        # container running) or the shell itself.
+        cleanUpCmdLine = [
+            '/bin/sh', '-c',
+            'kill -9 -1 2>/dev/null; for d in "$@"; do'
+            ' rm -rf "$d"/* "$d"/.[!.]* "$d"/..?* 2>/dev/null; done; true',
+            'sh'] + self._workerScratchDirs()
+        try:
+            execId = self._dc.exec_create(worker.id, cleanUpCmdLine)['Id']
+            self._dc.exec_start(execId)
+            exitCode = self._dc.exec_inspect(execId)['ExitCode']
+        except (docker.errors.APIError, requests.exceptions.RequestException) as e:
+            _logger.error('Failed to clean up container:"{}".\n{}'.format(
+                worker.id, str(e)))
+            return False
+        return exitCode == 0
+
+    def _readOomKillCount(self, worker):
+        """
+          Returns the number of processes in ``worker`` that the OOM killer
+          has killed (the ``oom_kill`` counter of the container's memory
+          cgroup) or None if this could not be read.
+        """
+        # cgroup v2, then cgroup v1 (Linux >= 4.13)
+        readCmdLine = [
+            '/bin/sh', '-c',
+            'cat /sys/fs/cgroup/memory.events 2>/dev/null || '
+            'cat /sys/fs/cgroup/memory/memory.oom_control']
+        try:
+            execId = self._dc.exec_create(worker.id, readCmdLine)['Id']
+            output = self._dc.exec_start(execId)
+            exitCode = self._dc.exec_inspect(execId)['ExitCode']
+        except (docker.errors.APIError, requests.exceptions.RequestException) as e:
+            _logger.error('Failed to read OOM kill count of container:"{}".\n{}'.format(
+                worker.id, str(e)))
+            return None
+        if exitCode != 0:
+            return None
+        for line in output.decode(errors='replace').splitlines():
+            fields = line.split()
+            if len(fields) == 2 and fields[0] == 'oom_kill' and fields[1].isdigit():
+                return int(fields[1])
+        return None
+
+    def _jobRanOutOfMemory(self, worker, oomKillsBefore, exitCode):
+        oomKillsAfter = None
+        if oomKillsBefore is not None:
+            oomKillsAfter = self._readOomKillCount(worker)
+        if oomKillsAfter is not None:
+            return oomKillsAfter > oomKillsBefore
+        # Docker only records OOMKilled when the container stops.
+        _logger.warning('Cannot read OOM kill count of container:{}. Assuming a job killed '
+                        'by SIGKILL ran out of memory'.format(worker.id))
+        return exitCode == 137
+
+    def _runInWorkerContainer(self, cmdLine, logFilePath, envVars):
+        # Grab a docker client. This determines the job slot and hence the
+        # container that is used.
+        self._dc = self._resource_pool.get_docker_client()
+
+        self._logFilePath = logFilePath
+        if self._logCompression:
+            self._logFilePath += '.gz'
+        self._logTruncated = None
+        self._outOfMemory = False
+        self._workerKilled = False
+        self._execOutOfTime = False
+        self._usingWorker = True
+        exitCode = None
+        runTime = None
+        worker = None
+        recycle = True
+        try:
+            worker = self._takeWorkerContainer()
+            if self.resource_pinning:
+                self._dc.update_container(worker.id, **self._pinningArgs())
+            with self._killLock:
+                self._worker = worker
+
+            oomKillsBefore = None
+            if self.memoryLimit > 0:
+                oomKillsBefore = self._readOomKillCount(worker)
+            execId = self._dc.exec_create(
+                worker.id, self._execCommandLine(cmdLine, envVars))['Id']
+            timer = None
+            startTime = time.perf_counter()
+            try:
+                if self.timeLimit > 0:
+                    _logger.info('Using timeout {} seconds'.format(self.timeLimit))
+                    timer = self._resource_pool.timer_wheel.schedule(
+                        self.timeLimit, self._startExecTimedOut)
+                # Stream the output to file in chunks as it is produced
+                _logger.info('Writing log to {}'.format(self._logFilePath))
+                with LogCapture.CappedLogWriter(self._logFilePath, self._logMaxSize,
+                                                self._logCompression) as writer:
+                    for chunk in self._dc.exec_start(execId, stream=True):
+                        writer.write(chunk)
+            finally:
+                if timer is not None:
+                    self._resource_pool.timer_wheel.cancel(timer)
+                runTime = time.perf_counter() - startTime
+            if self._logMaxSize is not None:
+                self._logTruncated = writer.truncated
+            worker.num_jobs += 1
+
+            if self._execOutOfTime:
+                _logger.info('Timeout occurred')
+            elif not self._workerKilled:
+                exitCode = self._dc.exec_inspect(execId)['ExitCode']
+                if self.memoryLimit > 0:
+                    self._outOfMemory = self._jobRanOutOfMemory(
+                        worker, oomKillsBefore, exitCode)
+                if self._outOfMemory:
+                    _logger.info('Job ran out of memory')
+                elif worker.num_jobs < self._maxJobsPerContainer:
+                    recycle = not self._cleanUpWorkerContainer(worker)
+        except docker.errors.APIError as e:
+            _logger.error('Failed to run job in container "{}".\nReason: {}'.format(
+                None if worker is None else worker.id, str(e)))
+            if runTime is None:
+                # The job never started
+                raise
+        finally:
+            with self._killLock:
+                self._worker = None
+                self._usingWorker = False
+            self._releaseCpus()
+            if worker is not None:
+                if recycle:
+                    _logger.info('Recycling container:{} (ran {} jobs)'.format(
+                        worker.id, worker.num_jobs))
+                    self._resource_pool.reaper.remove(worker.id)
+                else:
+                    self._resource_pool.return_worker_container(self._dc, worker)
+            self._resource_pool.release_docker_client(self._dc)
+            self._dc = None
+
+        return BackendResult(exitCode=exitCode,
+                             runTime=runTime,
+                             oot=self._execOutOfTime,
+                             oom=self._outOfMemory,
+                             logFilePath=self._logFilePath if self._logCompression else None,
+                             logTruncated=self._logTruncated)
+
+    def _startExecTimedOut(self):
+        # Called by the timer wheel. Killing the container can block so it
+        # is not done in the wheel's thread.
+        threading.Thread(target=self._execTimedOut, name='exec-timeout',
+                         daemon=True).start()
+
+    def _execTimedOut(self):
+        self._execOutOfTime = True
+        self._killWorker()
+
+    def _killWorker(self):
+        # Killing the container ends the job. The container is then recycled.
+        with self._killLock:
+            if self._worker is None or self._workerKilled:
+                return
+            self._workerKilled = True
+            _logger.info('Stopping container:{}'.format(self._worker.id))
+            try:
+                self._resource_pool.kill_container(self._worker.id)
+            except (docker.errors.APIError, requests.exceptions.RequestException) as e:
+                _logger.error('Failed to kill container:"{}".\n{}'.format(
+                    self._worker.id, str(e)))
 
     def kill(self):
+        if self._usingWorker:
+            self._killWorker()
+            return
         try:
             self._killLock.acquire()
             self._endTime = time.perf_counter()
             if self._container != None:
+                if self._dc is None:
+                    # The client was released whilst waiting for the container
+                    self._dc = self._resource_pool.get_docker_client()
                 _logger.info('Stopping container:{}'.format(
                     self._container['Id']))
                 try:
@@ -662,47 +1653,50 @@ class DockerBackend(BackendBaseClass):
                         self._container['Id'])
                     if containerStatus["State"]["Running"]:
                         self._dc.kill(self._container['Id'])
+                        containerStatus = self._dc.inspect_container(
+                            self._container['Id'])
+                    # Record if OOM occurred
+                    self._outOfMemory = containerStatus['State']['OOMKilled']
+                    assert isinstance(self._outOfMemory, bool)
                 except docker.errors.APIError as e:
                     _logger.error('Failed to kill container:"{}".\n{}'.format(
                         self._container['Id'], str(e)))
-
-                # Write logs to file (note we get binary in Python 3, not sure
-                # about Python 2)
-                with open(self._logFilePath, 'wb') as f:
-                    logData = self._dc.logs(container=self._container['Id'],
-                                            stdout=True, stderr=True, timestamps=False,
-                                            tail='all', stream=False)
-                    _logger.info('Writing log to {}'.format(self._logFilePath))
-                    f.write(logData)
-
-                # Record if OOM occurred
-                containerInfo = self._dc.inspect_container(
-                    container=self._container['Id'])
-                self._outOfMemory = containerInfo['State']['OOMKilled']
-                assert isinstance(self._outOfMemory, bool)
-
-                try:
-                    _logger.info('Destroying container:{}'.format(
-                        self._container['Id']))
-                    # Note setting `v=True` is very important. This removes
-                    # the volumes associated with the container. Otherwise
-                    # we'll leave loads of stray volumes lying around.
-                    self._dc.remove_container(
-                        container=self._container['Id'], v=True, force=True)
-                except docker.errors.APIError as e:
-                    _logger.error('Failed to remove container:"{}".\n{}'.format(
-                        self._container['Id'], str(e)))
+                # Nothing runs on the CPUs now
+                self._releaseCpus()
+
+                # Stream the logs to file in chunks so that the whole log is
+                # never held in memory (note we get binary in Python 3).
+                _logger.info('Writing log to {}'.format(self._logFilePath))
+                with LogCapture.CappedLogWriter(self._logFilePath, self._logMaxSize,
+                                                self._logCompression) as writer:
+                    logStream = self._dc.logs(container=self._container['Id'],
+                                              stdout=True, stderr=True, timestamps=False,
+                                              tail='all', stream=True, follow=False)
+                    for chunk in logStream:
+                        writer.write(chunk)
+                if self._logMaxSize is not None:
+                    self._logTruncated = writer.truncated
+
+                # Everything needed for the result has been collected so
+                # removal is done off the critical path.
+                self._resource_pool.reaper.remove(self._container['Id'])
                 self._container = None
         finally:
             if self._dc is not None:
                 self._resource_pool.release_docker_client(self._dc)
             self._dc = None
-            if self.resource_pinning and self._grabbed_cpus is not None:
-                self._resource_pool.release_cpus(self._grabbed_cpus)
-                self._grabbed_cpus = None
+            self._releaseCpus()
             self._killLock.release()
 
+    def _releaseCpus(self):
+        if self.resource_pinning and self._grabbed_cpus is not None:
+            self._resource_pool.release_cpus(self._grabbed_cpus)
+            self._grabbed_cpus = None
+
     def programPath(self):
+        if self._persistentMounts is not None:
+            # Host paths are used as is inside the container
+            return self.hostProgramPath
         return '/tmp/{}'.format(os.path.basename(self.hostProgramPath))
 
     def checkToolExists(self, toolPath):
@@ -710,16 +1704,7 @@ class DockerBackend(BackendBaseClass):
             _logger.info('Skipping tool check')
             return
         assert os.path.isabs(toolPath)
-        # HACK: Is there a better way to do this?
-        _logger.debug('Checking tool "{}" exists in image'.format(toolPath))
-        tempContainer = self._dc.create_container(image=self._dockerImage['Id'],
-                                                  command=['ls', toolPath])
-        _logger.debug('Created temporary container: {}'.format(
-            tempContainer['Id']))
-        self._dc.start(container=tempContainer['Id'])
-        exitCode = self._dc.wait(container=tempContainer['Id'])
-        self._dc.remove_container(container=tempContainer['Id'], force=True)
-        if exitCode != 0:
+        if not self._resource_pool.tool_exists(self._dockerImage['Id'], toolPath):
             raise DockerBackendException(
                 'Tool "{}" does not exist in Docker image'.format(toolPath))
 
@@ -727,6 +1712,8 @@ class DockerBackend(BackendBaseClass):
     def workingDirectoryInternal(self):
         # Return the path to the working directory that will be used inside the
         # container
+        if self._persistentMounts is not None:
+            return self.workingDirectory
         return self._workDirInsideContainer
 
     def addFileToBackend(self, path, read_only):
@@ -741,6 +1728,11 @@ class DockerBackend(BackendBaseClass):
         if not isinstance(read_only, bool):
             raise DockerBackendException('"read_only" must be boolean')
 
+        if self._persistentMounts is not None:
+            # Host paths are used as is inside the container
+            self._additionalHostContainerFileMaps[path] = (path, read_only)
+            return
+
         # FIXME: This mapping is lame. We could do something more sophisticated
         # to avoid this limitation.
         if fileName in self._usedFileMapNames:
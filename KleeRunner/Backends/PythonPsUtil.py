@@ -1,9 +1,12 @@
 # vim: set sw=4 ts=4 softtabstop=4 expandtab:
 from . BackendBase import *
+from .. import MemoryMonitor
 import logging
 import os
 import pprint
 import psutil
+import select
+import signal
 import subprocess
 import threading
 import time
@@ -21,6 +24,129 @@ class PythonPsUtilBackendException(BackendException):
     pass
 
 
+def _waitUntilExited(pid, timeout):
+    """
+      Wait up to ``timeout`` seconds (None implies wait forever) for the
+      child ``pid`` to exit without reaping it. Returns True if it exited.
+    """
+    if hasattr(os, 'pidfd_open'):
+        # Linux >= 5.3. The pidfd becomes readable when the process exits.
+        try:
+            pidfd = os.pidfd_open(pid)
+        except OSError:
+            pidfd = None
+        if pidfd is not None:
+            try:
+                ready, _, _ = select.select([pidfd], [], [], timeout)
+                return len(ready) > 0
+            finally:
+                os.close(pidfd)
+    endTime = time.perf_counter() + (timeout if timeout is not None else float('inf'))
+    delay = 0.0005
+    while os.waitid(os.P_PID, pid, os.WEXITED | os.WNOHANG | os.WNOWAIT) is None:
+        remaining = endTime - time.perf_counter()
+        if remaining <= 0.0:
+            return False
+        delay = min(delay * 2, remaining, 0.05)
+        time.sleep(delay)
+    return True
+
+
+def waitForProcess(popen, timeout=None, beforeReap=None):
+    """
+      Wait for the ``subprocess.Popen`` process ``popen`` to exit and reap
+      it using ``os.wait4()``. ``timeout`` is in seconds (None implies
+      wait forever). Returns ``(exitCode, rusage)`` where ``exitCode`` is
+      negative if the process was killed by a signal and ``rusage``
+      covers the process and every descendant it waited for.
+      Raises ``subprocess.TimeoutExpired`` if the process is still running
+      after ``timeout`` seconds. If given, ``beforeReap`` is called once the
+      process has exited but before its PID is released.
+    """
+    if timeout is not None or beforeReap is not None:
+        if not _waitUntilExited(popen.pid, timeout):
+            raise subprocess.TimeoutExpired(popen.args, timeout)
+    if beforeReap is not None:
+        beforeReap()
+    _, status, rusage = os.wait4(popen.pid, 0)
+    if os.WIFSIGNALED(status):
+        exitCode = -os.WTERMSIG(status)
+    else:
+        exitCode = os.WEXITSTATUS(status)
+    # Stop Popen from trying to reap the process again
+    popen.returncode = exitCode
+    return (exitCode, rusage)
+
+
+def liveProcessesInGroup(pgid, procRoot='/proc'):
+    """
+      Returns the PIDs of the processes in the process group ``pgid`` that
+      are not zombies.
+    """
+    pids = []
+    for name in os.listdir(procRoot):
+        if not name.isdigit():
+            continue
+        try:
+            with open(os.path.join(procRoot, name, 'stat'), 'r') as f:
+                stat = f.read()
+        except OSError:
+            # The process exited
+            continue
+        # Fields after the command name (which may contain spaces)
+        fields = stat[stat.rfind(')') + 2:].split()
+        if len(fields) > 2 and fields[0] != 'Z' and fields[2] == str(pgid):
+            pids.append(int(name))
+    return pids
+
+
+def resourceUsageFromRusage(rusage):
+    """
+      Returns the fields of ``rusage`` (from ``os.wait4()``) that are
+      recorded in the result info of a job.
+    """
+    return {
+        # ru_maxrss is in KiB on Linux
+        'max_rss': rusage.ru_maxrss / 1024,
+        'minor_page_faults': rusage.ru_minflt,
+        'major_page_faults': rusage.ru_majflt,
+        'voluntary_context_switches': rusage.ru_nvcsw,
+        'involuntary_context_switches': rusage.ru_nivcsw,
+        'block_input_operations': rusage.ru_inblock,
+        'block_output_operations': rusage.ru_oublock,
+    }
+
+
+class ProcessGroup:
+    """
+      The process group of a job led by the tool. Once the tool has been
+      reaped its PGID may be reused so other threads must not signal the
+      group after ``markReaped()`` is called.
+    """
+    def __init__(self, pgid):
+        self.pgid = pgid
+        self._lock = threading.Lock()
+        self._reaped = False
+
+    def markReaped(self):
+        with self._lock:
+            self._reaped = True
+
+    def signal(self, sig):
+        """
+          Send ``sig`` to the group. Returns False if the tool has been
+          reaped so nothing was sent.
+        """
+        with self._lock:
+            if self._reaped:
+                return False
+            try:
+                os.killpg(self.pgid, sig)
+            except ProcessLookupError:
+                pass
+            return True
+
+
 class PythonPsUtilBackend(BackendBaseClass):
 
     def __init__(self, hostProgramPath, workingDirectory, timeLimit, memoryLimit, stackLimit, ctx, **kwargs):
@@ -42,20 +168,46 @@ class PythonPsUtilBackend(BackendBaseClass):
             raise PythonPsUtilBackendException(
                 '{} must be a float > 0.0'.format(memoryLimitTimePeriodKey))
 
+        killGracePeriodKey = 'kill_grace_period'
+        self.killGracePeriodInSeconds = kwargs.get(killGracePeriodKey, 1.0)
+        if not (isinstance(self.killGracePeriodInSeconds, float) and
+                self.killGracePeriodInSeconds >= 0.0):
+            raise PythonPsUtilBackendException(
+                '{} must be a float >= 0.0'.format(killGracePeriodKey))
+
         self._process = None
-        self._eventObj = None
+        self._processGroup = None
+        self._monitoredTree = None
+        self._memoryMonitor = None
+        if self.memoryLimit > 0:
+            self._setupMemoryMonitor()
+
+    def _setupMemoryMonitor(self):
+        # One thread measures the memory of every job
+        self._memoryMonitor = MemoryMonitor.fromContext(
+            self.ctx, self.memoryLimitPollTimePeriodInSeconds)
 
     @property
     def name(self):
         return "PythonPsUtil"
 
     def kill(self):
-        if self._process != None:
-            try:
-                if self._process.is_running():
-                    self._terminateProcess(self._process, 0.0)
-            except psutil.NoSuchProcess:
-                pass
+        processGroup = self._processGroup
+        if processGroup != None:
+            self._terminateProcessGroup(processGroup, 0.0)
+
+    def memoryUsage(self):
+        monitoredTree = self._monitoredTree
+        if monitoredTree is not None and monitoredTree.residentMiB is not None:
+            return monitoredTree.residentMiB
+        process = self._process
+        if process is None:
+            return None
+        try:
+            processes = [process] + process.children(recursive=True)
+            return sum(p.memory_info().rss for p in processes) / (2**20)
+        except psutil.NoSuchProcess:
+            return None
 
     def programPath(self):
         # We run directly on the host so nothing special here
@@ -72,9 +224,10 @@ class PythonPsUtilBackend(BackendBaseClass):
 
         # Run the tool
         exitCode = None
+        rusage = None
+        popen = None
         self._process = None
         startTime = time.perf_counter()
-        pollThread = None
         self._outOfMemory = False
         outOfTime = False
         runTime = 0.0
@@ -89,53 +242,98 @@ class PythonPsUtilBackend(BackendBaseClass):
                 # HACK: Use subprocess.Popen and then create the psutil wrapper
                 # around it because it returns the wrong exit code.
                 # This is a workaround for https://github.com/giampaolo/psutil/issues/960
-                self._subprocess_process = subprocess.Popen(cmdLine,
-                                             cwd=self.workingDirectory,
-                                             stdout=f,
-                                             stderr=f,
-                                             env=envVars,
-                                             preexec_fn=preExecFn)
+                # The tool is the leader of a new session (and so process
+                # group) so that it and all its descendants can be killed
+                # at once.
+                popen = subprocess.Popen(cmdLine,
+                                         cwd=self.workingDirectory,
+                                         stdout=f,
+                                         stderr=f,
+                                         env=envVars,
+                                         preexec_fn=preExecFn,
+                                         start_new_session=True)
+                self._subprocess_process = popen
+                processGroup = ProcessGroup(popen.pid)
+                self._processGroup = processGroup
                 try:
-                    self._process = psutil.Process(pid=self._subprocess_process.pid)
+                    self._process = psutil.Process(pid=popen.pid)
                 except psutil.NoSuchProcess as e:
                     # HACK: Catch case where process has already died
                     pass
 
-                if self.memoryLimit > 0:
-                    pollThread = self._memoryLimitPolling(self._process)
+                if self._memoryMonitor is not None and self._process is not None:
+                    self._monitoredTree = self._memoryMonitor.register(
+                        self._process.pid, self.memoryLimit,
+                        self._memoryLimitExceeded)
 
                 _logger.info(
                     'Running with timeout of {} seconds'.format(self.timeLimit))
-                exitCode = self._subprocess_process.wait(timeout=self.timeLimit)
+                exitCode, rusage = waitForProcess(
+                    popen, self.timeLimit if self.timeLimit > 0 else None,
+                    beforeReap=processGroup.markReaped)
             except subprocess.TimeoutExpired as e:
                 outOfTime = True
                 # Note the code in the finally block will sort out clean up
             finally:
-                self.kill()
-
-                # This is a sanity check to make sure that the memory polling thread exits
-                # before this method exits
-                if pollThread != None:
-                    if self._eventObj != None:
-                        self._eventObj.set()  # Wake up polling thread if it's blocked on eventObj
-                    _logger.debug('Joining memory polling thread START')
-                    try:
-                        pollThread.join()
-                        _logger.debug('Joining memory polling thread FINISHED')
-                    except RuntimeError:
-                        _logger.error(
-                            'RuntimeError waiting for memory polling thread to terminate')
+                teardownStartTime = time.perf_counter()
+                if popen is not None:
+                    rusage = self._tearDown(popen, processGroup, rusage)
+
+                if self._monitoredTree is not None:
+                    self._memoryMonitor.unregister(self._monitoredTree)
+                    self._monitoredTree = None
                 self._process = None
+                self._processGroup = None
 
                 endTime = time.perf_counter()
                 runTime = endTime - startTime
+                teardownTime = endTime - teardownStartTime
 
+        # Note the resource usage does not include descendants that were
+        # orphaned (and so not waited for by the tool).
         return BackendResult(exitCode=exitCode,
                              runTime=runTime,
                              oot=outOfTime,
                              oom=self._outOfMemory,
-                             userCpuTime=None,  # FIXME: Find a way to record this
-                             sysCpuTime=None)  # FIXME: Find a way to record this
+                             userCpuTime=rusage.ru_utime,
+                             sysCpuTime=rusage.ru_stime,
+                             resourceUsage=resourceUsageFromRusage(rusage),
+                             teardownTime=teardownTime)
+
+    def _tearDown(self, popen, processGroup, rusage):
+        """
+          Kill every process left in the process group of ``popen`` and
+          reap ``popen`` if that has not been done yet (i.e. ``rusage`` is
+          None). Returns the rusage of ``popen``.
+        """
+        pgid = popen.pid
+        if rusage is None:
+            # The tool is still running (e.g. it ran out of time). Give it a
+            # chance to clean up after itself before aggressively killing it.
+            _logger.debug('Trying to terminate process group:{}'.format(pgid))
+            self._signalProcessGroup(pgid, signal.SIGTERM)
+            try:
+                _, rusage = waitForProcess(popen, self.killGracePeriodInSeconds,
+                                           beforeReap=processGroup.markReaped)
+            except subprocess.TimeoutExpired:
+                _logger.info('Trying to kill process group:{}'.format(pgid))
+                self._signalProcessGroup(pgid, signal.SIGKILL)
+                _, rusage = waitForProcess(popen, beforeReap=processGroup.markReaped)
+        # Kill any descendants that outlived the tool. Killed descendants
+        # are reaped by init so may briefly remain as zombies.
+        if self._processGroupExists(pgid):
+            _logger.info('Killing processes left in process group:{}'.format(pgid))
+            self._signalProcessGroup(pgid, signal.SIGKILL)
+            endTime = time.perf_counter() + 1.0
+            stragglers = liveProcessesInGroup(pgid)
+            while len(stragglers) > 0:
+                if time.perf_counter() > endTime:
+                    _logger.error('Processes {} in process group {} survived SIGKILL'.format(
+                        stragglers, pgid))
+                    break
+                time.sleep(0.01)
+                stragglers = liveProcessesInGroup(pgid)
+        return rusage
 
     def _setStacksize(self):
         """
@@ -153,103 +351,64 @@ class PythonPsUtilBackend(BackendBaseClass):
             resource.setrlimit(resource.RLIMIT_STACK,
                                (self.stackLimit, self.stackLimit))
 
-    def _getProcessMemoryUsageInMiB(self, process):
-        # use Virtual memory size rather than resident set
-        return process.memory_info()[1] / (2**20)
-
-    def _terminateProcess(self, process, pause):
+    def _memoryLimitExceeded(self, monitoredTree):
+        """
+          Called by the memory monitor thread when the tool goes over the
+          memory limit.
+        """
+        processGroup = self._processGroup
+        if processGroup is None:
+            return
+        _logger.warning('Memory limit reached (recorded {} MiB). Killing tool with PID {}'.format(
+            monitoredTree.virtualMiB, processGroup.pgid))
+        self._outOfMemory = True
+
+        # Give the tool a chance to clean up after itself before
+        # aggressively killing it. This is done in a new thread so that the
+        # monitor is not blocked.
+        threading.Thread(target=self._terminateProcessGroup,
+                         args=(processGroup, self.killGracePeriodInSeconds),
+                         name='terminate-{}'.format(processGroup.pgid),
+                         daemon=True).start()
+
+    def _signalProcessGroup(self, pgid, sig):
+        try:
+            os.killpg(pgid, sig)
+        except ProcessLookupError:
+            pass
+
+    def _processGroupExists(self, pgid):
+        try:
+            os.killpg(pgid, 0)
+            return True
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+
+    def _terminateProcessGroup(self, processGroup, pause):
+        """
+          Send SIGTERM to every process in ``processGroup`` followed by
+          SIGKILL after up to ``pause`` seconds if any are still running.
+          The tool is reaped by run() which ends the wait early. Nothing is
+          sent once that has happened because the PGID may have been
+          reused. run() kills any processes left in the group itself.
+        """
         assert isinstance(pause, float)
         assert pause >= 0.0
         # Gently terminate
-        _logger.debug('Trying to terminate PID:{}'.format(process.pid))
-        children = process.children(recursive=True)
-        process.terminate()
-        for child in children:
-            try:
-                _logger.debug(
-                    'Trying to terminate child process PID:{}'.format(child.pid))
-                child.terminate()
-            except psutil.NoSuchProcess:
-                pass
+        _logger.debug('Trying to terminate process group:{}'.format(processGroup.pgid))
+        if not processGroup.signal(signal.SIGTERM):
+            return
 
-        # If requested give the process time to clean up after itself
-        # if it is still running
-        if self._processIsRunning(process) and pause > 0.0:
-            time.sleep(pause)
+        # If requested give the processes time to clean up after themselves
+        endTime = time.perf_counter() + pause
+        while time.perf_counter() < endTime and self._processGroupExists(processGroup.pgid):
+            time.sleep(0.01)
 
         # Now aggresively kill
-        _logger.info('Trying to kill PID:{}'.format(process.pid))
-        children = process.children(recursive=True)
-        process.kill()
-        for child in children:
-            try:
-                _logger.info(
-                    'Trying to kill child process PID:{}'.format(child.pid))
-                child.kill()
-            except psutil.NoSuchProcess:
-                pass
-
-    def _processIsRunning(self, process):
-        return process.is_running() and not process.status() == psutil.STATUS_ZOMBIE
-
-    def _memoryLimitPolling(self, process):
-        """
-          This function launches a new thread that will periodically
-          poll the total memory usage of the tool that is being run.
-          If it goes over the limit will kill it
-        """
-        assert self.memoryLimitPollTimePeriodInSeconds > 0
-        assert self._outOfMemory == False
-
-        # Other parts of the runner can can set on this to prevent this thread
-        # from waiting on this Event object.
-        self._eventObj = threading.Event()
-        self._eventObj.clear()
-
-        def threadBody():
-            _logger.info('Launching memory limit polling thread for PID {} with polling time period of {} seconds'.format(
-                process.pid, self.memoryLimitPollTimePeriodInSeconds))
-            try:
-                while self._processIsRunning(process):
-                    self._eventObj.wait(
-                        self.memoryLimitPollTimePeriodInSeconds)
-                    totalMemoryUsage = 0
-                    totalMemoryUsage += self._getProcessMemoryUsageInMiB(
-                        process)
-
-                    # The process might of forked so add the memory usage of
-                    # its children too
-                    childCount = 0
-                    for childProc in process.children(recursive=True):
-                        try:
-                            totalMemoryUsage += self._getProcessMemoryUsageInMiB(
-                                childProc)
-                            childCount += 1
-                        except psutil.NoSuchProcess:
-                            _logger.warning(
-                                'Child process disappeared whilst examining it\'s memory use')
-
-                    _logger.debug(
-                        'Total memory usage in MiB:{}'.format(totalMemoryUsage))
-                    _logger.debug(
-                        'Total number of children: {}'.format(childCount))
-
-                    if totalMemoryUsage > self.memoryLimit:
-                        _logger.warning('Memory limit reached (recorded {} MiB). Killing tool with PID {}'.format(
-                            totalMemoryUsage, process.pid))
-                        self._outOfMemory = True
-                        # Give the tool a chance to clean up after itself
-                        # before aggressively killing it
-                        self._terminateProcess(process, pause=1.0)
-                        break
-            except psutil.NoSuchProcess:
-                _logger.warning('Main process no longer available')
-
-        newThreadName = 'memory_poller-{}'.format(process.pid)
-        thread = threading.Thread(
-            target=threadBody, name=newThreadName, daemon=True)
-        thread.start()
-        return thread
+        _logger.info('Trying to kill process group:{}'.format(processGroup.pgid))
+        processGroup.signal(signal.SIGKILL)
 
     def checkToolExists(self, toolPath):
         assert os.path.isabs(toolPath)
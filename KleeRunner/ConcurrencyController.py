@@ -0,0 +1,247 @@
+# vim: set sw=4 ts=4 softtabstop=4 expandtab:
+"""
+  Adaptive control of the number of jobs that run in parallel.
+
+  The host is periodically sampled (pressure stall information, load
+  average and available memory) and the number of jobs allowed to run is
+  lowered when the host is under pressure and raised when it has spare
+  capacity. Running jobs are never killed. Lowering the limit only stops
+  new jobs from starting until enough jobs have finished.
+"""
+import logging
+import os
+import threading
+import time
+
+import psutil
+
+_logger = logging.getLogger(__name__)
+
+
+def readPressure(resource, pressureDir='/proc/pressure'):
+    """
+      Returns the ``some`` ``avg10`` value (the percentage of the last ten
+      seconds in which at least one task was stalled on ``resource``) from
+      the kernel's pressure stall information or None if it is not
+      available (e.g. the kernel is older than 4.20).
+    """
+    try:
+        with open(os.path.join(pressureDir, resource), 'r') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) == 0 or fields[0] != 'some':
+                    continue
+                for field in fields[1:]:
+                    key, _, value = field.partition('=')
+                    if key == 'avg10':
+                        return float(value)
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def sampleHost(pressureDir='/proc/pressure'):
+    """
+      Returns a dictionary describing the current load on the host. Values
+      that cannot be measured are None.
+    """
+    try:
+        loadPerCPU = os.getloadavg()[0] / (os.cpu_count() or 1)
+    except (AttributeError, OSError):
+        loadPerCPU = None
+    vm = psutil.virtual_memory()
+    return {
+        'cpu_pressure': readPressure('cpu', pressureDir),
+        'memory_pressure': readPressure('memory', pressureDir),
+        'load_per_cpu': loadPerCPU,
+        'memory_available': float(vm.available) / vm.total,
+    }
+
+
+class SlotLimiter:
+    """
+      Limits the number of jobs that run at the same time to ``limit``.
+      The limit can be changed whilst jobs are running.
+    """
+    def __init__(self, limit):
+        assert limit > 0
+        self._limit = limit
+        self._running = 0
+        self._stopped = False
+        self._cond = threading.Condition()
+
+    @property
+    def limit(self):
+        with self._cond:
+            return self._limit
+
+    @property
+    def running(self):
+        with self._cond:
+            return self._running
+
+    def setLimit(self, limit):
+        assert limit > 0
+        with self._cond:
+            self._limit = limit
+            self._cond.notify_all()
+
+    def acquire(self):
+        """
+          Block until a job may run. Returns False if ``stop()`` was
+          called before that happened. Otherwise ``release()`` must be
+          called when the job finishes.
+        """
+        with self._cond:
+            self._cond.wait_for(
+                lambda: self._stopped or self._running < self._limit)
+            if self._stopped:
+                return False
+            self._running += 1
+            return True
+
+    def release(self):
+        with self._cond:
+            assert self._running > 0
+            self._running -= 1
+            self._cond.notify_all()
+
+    def stop(self):
+        """
+          Blocked and future calls to ``acquire()`` return False.
+        """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+
+class ConcurrencyController:
+    """
+      Adjusts the limit of ``limiter`` between ``minSlots`` and
+      ``maxSlots`` every ``period`` seconds based on ``sampleFn()`` (see
+      ``sampleHost()``).
+
+      The limit is lowered by a quarter when any measurement is above its
+      high threshold and raised by an eighth (at least one) when every
+      measurement is below its low threshold and all slots are busy.
+      Pressure values are percentages, ``load_per_cpu`` is the one minute
+      load average divided by the number of CPUs and ``memory_available``
+      is a fraction of total memory. The load average reacts slowly so it
+      is only used when CPU pressure is not available.
+    """
+    def __init__(self, limiter, minSlots, maxSlots, period=10.0,
+                 sampleFn=sampleHost,
+                 cpuPressure=(10.0, 40.0),
+                 memoryPressure=(1.0, 10.0),
+                 loadPerCPU=(0.9, 1.5),
+                 memoryAvailable=(0.2, 0.1)):
+        assert isinstance(limiter, SlotLimiter)
+        assert 0 < minSlots <= maxSlots
+        assert period > 0
+        self._limiter = limiter
+        self._minSlots = minSlots
+        self._maxSlots = maxSlots
+        self._period = period
+        self._sampleFn = sampleFn
+        self._cpuPressure = cpuPressure
+        self._memoryPressure = memoryPressure
+        self._loadPerCPU = loadPerCPU
+        self._memoryAvailable = memoryAvailable
+        self._stopEvent = threading.Event()
+        self._thread = None
+        self._startTime = time.perf_counter()
+        # Statistics
+        self._numIncreases = 0
+        self._numDecreases = 0
+        self._lowestLimit = limiter.limit
+        self._highestLimit = limiter.limit
+
+    def _pressureReasons(self, sample):
+        """
+          Returns a tuple ``(overloaded, idle)`` where ``overloaded`` is a
+          list describing the measurements above their high threshold and
+          ``idle`` is True if every measurement is below its low threshold.
+        """
+        overloaded = []
+        idle = True
+
+        def check(name, value, thresholds, higherIsWorse=True):
+            nonlocal idle
+            if value is None:
+                return
+            low, high = thresholds
+            if not higherIsWorse:
+                value, low, high = -value, -low, -high
+            if value > high:
+                overloaded.append('{} {:.2f}'.format(name, abs(value)))
+            if value >= low:
+                idle = False
+
+        check('cpu_pressure', sample['cpu_pressure'], self._cpuPressure)
+        check('memory_pressure', sample['memory_pressure'], self._memoryPressure)
+        if sample['cpu_pressure'] is None:
+            check('load_per_cpu', sample['load_per_cpu'], self._loadPerCPU)
+        check('memory_available', sample['memory_available'],
+              self._memoryAvailable, higherIsWorse=False)
+        return (overloaded, idle)
+
+    def adjust(self, sample):
+        """
+          Change the limit in response to ``sample``. Returns the new
+          limit.
+        """
+        limit = self._limiter.limit
+        overloaded, idle = self._pressureReasons(sample)
+        newLimit = limit
+        reason = None
+        if len(overloaded) > 0:
+            newLimit = max(self._minSlots, limit - max(1, limit // 4))
+            reason = ', '.join(overloaded)
+        elif idle and self._limiter.running >= limit:
+            newLimit = min(self._maxSlots, limit + max(1, limit // 8))
+            reason = 'host has spare capacity'
+        if newLimit == limit:
+            _logger.debug('Keeping {} slots. Host: {}'.format(limit, sample))
+            return limit
+        _logger.info('{} slots from {} to {} ({}) at {:.1f} seconds'.format(
+            'Increasing' if newLimit > limit else 'Decreasing',
+            limit, newLimit, reason, time.perf_counter() - self._startTime))
+        if newLimit > limit:
+            self._numIncreases += 1
+        else:
+            self._numDecreases += 1
+        self._lowestLimit = min(self._lowestLimit, newLimit)
+        self._highestLimit = max(self._highestLimit, newLimit)
+        self._limiter.setLimit(newLimit)
+        return newLimit
+
+    def start(self):
+        assert self._thread is None
+
+        def threadBody():
+            while not self._stopEvent.wait(self._period):
+                try:
+                    self.adjust(self._sampleFn())
+                except Exception: # pylint: disable=broad-except
+                    _logger.warning('Failed to sample host load', exc_info=True)
+
+        self._thread = threading.Thread(
+            target=threadBody, name='concurrency_controller', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopEvent.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def stats(self):
+        return {
+            'min_slots': self._minSlots,
+            'max_slots': self._maxSlots,
+            'period': self._period,
+            'increases': self._numIncreases,
+            'decreases': self._numDecreases,
+            'lowest_limit': self._lowestLimit,
+            'highest_limit': self._highestLimit,
+            'final_limit': self._limiter.limit,
+        }
@@ -0,0 +1,369 @@
+# vim: set sw=4 ts=4 softtabstop=4 expandtab:
+"""
+  Distribution of the jobs of a batch run over several hosts.
+
+  A coordinator owns the tasks (lists of invocation indices that must be
+  run sequentially) and workers lease tasks from it over TCP, run them and
+  send back the result of each job. Leases must be renewed by the worker
+  before they expire. If a worker dies its leases expire and the jobs of
+  the task that have no result are given to another worker.
+
+  Messages are single lines of JSON. A client opens a connection, sends one
+  request and reads one reply. The protocol is not authenticated so the
+  coordinator should only listen on a trusted network.
+"""
+import collections
+import itertools
+import json
+import logging
+import socket
+import socketserver
+import threading
+import time
+
+_logger = logging.getLogger(__name__)
+
+# Largest message that will be accepted
+_MAX_MESSAGE_SIZE = 64 * (2**20)
+
+
+class CoordinatorException(Exception):
+    def __init__(self, msg):
+        # pylint: disable=super-init-not-called
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+
+def parseAddress(address):
+    """
+      Parse a ``HOST:PORT`` string into a ``(host, port)`` tuple.
+    """
+    host, sep, port = address.rpartition(':')
+    if sep == '' or host == '':
+        raise CoordinatorException(
+            'Address "{}" must be of the form HOST:PORT'.format(address))
+    try:
+        port = int(port)
+    except ValueError:
+        raise CoordinatorException('Invalid port in "{}"'.format(address))
+    return (host, port)
+
+
+class Lease:
+    """
+      A task given to a worker. ``remaining`` holds the indices that do not
+      have a result yet.
+    """
+    def __init__(self, leaseId, taskNumber, indices, workerId, expiry):
+        self.leaseId = leaseId
+        self.taskNumber = taskNumber
+        self.indices = indices
+        self.remaining = list(indices)
+        self.workerId = workerId
+        self.expiry = expiry
+
+
+class JobCoordinator:
+    """
+      Hands out tasks to workers under leases and collects their results.
+
+      tasks: Iterable of tasks (lists of invocation indices). It is consumed
+             lazily.
+      invocationInfos: List of InvocationInfo objects
+      onResult: Called with ``(index, rawResultInfo)`` for every accepted
+                result. Calls are serialised.
+      leaseTimeout: Seconds a worker has to renew a lease
+    """
+    def __init__(self, tasks, invocationInfos, onResult, leaseTimeout=300.0,
+                 clock=time.monotonic):
+        assert leaseTimeout > 0
+        self._tasks = iter(tasks)
+        self._tasksExhausted = False
+        self._taskCounter = itertools.count()
+        self._invocationInfos = invocationInfos
+        self._onResult = onResult
+        self._leaseTimeout = leaseTimeout
+        self._clock = clock
+        self._cond = threading.Condition()
+        # Tasks (or what remains of them) to hand out before taking more
+        # from ``tasks``. E.g. those whose lease expired.
+        self._requeued = collections.deque()
+        self._leases = dict() # Maps lease id to Lease
+        self._leaseCounter = itertools.count()
+        self._stopped = False
+        # Every worker that has asked for work
+        self._seenWorkers = set()
+        # Workers that are believed to be alive
+        self._workers = set()
+        # Workers that have been told there is no more work
+        self._finishedWorkers = set()
+        self.numExpiredLeases = 0
+        self.numResults = 0
+
+    @property
+    def leaseTimeout(self):
+        return self._leaseTimeout
+
+    @property
+    def workers(self):
+        with self._cond:
+            return set(self._seenWorkers)
+
+    def _nextTask(self):
+        if len(self._requeued) > 0:
+            return self._requeued.popleft()
+        if self._tasksExhausted:
+            return None
+        try:
+            return (next(self._taskCounter), list(next(self._tasks)))
+        except StopIteration:
+            self._tasksExhausted = True
+            return None
+
+    def _isFinished(self):
+        if self._stopped:
+            return True
+        if (not self._tasksExhausted and len(self._requeued) == 0 and
+                len(self._leases) == 0):
+            # Find out if the tasks have run out
+            task = self._nextTask()
+            if task is not None:
+                self._requeued.append(task)
+        return (self._tasksExhausted and len(self._requeued) == 0 and
+                len(self._leases) == 0)
+
+    def lease(self, workerId, maxTasks=1):
+        """
+          Lease up to ``maxTasks`` tasks to ``workerId``.
+
+          Returns a tuple ``(leases, finished)`` where ``leases`` is a list of
+          dictionaries describing the leased tasks (including the raw
+          invocation info of each index) and ``finished`` is True when there
+          is no more work and the worker should exit.
+        """
+        assert maxTasks > 0
+        self.expireLeases()
+        leases = []
+        with self._cond:
+            self._workers.add(workerId)
+            self._seenWorkers.add(workerId)
+            while not self._stopped and len(leases) < maxTasks:
+                task = self._nextTask()
+                if task is None:
+                    break
+                taskNumber, indices = task
+                lease = Lease(next(self._leaseCounter), taskNumber, indices,
+                              workerId, self._clock() + self._leaseTimeout)
+                self._leases[lease.leaseId] = lease
+                _logger.debug('Leased task {} ({}) to {} as lease {}'.format(
+                    taskNumber, indices, workerId, lease.leaseId))
+                leases.append({
+                    'lease': lease.leaseId,
+                    'indices': indices,
+                    'invocation_infos': [
+                        self._invocationInfos[i].GetInternalRepr() for i in indices],
+                })
+            # Note that the worker is told to exit only if there is no work
+            # that could be requeued in the future.
+            finished = len(leases) == 0 and self._isFinished()
+            if finished:
+                self._finishedWorkers.add(workerId)
+                self._cond.notify_all()
+            return (leases, finished)
+
+    def renew(self, workerId, leaseIds):
+        """
+          Renew the leases ``leaseIds`` held by ``workerId``. Returns the
+          list of lease ids that are no longer valid (e.g. because they
+          expired and were given to another worker).
+        """
+        invalid = []
+        with self._cond:
+            expiry = self._clock() + self._leaseTimeout
+            for leaseId in leaseIds:
+                lease = self._leases.get(leaseId, None)
+                if lease is None or lease.workerId != workerId:
+                    invalid.append(leaseId)
+                    continue
+                lease.expiry = expiry
+        return invalid
+
+    def complete(self, workerId, leaseId, index, result):
+        """
+          Record the result of job ``index`` run under lease ``leaseId``.
+          Returns False if the result was rejected because the lease is no
+          longer valid.
+        """
+        with self._cond:
+            if self._stopped:
+                return False
+            lease = self._leases.get(leaseId, None)
+            if lease is None or lease.workerId != workerId or index not in lease.remaining:
+                _logger.warning('Rejecting result for index {} from {} (lease {} is not valid)'.format(
+                    index, workerId, leaseId))
+                return False
+            lease.remaining.remove(index)
+            if len(lease.remaining) == 0:
+                del self._leases[leaseId]
+            self.numResults += 1
+            self._onResult(index, result)
+            self._cond.notify_all()
+            return True
+
+    def expireLeases(self):
+        """
+          Requeue the jobs of leases that have expired. Returns the number of
+          leases that expired.
+        """
+        with self._cond:
+            now = self._clock()
+            expired = [l for l in self._leases.values() if l.expiry <= now]
+            for lease in expired:
+                del self._leases[lease.leaseId]
+                # Assume the worker is dead. It is added back if it asks
+                # for more work.
+                self._workers.discard(lease.workerId)
+                _logger.warning('Lease {} held by {} expired. Requeuing {}'.format(
+                    lease.leaseId, lease.workerId, lease.remaining))
+                self._requeued.append((lease.taskNumber, lease.remaining))
+            self.numExpiredLeases += len(expired)
+            return len(expired)
+
+    def stop(self):
+        """
+          Stop handing out tasks. Workers are told to exit.
+        """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    def waitUntilFinished(self, timeout=None):
+        """
+          Returns True if every task has a result or ``stop()`` was called.
+        """
+        with self._cond:
+            return self._cond.wait_for(self._isFinished, timeout=timeout)
+
+    def waitForWorkers(self, timeout):
+        """
+          Wait for every worker to be told that there is no more work so
+          they do not try to contact a coordinator that has gone away.
+          Returns True if they were all told before ``timeout`` seconds.
+        """
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: self._workers <= self._finishedWorkers, timeout=timeout)
+
+    def unfinishedTasks(self):
+        """
+          Returns the tasks (lists of indices) that do not have a result.
+          Should only be used after ``stop()``.
+        """
+        with self._cond:
+            tasks = [lease.remaining for lease in self._leases.values()]
+            tasks.extend(indices for _, indices in self._requeued)
+            if not self._tasksExhausted:
+                tasks.extend(list(t) for t in self._tasks)
+            return [t for t in tasks if len(t) > 0]
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            line = self.rfile.readline(_MAX_MESSAGE_SIZE)
+            request = json.loads(line.decode('utf-8'))
+            reply = self.server.handleRequest(request)
+        except Exception as e: # pylint: disable=broad-except
+            _logger.warning('Bad request from {}: {}'.format(self.client_address, e))
+            reply = {'error': str(e)}
+        self.wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+
+
+class CoordinatorServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """
+      Serves ``coordinator`` to workers at ``address``. ``config`` is the
+      runner configuration given to workers when they connect.
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, coordinator, address, config):
+        assert isinstance(coordinator, JobCoordinator)
+        self._coordinator = coordinator
+        self._config = config
+        socketserver.TCPServer.__init__(self, address, _RequestHandler)
+
+    def handleRequest(self, request):
+        requestType = request['type']
+        workerId = request['worker']
+        if requestType == 'hello':
+            _logger.info('Worker {} connected'.format(workerId))
+            return {
+                'config': self._config,
+                'lease_timeout': self._coordinator.leaseTimeout,
+            }
+        if requestType == 'lease':
+            leases, finished = self._coordinator.lease(
+                workerId, int(request.get('max', 1)))
+            return {'leases': leases, 'finished': finished}
+        if requestType == 'renew':
+            return {'invalid': self._coordinator.renew(workerId, request['leases'])}
+        if requestType == 'result':
+            accepted = self._coordinator.complete(
+                workerId, request['lease'], request['index'], request['result'])
+            return {'accepted': accepted}
+        raise CoordinatorException('Unknown request type "{}"'.format(requestType))
+
+
+class CoordinatorClient:
+    """
+      Used by workers to talk to a ``CoordinatorServer``.
+    """
+    def __init__(self, address, workerId, timeout=60.0):
+        self._address = address
+        self._workerId = workerId
+        self._timeout = timeout
+
+    @property
+    def workerId(self):
+        return self._workerId
+
+    def _request(self, request):
+        request['worker'] = self._workerId
+        with socket.create_connection(self._address, timeout=self._timeout) as sock:
+            sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+            with sock.makefile('rb') as f:
+                line = f.readline(_MAX_MESSAGE_SIZE)
+        if len(line) == 0:
+            raise CoordinatorException('Coordinator closed the connection')
+        reply = json.loads(line.decode('utf-8'))
+        if 'error' in reply:
+            raise CoordinatorException(
+                'Coordinator reported error: {}'.format(reply['error']))
+        return reply
+
+    def hello(self):
+        """
+          Returns a tuple ``(config, leaseTimeout)``.
+        """
+        reply = self._request({'type': 'hello'})
+        return (reply['config'], reply['lease_timeout'])
+
+    def lease(self, maxTasks=1):
+        """
+          Returns a tuple ``(leases, finished)``. See ``JobCoordinator.lease()``.
+        """
+        reply = self._request({'type': 'lease', 'max': maxTasks})
+        return (reply['leases'], reply['finished'])
+
+    def renew(self, leaseIds):
+        return self._request({'type': 'renew', 'leases': list(leaseIds)})['invalid']
+
+    def sendResult(self, leaseId, index, result):
+        return self._request({
+            'type': 'result',
+            'lease': leaseId,
+            'index': index,
+            'result': result})['accepted']
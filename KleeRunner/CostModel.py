@@ -0,0 +1,173 @@
+# vim: set sw=4 ts=4 softtabstop=4 expandtab:
+"""
+  Predict the cost (wallclock time) of jobs from the results of a previous
+  run so that batch runs can be scheduled longest processing time first.
+"""
+import heapq
+import logging
+from . import ResultInfo
+
+_logger = logging.getLogger(__name__)
+
+
+def _median(values):
+    assert len(values) > 0
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2 == 1:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def _asList(value):
+    if isinstance(value, list):
+        return value
+    return [value]
+
+
+def invocationKey(rawInvocationInfo):
+    """
+      Key used to identify an invocation across runs.
+    """
+    return (rawInvocationInfo['program'],
+            rawInvocationInfo.get('ktest_file', None),
+            tuple(rawInvocationInfo['command_line_arguments']))
+
+
+class CostModel:
+    """
+      Predicts the wallclock time of jobs.
+
+      Predictions use the following in order of preference
+
+      * The observed time of the same invocation (program, ktest file and
+        arguments) in the history.
+      * The median observed time of other invocations of the same program.
+      * The median observed time of all invocations in the history.
+      * ``timeLimit`` if there is no history.
+
+      Jobs that hit the backend timeout in the history are predicted to take
+      at least ``timeLimit``. A job that ran out of memory was killed early
+      so the time it took is only a lower bound. Such runs are not used as
+      observed times and invocations that always ran out of memory are
+      predicted as if they had no history but to take at least that long.
+    """
+    def __init__(self, timeLimit=0):
+        assert isinstance(timeLimit, (int, float))
+        assert timeLimit >= 0
+        self._timeLimit = float(timeLimit)
+        self._exact = dict() # Maps invocation key to predicted cost
+        self._byProgram = dict() # Maps program to list of observed costs
+        self._lowerBounds = dict() # Maps invocation key to minimum cost
+        self._fallback = None
+        self.numOutOfMemory = 0
+        self.numTimeouts = 0
+
+    @property
+    def timeLimit(self):
+        return self._timeLimit
+
+    def addResult(self, rawResultInfo):
+        """
+          Add a raw ResultInfo (which may be in the merged format) to the
+          history. Error results are ignored.
+        """
+        if 'error' in rawResultInfo:
+            return
+        wallclockTimes = _asList(rawResultInfo['wallclock_time'])
+        timeouts = _asList(rawResultInfo.get('backend_timeout', False))
+        outOfMemory = _asList(rawResultInfo.get('out_of_memory', False))
+        if len(timeouts) != len(wallclockTimes):
+            timeouts = [timeouts[0]] * len(wallclockTimes)
+        if len(outOfMemory) != len(wallclockTimes):
+            outOfMemory = [outOfMemory[0]] * len(wallclockTimes)
+        costs = []
+        lowerBound = 0.0
+        for wallclockTime, timeout, oom in zip(wallclockTimes, timeouts, outOfMemory):
+            cost = float(wallclockTime)
+            if timeout:
+                # The job was killed so it would have run for at least this
+                # long.
+                cost = max(cost, self._timeLimit)
+                self.numTimeouts += 1
+            elif oom:
+                # The job was killed before it finished
+                lowerBound = max(lowerBound, cost)
+                self.numOutOfMemory += 1
+                continue
+            costs.append(cost)
+        key = invocationKey(rawResultInfo['invocation_info'])
+        if len(costs) == 0:
+            self._exact.pop(key, None)
+            self._lowerBounds[key] = lowerBound
+            return
+        cost = sum(costs) / len(costs)
+        self._lowerBounds.pop(key, None)
+        self._exact[key] = cost
+        self._byProgram.setdefault(key[0], []).append(cost)
+        self._fallback = None
+
+    def addResultInfos(self, resultInfos):
+        """
+          Add all the results of raw ResultInfos (i.e. the dictionary
+          stored in a ResultInfo file) to the history.
+        """
+        for r in resultInfos['results']:
+            self.addResult(r)
+
+    @property
+    def numKnownInvocations(self):
+        return len(self._exact) + len(self._lowerBounds)
+
+    def predict(self, rawInvocationInfo):
+        """
+          Returns a tuple ``(cost, source)`` where ``cost`` is the predicted
+          wallclock time in seconds and ``source`` is one of ``"exact"``,
+          ``"program"`` or ``"fallback"``.
+        """
+        key = invocationKey(rawInvocationInfo)
+        if key in self._exact:
+            return (self._exact[key], 'exact')
+        lowerBound = self._lowerBounds.get(key, 0.0)
+        if key[0] in self._byProgram:
+            return (max(lowerBound, _median(self._byProgram[key[0]])), 'program')
+        if self._fallback is None:
+            if len(self._exact) > 0:
+                self._fallback = _median(list(self._exact.values()))
+            else:
+                self._fallback = self._timeLimit
+        return (max(lowerBound, self._fallback), 'fallback')
+
+
+def loadCostModel(path, timeLimit=0):
+    """
+      Create a ``CostModel`` from the ResultInfo file at ``path``.
+    """
+    model = CostModel(timeLimit)
+    with open(path, 'r') as f:
+        model.addResultInfos(ResultInfo.loadRawResultInfos(f))
+    _logger.info('Loaded history for {} invocations ({} timeouts, {} out of memory)'.format(
+        model.numKnownInvocations, model.numTimeouts, model.numOutOfMemory))
+    return model
+
+
+def longestProcessingTimeFirst(taskCosts):
+    """
+      Given a list of ``(task, cost)`` tuples return a new list sorted so that
+      the most costly tasks are first. Ties keep their original order.
+    """
+    return sorted(taskCosts, key=lambda tc: tc[1], reverse=True)
+
+
+def predictMakespan(costs, numWorkers):
+    """
+      Predict the makespan of running tasks with ``costs`` (in dispatch
+      order) on ``numWorkers`` workers where each task is started on the
+      first worker to become free.
+    """
+    assert numWorkers > 0
+    workers = [0.0] * numWorkers
+    for cost in costs:
+        earliest = heapq.heappop(workers)
+        heapq.heappush(workers, earliest + cost)
+    return max(workers)
@@ -0,0 +1,248 @@
+# vim: set sw=4 ts=4 softtabstop=4 expandtab:
+"""
+  The CPU topology of the host (SMT siblings, last level caches and NUMA
+  nodes) read from sysfs and an allocator that uses it to pin jobs.
+
+  The allocator hands out whole cores so that jobs do not share a core
+  through SMT and keeps all the CPUs of a job in one last level cache
+  (LLC) or, failing that, one NUMA node so that the job's memory can be
+  bound to that node.
+"""
+import logging
+import os
+
+_logger = logging.getLogger(__name__)
+
+
+def parseCpuList(text):
+    """
+      Parse a list in the kernel's format (e.g. ``0-3,8,10-11``). Returns
+      a set of integers.
+    """
+    result = set()
+    for part in text.strip().split(','):
+        if len(part) == 0:
+            continue
+        if '-' in part:
+            first, last = part.split('-')
+            result.update(range(int(first), int(last) + 1))
+        else:
+            result.add(int(part))
+    return result
+
+
+def formatCpuList(ids):
+    """
+      The inverse of ``parseCpuList()``.
+    """
+    ranges = []
+    for i in sorted(ids):
+        if len(ranges) > 0 and ranges[-1][1] == i - 1:
+            ranges[-1][1] = i
+        else:
+            ranges.append([i, i])
+    return ','.join(str(first) if first == last else '{}-{}'.format(first, last)
+                    for first, last in ranges)
+
+
+def _readFile(path):
+    try:
+        with open(path, 'r') as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+class CpuTopology:
+    """
+      Topology of the online CPUs read from ``sysfsRoot`` (normally
+      ``/sys/devices/system``). For every CPU id it records the
+      set of CPUs in the same core (``core``), sharing the same last level
+      cache (``llc``) and the NUMA node it is in (``node``).
+    """
+    def __init__(self, sysfsRoot='/sys/devices/system'):
+        self.core = dict()
+        self.llc = dict()
+        self.node = dict()
+        cpuRoot = os.path.join(sysfsRoot, 'cpu')
+        online = _readFile(os.path.join(cpuRoot, 'online'))
+        if online is not None:
+            cpuIds = parseCpuList(online)
+        else:
+            cpuIds = set(int(name[3:]) for name in os.listdir(cpuRoot)
+                         if name.startswith('cpu') and name[3:].isdigit())
+        if len(cpuIds) == 0:
+            raise Exception('Found no CPUs in "{}"'.format(cpuRoot))
+
+        for cpuId in cpuIds:
+            cpuDir = os.path.join(cpuRoot, 'cpu{}'.format(cpuId))
+            siblings = _readFile(os.path.join(cpuDir, 'topology', 'thread_siblings_list'))
+            self.core[cpuId] = frozenset(
+                parseCpuList(siblings) if siblings is not None else [cpuId])
+            self.llc[cpuId] = frozenset(self._readLastLevelCache(cpuDir, cpuId))
+
+        # Machines without NUMA have no node directory. Everything is in
+        # node 0.
+        nodeRoot = os.path.join(sysfsRoot, 'node')
+        if os.path.isdir(nodeRoot):
+            for name in os.listdir(nodeRoot):
+                if not (name.startswith('node') and name[4:].isdigit()):
+                    continue
+                cpuList = _readFile(os.path.join(nodeRoot, name, 'cpulist'))
+                if cpuList is None:
+                    continue
+                for cpuId in parseCpuList(cpuList):
+                    if cpuId in cpuIds:
+                        self.node[cpuId] = int(name[4:])
+        for cpuId in cpuIds:
+            self.node.setdefault(cpuId, 0)
+
+    def _readLastLevelCache(self, cpuDir, cpuId):
+        # Returns the CPUs sharing the highest level data or unified cache
+        # of ``cpuId``. If the caches are not described the CPUs in the
+        # same package are used.
+        bestLevel = -1
+        shared = None
+        cacheDir = os.path.join(cpuDir, 'cache')
+        if os.path.isdir(cacheDir):
+            for name in os.listdir(cacheDir):
+                if not name.startswith('index'):
+                    continue
+                if _readFile(os.path.join(cacheDir, name, 'type')) == 'Instruction':
+                    continue
+                level = _readFile(os.path.join(cacheDir, name, 'level'))
+                cpuList = _readFile(os.path.join(cacheDir, name, 'shared_cpu_list'))
+                if level is None or cpuList is None:
+                    continue
+                if int(level) > bestLevel:
+                    bestLevel = int(level)
+                    shared = parseCpuList(cpuList)
+        if shared is None:
+            package = _readFile(os.path.join(cpuDir, 'topology', 'package_cpus_list'))
+            if package is None:
+                package = _readFile(os.path.join(cpuDir, 'topology', 'core_siblings_list'))
+            shared = parseCpuList(package) if package is not None else set([cpuId])
+        return shared
+
+    @property
+    def cpus(self):
+        return set(self.core.keys())
+
+
+class CpuAllocator:
+    """
+      Allocates ``cpusPerJob`` of the CPUs in ``availableCpuIds`` to each
+      job using ``topology``.
+
+      If ``wholeCores`` is True each job gets ``cpusPerJob`` cores. Only
+      one CPU of each core is used and its SMT siblings are left idle so
+      that timings are not disturbed by another job. Otherwise the CPUs of
+      a core are given to the same job where possible.
+
+      The CPUs of a job are taken from a single LLC if possible, otherwise
+      from a single NUMA node. If ``sameNode`` is False they may be spread
+      over nodes as a last resort.
+    """
+    def __init__(self, topology, availableCpuIds, cpusPerJob, wholeCores=False, sameNode=False):
+        assert isinstance(cpusPerJob, int) and cpusPerJob > 0
+        unknown = set(availableCpuIds) - topology.cpus
+        if len(unknown) > 0:
+            raise Exception(
+                'CPUs {} are not online on this system'.format(sorted(unknown)))
+        self._topology = topology
+        self._available = frozenset(availableCpuIds)
+        self._cpusPerJob = cpusPerJob
+        self._wholeCores = wholeCores
+        self._sameNode = sameNode
+        self._free = set(self._available)
+        # Maps the CPUs given to a job to all the CPUs it reserved
+        self._allocations = dict()
+
+        # Groups of CPUs tried in order of preference
+        # An LLC that spans NUMA nodes is split so that groups never do
+        llcs = set(frozenset(other for other in topology.llc[c] & self._available
+                             if topology.node[other] == topology.node[c])
+                   for c in self._available)
+        nodes = dict()
+        for cpuId in self._available:
+            nodes.setdefault(topology.node[cpuId], set()).add(cpuId)
+        self._groups = [
+            sorted(llcs, key=min),
+            sorted((frozenset(cpus) for cpus in nodes.values()), key=min),
+        ]
+        if not sameNode:
+            self._groups.append([self._available])
+        for cpuId in sorted(self._available):
+            _logger.info('CPU {} (core {}, LLC {}, NUMA node {}) is in the resource pool'.format(
+                cpuId, formatCpuList(self._core(cpuId)),
+                formatCpuList(topology.llc[cpuId] & self._available),
+                topology.node[cpuId]))
+
+    def _core(self, cpuId):
+        return self._topology.core[cpuId] & self._available
+
+    @property
+    def maxJobs(self):
+        """
+          The number of jobs that can have CPUs at the same time (ignoring
+          fragmentation).
+        """
+        if self._wholeCores:
+            return len(set(self._core(c) for c in self._available)) // self._cpusPerJob
+        return len(self._available) // self._cpusPerJob
+
+    def _pick(self, group):
+        # Returns (cpus used, cpus reserved) for a job from ``group`` or
+        # None if it does not have enough free CPUs.
+        used = []
+        reserved = set()
+        cores = sorted(set(self._core(c) for c in group), key=min)
+        # Take idle cores before the remaining CPUs of partly used cores
+        cores.sort(key=lambda core: not core.issubset(self._free))
+        for core in cores:
+            if len(used) == self._cpusPerJob:
+                break
+            freeCpus = sorted(core & self._free)
+            if self._wholeCores:
+                if len(freeCpus) != len(core):
+                    continue
+                used.append(freeCpus[0])
+                reserved.update(freeCpus)
+            else:
+                freeCpus = freeCpus[:self._cpusPerJob - len(used)]
+                used.extend(freeCpus)
+                reserved.update(freeCpus)
+        if len(used) < self._cpusPerJob:
+            return None
+        return (used, reserved)
+
+    def allocate(self):
+        """
+          Returns the set of CPU ids for a job. Raises an exception if there
+          are not enough free CPUs.
+        """
+        for groups in self._groups:
+            # Use the group with the fewest free CPUs that fits the job to
+            # leave large groups for later jobs.
+            candidates = []
+            for group in groups:
+                picked = self._pick(group)
+                if picked is not None:
+                    candidates.append((len(group & self._free), min(group), picked))
+            if len(candidates) == 0:
+                continue
+            _, _, (used, reserved) = min(candidates, key=lambda c: (c[0], c[1]))
+            self._free.difference_update(reserved)
+            self._allocations[frozenset(used)] = reserved
+            return set(used)
+        raise Exception('Failed to retrieve CPU resources required for job')
+
+    def release(self, cpuIds):
+        """
+          Return the CPUs given to a job by ``allocate()``.
+        """
+        try:
+            reserved = self._allocations.pop(frozenset(cpuIds))
+        except KeyError:
+            raise Exception('Failed to return CPUs {} to pool'.format(sorted(cpuIds)))
+        self._free.update(reserved)
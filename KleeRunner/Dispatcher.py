@@ -0,0 +1,89 @@
+# vim: set sw=4 ts=4 softtabstop=4 expandtab:
+"""
+  Submission of tasks to an executor with a bounded number of futures
+  in flight.
+"""
+import concurrent.futures
+import logging
+
+_logger = logging.getLogger(__name__)
+
+# Returned by a task iterator when no task can be submitted until a task
+# that is in flight completes.
+NOT_READY = object()
+
+
+class WindowedDispatcher:
+    """
+      Submits tasks to ``executor`` pulling them from an iterator as slots
+      free up so that at most ``maxInFlight`` futures exist at any time.
+      This keeps memory and bookkeeping proportional to ``maxInFlight``
+      rather than to the total number of tasks.
+
+      A task is any object with a ``run()`` method. The task iterator may
+      return ``NOT_READY`` to indicate that no more tasks should be
+      submitted until an in flight task completes.
+    """
+    def __init__(self, executor, maxInFlight):
+        assert isinstance(maxInFlight, int)
+        assert maxInFlight > 0
+        self._executor = executor
+        self._maxInFlight = maxInFlight
+        self._stopped = False
+        # Maps in flight futures to their task. Note this dictionary
+        # is modified in place so it can be used for cancellation.
+        self.futureToTask = dict()
+
+    @property
+    def maxInFlight(self):
+        return self._maxInFlight
+
+    @property
+    def stopped(self):
+        return self._stopped
+
+    def stop(self):
+        """
+          Stop submitting new tasks. Tasks that are already in flight are
+          not affected.
+        """
+        self._stopped = True
+
+    def _submit(self, tasks):
+        while not self._stopped and len(self.futureToTask) < self._maxInFlight:
+            try:
+                task = next(tasks)
+            except StopIteration:
+                return
+            if task is NOT_READY:
+                return
+            future = self._executor.submit(task.run)
+            self.futureToTask[future] = task
+
+    def run(self, tasks, onComplete):
+        """
+          Run ``tasks`` (an iterable). ``onComplete(future, task)`` is called
+          from the calling thread for every submitted task once its future is
+          done (this includes cancelled futures).
+
+          Returns an iterator over the tasks that were never submitted
+          because ``stop()`` was called.
+
+          Raises ``RuntimeError`` if the iterator returns ``NOT_READY`` when
+          no tasks are in flight.
+        """
+        tasks = iter(tasks)
+        self._submit(tasks)
+        while len(self.futureToTask) > 0:
+            done, _ = concurrent.futures.wait(
+                list(self.futureToTask.keys()),
+                return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                task = self.futureToTask.pop(future)
+                onComplete(future, task)
+            self._submit(tasks)
+        # Nothing is in flight so submission can only have stopped early if
+        # the remaining tasks are waiting on something that will never happen
+        if not self._stopped and next(tasks, None) is NOT_READY:
+            raise RuntimeError('Tasks are not ready but none are in flight')
+        return tasks
@@ -64,6 +64,18 @@ def loadRunnerConfig(configFilePath):
     return (config, True)
 
 
+def checkRepeatSupported(config, repeat):
+    """
+      Returns False (and logs why) if invocations cannot be repeated
+      ``repeat`` times with the runner configuration ``config``.
+    """
+    if repeat > 1 and 'result_cache' in config.get('runner_config', {}):
+        # Repetitions would be answered from the cache rather than measured
+        _logger.error('--repeat cannot be used with a runner that uses "result_cache"')
+        return False
+    return True
+
+
 def setupWorkingDirectory(workingDir):
     # Setup the working directory
     absWorkDir = os.path.abspath(workingDir)
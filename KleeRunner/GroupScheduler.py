@@ -0,0 +1,154 @@
+# vim: set sw=4 ts=4 softtabstop=4 expandtab:
+"""
+  Scheduling of groups of jobs (``sequential_execution_indices``) that may
+  depend on each other.
+
+  Groups are identified by their position in ``sequential_execution_indices``.
+  The optional ``sequential_execution_dependencies`` in the invocation info
+  ``misc`` is a list with an entry for every group. Each entry is a list of
+  the groups that must finish before the group may start.
+"""
+import heapq
+import logging
+from . import Dispatcher
+
+_logger = logging.getLogger(__name__)
+
+
+class GroupSchedulerException(Exception):
+    def __init__(self, msg):
+        # pylint: disable=super-init-not-called
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+
+def validateDependencies(dependencies, numGroups):
+    """
+      Check that ``dependencies`` is well formed for ``numGroups`` groups
+      and is acyclic. Raises ``GroupSchedulerException`` if it is not.
+    """
+    if not isinstance(dependencies, list):
+        raise GroupSchedulerException('Group dependencies must be a list')
+    if len(dependencies) != numGroups:
+        raise GroupSchedulerException(
+            'Group dependencies has {} entries but there are {} groups'.format(
+                len(dependencies), numGroups))
+    for group, deps in enumerate(dependencies):
+        if not isinstance(deps, list):
+            raise GroupSchedulerException(
+                'Dependencies of group {} must be a list'.format(group))
+        for dep in deps:
+            if not isinstance(dep, int) or dep < 0 or dep >= numGroups:
+                raise GroupSchedulerException(
+                    'Group {} depends on invalid group "{}"'.format(group, dep))
+            if dep == group:
+                raise GroupSchedulerException(
+                    'Group {} depends on itself'.format(group))
+    order = topologicalOrder([0] * numGroups, dependencies)
+    if len(order) != numGroups:
+        cycle = sorted(set(range(0, numGroups)).difference(order))
+        raise GroupSchedulerException(
+            'Group dependencies contain a cycle involving groups {}'.format(cycle))
+
+
+def _dependents(dependencies):
+    dependents = [[] for _ in dependencies]
+    for group, deps in enumerate(dependencies):
+        for dep in set(deps):
+            dependents[dep].append(group)
+    return dependents
+
+
+def topologicalOrder(priorities, dependencies):
+    """
+      Returns the groups in an order where every group comes after the
+      groups it depends on. Among groups whose dependencies have been
+      placed the one with the highest priority (ties broken by the lowest
+      group number) is placed first. If there is a cycle the groups in it
+      are missing from the returned list.
+    """
+    assert len(priorities) == len(dependencies)
+    numUnplaced = [len(set(deps)) for deps in dependencies]
+    dependents = _dependents(dependencies)
+    ready = [(-priorities[g], g) for g, n in enumerate(numUnplaced) if n == 0]
+    heapq.heapify(ready)
+    order = []
+    while len(ready) > 0:
+        _, group = heapq.heappop(ready)
+        order.append(group)
+        for dependent in dependents[group]:
+            numUnplaced[dependent] -= 1
+            if numUnplaced[dependent] == 0:
+                heapq.heappush(ready, (-priorities[dependent], dependent))
+    return order
+
+
+class GroupScheduler:
+    """
+      An iterator over the group numbers of groups that are ready to run.
+      A group is ready once every group it depends on has finished
+      (regardless of whether its jobs had errors). Among ready groups the
+      one with the highest priority is returned first.
+
+      When groups are waiting on groups that have not finished the iterator
+      returns ``Dispatcher.NOT_READY`` so it can be used with
+      ``Dispatcher.WindowedDispatcher``. ``taskFinished()`` must be called
+      when each group finishes.
+
+      tasks: List of groups (lists of invocation indices). Empty groups are
+             treated as already finished (e.g. when resuming).
+      priorities: List with the priority of each group
+      dependencies: See ``validateDependencies()``
+    """
+    def __init__(self, tasks, priorities, dependencies):
+        assert len(tasks) == len(priorities) == len(dependencies)
+        self._tasks = tasks
+        self._priorities = priorities
+        self._dependents = _dependents(dependencies)
+        self._numWaitingOn = [len(set(deps)) for deps in dependencies]
+        self._ready = []
+        self._numUnscheduled = len(tasks)
+        self._scheduled = [False] * len(tasks)
+        # Find the initial groups first because marking an empty group ready
+        # can make its dependents ready too.
+        initial = [g for g, n in enumerate(self._numWaitingOn) if n == 0]
+        for group in initial:
+            self._markReady(group)
+
+    def _markReady(self, group):
+        if len(self._tasks[group]) == 0:
+            # Nothing to run
+            self._scheduled[group] = True
+            self._numUnscheduled -= 1
+            self.taskFinished(group)
+            return
+        heapq.heappush(self._ready, (-self._priorities[group], group))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if len(self._ready) > 0:
+            _, group = heapq.heappop(self._ready)
+            self._scheduled[group] = True
+            self._numUnscheduled -= 1
+            return group
+        if self._numUnscheduled == 0:
+            raise StopIteration()
+        return Dispatcher.NOT_READY
+
+    def taskFinished(self, group):
+        for dependent in self._dependents[group]:
+            self._numWaitingOn[dependent] -= 1
+            if self._numWaitingOn[dependent] == 0:
+                self._markReady(dependent)
+
+    def unscheduledTasks(self):
+        """
+          Returns the group numbers of non empty groups that have not been
+          returned by the iterator.
+        """
+        return [g for g, scheduled in enumerate(self._scheduled)
+                if not scheduled and len(self._tasks[g]) > 0]
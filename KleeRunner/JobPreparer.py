@@ -0,0 +1,250 @@
+# vim: set sw=4 ts=4 softtabstop=4 expandtab:
+"""
+  Just in time creation of runners for a batch run.
+
+  Creating a runner involves creating its working directory and
+  initialising its backend which can be expensive. Rather than creating
+  every runner before the first job starts, runners are created when they
+  are needed with a small number of tasks being prepared ahead of time in
+  a background thread.
+"""
+import logging
+import os
+import shutil
+import threading
+import traceback
+from . import WorkDirLayout
+
+_logger = logging.getLogger(__name__)
+
+
+class PreparedJob:
+    """
+      The runner for a single invocation index or the error (a formatted
+      traceback) that occurred whilst trying to create it.
+    """
+    def __init__(self, index, runner, error):
+        assert isinstance(index, int)
+        assert (runner is None) != (error is None)
+        self.index = index
+        self.runner = runner
+        self.error = error
+
+
+class JobPreparer:
+    """
+      Creates runners and their working directories for invocation indices.
+    """
+    def __init__(self, invocationInfos, workDirsRoot, runnerClass, runnerConfig,
+                 ctx, removeExisting=False, layout=None):
+        """
+          invocationInfos: List (or dictionary keyed by index) of
+                           InvocationInfo objects
+          workDirsRoot: Absolute path to the directory to create working
+                        directories in
+          runnerClass: Class of the runner to create
+          runnerConfig: The runner configuration dictionary
+          ctx: RunnerContext shared by all runners
+          removeExisting: If True remove any existing working directory for a
+                          job rather than failing.
+          layout: WorkDirLayout used to create working directories. The
+                  flat layout is used if None.
+        """
+        assert isinstance(invocationInfos, (list, dict))
+        assert os.path.isabs(workDirsRoot)
+        assert isinstance(runnerConfig, dict)
+        self._invocationInfos = invocationInfos
+        self._workDirsRoot = workDirsRoot
+        self._runnerClass = runnerClass
+        self._runnerConfig = runnerConfig
+        self._ctx = ctx
+        self._removeExisting = removeExisting
+        if layout is None:
+            layout = WorkDirLayout.WorkDirLayout(workDirsRoot)
+        self._layout = layout
+
+    def workingDirectory(self, index):
+        return self._layout.path(index)
+
+    def invocationInfo(self, index):
+        return self._invocationInfos[index]
+
+    def prepare(self, index):
+        """
+          Create the working directory and runner for invocation ``index``.
+          Exceptions raised whilst doing this are propagated.
+        """
+        invocationInfo = self._invocationInfos[index]
+        workDir = self.workingDirectory(index)
+        if self._removeExisting and os.path.exists(workDir):
+            # Left over from a job that did not complete
+            _logger.info('Removing incomplete working directory "{}"'.format(
+                workDir))
+            shutil.rmtree(workDir)
+        _logger.debug('Creating working directory "{}"'.format(workDir))
+        self._layout.create(index)
+
+        # Do coverage_dir subtitution if necessary
+        if invocationInfo.CoverageDir is not None:
+            coverage_dir = invocationInfo.CoverageDir
+            assert isinstance(coverage_dir, str)
+            new_coverage_dir = coverage_dir.replace(
+                '@global_work_dir@', self._workDirsRoot)
+            _logger.info('Replacing coverage dir "{}" with "{}"'.format(
+                coverage_dir,
+                new_coverage_dir)
+            )
+            invocationInfo.GetInternalRepr()['coverage_dir'] = new_coverage_dir
+            # Create the directory if necessary
+            if not os.path.exists(new_coverage_dir):
+                _logger.info('Creating coverage directory "{}"'.format(
+                    new_coverage_dir))
+                os.makedirs(new_coverage_dir, exist_ok=True)
+
+        # Pass in a copy of rc so that if a runner accidently modifies
+        # a config it won't affect other runners.
+        runner = self._runnerClass(
+            invocationInfo, workDir, self._runnerConfig.copy(), self._ctx)
+        runner.prepare()
+        return runner
+
+    def tryPrepare(self, index):
+        """
+          Like ``prepare()`` but returns a ``PreparedJob`` that holds the
+          error rather than raising an exception.
+        """
+        try:
+            return PreparedJob(index, self.prepare(index), None)
+        except Exception: # pylint: disable=broad-except
+            error = traceback.format_exc()
+            _logger.error('Failed to create runner for index {}:\n{}'.format(
+                index, error))
+            return PreparedJob(index, None, error)
+
+    def errorResult(self, index, error):
+        """
+          Returns a raw ResultInfo describing ``error`` for invocation
+          ``index``.
+        """
+        assert isinstance(error, str)
+        return {
+            'working_directory': self.workingDirectory(index),
+            'invocation_info': self._invocationInfos[index].GetInternalRepr(),
+            'error': error,
+        }
+
+
+class LookaheadPreparer:
+    """
+      Prepares the jobs for a sequence of tasks in a background thread so
+      that runner creation happens off the critical path.
+
+      A task is a list of invocation indices. Tasks are identified by their
+      position in ``tasks`` and their jobs are retrieved using ``take()``. At
+      most ``lookahead`` prepared tasks that have not been taken are held at
+      any time so tasks should be taken in roughly the order they are given.
+    """
+    def __init__(self, preparer, tasks, lookahead, preparedJobs=None):
+        """
+          preparer: JobPreparer used to create runners
+          tasks: Iterable of tasks
+          lookahead: Maximum number of prepared tasks that have not been taken
+          preparedJobs: Optional dictionary mapping invocation index to a
+                        PreparedJob that has already been created.
+        """
+        assert isinstance(preparer, JobPreparer)
+        assert isinstance(lookahead, int)
+        assert lookahead > 0
+        self._preparer = preparer
+        self._tasks = tasks
+        self._lookahead = lookahead
+        self._preparedJobs = dict(preparedJobs) if preparedJobs else dict()
+        self._ready = dict() # Maps task number to list of PreparedJob
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._finished = False
+        self._thread = threading.Thread(
+            target=self._prepareTasks, name='runner_preparer', daemon=True)
+        self._thread.start()
+
+    def _prepareTasks(self):
+        for taskNumber, indices in enumerate(self._tasks):
+            with self._cond:
+                while len(self._ready) >= self._lookahead and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+            jobs = []
+            for index in indices:
+                job = self._preparedJobs.pop(index, None)
+                if job is None:
+                    job = self._preparer.tryPrepare(index)
+                jobs.append(job)
+            with self._cond:
+                self._ready[taskNumber] = jobs
+                self._cond.notify_all()
+        with self._cond:
+            self._finished = True
+            self._cond.notify_all()
+
+    def take(self, taskNumber):
+        """
+          Returns the list of ``PreparedJob`` for task ``taskNumber`` blocking
+          until it is ready. Returns None if preparation was stopped before
+          the task was prepared.
+        """
+        with self._cond:
+            while taskNumber not in self._ready:
+                if self._stopped or self._finished:
+                    return None
+                self._cond.wait()
+            jobs = self._ready.pop(taskNumber)
+            self._cond.notify_all()
+            return jobs
+
+    def stop(self):
+        """
+          Stop preparing tasks. Calls to ``take()`` for tasks that have not
+          been prepared will return None.
+        """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+
+class InlinePreparer:
+    """
+      Has the same interface as ``LookaheadPreparer`` but prepares the jobs
+      of a task in the thread that calls ``take()``. This is used when the
+      order tasks will run in is not known ahead of time (e.g. because
+      tasks depend on each other).
+    """
+    def __init__(self, preparer, tasks, preparedJobs=None):
+        """
+          preparer: JobPreparer used to create runners
+          tasks: List of tasks indexed by task number
+          preparedJobs: Optional dictionary mapping invocation index to a
+                        PreparedJob that has already been created.
+        """
+        assert isinstance(preparer, JobPreparer)
+        self._preparer = preparer
+        self._tasks = tasks
+        self._preparedJobs = dict(preparedJobs) if preparedJobs else dict()
+        self._lock = threading.Lock()
+        self._stopped = False
+
+    def take(self, taskNumber):
+        jobs = []
+        for index in self._tasks[taskNumber]:
+            with self._lock:
+                if self._stopped:
+                    return None
+                job = self._preparedJobs.pop(index, None)
+            if job is None:
+                job = self._preparer.tryPrepare(index)
+            jobs.append(job)
+        return jobs
+
+    def stop(self):
+        with self._lock:
+            self._stopped = True
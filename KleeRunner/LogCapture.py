@@ -0,0 +1,91 @@
+# vim: set sw=4 ts=4 softtabstop=4 expandtab:
+"""
+  Writing the output of a tool to its log file as it is streamed in chunks
+  whilst bounding both the memory used and the size of the log file.
+
+  When a maximum size is given the first half of it (the head) is written
+  as it arrives and only the most recent half (the tail) is held in memory.
+  If the output is larger than the maximum the log contains the head, a
+  truncation marker and then the tail.
+"""
+import gzip
+import logging
+
+_logger = logging.getLogger(__name__)
+
+TRUNCATION_MARKER = '\n[klee-runner: {} bytes of output truncated]\n'
+
+
+def openLogFile(path):
+    """
+      Open the log file ``path`` for reading as text. Logs written with
+      compression (i.e. ``path`` ends with ``.gz``) are decompressed.
+    """
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', errors='replace')
+    return open(path, 'r', errors='replace')
+
+
+class CappedLogWriter:
+    """
+      Writes chunks of output (bytes) to ``path``. ``maxSize`` is the
+      maximum number of bytes of output kept (None implies unlimited). If
+      ``compress`` is True the log is written with gzip compression.
+    """
+    def __init__(self, path, maxSize=None, compress=False):
+        assert maxSize is None or (isinstance(maxSize, int) and maxSize > 0)
+        self.path = path
+        self._headSize = None if maxSize is None else maxSize - (maxSize // 2)
+        self._tailSize = None if maxSize is None else maxSize // 2
+        self._tail = bytearray()
+        self._written = 0
+        self.bytesSeen = 0
+        if compress:
+            self._file = gzip.open(path, 'wb')
+        else:
+            self._file = open(path, 'wb')
+
+    @property
+    def truncated(self):
+        """
+          True if some of the output was not written to the log.
+        """
+        return self._headSize is not None and self.bytesSeen > self._headSize + self._tailSize
+
+    def write(self, chunk):
+        self.bytesSeen += len(chunk)
+        if self._headSize is None:
+            self._file.write(chunk)
+            return
+        if self._written < self._headSize:
+            head = chunk[:self._headSize - self._written]
+            self._file.write(head)
+            self._written += len(head)
+            chunk = chunk[len(head):]
+        if len(chunk) > 0:
+            self._tail += chunk
+            if len(self._tail) > 2 * self._tailSize:
+                # Trim occasionally rather than on every chunk
+                del self._tail[:len(self._tail) - self._tailSize]
+
+    def close(self):
+        try:
+            if self._tailSize is not None:
+                if len(self._tail) > self._tailSize:
+                    del self._tail[:len(self._tail) - self._tailSize]
+                if self.truncated:
+                    numTruncated = self.bytesSeen - self._written - len(self._tail)
+                    _logger.warning('Truncated {} bytes of output written to "{}"'.format(
+                        numTruncated, self.path))
+                    self._file.write(TRUNCATION_MARKER.format(numTruncated).encode())
+                self._file.write(self._tail)
+                self._tail = bytearray()
+        finally:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        return False
@@ -0,0 +1,214 @@
+# vim: set sw=4 ts=4 softtabstop=4 expandtab:
+"""
+  Memory aware admission control for jobs.
+
+  Rather than relying only on a fixed number of parallel jobs, a job is
+  only started when the memory reserved by the jobs that are already
+  running plus the memory the job declares (its ``max_memory``) fits in a
+  budget.
+"""
+import logging
+import threading
+import time
+
+import psutil
+
+_logger = logging.getLogger(__name__)
+
+
+def defaultBudget(headroom):
+    """
+      Returns the default budget in MiB which is the memory currently
+      available on the host minus ``headroom`` MiB.
+    """
+    assert headroom >= 0
+    available = psutil.virtual_memory().available // (2**20)
+    return max(0, available - headroom)
+
+
+class MemoryReservation:
+    """
+      Memory reserved for a running job.
+    """
+    def __init__(self, declared, charge, usageFn):
+        self.declared = declared
+        # The amount currently counted against the budget
+        self.charge = charge
+        self.maxCharge = charge
+        self.usageFn = usageFn
+        self.peakUsage = None
+        self.startTime = time.perf_counter()
+
+
+class MemoryAdmission:
+    """
+      Admits jobs whilst the sum of the memory reserved by admitted jobs
+      fits in ``budget`` MiB.
+
+      A job that declares no memory limit (zero) reserves the whole
+      budget. A job that does not fit in the budget on its own is admitted
+      when no other jobs are running so it can never block forever.
+
+      If ``adaptMargin`` is not None the reservation of a job that has been
+      running for at least ``settleTime`` seconds is reduced to its peak
+      measured memory usage plus ``adaptMargin`` (a fraction) of that usage,
+      but never above what it declared. This allows more jobs to run when
+      jobs use much less memory than they declare at the risk of
+      overcommitting if jobs grow suddenly.
+    """
+    def __init__(self, budget, adaptMargin=None, settleTime=30.0):
+        assert budget > 0
+        assert adaptMargin is None or adaptMargin >= 0
+        assert settleTime >= 0
+        self._budget = budget
+        self._adaptMargin = adaptMargin
+        self._settleTime = settleTime
+        self._cond = threading.Condition()
+        self._reservations = set()
+        self._reserved = 0
+        self._stopped = False
+        self._pollThread = None
+        # Statistics
+        self._numAdmitted = 0
+        self._numDelayed = 0
+        self._totalDelay = 0.0
+        self._maxDelay = 0.0
+        self._peakReserved = 0
+
+    @property
+    def budget(self):
+        return self._budget
+
+    @property
+    def reserved(self):
+        with self._cond:
+            return self._reserved
+
+    def _fits(self, charge):
+        if len(self._reservations) == 0:
+            return True
+        return self._reserved + charge <= self._budget
+
+    def acquire(self, declared, usageFn=None):
+        """
+          Block until a job that declares ``declared`` MiB (zero meaning
+          no limit) can be admitted.
+
+          ``usageFn`` is an optional function that returns the memory in
+          MiB the job is currently using (or None if unknown). It is used
+          to adapt the reservation.
+
+          Returns a ``MemoryReservation`` that must be passed to
+          ``release()`` when the job finishes or None if ``stop()`` was
+          called before the job was admitted.
+        """
+        assert declared >= 0
+        charge = declared if declared > 0 else self._budget
+        if charge > self._budget:
+            _logger.warning('Job declares {} MiB which exceeds the memory budget of {} MiB. '
+                            'It will only run when no other jobs are running'.format(
+                                charge, self._budget))
+        waitStart = time.perf_counter()
+        delayed = False
+        with self._cond:
+            while not self._stopped and not self._fits(charge):
+                if not delayed:
+                    _logger.debug('Waiting to admit job declaring {} MiB ({} MiB of {} MiB reserved)'.format(
+                        charge, self._reserved, self._budget))
+                delayed = True
+                self._cond.wait()
+            if self._stopped:
+                return None
+            if delayed:
+                delay = time.perf_counter() - waitStart
+                self._numDelayed += 1
+                self._totalDelay += delay
+                self._maxDelay = max(self._maxDelay, delay)
+            self._numAdmitted += 1
+            reservation = MemoryReservation(declared, charge, usageFn)
+            self._reservations.add(reservation)
+            self._reserved += charge
+            self._peakReserved = max(self._peakReserved, self._reserved)
+            return reservation
+
+    def release(self, reservation):
+        assert isinstance(reservation, MemoryReservation)
+        with self._cond:
+            self._reservations.remove(reservation)
+            self._reserved -= reservation.charge
+            self._cond.notify_all()
+
+    def updateFromUsage(self):
+        """
+          Measure the memory used by running jobs and adapt their
+          reservations. Does nothing if adaptation is disabled.
+        """
+        if self._adaptMargin is None:
+            return
+        with self._cond:
+            reservations = [r for r in self._reservations if r.usageFn is not None]
+        # Measuring usage may be slow so do it without holding the lock
+        now = time.perf_counter()
+        measurements = []
+        for reservation in reservations:
+            try:
+                measurements.append((reservation, reservation.usageFn()))
+            except Exception: # pylint: disable=broad-except
+                _logger.debug('Failed to measure memory usage', exc_info=True)
+        with self._cond:
+            for reservation, usage in measurements:
+                if usage is None or reservation not in self._reservations:
+                    continue
+                reservation.peakUsage = max(reservation.peakUsage or 0, usage)
+                if now - reservation.startTime < self._settleTime:
+                    continue
+                newCharge = min(reservation.maxCharge,
+                                reservation.peakUsage * (1.0 + self._adaptMargin))
+                self._reserved += newCharge - reservation.charge
+                reservation.charge = newCharge
+            self._cond.notify_all()
+
+    def startPolling(self, period):
+        """
+          Call ``updateFromUsage()`` every ``period`` seconds in a
+          background thread until ``stop()`` is called.
+        """
+        assert period > 0
+        assert self._pollThread is None
+
+        def threadBody():
+            while True:
+                with self._cond:
+                    self._cond.wait_for(lambda: self._stopped, timeout=period)
+                    if self._stopped:
+                        return
+                self.updateFromUsage()
+
+        self._pollThread = threading.Thread(
+            target=threadBody, name='memory_admission', daemon=True)
+        self._pollThread.start()
+
+    def stop(self):
+        """
+          Stop admitting jobs. Blocked and future calls to ``acquire()``
+          return None.
+        """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    def stats(self):
+        """
+          Returns a dictionary describing the budget and how much queueing
+          delay admission control caused.
+        """
+        with self._cond:
+            return {
+                'budget': self._budget,
+                'adapt_margin': self._adaptMargin,
+                'peak_reserved': self._peakReserved,
+                'jobs_admitted': self._numAdmitted,
+                'jobs_delayed': self._numDelayed,
+                'total_queueing_delay': self._totalDelay,
+                'max_queueing_delay': self._maxDelay,
+            }
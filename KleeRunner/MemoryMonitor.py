@@ -0,0 +1,210 @@
+# vim: set sw=4 ts=4 softtabstop=4 expandtab:
+"""
+  Process wide monitor of the memory used by running jobs.
+
+  Rather than a thread per job walking its process tree with psutil, a
+  single thread reads ``/proc/<pid>/stat`` for every process once per tick
+  and attributes the memory of each process to the supervised process
+  tree (job) it belongs to. Callbacks are run when a job exceeds its
+  memory limit. The monitor is shared through the ``RunnerContext`` (see
+  ``fromContext()``).
+"""
+import logging
+import os
+import threading
+import time
+
+_logger = logging.getLogger(__name__)
+
+CONTEXT_OBJECT_NAME = 'MemoryMonitor'
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def readProcessTable(procRoot='/proc'):
+    """
+      Returns a dictionary mapping the PID of every process to a tuple
+      ``(ppid, virtualBytes, residentBytes)``.
+    """
+    table = dict()
+    for name in os.listdir(procRoot):
+        if not name.isdigit():
+            continue
+        try:
+            with open(os.path.join(procRoot, name, 'stat'), 'r') as f:
+                stat = f.read()
+        except OSError:
+            # The process exited
+            continue
+        # The command name (field 2) is in parentheses and may itself
+        # contain spaces and parentheses.
+        fields = stat[stat.rfind(')') + 2:].split()
+        try:
+            table[int(name)] = (int(fields[1]),
+                                int(fields[20]),
+                                int(fields[21]) * _PAGE_SIZE)
+        except (IndexError, ValueError):
+            _logger.debug('Could not parse "{}"'.format(stat))
+    return table
+
+
+class MonitoredTree:
+    """
+      A process tree (a job) registered with the monitor. ``memoryLimit``
+      is in MiB (zero implies the usage is only measured).
+      ``onLimitExceeded(tree)`` is called from the monitor thread the
+      first time the virtual memory of the tree exceeds the limit so it
+      must not block.
+    """
+    def __init__(self, pid, memoryLimit, onLimitExceeded):
+        self.pid = pid
+        self.memoryLimit = memoryLimit
+        self.onLimitExceeded = onLimitExceeded
+        # Totals for the tree from the last sweep (None until measured)
+        self.virtualMiB = None
+        self.residentMiB = None
+        self.numProcesses = 0
+        self.limitExceeded = False
+
+
+class MemoryMonitor:
+    """
+      Measures the memory used by every registered process tree every
+      ``period`` seconds.
+    """
+    def __init__(self, period=0.5, procRoot='/proc'):
+        assert period > 0.0
+        self._period = period
+        self._procRoot = procRoot
+        self._trees = set()
+        self._lock = threading.Lock()
+        self._stopEvent = threading.Event()
+        self._thread = None
+        self._numSweeps = 0
+        self._totalSweepTime = 0.0
+        self._lastSweepTime = None
+        self._maxSweepTime = 0.0
+
+    @property
+    def period(self):
+        return self._period
+
+    def requestPeriod(self, period):
+        """
+          Sweep at least every ``period`` seconds.
+        """
+        assert period > 0.0
+        with self._lock:
+            self._period = min(self._period, period)
+
+    def register(self, pid, memoryLimit, onLimitExceeded):
+        """
+          Start monitoring the process tree rooted at ``pid``. Returns the
+          ``MonitoredTree``.
+        """
+        tree = MonitoredTree(pid, memoryLimit, onLimitExceeded)
+        with self._lock:
+            self._trees.add(tree)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='memory_monitor', daemon=True)
+                self._thread.start()
+        return tree
+
+    def unregister(self, tree):
+        with self._lock:
+            self._trees.discard(tree)
+
+    def _run(self):
+        _logger.info('Launching memory monitor thread with polling time period of {} seconds'.format(
+            self._period))
+        while not self._stopEvent.wait(self._period):
+            try:
+                self.sweep()
+            except Exception: # pylint: disable=broad-except
+                _logger.exception('Memory monitor sweep failed')
+
+    def stop(self):
+        self._stopEvent.set()
+        with self._lock:
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+
+    def sweep(self):
+        """
+          Measure every registered tree once and run the callbacks of those
+          that exceeded their limit.
+        """
+        with self._lock:
+            trees = list(self._trees)
+        if len(trees) == 0:
+            return
+        startTime = time.perf_counter()
+        table = readProcessTable(self._procRoot)
+        children = dict()
+        for pid, (ppid, _, _) in table.items():
+            children.setdefault(ppid, []).append(pid)
+        exceeded = []
+        for tree in trees:
+            virtualBytes = 0
+            residentBytes = 0
+            numProcesses = 0
+            stack = [tree.pid] if tree.pid in table else []
+            while len(stack) > 0:
+                pid = stack.pop()
+                _, vms, rss = table[pid]
+                virtualBytes += vms
+                residentBytes += rss
+                numProcesses += 1
+                stack.extend(children.get(pid, []))
+            tree.virtualMiB = virtualBytes / (2**20)
+            tree.residentMiB = residentBytes / (2**20)
+            tree.numProcesses = numProcesses
+            _logger.debug('Total memory usage of PID {} in MiB:{} ({} processes)'.format(
+                tree.pid, tree.virtualMiB, numProcesses))
+            if (tree.memoryLimit > 0 and not tree.limitExceeded and
+                    tree.virtualMiB > tree.memoryLimit):
+                tree.limitExceeded = True
+                exceeded.append(tree)
+        sweepTime = time.perf_counter() - startTime
+        with self._lock:
+            self._numSweeps += 1
+            self._totalSweepTime += sweepTime
+            self._lastSweepTime = sweepTime
+            self._maxSweepTime = max(self._maxSweepTime, sweepTime)
+        for tree in exceeded:
+            try:
+                tree.onLimitExceeded(tree)
+            except Exception: # pylint: disable=broad-except
+                _logger.exception('Memory limit callback for PID {} failed'.format(
+                    tree.pid))
+
+    def stats(self):
+        """
+          Returns a dictionary describing the overhead of monitoring.
+        """
+        with self._lock:
+            return {
+                'period': self._period,
+                'sweeps': self._numSweeps,
+                'total_sweep_time': self._totalSweepTime,
+                'last_sweep_time': self._lastSweepTime,
+                'max_sweep_time': self._maxSweepTime,
+                'monitored_jobs': len(self._trees),
+            }
+
+
+def fromContext(ctx, period=0.5):
+    """
+      Returns the monitor shared by everything using the RunnerContext
+      ``ctx`` creating it if necessary.
+    """
+    monitor, success = ctx.get_object(CONTEXT_OBJECT_NAME)
+    if not success:
+        monitor = MemoryMonitor(period)
+        if not ctx.add_object(CONTEXT_OBJECT_NAME, monitor):
+            # Created by another runner first
+            monitor, _ = ctx.get_object(CONTEXT_OBJECT_NAME)
+    monitor.requestPeriod(period)
+    return monitor
@@ -0,0 +1,341 @@
+# vim: set sw=4 ts=4 softtabstop=4 expandtab:
+"""
+  Live metrics for batch runs.
+
+  Counters are updated as jobs start and finish and are periodically
+  written in the Prometheus text exposition format to a file (atomically)
+  and optionally served over HTTP on localhost.
+"""
+import bisect
+import http.server
+import logging
+import os
+import socketserver
+import threading
+import time
+
+_logger = logging.getLogger(__name__)
+
+_PREFIX = 'batch_runner_'
+
+
+# Upper bounds (in seconds) of the buckets of the job wallclock time
+# histogram. There is also an implicit +Inf bucket.
+WALLCLOCK_BUCKETS = (
+    0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+    300.0, 900.0, 1800.0, 3600.0, 7200.0, 14400.0, 43200.0, 86400.0)
+
+
+def _histogramQuantile(bucketCounts, q, minimum, maximum):
+    """
+      Estimate the quantile ``q`` from the number of values in each bucket
+      of ``WALLCLOCK_BUCKETS`` (and +Inf) by interpolating linearly inside
+      the bucket it falls in, like Prometheus' ``histogram_quantile()``.
+      The estimate is clamped to the smallest and largest values seen.
+    """
+    count = sum(bucketCounts)
+    assert count > 0
+    assert 0.0 <= q <= 1.0
+    rank = q * count
+    cumulative = 0
+    for index, bucketCount in enumerate(bucketCounts):
+        if bucketCount > 0 and cumulative + bucketCount >= rank:
+            if index == len(WALLCLOCK_BUCKETS):
+                return maximum
+            lower = WALLCLOCK_BUCKETS[index - 1] if index > 0 else 0.0
+            upper = WALLCLOCK_BUCKETS[index]
+            estimate = lower + (upper - lower) * (rank - cumulative) / bucketCount
+            return min(max(estimate, minimum), maximum)
+        cumulative += bucketCount
+    return maximum
+
+
+def _escapeLabelValue(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class BatchMetrics:
+    """
+      Thread safe counters describing the progress of a batch run.
+
+      numJobs: Number of jobs this run will execute
+      numSlots: Number of jobs that can run in parallel or None if
+                running jobs are not tracked by this object
+      backendName: Name of the backend that the slots belong to
+    """
+    def __init__(self, numJobs, numSlots, backendName):
+        assert isinstance(numJobs, int)
+        assert numJobs >= 0
+        self._numJobs = numJobs
+        self._numSlots = numSlots
+        self._backendName = backendName
+        self._lock = threading.Lock()
+        self._startTime = time.perf_counter()
+        self._numCompleted = 0
+        self._numFailed = 0
+        self._numTimeouts = 0
+        self._numOutOfMemory = 0
+        self._numRunning = 0
+        # Counts for each bucket of ``WALLCLOCK_BUCKETS`` and +Inf
+        self._wallclockBuckets = [0] * (len(WALLCLOCK_BUCKETS) + 1)
+        self._wallclockSum = 0.0
+        self._wallclockMin = None
+        self._wallclockMax = None
+        self._memoryMonitor = None
+
+    def setMemoryMonitor(self, memoryMonitor):
+        """
+          Report the overhead of ``memoryMonitor`` (a
+          ``MemoryMonitor.MemoryMonitor``) as well.
+        """
+        with self._lock:
+            self._memoryMonitor = memoryMonitor
+
+    def jobStarted(self):
+        with self._lock:
+            self._numRunning += 1
+
+    def jobStopped(self):
+        with self._lock:
+            self._numRunning -= 1
+
+    def recordResult(self, rawResultInfo):
+        """
+          Count the raw ResultInfo of a finished job.
+        """
+        with self._lock:
+            if 'error' in rawResultInfo:
+                self._numFailed += 1
+                return
+            self._numCompleted += 1
+            if rawResultInfo.get('backend_timeout', False):
+                self._numTimeouts += 1
+            if rawResultInfo.get('out_of_memory', False):
+                self._numOutOfMemory += 1
+            wallclockTime = rawResultInfo.get('wallclock_time', None)
+            if isinstance(wallclockTime, (int, float)):
+                wallclockTime = float(wallclockTime)
+                self._wallclockBuckets[
+                    bisect.bisect_left(WALLCLOCK_BUCKETS, wallclockTime)] += 1
+                self._wallclockSum += wallclockTime
+                if self._wallclockMin is None:
+                    self._wallclockMin = wallclockTime
+                    self._wallclockMax = wallclockTime
+                else:
+                    self._wallclockMin = min(self._wallclockMin, wallclockTime)
+                    self._wallclockMax = max(self._wallclockMax, wallclockTime)
+
+    def snapshot(self):
+        """
+          Returns a dictionary of the current metric values.
+        """
+        with self._lock:
+            elapsed = time.perf_counter() - self._startTime
+            numFinished = self._numCompleted + self._numFailed
+            snapshot = {
+                'jobs': self._numJobs,
+                'jobs_completed': self._numCompleted,
+                'jobs_failed': self._numFailed,
+                'jobs_timeout': self._numTimeouts,
+                'jobs_out_of_memory': self._numOutOfMemory,
+                'elapsed_seconds': elapsed,
+                'slots': self._numSlots,
+                'busy_slots': None,
+                'queue_depth': None,
+                'job_wallclock_count': sum(self._wallclockBuckets),
+                'job_wallclock_sum': self._wallclockSum,
+                'job_wallclock_buckets': list(self._wallclockBuckets),
+                'job_wallclock_p50': None,
+                'job_wallclock_p95': None,
+            }
+            if self._numSlots is not None:
+                snapshot['busy_slots'] = self._numRunning
+                snapshot['queue_depth'] = (self._numJobs - numFinished -
+                                           self._numRunning)
+            wallclockRange = (self._wallclockMin, self._wallclockMax)
+            memoryMonitor = self._memoryMonitor
+        snapshot['memory_monitor_sweeps'] = None
+        snapshot['memory_monitor_sweep_seconds'] = None
+        snapshot['memory_monitor_last_sweep_seconds'] = None
+        snapshot['memory_monitor_jobs'] = None
+        if memoryMonitor is not None:
+            monitorStats = memoryMonitor.stats()
+            snapshot['memory_monitor_sweeps'] = monitorStats['sweeps']
+            snapshot['memory_monitor_sweep_seconds'] = monitorStats['total_sweep_time']
+            snapshot['memory_monitor_last_sweep_seconds'] = monitorStats['last_sweep_time']
+            snapshot['memory_monitor_jobs'] = monitorStats['monitored_jobs']
+        if snapshot['job_wallclock_count'] > 0:
+            snapshot['job_wallclock_p50'] = _histogramQuantile(
+                snapshot['job_wallclock_buckets'], 0.5, *wallclockRange)
+            snapshot['job_wallclock_p95'] = _histogramQuantile(
+                snapshot['job_wallclock_buckets'], 0.95, *wallclockRange)
+        rate = numFinished / elapsed if elapsed > 0 else 0.0
+        snapshot['jobs_per_second'] = rate
+        snapshot['eta_seconds'] = None
+        if rate > 0:
+            snapshot['eta_seconds'] = (self._numJobs - numFinished) / rate
+        return snapshot
+
+    def renderPrometheus(self):
+        """
+          Returns the metrics in the Prometheus text exposition format.
+        """
+        s = self.snapshot()
+        lines = []
+
+        def add(name, metricType, helpText, value, labels=None):
+            if value is None:
+                return
+            lines.append('# HELP {}{} {}'.format(_PREFIX, name, helpText))
+            lines.append('# TYPE {}{} {}'.format(_PREFIX, name, metricType))
+            lines.append('{}{}{} {}'.format(_PREFIX, name, labels or '', value))
+
+        add('jobs', 'gauge', 'Number of jobs in this run.', s['jobs'])
+        add('jobs_completed_total', 'counter',
+            'Jobs that ran to completion.', s['jobs_completed'])
+        add('jobs_failed_total', 'counter',
+            'Jobs that failed with an error.', s['jobs_failed'])
+        add('jobs_timeout_total', 'counter',
+            'Completed jobs that hit the time limit.', s['jobs_timeout'])
+        add('jobs_out_of_memory_total', 'counter',
+            'Completed jobs that ran out of memory.', s['jobs_out_of_memory'])
+        add('jobs_per_second', 'gauge',
+            'Jobs finished per second since the start of the run.',
+            s['jobs_per_second'])
+        add('eta_seconds', 'gauge',
+            'Estimated seconds until all jobs have finished.', s['eta_seconds'])
+        add('elapsed_seconds', 'gauge',
+            'Seconds since the start of the run.', s['elapsed_seconds'])
+        backendLabel = '{{backend="{}"}}'.format(
+            _escapeLabelValue(self._backendName))
+        add('slots', 'gauge', 'Jobs that can run in parallel.', s['slots'],
+            backendLabel)
+        add('busy_slots', 'gauge', 'Jobs that are running.', s['busy_slots'],
+            backendLabel)
+        add('queue_depth', 'gauge', 'Jobs waiting to run.', s['queue_depth'])
+        add('memory_monitor_sweeps_total', 'counter',
+            'Sweeps of /proc by the memory monitor.', s['memory_monitor_sweeps'])
+        add('memory_monitor_sweep_seconds_total', 'counter',
+            'Time spent sweeping /proc by the memory monitor.',
+            s['memory_monitor_sweep_seconds'])
+        add('memory_monitor_last_sweep_seconds', 'gauge',
+            'Duration of the last sweep of /proc by the memory monitor.',
+            s['memory_monitor_last_sweep_seconds'])
+        add('memory_monitor_jobs', 'gauge',
+            'Jobs whose memory is being monitored.', s['memory_monitor_jobs'])
+
+        add('job_wallclock_p50_seconds', 'gauge',
+            'Estimated median wallclock time of completed jobs.',
+            s['job_wallclock_p50'])
+        add('job_wallclock_p95_seconds', 'gauge',
+            'Estimated 95th percentile wallclock time of completed jobs.',
+            s['job_wallclock_p95'])
+
+        name = '{}job_wallclock_seconds'.format(_PREFIX)
+        lines.append('# HELP {} Wallclock time of completed jobs.'.format(name))
+        lines.append('# TYPE {} histogram'.format(name))
+        cumulative = 0
+        for upper, bucketCount in zip(WALLCLOCK_BUCKETS + ('+Inf',),
+                                      s['job_wallclock_buckets']):
+            cumulative += bucketCount
+            lines.append('{}_bucket{{le="{}"}} {}'.format(name, upper, cumulative))
+        lines.append('{}_sum {}'.format(name, s['job_wallclock_sum']))
+        lines.append('{}_count {}'.format(name, s['job_wallclock_count']))
+        return '\n'.join(lines) + '\n'
+
+    def writeFile(self, path):
+        """
+          Atomically replace the file at ``path`` with the current metrics.
+        """
+        tmpPath = path + '.tmp'
+        with open(tmpPath, 'w') as f:
+            f.write(self.renderPrometheus())
+        os.replace(tmpPath, path)
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class MetricsReporter:
+    """
+      Publishes ``metrics`` by writing them to ``path`` every ``period``
+      seconds and, if ``port`` is not None, serving them from
+      ``http://127.0.0.1:<port>/metrics``.
+    """
+    def __init__(self, metrics, path=None, period=5.0, port=None):
+        assert isinstance(metrics, BatchMetrics)
+        assert period > 0
+        self._metrics = metrics
+        self._path = path
+        self._period = period
+        self._stopEvent = threading.Event()
+        self._thread = None
+        self._server = None
+        self._serverThread = None
+        if port is not None:
+            self._server = self._createServer(port)
+
+    def _createServer(self, port):
+        metrics = self._metrics
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self): # pylint: disable=invalid-name
+                if self.path not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = metrics.renderPrometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, fmt, *args): # pylint: disable=arguments-differ
+                _logger.debug('Metrics request: ' + fmt, *args)
+
+        return _ThreadingHTTPServer(('127.0.0.1', port), Handler)
+
+    @property
+    def port(self):
+        if self._server is None:
+            return None
+        return self._server.server_address[1]
+
+    def _write(self):
+        try:
+            self._metrics.writeFile(self._path)
+        except Exception as e: # pylint: disable=broad-except
+            _logger.warning('Failed to write metrics to "{}": {}'.format(
+                self._path, e))
+
+    def start(self):
+        if self._path is not None:
+            def threadBody():
+                while not self._stopEvent.wait(self._period):
+                    self._write()
+            self._thread = threading.Thread(
+                target=threadBody, name='metrics_writer', daemon=True)
+            self._thread.start()
+        if self._server is not None:
+            self._serverThread = threading.Thread(
+                target=self._server.serve_forever, name='metrics_server',
+                daemon=True)
+            self._serverThread.start()
+            _logger.info('Serving metrics on http://127.0.0.1:{}/metrics'.format(
+                self.port))
+
+    def stop(self):
+        """
+          Stop publishing. The metrics file is written one last time so it
+          holds the final values.
+        """
+        self._stopEvent.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._path is not None:
+            self._write()
+        if self._serverThread is not None:
+            self._server.shutdown()
+        if self._server is not None:
+            self._server.server_close()
@@ -0,0 +1,230 @@
+# vim: set sw=4 ts=4 softtabstop=4 expandtab:
+"""
+  Content addressed cache of the results of deterministic jobs.
+
+  An entry is keyed by the SHA-256 of the contents of the files a job reads
+  (e.g. the program and KTest file) and a JSON serialisable description of
+  everything else that determines its outcome (arguments, environment and
+  runner configuration). Each entry is a directory containing
+
+  * ``result.json`` - The cached result fields
+  * ``log.txt`` - The log of the job
+  * ``coverage/`` - Files the job wrote to its coverage directory
+
+  Entries are written to a temporary directory and renamed into place so
+  that runs sharing a cache never see partial entries. The total size of
+  the cache is bounded by evicting the least recently used entries (the
+  modification time of ``result.json`` is updated on every hit).
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+_logger = logging.getLogger(__name__)
+
+_RESULT_FILE = 'result.json'
+_LOG_FILE = 'log.txt'
+_COVERAGE_DIR = 'coverage'
+
+# Maps (path, size, modification time) to the digest of the file so
+# the program is not hashed again for every job that uses it.
+_fileDigests = dict()
+_fileDigestsLock = threading.Lock()
+
+
+class ResultCacheException(Exception):
+    def __init__(self, msg):
+        # pylint: disable=super-init-not-called
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+
+def hashFile(path):
+    """
+      Returns the hex SHA-256 digest of the contents of the file at ``path``.
+    """
+    st = os.stat(path)
+    fileId = (path, st.st_size, st.st_mtime_ns)
+    with _fileDigestsLock:
+        digest = _fileDigests.get(fileId, None)
+    if digest is not None:
+        return digest
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            h.update(block)
+    digest = h.hexdigest()
+    with _fileDigestsLock:
+        _fileDigests[fileId] = digest
+    return digest
+
+
+def _treeSize(path):
+    size = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                size += os.lstat(os.path.join(dirpath, filename)).st_size
+            except OSError:
+                pass
+    return size
+
+
+def copyTree(src, dest):
+    """
+      Copy the files in ``src`` into ``dest`` (which may already exist)
+      preserving the directory structure.
+    """
+    for dirpath, _, filenames in os.walk(src):
+        destDir = os.path.join(dest, os.path.relpath(dirpath, src))
+        os.makedirs(destDir, exist_ok=True)
+        for filename in filenames:
+            shutil.copy2(os.path.join(dirpath, filename),
+                         os.path.join(destDir, filename))
+
+
+class CacheEntry:
+    """
+      An entry found by ``ResultCache.lookup()``.
+    """
+    def __init__(self, path, result):
+        self.path = path
+        self.result = result
+
+    @property
+    def logFile(self):
+        return os.path.join(self.path, _LOG_FILE)
+
+    @property
+    def coverageDir(self):
+        """
+          Directory holding the cached coverage files or None if the job
+          had no coverage directory.
+        """
+        path = os.path.join(self.path, _COVERAGE_DIR)
+        return path if os.path.isdir(path) else None
+
+
+class ResultCache:
+    """
+      Cache in ``directory`` that holds at most roughly ``maxSizeInMiB`` MiB
+      of entries.
+    """
+    def __init__(self, directory, maxSizeInMiB):
+        assert os.path.isabs(directory)
+        assert maxSizeInMiB > 0
+        self._directory = directory
+        self._maxSize = maxSizeInMiB * (2**20)
+        self._lock = threading.Lock()
+        # Estimate of the size of the cache. Other processes may also be
+        # adding entries so it is recomputed when eviction happens.
+        self._size = None
+        os.makedirs(self._directory, exist_ok=True)
+
+    @property
+    def directory(self):
+        return self._directory
+
+    def computeKey(self, files, data):
+        """
+          Returns the key for a job that reads ``files`` and is otherwise
+          described by the JSON serialisable ``data``.
+        """
+        h = hashlib.sha256()
+        for path in files:
+            h.update(hashFile(path).encode())
+        h.update(json.dumps(data, sort_keys=True).encode())
+        return h.hexdigest()
+
+    def _entryPath(self, key):
+        return os.path.join(self._directory, key[:2], key)
+
+    def lookup(self, key):
+        """
+          Returns the ``CacheEntry`` for ``key`` or None if there is none.
+        """
+        path = self._entryPath(key)
+        resultFile = os.path.join(path, _RESULT_FILE)
+        try:
+            with open(resultFile, 'r') as f:
+                result = json.load(f)
+            # Mark the entry as recently used
+            os.utime(resultFile)
+        except (OSError, ValueError):
+            return None
+        return CacheEntry(path, result)
+
+    def store(self, key, result, logFile, coverageDir=None):
+        """
+          Add an entry for ``key``. ``result`` is a JSON serialisable
+          dictionary, ``logFile`` is the log of the job and ``coverageDir``
+          (if not None) is the directory holding the coverage files the job
+          wrote.
+        """
+        shardDir = os.path.dirname(self._entryPath(key))
+        os.makedirs(shardDir, exist_ok=True)
+        tmpDir = tempfile.mkdtemp(dir=shardDir, prefix='.tmp-')
+        try:
+            if os.path.exists(logFile):
+                shutil.copy2(logFile, os.path.join(tmpDir, _LOG_FILE))
+            if coverageDir is not None:
+                copyTree(coverageDir, os.path.join(tmpDir, _COVERAGE_DIR))
+            with open(os.path.join(tmpDir, _RESULT_FILE), 'w') as f:
+                json.dump(result, f)
+            size = _treeSize(tmpDir)
+            try:
+                os.rename(tmpDir, self._entryPath(key))
+            except OSError:
+                # Another job stored the same entry first
+                shutil.rmtree(tmpDir, ignore_errors=True)
+                return
+        except BaseException:
+            shutil.rmtree(tmpDir, ignore_errors=True)
+            raise
+        with self._lock:
+            if self._size is not None:
+                self._size += size
+            needsEviction = self._size is None or self._size > self._maxSize
+        if needsEviction:
+            self.evict()
+
+    def evict(self):
+        """
+          Remove least recently used entries until the cache is below 90% of
+          its maximum size (so eviction does not happen on every store).
+        """
+        with self._lock:
+            entries = []
+            for shard in os.listdir(self._directory):
+                shardDir = os.path.join(self._directory, shard)
+                if not os.path.isdir(shardDir):
+                    continue
+                for name in os.listdir(shardDir):
+                    if name.startswith('.tmp-'):
+                        continue
+                    path = os.path.join(shardDir, name)
+                    try:
+                        lastUsed = os.stat(os.path.join(path, _RESULT_FILE)).st_mtime
+                    except OSError:
+                        continue
+                    entries.append((lastUsed, _treeSize(path), path))
+            self._size = sum(size for _, size, _ in entries)
+            if self._size <= self._maxSize:
+                return
+            target = self._maxSize * 0.9
+            entries.sort()
+            numEvicted = 0
+            for _, size, path in entries:
+                if self._size <= target:
+                    break
+                shutil.rmtree(path, ignore_errors=True)
+                self._size -= size
+                numEvicted += 1
+            _logger.info('Evicted {} entries from result cache "{}"'.format(
+                numEvicted, self._directory))
@@ -54,3 +54,43 @@ def group_result_infos_by(result_infos_list, key_fn=get_result_info_key):
                 key_to_result_infos[key][result_infos_index] = r
 
     return (key_to_result_infos, rejected_result_infos)
+
+def merge_repeated_results(results):
+    """
+    Given a list of raw `ResultInfo`s (or `None` if a result is missing) for
+    repetitions of the same invocation return a single raw `ResultInfo` in
+    the merged result shape (as produced by `tools/result-info-klee-merge.py`).
+    Every field except `invocation_info` becomes a list with a value for each
+    repetition and `merged_result` is set.
+
+    If any repetition is missing or had an error an error `ResultInfo`
+    describing the problems is returned instead.
+    """
+    assert isinstance(results, list)
+    assert len(results) > 0
+    present = [r for r in results if r is not None]
+    assert len(present) > 0
+
+    errors = []
+    for repetition, r in enumerate(results):
+        if r is None:
+            errors.append('Repetition {}: no result'.format(repetition))
+        elif 'error' in r:
+            errors.append('Repetition {}: {}'.format(repetition, r['error']))
+    if len(errors) > 0:
+        error_result = {
+            'invocation_info': present[0]['invocation_info'],
+            'error': '\n'.join(errors),
+        }
+        if 'working_directory' in present[0]:
+            error_result['working_directory'] = present[0]['working_directory']
+        return error_result
+
+    merged_result = {'invocation_info': results[0]['invocation_info']}
+    for r in results:
+        for key in r.keys():
+            if key == 'invocation_info' or key in merged_result:
+                continue
+            merged_result[key] = [other.get(key, None) for other in results]
+    merged_result['merged_result'] = True
+    return merged_result
@@ -0,0 +1,267 @@
+# vim: set sw=4 ts=4 softtabstop=4 expandtab:
+"""
+  Append-only journal of runner results.
+
+  Each completed job is written to the journal as a single line of JSON
+  as soon as it finishes. This means results are not held in memory for
+  the whole batch run and are not lost if the batch run dies. Use
+  ``finalizeJournal()`` to turn a journal into a ResultInfo file.
+"""
+import json
+import logging
+import os
+import threading
+from . import ResultInfoUtil
+from . import util
+
+_logger = logging.getLogger(__name__)
+
+
+class ResultJournalException(Exception):
+
+    def __init__(self, msg):
+        # pylint: disable=super-init-not-called
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+
+class ResultJournal:
+    """
+      Writer for a journal. Records are
+      ``{"index": <invocation index>, "result": <raw ResultInfo>}``.
+      It is safe to call ``append()`` from multiple threads.
+
+      If ``path`` already exists new records are appended to it.
+    """
+    def __init__(self, path, sync=False):
+        assert isinstance(path, str)
+        assert isinstance(sync, bool)
+        self._path = path
+        self._sync = sync
+        self._lock = threading.Lock()
+        if os.path.exists(self._path):
+            _discardTruncatedRecord(self._path)
+        self._file = open(self._path, 'a')
+        self._numRecords = 0
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def numRecords(self):
+        """
+          Number of records appended by this writer.
+        """
+        return self._numRecords
+
+    def append(self, index, result):
+        assert isinstance(index, int)
+        assert isinstance(result, dict)
+        line = json.dumps({'index': index, 'result': result},
+                          separators=(',', ':'), default=str)
+        assert '\n' not in line
+        with self._lock:
+            if self._file is None:
+                raise ResultJournalException(
+                    'Journal "{}" is closed'.format(self._path))
+            self._file.write(line + '\n')
+            self._file.flush()
+            if self._sync:
+                os.fsync(self._file.fileno())
+            self._numRecords += 1
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+def _discardTruncatedRecord(path):
+    """
+      Remove a partially written record from the end of the journal at
+      ``path`` so that appended records start on a new line.
+    """
+    with open(path, 'rb+') as f:
+        size = f.seek(0, os.SEEK_END)
+        if size == 0:
+            return
+        f.seek(size - 1)
+        if f.read(1) == b'\n':
+            return
+        # Find the end of the last complete record
+        blockSize = 4096
+        end = size
+        while end > 0:
+            start = max(0, end - blockSize)
+            f.seek(start)
+            block = f.read(end - start)
+            newLinePos = block.rfind(b'\n')
+            if newLinePos != -1:
+                end = start + newLinePos + 1
+                break
+            end = start
+        _logger.warning('Discarding {} bytes of truncated record at end of journal "{}"'.format(
+            size - end, path))
+        f.truncate(end)
+
+
+def iterJournal(path):
+    """
+      Yields ``(index, result)`` tuples in the order they were written to the
+      journal at ``path``.
+
+      A truncated final line (e.g. because the writer was killed mid-write) is
+      skipped with a warning. Corruption anywhere else raises
+      ``ResultJournalException``.
+    """
+    with open(path, 'rb') as f:
+        for index, _, record in _iterRecords(f):
+            yield (index, record['result'])
+
+
+def _iterRecords(openFile):
+    """
+      Yields ``(index, offset, record)`` where ``offset`` is the position
+      of the record in the journal. ``openFile`` must be opened in binary
+      mode.
+    """
+    lineNumber = 0
+    offset = openFile.tell()
+    line = openFile.readline()
+    while line != b'':
+        lineNumber += 1
+        nextOffset = openFile.tell()
+        nextLine = openFile.readline()
+        try:
+            record = json.loads(line.decode('utf-8'))
+            if not (isinstance(record, dict) and
+                    isinstance(record.get('index', None), int) and
+                    isinstance(record.get('result', None), dict)):
+                raise ValueError('Malformed record')
+        except ValueError as e:
+            if nextLine == b'':
+                _logger.warning(
+                    'Ignoring truncated record at end of journal "{}"'.format(
+                        openFile.name))
+                return
+            raise ResultJournalException(
+                'Failed to parse line {} of journal "{}": {}'.format(
+                    lineNumber, openFile.name, e))
+        yield (record['index'], offset, record)
+        offset = nextOffset
+        line = nextLine
+
+
+def latestRecordOffsets(path):
+    """
+      Returns a dictionary mapping each invocation index that appears in the
+      journal at ``path`` to the offset of the most recent record for it.
+      Later records for an index supersede earlier ones.
+    """
+    indexToOffset = dict()
+    with open(path, 'rb') as f:
+        for index, offset, _ in _iterRecords(f):
+            indexToOffset[index] = offset
+    return indexToOffset
+
+
+def _readRecordAt(openFile, offset):
+    openFile.seek(offset)
+    return json.loads(openFile.readline().decode('utf-8'))
+
+
+def finalizeJournal(journalPath, yamlOutputFilePath, schemaVersion, miscData,
+                    numInvocations=None, repeat=1):
+    """
+      Write a ResultInfo file to ``yamlOutputFilePath`` from the journal at
+      ``journalPath``. Only one result is held in memory at a time. If an
+      invocation index has several records only the most recent is used.
+
+      If ``repeat`` is greater than one index ``r * numInvocations + i`` is
+      taken to be repetition ``r`` of invocation ``i`` and the repetitions of
+      each invocation are written as a single merged result (see
+      ``ResultInfoUtil.merge_repeated_results()``).
+
+      The output is written to a temporary file first and then renamed so
+      that ``yamlOutputFilePath`` is never left half written.
+
+      Returns the number of results written.
+    """
+    assert isinstance(schemaVersion, int)
+    assert isinstance(miscData, dict) or miscData is None
+    assert repeat >= 1
+    assert repeat == 1 or numInvocations > 0
+    _logger.info('Finalizing journal "{}"'.format(journalPath))
+    indexToOffset = latestRecordOffsets(journalPath)
+    if repeat > 1:
+        return _finalizeRepeatedJournal(journalPath, yamlOutputFilePath,
+                                        schemaVersion, miscData,
+                                        indexToOffset, numInvocations, repeat)
+    keepOffsets = set(indexToOffset.values())
+    del indexToOffset
+
+    header = {'schema_version': schemaVersion}
+    if miscData is not None:
+        header['misc'] = miscData
+
+    tmpPath = yamlOutputFilePath + '.tmp'
+    numResults = 0
+    _logger.info('Writing output to {}'.format(yamlOutputFilePath))
+    with open(tmpPath, 'w') as outFile, open(journalPath, 'rb') as journalFile:
+        outFile.write('# Generated by klee-runner\n')
+        outFile.write(util.dumpYaml(header))
+        if len(keepOffsets) == 0:
+            outFile.write('results: []\n')
+        else:
+            outFile.write('results:\n')
+        for _, offset, record in _iterRecords(journalFile):
+            if offset not in keepOffsets:
+                continue
+            # Emit as a block sequence entry under "results"
+            outFile.write(util.dumpYaml([record['result']]))
+            numResults += 1
+    os.replace(tmpPath, yamlOutputFilePath)
+    return numResults
+
+
+def _finalizeRepeatedJournal(journalPath, yamlOutputFilePath, schemaVersion,
+                             miscData, indexToOffset, numInvocations, repeat):
+    invocationIndices = sorted(set(
+        index % numInvocations for index in indexToOffset.keys()))
+
+    header = {'schema_version': schemaVersion}
+    if miscData is not None:
+        header['misc'] = miscData
+
+    tmpPath = yamlOutputFilePath + '.tmp'
+    _logger.info('Writing merged output to {}'.format(yamlOutputFilePath))
+    with open(tmpPath, 'w') as outFile, open(journalPath, 'rb') as journalFile:
+        outFile.write('# Generated by klee-runner\n')
+        outFile.write(util.dumpYaml(header))
+        if len(invocationIndices) == 0:
+            outFile.write('results: []\n')
+        else:
+            outFile.write('results:\n')
+        for invocationIndex in invocationIndices:
+            results = []
+            for repetition in range(0, repeat):
+                offset = indexToOffset.get(
+                    repetition * numInvocations + invocationIndex, None)
+                if offset is None:
+                    results.append(None)
+                else:
+                    results.append(_readRecordAt(journalFile, offset)['result'])
+            outFile.write(util.dumpYaml(
+                [ResultInfoUtil.merge_repeated_results(results)]))
+    os.replace(tmpPath, yamlOutputFilePath)
+    return len(invocationIndices)
@@ -68,6 +68,7 @@ class KleeRunner(RunnerBaseClass):
             raise KleeRunner('attach_gdb is not supported by this runner')
 
         self.outputDir = None
+        self._toolInvocationCache = None
 
         super(KleeRunner, self).__init__(invocationInfo, workingDirectory, rc, ctx)
 
@@ -100,7 +101,13 @@ class KleeRunner(RunnerBaseClass):
         r['klee_dir'] = self.outputDir
         return r
 
-    def run(self):
+    def _toolInvocation(self):
+        """
+          Returns ``(cmdLine, envExtra)`` used to run KLEE. This is only
+          built once because it registers files with the backend.
+        """
+        if self._toolInvocationCache is not None:
+            return self._toolInvocationCache
         # Build the command line
         cmdLine = [self.toolPath] + self.additionalArgs
 
@@ -140,8 +147,16 @@ class KleeRunner(RunnerBaseClass):
         # Now add the command line arguments for program under test
         cmdLine.extend(self.InvocationInfo.CommandLineArguments)
 
-        backendResult = self.runTool(
-            cmdLine, envExtra=self.InvocationInfo.EnvironmentVariables)
+        self._toolInvocationCache = (
+            cmdLine, self.InvocationInfo.EnvironmentVariables)
+        return self._toolInvocationCache
+
+    def preparedToolInvocation(self):
+        return self._toolInvocation()
+
+    def run(self):
+        cmdLine, envExtra = self._toolInvocation()
+        backendResult = self.runTool(cmdLine, envExtra=envExtra)
         if backendResult.outOfTime:
             _logger.warning('Hard timeout hit')
 
@@ -1,11 +1,21 @@
 # vim: set sw=4 ts=4 softtabstop=4 expandtab:
+import fcntl
 import logging
 import os
+import shutil
+import subprocess
 import tempfile
+import threading
 from . RunnerBase import RunnerBaseClass
+from .. import ResultCache
+from .. Backends.BackendBase import BackendResult
 
 _logger = logging.getLogger(__name__)
 
+# Serialises merging into coverage directories. The ``fcntl`` locks (which the
+# gcov runtime also takes) do not exclude other threads of this process.
+_coverageMergeLock = threading.Lock()
+
 
 class NativeReplayRunnerException(Exception):
 
@@ -14,6 +24,66 @@ class NativeReplayRunnerException(Exception):
         self.msg = msg
 
 
+def _mergeGcdaFile(gcovTool, src, dest):
+    """
+      Add the counters in the ``.gcda`` file ``src`` to those in ``dest``
+      (which is created if it does not exist).
+    """
+    with open(src, 'rb') as f:
+        data = f.read()
+    fd = os.open(dest, os.O_RDWR | os.O_CREAT, 0o644)
+    with os.fdopen(fd, 'r+b') as f:
+        # Lock like the gcov runtime does when a program exits so that jobs
+        # writing to the directory directly are not lost.
+        fcntl.lockf(f, fcntl.LOCK_EX)
+        existing = f.read()
+        if len(existing) > 0:
+            # gcov-tool merges the files with the same relative path in two
+            # directories.
+            fileName = os.path.basename(dest)
+            tmpDir = tempfile.mkdtemp()
+            try:
+                for name, contents in (('a', existing), ('b', data)):
+                    os.mkdir(os.path.join(tmpDir, name))
+                    with open(os.path.join(tmpDir, name, fileName), 'wb') as g:
+                        g.write(contents)
+                outDir = os.path.join(tmpDir, 'out')
+                cmdLine = [gcovTool, 'merge', '-o', outDir,
+                           os.path.join(tmpDir, 'a'), os.path.join(tmpDir, 'b')]
+                try:
+                    subprocess.check_output(cmdLine, stderr=subprocess.STDOUT)
+                except subprocess.CalledProcessError as e:
+                    raise NativeReplayRunnerException(
+                        'Failed to merge "{}" into "{}": {}'.format(
+                            src, dest, e.output.decode(errors='replace')))
+                with open(os.path.join(outDir, fileName), 'rb') as g:
+                    data = g.read()
+            finally:
+                shutil.rmtree(tmpDir, ignore_errors=True)
+        f.seek(0)
+        f.truncate()
+        f.write(data)
+
+
+def mergeCoverageDir(gcovTool, src, dest):
+    """
+      Merge the coverage files in ``src`` into ``dest`` preserving the
+      directory structure. The counters of ``.gcda`` files are summed using
+      ``gcovTool`` and other files are copied.
+    """
+    with _coverageMergeLock:
+        for dirpath, _, filenames in os.walk(src):
+            destDir = os.path.join(dest, os.path.relpath(dirpath, src))
+            os.makedirs(destDir, exist_ok=True)
+            for filename in filenames:
+                srcFile = os.path.join(dirpath, filename)
+                destFile = os.path.join(destDir, filename)
+                if filename.endswith('.gcda'):
+                    _mergeGcdaFile(gcovTool, srcFile, destFile)
+                else:
+                    shutil.copy2(srcFile, destFile)
+
+
 class NativeReplayRunner(RunnerBaseClass):
 
     def __init__(self, invocationInfo, workingDirectory, rc, ctx):
@@ -37,9 +107,12 @@ class NativeReplayRunner(RunnerBaseClass):
         if not isinstance(self._attach_gdb, bool):
             raise NativeReplayRunnerException('Invocation info "attach_gdb" should be a bool')
 
+        self._toolInvocationCache = None
+        self._privateCoverageDir = None
         super(NativeReplayRunner, self).__init__(
             invocationInfo, workingDirectory, rc, ctx)
         self.toolPath = None
+        self._setupResultCache(rc)
 
         # Disallow client using environment variable which we use
         if ('KTEST_FILE' in invocationInfo.EnvironmentVariables or
@@ -62,14 +135,144 @@ class NativeReplayRunner(RunnerBaseClass):
                     raise NativeReplayRunnerException(
                         '"{}" is not allowed as an environment variable'.format(env_var_to_check))
 
+            if self._resultCache is not None and shutil.which(self._gcovTool) is None:
+                raise NativeReplayRunnerException(
+                    'gcov tool "{}" (needed to merge cached coverage) could not be found'.format(
+                        self._gcovTool))
+
+    def _setupResultCache(self, rc):
+        self._resultCache = None
+        self._cacheHit = False
+        self._killed = False
+        if 'result_cache' not in rc:
+            return
+        cacheConfig = rc['result_cache']
+        if not isinstance(cacheConfig, dict):
+            raise NativeReplayRunnerException(
+                '"result_cache" must map to a dictionary')
+        for key in cacheConfig.keys():
+            if key not in ('directory', 'max_size', 'gcov_tool'):
+                raise NativeReplayRunnerException(
+                    '"{}" is not a valid "result_cache" option'.format(key))
+        if not isinstance(cacheConfig.get('directory', None), str):
+            raise NativeReplayRunnerException(
+                '"result_cache" must have a "directory" string')
+        directory = os.path.expanduser(cacheConfig['directory'])
+        if not os.path.isabs(directory):
+            raise NativeReplayRunnerException(
+                '"result_cache" "directory" must be an absolute path')
+        maxSize = cacheConfig.get('max_size', 1024)
+        if not isinstance(maxSize, int) or maxSize <= 0:
+            raise NativeReplayRunnerException(
+                '"result_cache" "max_size" must be an integer > 0')
+        self._gcovTool = cacheConfig.get('gcov_tool', 'gcov-tool')
+        if not isinstance(self._gcovTool, str):
+            raise NativeReplayRunnerException(
+                '"result_cache" "gcov_tool" must be a string')
+
+        # Everything in the runner config (apart from where results are
+        # cached) can affect the result
+        self._cachedRunnerConfig = dict(rc)
+        del self._cachedRunnerConfig['result_cache']
+
+        # The cache is shared by all runners
+        objectName = 'NativeReplay.ResultCache:{}'.format(directory)
+        self._resultCache, success = self.ctx.get_object(objectName)
+        if not success:
+            self._resultCache = ResultCache.ResultCache(directory, maxSize)
+            if not self.ctx.add_object(objectName, self._resultCache):
+                # Another runner created it first
+                self._resultCache, _ = self.ctx.get_object(objectName)
+
     @property
     def name(self):
         return "Native replay"
 
     def getResults(self):
         r = super(NativeReplayRunner, self).getResults()
+        if self._resultCache is not None:
+            r['cache_hit'] = self._cacheHit
         return r
 
+    def _resultCacheKey(self, cmdLine, env):
+        """
+          Returns the key for this job in the result cache or None if the
+          job should not be cached.
+        """
+        if self._attach_gdb:
+            return None
+        # The contents of the KTest file is hashed so its path is not used
+        env = dict(env)
+        for name in ('KTEST_FILE', 'GCOV_PREFIX'):
+            env.pop(name, None)
+        env.update(self.toolEnvironmentVariables)
+        return self._resultCache.computeKey(
+            [self.program, self.InvocationInfo.KTestFile],
+            {
+                'runner': 'NativeReplay',
+                'command_line': cmdLine,
+                'env': env,
+                'coverage': self.InvocationInfo.CoverageDir is not None,
+                'runner_config': self._cachedRunnerConfig,
+            })
+
+    def _useCachedResult(self, entry):
+        """
+          Use the result in ``entry`` for this job. Returns False if the
+          files of the entry could not be copied (e.g. because it was evicted
+          after it was looked up) in which case the job must be run.
+        """
+        r = entry.result
+        try:
+            shutil.copy2(entry.logFile, self.logFile)
+            if entry.coverageDir is not None and self._privateCoverageDir is not None:
+                ResultCache.copyTree(entry.coverageDir, self._privateCoverageDir)
+        except OSError as e:
+            _logger.warning('Failed to use cached result: {}'.format(e))
+            if self._privateCoverageDir is not None:
+                # Remove any files that were copied
+                shutil.rmtree(self._privateCoverageDir)
+                os.mkdir(self._privateCoverageDir)
+            return False
+        self._backendResult = BackendResult(
+            r['exit_code'], r['wallclock_time'], False, False,
+            r['user_cpu_time'], r['sys_cpu_time'])
+        self._cacheHit = True
+        return True
+
+    def _storeResult(self, cacheKey):
+        result = self._backendResult
+        if self._killed or result.outOfTime or result.outOfMemory:
+            # Not a result of the inputs alone
+            return
+        if result.logFilePath is not None or result.logTruncated:
+            # The cache only holds complete uncompressed logs
+            return
+        try:
+            self._resultCache.store(
+                cacheKey,
+                {
+                    'exit_code': result.exitCode,
+                    'wallclock_time': result.runTime,
+                    'user_cpu_time': result.userCpuTime,
+                    'sys_cpu_time': result.sysCpuTime,
+                },
+                self.logFile,
+                self._privateCoverageDir)
+        except OSError as e:
+            _logger.warning('Failed to store result in cache: {}'.format(e))
+
+    def _mergeCoverage(self):
+        if self._privateCoverageDir is None:
+            return
+        mergeCoverageDir(self._gcovTool, self._privateCoverageDir,
+                         self.InvocationInfo.CoverageDir)
+        shutil.rmtree(self._privateCoverageDir)
+
+    def kill(self, pause=0.0):
+        self._killed = True
+        super(NativeReplayRunner, self).kill(pause)
+
     def _checkToolExistsInBackend(self):
         # There is no "tool" here so don't check if it exists.
         pass
@@ -78,8 +281,16 @@ class NativeReplayRunner(RunnerBaseClass):
         self.toolPath = None
 
     def run(self):
+        self._runToolInvocations()
+
+    def _toolInvocation(self):
+        """
+          Returns ``(cmdLine, env)`` used to replay the KTest file. This is
+          only built once because it registers files with the backend.
+        """
+        if self._toolInvocationCache is not None:
+            return self._toolInvocationCache
         # Build the command line
-        cmdLine = [self.toolPath] + self.additionalArgs
         cmdLine = [self.programPathArgument] + self.additionalArgs
 
         # Make sure the backend knows that this file needs to be available in
@@ -94,14 +305,44 @@ class NativeReplayRunner(RunnerBaseClass):
             self.InvocationInfo.KTestFile)
 
         if self.InvocationInfo.CoverageDir is not None:
+            coverageDir = self.InvocationInfo.CoverageDir
+            if self._resultCache is not None:
+                # The coverage directory may be shared by other jobs so the
+                # job writes to its own directory (which can be cached) that
+                # is merged into the coverage directory afterwards.
+                self._privateCoverageDir = os.path.join(
+                    self.workingDirectory, 'gcov_prefix')
+                os.mkdir(self._privateCoverageDir)
+                coverageDir = self._privateCoverageDir
             # NOTE: Coverage directory must be writable
-            self._backend.addFileToBackend(self.InvocationInfo.CoverageDir, read_only=False)
+            self._backend.addFileToBackend(coverageDir, read_only=False)
             # This is Gcov specific. This will tell the instrumented binary
             # to emit all `*.gcda` files into a path prefixed by this path.
-            env['GCOV_PREFIX'] = self._backend.getFilePathInBackend(
-                self.InvocationInfo.CoverageDir)
+            env['GCOV_PREFIX'] = self._backend.getFilePathInBackend(coverageDir)
             # Don't strip anything off the initial hardwired paths.
             env['GCOV_PREFIX_STRIP'] = "0"
+        self._toolInvocationCache = (cmdLine, env)
+        return self._toolInvocationCache
+
+    def preparedToolInvocation(self):
+        if self._attach_gdb or self._resultCache is not None:
+            # The tool might not be run with this command line
+            return None
+        return self._toolInvocation()
+
+    def toolInvocations(self):
+        cmdLine, env = self._toolInvocation()
+
+        cacheKey = None
+        if self._resultCache is not None:
+            cacheKey = self._resultCacheKey(cmdLine, env)
+            if cacheKey is not None:
+                entry = self._resultCache.lookup(cacheKey)
+                if entry is not None:
+                    _logger.info('Using cached result {}'.format(cacheKey))
+                    if self._useCachedResult(entry):
+                        self._mergeCoverage()
+                        return
 
         gdb_script_file = None
         try:
@@ -128,9 +369,13 @@ class NativeReplayRunner(RunnerBaseClass):
                     '--args', # Give remaining arguments to the program
                 ] + cmdLine
 
-            backendResult = self.runTool(cmdLine, envExtra=env)
+            backendResult = yield (cmdLine, env)
+            self._backendResult = backendResult
             if backendResult.outOfTime:
                 _logger.warning('Hard timeout hit')
+            if cacheKey is not None:
+                self._storeResult(cacheKey)
+            self._mergeCoverage()
         finally:
             if gdb_script_file is not None:
                 gdb_script_file.close()
@@ -211,24 +211,24 @@ class RunnerBaseClass(metaclass=abc.ABCMeta):
     _initLock = threading.Lock()
 
     def __init__(self, invocationInfo, workingDirectory, rc, ctx):
+        _logger.debug('Initialising {}'.format(invocationInfo.Program))
+        # Runners may be created in parallel so only the allocation of the
+        # unique ID is serialised. Anything shared between runners must be
+        # accessed through the RunnerContext.
         with RunnerBaseClass._initLock:
-            _logger.debug('Initialising {}'.format(invocationInfo.Program))
-
-            # Unique ID (we assume this constructor is never called in
-            # parallel)
             self.uid = RunnerBaseClass.staticCounter
             RunnerBaseClass.staticCounter += 1
 
-            self._backendResult = None
-            self._invocationInfo = invocationInfo
+        self._backendResult = None
+        self._invocationInfo = invocationInfo
 
-            self._checkProgramPath()
-            self._setupWorkingDirectory(workingDirectory)
+        self._checkProgramPath()
+        self._setupWorkingDirectory(workingDirectory)
 
-            self._readConfig(rc)
-            self._ctx = ctx
-            assert isinstance(self._ctx, RunnerContext.RunnerContext)
-            self._setupBackend(rc)
+        self._readConfig(rc)
+        self._ctx = ctx
+        assert isinstance(self._ctx, RunnerContext.RunnerContext)
+        self._setupBackend(rc)
 
     @property
     def logFile(self):
@@ -262,10 +262,21 @@ class RunnerBaseClass(metaclass=abc.ABCMeta):
         results['working_directory'] = self.workingDirectory
         results['exit_code'] = self.exitCode
         results['out_of_memory'] = self.ranOutOfMemory
-        results['log_file'] = self.logFile
+        if self._backendResult.logFilePath is not None:
+            results['log_file'] = self._backendResult.logFilePath
+        else:
+            results['log_file'] = self.logFile
         results['user_cpu_time'] = self._backendResult.userCpuTime
         results['sys_cpu_time'] = self._backendResult.sysCpuTime
         results['backend_timeout'] = self._backendResult.outOfTime
+        if self._backendResult.peakMemory is not None:
+            results['peak_memory'] = self._backendResult.peakMemory
+        if self._backendResult.logTruncated is not None:
+            results['log_truncated'] = self._backendResult.logTruncated
+        if self._backendResult.teardownTime is not None:
+            results['teardown_time'] = self._backendResult.teardownTime
+        if self._backendResult.resourceUsage is not None:
+            results.update(self._backendResult.resourceUsage)
         results['invocation_info'] = copy.deepcopy(
             self.InvocationInfo.GetInternalRepr())
         return results
@@ -291,6 +302,13 @@ class RunnerBaseClass(metaclass=abc.ABCMeta):
         """
         return self._backend.workingDirectoryInternal
 
+    def memoryUsage(self):
+        """
+          Returns the memory in MiB currently used by the tool or None
+          if this is unknown.
+        """
+        return self._backend.memoryUsage()
+
     def kill(self, pause=0.0):
         """
         Subclasses need to override this if their
@@ -299,10 +317,64 @@ class RunnerBaseClass(metaclass=abc.ABCMeta):
         _logger.debug('Trying to kill {}'.format(self.name))
         self._backend.kill()
 
-    def runTool(self, cmdLine, envExtra={}):
+    def toolInvocations(self):
+        """
+          Generator that does the same as ``run()`` but rather than calling
+          ``runTool()`` it yields ``(cmdLine, envExtra)`` for every run of
+          the tool and is sent the resulting ``BackendResult``. This allows
+          the tool to be run without blocking a thread (see
+          ``KleeRunner.AsyncEngine``). Runners that do not support this
+          return None.
+        """
+        return None
+
+    def preparedToolInvocation(self):
+        """
+          Returns ``(cmdLine, envExtra)`` that ``run()`` will pass to
+          ``runTool()`` if it is known before the runner runs. Otherwise
+          returns None.
+        """
+        return None
+
+    def prepare(self):
+        """
+          Let the backend do set up for ``run()`` ahead of time. This is
+          called by ``JobPreparer`` after the runner is created.
+        """
+        if not self._backend.supportsPrepareRun:
+            return
+        invocation = self.preparedToolInvocation()
+        if invocation is None:
+            return
+        cmdLine, envExtra = invocation
+        self._backend.prepareRun(cmdLine, self.logFile, self.toolEnvironment(envExtra))
+
+    def _runToolInvocations(self):
+        # run() for runners that implement toolInvocations()
+        invocations = self.toolInvocations()
+        try:
+            request = next(invocations)
+            while True:
+                cmdLine, envExtra = request
+                request = invocations.send(self.runTool(cmdLine, envExtra))
+        except StopIteration:
+            pass
+
+    @property
+    def backend(self):
+        return self._backend
+
+    def toolEnvironment(self, envExtra={}):
+        """
+          Returns the environment variables to run the tool with.
+        """
         env = {}
         env.update(self.toolEnvironmentVariables)
         env.update(envExtra)  # These take precendence
+        return env
+
+    def runTool(self, cmdLine, envExtra={}):
+        env = self.toolEnvironment(envExtra)
 
         _logger.info('Running:\n{}\nwith env:{}'.format(
             pprint.pformat(cmdLine),
@@ -0,0 +1,198 @@
+# vim: set sw=4 ts=4 softtabstop=4 expandtab:
+"""
+  Layout of the working directories inside the working directory root of
+  a batch run.
+
+  * ``flat`` - ``workdir-<index>`` directly in the root.
+  * ``bucketed`` - ``<index / 10^6 % 1000>/<index / 1000 % 1000>/workdir-<index>``
+    so that no directory holds more than 1000 entries.
+  * ``hashed`` - ``<h[0:2]>/<h[2:4]>/workdir-<index>`` where ``h`` is the
+    hex SHA-256 of the index, spreading consecutive indices over 65536
+    directories.
+
+  The layouts other than ``flat`` write an index file (``workdir-index.jsonl``)
+  to the root. Its first line records the layout and every other line
+  maps an invocation index to the path of its working directory relative
+  to the root. Tools should use the index rather than scanning the root.
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+
+_logger = logging.getLogger(__name__)
+
+INDEX_FILE_NAME = 'workdir-index.jsonl'
+
+LAYOUTS = ['flat', 'bucketed', 'hashed']
+
+_WORKDIR_RE = re.compile(r'^workdir-(\d+)$')
+
+
+class WorkDirLayoutException(Exception):
+    def __init__(self, msg):
+        # pylint: disable=super-init-not-called
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+
+def relativePath(layout, index):
+    """
+      Returns the path of the working directory of invocation ``index``
+      relative to the root for ``layout``.
+    """
+    name = 'workdir-{}'.format(index)
+    if layout == 'flat':
+        return name
+    if layout == 'bucketed':
+        return os.path.join('{:03d}'.format(index // 10**6 % 1000),
+                            '{:03d}'.format(index // 1000 % 1000),
+                            name)
+    if layout == 'hashed':
+        h = hashlib.sha256(str(index).encode()).hexdigest()
+        return os.path.join(h[0:2], h[2:4], name)
+    raise WorkDirLayoutException('Unknown working directory layout "{}"'.format(layout))
+
+
+def readIndex(workDirsRoot):
+    """
+      Returns a tuple ``(layout, indexToPath)`` from the index file in
+      ``workDirsRoot`` where ``indexToPath`` maps invocation indices to
+      relative paths. Returns ``(None, None)`` if there is no index file.
+    """
+    indexFile = os.path.join(workDirsRoot, INDEX_FILE_NAME)
+    if not os.path.exists(indexFile):
+        return (None, None)
+    layout = None
+    indexToPath = dict()
+    with open(indexFile, 'r') as f:
+        for lineNumber, line in enumerate(f):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A partially written final line
+                _logger.warning('Ignoring malformed line {} of "{}"'.format(
+                    lineNumber + 1, indexFile))
+                continue
+            if lineNumber == 0:
+                layout = record['layout']
+                continue
+            indexToPath[record['index']] = record['path']
+    return (layout, indexToPath)
+
+
+class WorkDirLayout:
+    """
+      Creates working directories in ``workDirsRoot`` using ``layout``.
+    """
+    def __init__(self, workDirsRoot, layout='flat'):
+        assert os.path.isabs(workDirsRoot)
+        if layout not in LAYOUTS:
+            raise WorkDirLayoutException(
+                'Unknown working directory layout "{}"'.format(layout))
+        self._workDirsRoot = workDirsRoot
+        self._layout = layout
+        self._lock = threading.Lock()
+
+    @property
+    def layout(self):
+        return self._layout
+
+    @property
+    def indexFile(self):
+        return os.path.join(self._workDirsRoot, INDEX_FILE_NAME)
+
+    def initIndex(self):
+        """
+          Create the index file if the layout needs one. If it already
+          exists (e.g. when resuming) check it is for the same layout.
+        """
+        if self._layout == 'flat':
+            if os.path.exists(self.indexFile):
+                raise WorkDirLayoutException(
+                    '"{}" exists but the working directory layout is flat'.format(
+                        self.indexFile))
+            return
+        if os.path.exists(self.indexFile):
+            existingLayout, _ = readIndex(self._workDirsRoot)
+            if existingLayout != self._layout:
+                raise WorkDirLayoutException(
+                    'Working directory layout is "{}" but "{}" is for "{}"'.format(
+                        self._layout, self.indexFile, existingLayout))
+            return
+        with open(self.indexFile, 'w') as f:
+            f.write(json.dumps({'layout': self._layout, 'version': 1}) + '\n')
+
+    def path(self, index):
+        return os.path.join(self._workDirsRoot, relativePath(self._layout, index))
+
+    def create(self, index):
+        """
+          Create the working directory for ``index`` (which must not exist)
+          and record it in the index. Returns its path.
+        """
+        workDir = self.path(index)
+        if self._layout == 'flat':
+            os.mkdir(workDir)
+            return workDir
+        os.makedirs(os.path.dirname(workDir), exist_ok=True)
+        os.mkdir(workDir)
+        line = json.dumps({
+            'index': index,
+            'path': relativePath(self._layout, index)}) + '\n'
+        # Other processes (e.g. --worker-processes) may append to the index
+        # at the same time so each line is written with a single write().
+        with self._lock:
+            fd = os.open(self.indexFile, os.O_WRONLY | os.O_APPEND)
+            try:
+                os.write(fd, line.encode())
+            finally:
+                os.close(fd)
+        return workDir
+
+
+def relocateResults(rawResults, workDirsRoot):
+    """
+      Rewrite the paths (``working_directory``, ``log_file`` and
+      ``klee_dir``) of the raw ResultInfos in ``rawResults`` to point inside
+      ``workDirsRoot``, resolving each working directory through the index
+      in ``workDirsRoot``. This allows results to be analysed after the
+      working directories have been moved. Paths that are not inside a
+      working directory or whose index is unknown are left alone.
+    """
+    layout, indexToPath = readIndex(workDirsRoot)
+    if layout is None:
+        _logger.info('No index in "{}". Assuming flat layout'.format(workDirsRoot))
+
+    def relocate(path):
+        if not isinstance(path, str):
+            return path
+        parts = path.split(os.sep)
+        for position in range(len(parts) - 1, -1, -1):
+            m = _WORKDIR_RE.match(parts[position])
+            if m is None:
+                continue
+            index = int(m.group(1))
+            if indexToPath is None:
+                relPath = relativePath('flat', index)
+            elif index in indexToPath:
+                relPath = indexToPath[index]
+            else:
+                _logger.warning('Index {} is not in the index of "{}"'.format(
+                    index, workDirsRoot))
+                return path
+            return os.path.join(workDirsRoot, relPath, *parts[position + 1:])
+        return path
+
+    for r in rawResults:
+        for key in ('working_directory', 'log_file', 'klee_dir'):
+            if key not in r:
+                continue
+            if isinstance(r[key], list):
+                r[key] = [relocate(p) for p in r[key]]
+            else:
+                r[key] = relocate(r[key])
@@ -0,0 +1,97 @@
+# vim: set sw=4 ts=4 softtabstop=4 expandtab:
+import os
+import psutil
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+from . import MemoryMonitor
+
+
+@unittest.skipIf(sys.version_info < (3, 8), 'AsyncSupervisor requires Python >= 3.8')
+class AsyncSupervisorTests(unittest.TestCase):
+    def setUp(self):
+        # AsyncSupervisor refuses to run before Python 3.8 so, like
+        # batch-runner.py, only import it when it is used.
+        from . import AsyncSupervisor
+        self.module = AsyncSupervisor
+        self.tmpDir = tempfile.mkdtemp()
+        self.logFile = os.path.join(self.tmpDir, 'log.txt')
+        self.pidFile = os.path.join(self.tmpDir, 'pid')
+        self.supervisor = self.module.AsyncSupervisor()
+        self.memoryMonitor = None
+
+    def tearDown(self):
+        self.supervisor.stop()
+        if self.memoryMonitor is not None:
+            self.memoryMonitor.stop()
+        shutil.rmtree(self.tmpDir)
+
+    def runProcess(self, cmdLine, timeLimit=0, supervised=None):
+        if supervised is None:
+            supervised = self.module.SupervisedProcess(0)
+        return self.supervisor.submit(self.supervisor.runProcessAsync(
+            supervised, cmdLine, self.tmpDir, self.logFile, {}, timeLimit,
+            killGracePeriod=0.5)).result()
+
+    def assertNotRunning(self, pid):
+        # Killed orphans may be left as zombies if init is slow to reap them
+        try:
+            self.assertEqual(psutil.Process(pid).status(), psutil.STATUS_ZOMBIE)
+        except psutil.NoSuchProcess:
+            pass
+
+    def readPid(self):
+        with open(self.pidFile, 'r') as f:
+            return int(f.read())
+
+    def testExitCodeLogAndResourceUsage(self):
+        result = self.runProcess(['/bin/sh', '-c',
+            'i=0; while [ $i -lt 100000 ]; do i=$((i+1)); done; echo hello; exit 3'])
+        self.assertEqual(result.exitCode, 3)
+        self.assertFalse(result.outOfTime)
+        self.assertFalse(result.outOfMemory)
+        self.assertGreater(result.userCpuTime + result.sysCpuTime, 0.0)
+        self.assertGreater(result.resourceUsage['max_rss'], 0.0)
+        with open(self.logFile, 'r') as f:
+            self.assertEqual(f.read(), 'hello\n')
+
+    def testStragglerKilled(self):
+        # The tool exits leaving a descendant running
+        result = self.runProcess(['/bin/sh', '-c',
+                                  'sleep 30 & echo $! > {}'.format(self.pidFile)])
+        self.assertEqual(result.exitCode, 0)
+        self.assertLess(result.teardownTime, 1.0)
+        self.assertNotRunning(self.readPid())
+
+    def testTimeLimitKillsGroup(self):
+        # The tool ignores SIGTERM so SIGKILL is needed
+        result = self.runProcess(['/bin/sh', '-c',
+            "trap '' TERM; sleep 30 & echo $! > {}; wait".format(self.pidFile)],
+            timeLimit=1)
+        self.assertTrue(result.outOfTime)
+        self.assertIsNone(result.exitCode)
+        self.assertLess(result.runTime, 10.0)
+        self.assertNotRunning(self.readPid())
+
+    def testMemoryLimit(self):
+        self.memoryMonitor = MemoryMonitor.MemoryMonitor(0.05)
+        supervised = self.module.SupervisedProcess(50, self.memoryMonitor)
+        result = self.runProcess(
+            [sys.executable, '-c', 'import time; x = bytearray(200 * 2**20); time.sleep(30)'],
+            supervised=supervised)
+        self.assertTrue(result.outOfMemory)
+        self.assertLess(result.runTime, 10.0)
+        self.assertEqual(self.memoryMonitor.stats()['monitored_jobs'], 0)
+
+    def testKill(self):
+        supervised = self.module.SupervisedProcess(0)
+        timer = threading.Timer(0.5, self.supervisor.kill, args=(supervised,))
+        timer.start()
+        result = self.runProcess(['/bin/sleep', '30'], supervised=supervised)
+        timer.join()
+        self.assertNotEqual(result.exitCode, 0)
+        self.assertFalse(result.outOfTime)
+        self.assertEqual(self.supervisor.numRunning, 0)
@@ -0,0 +1,61 @@
+# vim: set sw=4 ts=4 softtabstop=4 expandtab:
+import os
+import shutil
+import tempfile
+import unittest
+
+from .Backends import Cgroup
+
+
+class CgroupLeafTests(unittest.TestCase):
+    """
+      Uses an ordinary directory in place of cgroupfs.
+    """
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.leaf = Cgroup.CgroupLeaf(os.path.join(self.tmpDir, 'job-0'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def readFile(self, name):
+        with open(os.path.join(self.leaf.path, name), 'r') as f:
+            return f.read()
+
+    def writeFile(self, name, data):
+        with open(os.path.join(self.leaf.path, name), 'w') as f:
+            f.write(data)
+
+    def testCreateSetsLimits(self):
+        self.leaf.create(16, cpusetCpus='0-1')
+        self.assertEqual(self.readFile('memory.max'), str(16 * 2**20))
+        self.assertEqual(self.readFile('memory.oom.group'), '1')
+        self.assertEqual(self.readFile('cpuset.cpus'), '0-1')
+        self.assertFalse(os.path.exists(os.path.join(self.leaf.path, 'cpuset.mems')))
+
+    def testCreateWithoutMemoryLimit(self):
+        self.leaf.create(0)
+        self.assertEqual(os.listdir(self.leaf.path), [])
+
+    def testAccounting(self):
+        self.leaf.create(0)
+        self.writeFile('cpu.stat', 'usage_usec 3500000\nuser_usec 2500000\nsystem_usec 1000000\n')
+        self.writeFile('memory.peak', str(3 * 2**20))
+        self.writeFile('memory.events', 'low 0\nhigh 0\nmax 4\noom 1\noom_kill 1\n')
+        self.assertEqual(self.leaf.cpuTimes(), (2.5, 1.0))
+        self.assertEqual(self.leaf.peakMemory(), 3.0)
+        self.assertTrue(self.leaf.oomKilled())
+
+    def testMissingMemoryController(self):
+        self.leaf.create(0)
+        self.assertIsNone(self.leaf.peakMemory())
+        self.assertIsNone(self.leaf.currentMemory())
+        self.assertFalse(self.leaf.oomKilled())
+
+    def testKillAndWait(self):
+        self.leaf.create(0)
+        self.writeFile('cgroup.events', 'populated 0\nfrozen 0\n')
+        self.assertTrue(self.leaf.killAndWait())
+        self.writeFile('cgroup.events', 'populated 1\nfrozen 0\n')
+        self.assertFalse(self.leaf.killAndWait(timeout=0.05))
+        self.assertEqual(self.readFile('cgroup.kill'), '1')
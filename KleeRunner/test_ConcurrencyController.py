@@ -0,0 +1,103 @@
+# vim: set sw=4 ts=4 softtabstop=4 expandtab:
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from . import ConcurrencyController
+
+
+def _sample(cpuPressure=0.0, memoryPressure=0.0, loadPerCPU=0.5,
+            memoryAvailable=0.5):
+    return {
+        'cpu_pressure': cpuPressure,
+        'memory_pressure': memoryPressure,
+        'load_per_cpu': loadPerCPU,
+        'memory_available': memoryAvailable,
+    }
+
+
+class ReadPressureTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def testReadSomeAvg10(self):
+        with open(os.path.join(self.tmpDir, 'cpu'), 'w') as f:
+            f.write('some avg10=12.50 avg60=3.00 avg300=1.00 total=100\n'
+                    'full avg10=0.00 avg60=0.00 avg300=0.00 total=0\n')
+        self.assertEqual(
+            ConcurrencyController.readPressure('cpu', self.tmpDir), 12.5)
+
+    def testMissing(self):
+        self.assertIsNone(
+            ConcurrencyController.readPressure('memory', self.tmpDir))
+
+
+class ConcurrencyControllerTests(unittest.TestCase):
+    def setUp(self):
+        self.limiter = ConcurrencyController.SlotLimiter(8)
+        self.controller = ConcurrencyController.ConcurrencyController(
+            self.limiter, 2, 10)
+
+    def fillSlots(self):
+        while self.limiter.running < self.limiter.limit:
+            self.assertTrue(self.limiter.acquire())
+
+    def testDecreaseUnderPressure(self):
+        self.assertEqual(self.controller.adjust(_sample(cpuPressure=60.0)), 6)
+        self.assertEqual(self.controller.adjust(_sample(memoryAvailable=0.05)), 5)
+        for _ in range(0, 5):
+            self.controller.adjust(_sample(memoryPressure=50.0))
+        self.assertEqual(self.limiter.limit, 2)
+
+    def testIncreaseOnlyWhenSlotsBusy(self):
+        self.assertEqual(self.controller.adjust(_sample()), 8)
+        self.fillSlots()
+        self.assertEqual(self.controller.adjust(_sample()), 9)
+        self.fillSlots()
+        self.assertEqual(self.controller.adjust(_sample()), 10)
+        self.assertEqual(self.controller.adjust(_sample()), 10)
+        stats = self.controller.stats()
+        self.assertEqual(stats['increases'], 2)
+        self.assertEqual(stats['highest_limit'], 10)
+
+    def testHoldBetweenThresholds(self):
+        self.fillSlots()
+        self.assertEqual(self.controller.adjust(_sample(cpuPressure=20.0)), 8)
+
+    def testLoadOnlyUsedWithoutCPUPressure(self):
+        self.assertEqual(self.controller.adjust(_sample(loadPerCPU=3.0)), 8)
+        self.assertEqual(
+            self.controller.adjust(_sample(cpuPressure=None, loadPerCPU=3.0)), 6)
+
+
+class SlotLimiterTests(unittest.TestCase):
+    def testLoweringLimitBlocksNewJobs(self):
+        limiter = ConcurrencyController.SlotLimiter(2)
+        self.assertTrue(limiter.acquire())
+        self.assertTrue(limiter.acquire())
+        limiter.setLimit(1)
+        acquired = threading.Event()
+
+        def waiter():
+            if limiter.acquire():
+                acquired.set()
+
+        thread = threading.Thread(target=waiter)
+        thread.start()
+        limiter.release()
+        # Still one job running which is the new limit
+        self.assertFalse(acquired.wait(0.1))
+        limiter.release()
+        self.assertTrue(acquired.wait(5))
+        thread.join()
+
+    def testStop(self):
+        limiter = ConcurrencyController.SlotLimiter(1)
+        self.assertTrue(limiter.acquire())
+        limiter.stop()
+        self.assertFalse(limiter.acquire())
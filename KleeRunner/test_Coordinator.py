@@ -0,0 +1,109 @@
+# vim: set sw=4 ts=4 softtabstop=4 expandtab:
+import threading
+import unittest
+
+from . import Coordinator
+from . import InvocationInfo
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def _invocationInfos(count):
+    return [InvocationInfo.InvocationInfo({
+        'program': '/bin/prog{}'.format(i),
+        'command_line_arguments': [],
+        'environment_variables': {}}) for i in range(count)]
+
+
+class JobCoordinatorTests(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.results = {}
+        self.coordinator = Coordinator.JobCoordinator(
+            [[0], [1, 2], [3]], _invocationInfos(4),
+            lambda index, result: self.results.__setitem__(index, result),
+            leaseTimeout=10.0, clock=self.clock)
+
+    def _completeLease(self, workerId, lease):
+        for index in lease['indices']:
+            self.assertTrue(self.coordinator.complete(
+                workerId, lease['lease'], index, {'index': index}))
+
+    def testAllTasksComplete(self):
+        while True:
+            leases, finished = self.coordinator.lease('a', 2)
+            if finished:
+                break
+            for lease in leases:
+                self.assertEqual(
+                    [i['program'] for i in lease['invocation_infos']],
+                    ['/bin/prog{}'.format(i) for i in lease['indices']])
+                self._completeLease('a', lease)
+        self.assertEqual(sorted(self.results.keys()), [0, 1, 2, 3])
+        self.assertTrue(self.coordinator.waitUntilFinished(0))
+        self.assertEqual(self.coordinator.unfinishedTasks(), [])
+
+    def testExpiredLeaseIsRequeued(self):
+        deadLeases, _ = self.coordinator.lease('dead', 2)
+        self.assertEqual([l['indices'] for l in deadLeases], [[0], [1, 2]])
+        # The dead worker managed to report one job of the second task
+        self.assertTrue(self.coordinator.complete('dead', deadLeases[1]['lease'], 1, {}))
+        self.clock.now = 5.0
+        self.assertEqual(self.coordinator.renew('dead', [deadLeases[0]['lease']]), [])
+        self.clock.now = 11.0
+        self.assertEqual(self.coordinator.expireLeases(), 1)
+        self.clock.now = 16.0
+        leases, finished = self.coordinator.lease('b', 3)
+        self.assertFalse(finished)
+        self.assertEqual([l['indices'] for l in leases], [[2], [0], [3]])
+        # Late results and renewals for expired leases are rejected
+        self.assertFalse(self.coordinator.complete('dead', deadLeases[1]['lease'], 2, {}))
+        self.assertEqual(self.coordinator.renew('dead', [deadLeases[0]['lease']]),
+                         [deadLeases[0]['lease']])
+        for lease in leases:
+            self._completeLease('b', lease)
+        self.assertEqual(self.coordinator.numExpiredLeases, 2)
+        self.assertTrue(self.coordinator.waitUntilFinished(0))
+        self.assertEqual(self.coordinator.workers, {'dead', 'b'})
+
+    def testNotFinishedWhileLeasesOutstanding(self):
+        leases, _ = self.coordinator.lease('a', 3)
+        self.assertEqual(self.coordinator.lease('b', 1), ([], False))
+        self.coordinator.stop()
+        self.assertEqual(self.coordinator.lease('b', 1), ([], True))
+        self.assertEqual(sorted(self.coordinator.unfinishedTasks()),
+                         sorted(l['indices'] for l in leases))
+
+
+class CoordinatorServerTests(unittest.TestCase):
+    def testWorkerProtocol(self):
+        results = {}
+        coordinator = Coordinator.JobCoordinator(
+            [[0], [1]], _invocationInfos(2),
+            lambda index, result: results.__setitem__(index, result),
+            leaseTimeout=30.0)
+        config = {'runner': 'NativeReplay', 'runner_config': {}}
+        server = Coordinator.CoordinatorServer(coordinator, ('127.0.0.1', 0), config)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            client = Coordinator.CoordinatorClient(server.server_address, 'w')
+            self.assertEqual(client.hello(), (config, 30.0))
+            leases, finished = client.lease(2)
+            self.assertFalse(finished)
+            self.assertEqual(client.renew([l['lease'] for l in leases]), [])
+            for lease in leases:
+                self.assertTrue(client.sendResult(
+                    lease['lease'], lease['indices'][0], {'exit_code': 0}))
+            self.assertEqual(client.lease(1), ([], True))
+            self.assertTrue(coordinator.waitForWorkers(0))
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(results, {0: {'exit_code': 0}, 1: {'exit_code': 0}})
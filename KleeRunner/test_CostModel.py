@@ -0,0 +1,82 @@
+# vim: set sw=4 ts=4 softtabstop=4 expandtab:
+import unittest
+
+from . import CostModel
+
+
+def _makeInvocation(program, args=None):
+    return {
+        'program': program,
+        'command_line_arguments': args if args is not None else [],
+        'ktest_file': None,
+    }
+
+
+def _makeResult(program, wallclockTime, timeout=False, args=None, oom=False):
+    return {
+        'invocation_info': _makeInvocation(program, args),
+        'wallclock_time': wallclockTime,
+        'backend_timeout': timeout,
+        'out_of_memory': oom,
+    }
+
+
+class CostModelTests(unittest.TestCase):
+    def setUp(self):
+        self.model = CostModel.CostModel(timeLimit=100)
+        self.model.addResultInfos({'results': [
+            _makeResult('/a', 10.0),
+            _makeResult('/a', 30.0, args=['x']),
+            # Killed by the timeout so it would have taken at least 100s
+            _makeResult('/b', 99.0, timeout=True),
+            _makeResult('/c', [2.0, 4.0]),
+            {'invocation_info': _makeInvocation('/d'), 'error': 'failed'},
+        ]})
+
+    def testExactPrediction(self):
+        self.assertEqual(
+            self.model.predict(_makeInvocation('/a')), (10.0, 'exact'))
+        self.assertEqual(
+            self.model.predict(_makeInvocation('/b')), (100.0, 'exact'))
+        self.assertEqual(
+            self.model.predict(_makeInvocation('/c')), (3.0, 'exact'))
+
+    def testProgramPrediction(self):
+        self.assertEqual(
+            self.model.predict(_makeInvocation('/a', ['y'])), (20.0, 'program'))
+
+    def testFallbackPrediction(self):
+        # Median of 10, 30, 100 and 3
+        self.assertEqual(
+            self.model.predict(_makeInvocation('/d')), (20.0, 'fallback'))
+        empty = CostModel.CostModel(timeLimit=5)
+        self.assertEqual(empty.predict(_makeInvocation('/a')), (5.0, 'fallback'))
+
+    def testOutOfMemoryIsLowerBound(self):
+        self.model.addResultInfos({'results': [
+            # Ran out of memory quickly. The other invocations of /a suggest
+            # it would take longer.
+            _makeResult('/a', 1.0, args=['oom'], oom=True),
+            # Ran out of memory after longer than anything else took
+            _makeResult('/e', 500.0, oom=True),
+            # Only the repetition that completed is used
+            _makeResult('/f', [1.0, 8.0], oom=[True, False]),
+        ]})
+        self.assertEqual(
+            self.model.predict(_makeInvocation('/a', ['oom'])), (20.0, 'program'))
+        self.assertEqual(
+            self.model.predict(_makeInvocation('/e')), (500.0, 'fallback'))
+        self.assertEqual(
+            self.model.predict(_makeInvocation('/f')), (8.0, 'exact'))
+        self.assertEqual(self.model.numOutOfMemory, 3)
+        # Results that ran out of memory are not observed times for the
+        # program.
+        self.assertEqual(
+            self.model.predict(_makeInvocation('/a', ['y'])), (20.0, 'program'))
+
+    def testLongestProcessingTimeFirst(self):
+        taskCosts = [('a', 1.0), ('b', 5.0), ('c', 3.0), ('d', 5.0)]
+        ordered = CostModel.longestProcessingTimeFirst(taskCosts)
+        self.assertEqual([t for t, _ in ordered], ['b', 'd', 'c', 'a'])
+        self.assertEqual(CostModel.predictMakespan([1.0, 1.0, 5.0], 2), 6.0)
+        self.assertEqual(CostModel.predictMakespan([5.0, 1.0, 1.0], 2), 5.0)
@@ -0,0 +1,125 @@
+# vim: set sw=4 ts=4 softtabstop=4 expandtab:
+import os
+import shutil
+import tempfile
+import unittest
+
+from . import CpuTopology
+
+
+def writeFile(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(data + '\n')
+
+
+def makeFakeSysfs(root, cores, nodes, withCaches=True):
+    """
+      Write a fake ``/sys/devices/system`` to ``root``. ``cores`` is a list
+      of the SMT siblings of each core and ``nodes`` a list of the CPUs in
+      each NUMA node (which is also its L3 cache).
+    """
+    cpuIds = sorted(c for core in cores for c in core)
+    writeFile(os.path.join(root, 'cpu', 'online'), CpuTopology.formatCpuList(cpuIds))
+    for core in cores:
+        for cpuId in core:
+            cpuDir = os.path.join(root, 'cpu', 'cpu{}'.format(cpuId))
+            writeFile(os.path.join(cpuDir, 'topology', 'thread_siblings_list'),
+                      CpuTopology.formatCpuList(core))
+            writeFile(os.path.join(cpuDir, 'topology', 'package_cpus_list'),
+                      CpuTopology.formatCpuList(cpuIds))
+            if not withCaches:
+                continue
+            caches = [(1, 'Data', core), (1, 'Instruction', core), (2, 'Unified', core)]
+            caches += [(3, 'Unified', node) for node in nodes if cpuId in node]
+            for index, (level, cacheType, shared) in enumerate(caches):
+                cacheDir = os.path.join(cpuDir, 'cache', 'index{}'.format(index))
+                writeFile(os.path.join(cacheDir, 'level'), str(level))
+                writeFile(os.path.join(cacheDir, 'type'), cacheType)
+                writeFile(os.path.join(cacheDir, 'shared_cpu_list'),
+                          CpuTopology.formatCpuList(shared))
+    for index, node in enumerate(nodes):
+        writeFile(os.path.join(root, 'node', 'node{}'.format(index), 'cpulist'),
+                  CpuTopology.formatCpuList(node))
+
+
+# Two NUMA nodes with two cores (of two threads) each
+CORES = [[0, 4], [1, 5], [2, 6], [3, 7]]
+NODES = [[0, 1, 4, 5], [2, 3, 6, 7]]
+
+
+class CpuListTests(unittest.TestCase):
+    def testParseAndFormat(self):
+        self.assertEqual(CpuTopology.parseCpuList('0-2,5,7-8\n'), {0, 1, 2, 5, 7, 8})
+        self.assertEqual(CpuTopology.parseCpuList(''), set())
+        self.assertEqual(CpuTopology.formatCpuList({8, 0, 1, 2, 5, 7}), '0-2,5,7-8')
+
+
+class CpuTopologyTests(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def testRead(self):
+        makeFakeSysfs(self.root, CORES, NODES)
+        topology = CpuTopology.CpuTopology(self.root)
+        self.assertEqual(topology.cpus, set(range(8)))
+        self.assertEqual(topology.core[5], {1, 5})
+        self.assertEqual(topology.llc[5], {0, 1, 4, 5})
+        self.assertEqual(topology.node[6], 1)
+
+    def testWithoutCachesOrNodes(self):
+        makeFakeSysfs(self.root, CORES, [], withCaches=False)
+        topology = CpuTopology.CpuTopology(self.root)
+        self.assertEqual(topology.llc[3], set(range(8)))
+        self.assertEqual(set(topology.node.values()), {0})
+
+
+class CpuAllocatorTests(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        makeFakeSysfs(self.root, CORES, NODES)
+        self.topology = CpuTopology.CpuTopology(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def createAllocator(self, cpusPerJob, **kwargs):
+        return CpuTopology.CpuAllocator(self.topology, set(range(8)), cpusPerJob, **kwargs)
+
+    def testWholeCores(self):
+        allocator = self.createAllocator(2, wholeCores=True)
+        self.assertEqual(allocator.maxJobs, 2)
+        first = allocator.allocate()
+        self.assertEqual(first, {0, 1})
+        # The siblings of the first job's CPUs are not used
+        self.assertEqual(allocator.allocate(), {2, 3})
+        with self.assertRaises(Exception):
+            allocator.allocate()
+        allocator.release(first)
+        self.assertEqual(allocator.allocate(), {0, 1})
+
+    def testSiblingsGivenToSameJob(self):
+        allocator = self.createAllocator(2)
+        self.assertEqual(allocator.allocate(), {0, 4})
+        # Best fit leaves the other LLC free for a bigger job
+        self.assertEqual(allocator.allocate(), {1, 5})
+        self.assertEqual(allocator.allocate(), {2, 6})
+
+    def testJobKeptInOneNode(self):
+        allocator = self.createAllocator(3, sameNode=True)
+        self.assertEqual(allocator.allocate(), {0, 1, 4})
+        self.assertEqual(allocator.allocate(), {2, 3, 6})
+        with self.assertRaises(Exception):
+            allocator.allocate()
+
+    def testSpanNodesOnlyIfAllowed(self):
+        self.assertEqual(self.createAllocator(6).allocate(), {0, 1, 2, 4, 5, 6})
+        with self.assertRaises(Exception):
+            self.createAllocator(6, sameNode=True).allocate()
+
+    def testUnknownCpu(self):
+        with self.assertRaises(Exception):
+            CpuTopology.CpuAllocator(self.topology, {0, 8}, 1)
@@ -0,0 +1,80 @@
+# vim: set sw=4 ts=4 softtabstop=4 expandtab:
+import concurrent.futures
+import threading
+import unittest
+
+from . import Dispatcher
+
+
+class MockTask:
+    def __init__(self, number, tracker):
+        self.number = number
+        self.tracker = tracker
+        self.ran = False
+
+    def run(self):
+        self.ran = True
+
+
+class InFlightTracker:
+    def __init__(self, dispatcher):
+        self.dispatcher = dispatcher
+        self.maxSeen = 0
+        self.lock = threading.Lock()
+
+    def observe(self):
+        with self.lock:
+            self.maxSeen = max(self.maxSeen, len(self.dispatcher.futureToTask))
+
+
+class WindowedDispatcherTests(unittest.TestCase):
+    def testAllTasksRunWithBoundedWindow(self):
+        completed = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            dispatcher = Dispatcher.WindowedDispatcher(executor, 3)
+            tracker = InFlightTracker(dispatcher)
+            tasks = (MockTask(i, tracker) for i in range(50))
+
+            def onComplete(future, task):
+                tracker.observe()
+                self.assertTrue(future.done())
+                completed.append(task.number)
+
+            remaining = dispatcher.run(tasks, onComplete)
+        self.assertEqual(sorted(completed), list(range(50)))
+        self.assertEqual(list(remaining), [])
+        self.assertLessEqual(tracker.maxSeen, 3)
+        self.assertEqual(len(dispatcher.futureToTask), 0)
+
+    def testStopPreventsSubmission(self):
+        completed = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            dispatcher = Dispatcher.WindowedDispatcher(executor, 2)
+            tasks = (MockTask(i, None) for i in range(10))
+
+            def onComplete(future, task):
+                completed.append(task)
+                dispatcher.stop()
+
+            remaining = list(dispatcher.run(tasks, onComplete))
+        # Only the initial window was submitted
+        self.assertEqual(len(completed), 2)
+        self.assertEqual([t.number for t in remaining], list(range(2, 10)))
+        self.assertTrue(all(not t.ran for t in remaining))
+
+    def testNotReadyWaitsForCompletion(self):
+        completed = []
+
+        def tasks():
+            yield MockTask(0, None)
+            # Task 1 can only be submitted once task 0 has completed
+            while len(completed) == 0:
+                yield Dispatcher.NOT_READY
+            yield MockTask(1, None)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            dispatcher = Dispatcher.WindowedDispatcher(executor, 2)
+            remaining = dispatcher.run(
+                tasks(), lambda future, task: completed.append(task.number))
+        self.assertEqual(completed, [0, 1])
+        self.assertEqual(list(remaining), [])
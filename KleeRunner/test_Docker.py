@@ -0,0 +1,448 @@
+# vim: set sw=4 ts=4 softtabstop=4 expandtab:
+import itertools
+import os
+import queue
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from . import LogCapture
+from .Backends import Docker
+from .RunnerContext import RunnerContext
+from .test_CpuTopology import makeFakeSysfs, CORES, NODES
+
+
+class FakeAPIClient:
+    """
+      Records the calls made by the backend instead of talking to a Docker
+      daemon. Every instance shares ``calls``.
+    """
+    calls = []
+    existingContainers = []
+    _ids = itertools.count()
+    # Exit code of jobs run with exec. None makes them run until killed.
+    execExitCode = 0
+    killed = threading.Event()
+    # Docker events are sent to this queue if it is not None
+    eventQueue = None
+    commands = dict()
+    # Successive values of the "oom_kill" count read from the memory cgroup
+    # of a container. The file cannot be read once this is empty.
+    oomKillCounts = []
+    execExitCodes = dict()
+
+    def __init__(self, version=None):
+        pass
+
+    def ping(self):
+        return True
+
+    def containers(self, all=False, filters=None):
+        return FakeAPIClient.existingContainers
+
+    def images(self):
+        FakeAPIClient.calls.append(('images',))
+        return [{'Id': 'sha256:image', 'RepoTags': ['klee:latest']}]
+
+    def create_host_config(self, **kwargs):
+        return kwargs
+
+    def create_container(self, **kwargs):
+        containerId = 'container-{}'.format(next(FakeAPIClient._ids))
+        FakeAPIClient.calls.append(('create_container', kwargs['command'], containerId,
+                                    kwargs.get('host_config')))
+        FakeAPIClient.commands[containerId] = kwargs['command']
+        return {'Id': containerId, 'Warnings': None}
+
+    def start(self, container):
+        FakeAPIClient.calls.append(('start', container))
+        if FakeAPIClient.commands[container][-1] != 'hang':
+            FakeAPIClient.sendDieEvent(container, 0)
+
+    @staticmethod
+    def sendDieEvent(container, exitCode):
+        if FakeAPIClient.eventQueue is not None:
+            FakeAPIClient.eventQueue.put({
+                'Type': 'container', 'Action': 'die', 'id': container, 'time': 0,
+                'Actor': {'ID': container, 'Attributes': {'exitCode': str(exitCode)}}})
+
+    def events(self, since=None, filters=None, decode=None):
+        FakeAPIClient.calls.append(('events', filters))
+        def stream():
+            while True:
+                event = FakeAPIClient.eventQueue.get()
+                if event is None:
+                    return
+                yield event
+        return stream()
+
+    def wait(self, container, timeout=None):
+        return 0
+
+    def inspect_container(self, container):
+        return {'State': {'Running': False, 'OOMKilled': False}}
+
+    def logs(self, container, stream=False, **kwargs):
+        if stream:
+            return iter([b'log\n'] * 100)
+        return b'log\n' * 100
+
+    def remove_container(self, container, **kwargs):
+        FakeAPIClient.calls.append(('remove_container', container))
+
+    def update_container(self, container, **kwargs):
+        FakeAPIClient.calls.append(('update_container', container, kwargs))
+
+    def kill(self, container):
+        FakeAPIClient.calls.append(('kill', container))
+        FakeAPIClient.killed.set()
+        FakeAPIClient.sendDieEvent(container, 137)
+
+    def exec_create(self, container, cmd, **kwargs):
+        execId = 'exec-{}'.format(next(FakeAPIClient._ids))
+        FakeAPIClient.calls.append(('exec_create', container, cmd, execId))
+        FakeAPIClient.commands[execId] = cmd
+        return {'Id': execId}
+
+    def exec_start(self, exec_id, stream=False, **kwargs):
+        if 'memory.events' in FakeAPIClient.commands[exec_id][-1]:
+            if len(FakeAPIClient.oomKillCounts) == 0:
+                FakeAPIClient.execExitCodes[exec_id] = 1
+                return b''
+            return 'low 0\nhigh 0\nmax 3\noom 1\noom_kill {}\n'.format(
+                FakeAPIClient.oomKillCounts.pop(0)).encode()
+        if not stream:
+            return b''
+        def output():
+            yield b'log\n'
+            if FakeAPIClient.execExitCode is None:
+                FakeAPIClient.killed.wait(10)
+        return output()
+
+    def exec_inspect(self, exec_id):
+        if 'memory.events' in FakeAPIClient.commands[exec_id][-1]:
+            return {'Running': False, 'ExitCode': FakeAPIClient.execExitCodes.get(exec_id, 0)}
+        return {'Running': False, 'ExitCode': FakeAPIClient.execExitCode}
+
+
+@mock.patch.object(Docker.docker, 'APIClient', FakeAPIClient)
+class DockerBackendTests(unittest.TestCase):
+    def setUp(self):
+        FakeAPIClient.calls = []
+        FakeAPIClient.existingContainers = []
+        FakeAPIClient.execExitCode = 0
+        FakeAPIClient.killed = threading.Event()
+        FakeAPIClient.eventQueue = None
+        self.tmpDir = tempfile.mkdtemp()
+        self.ctx = RunnerContext(1)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def createBackend(self, **kwargs):
+        return Docker.DockerBackend('/bin/true', self.tmpDir, 0, 0, None, self.ctx,
+                                    image='klee:latest', **kwargs)
+
+    def callsNamed(self, name):
+        return [c for c in FakeAPIClient.calls if c[0] == name]
+
+    def waitForReaper(self):
+        pool, _ = self.ctx.get_object('DockerBackend.ResourcePool')
+        pool.reaper.shutdown()
+
+    def testImageAndToolLookupsAreCached(self):
+        backends = [self.createBackend() for _ in range(3)]
+        for backend in backends:
+            backend.checkToolExists('/usr/bin/klee')
+        self.assertEqual(len(self.callsNamed('images')), 1)
+        self.assertEqual([c[1] for c in self.callsNamed('create_container')],
+                         [['ls', '/usr/bin/klee']])
+
+    def testPrecreatedContainerIsUsed(self):
+        backend = self.createBackend(precreate_containers=True)
+        self.assertTrue(backend.supportsPrepareRun)
+        logFile = os.path.join(self.tmpDir, 'log.txt')
+        backend.prepareRun(['/tmp/true'], logFile, {'A': '1'})
+        created = self.callsNamed('create_container')
+        self.assertEqual(len(created), 1)
+        result = backend.run(['/tmp/true'], logFile, {'A': '1'})
+        self.assertEqual(result.exitCode, 0)
+        self.waitForReaper()
+        # No new container was created for the run
+        self.assertEqual(self.callsNamed('create_container'), created)
+        self.assertEqual(self.callsNamed('start'), [('start', created[0][2])])
+
+    def testPrecreatedContainerWithOtherArgumentsIsReplaced(self):
+        backend = self.createBackend(precreate_containers=True)
+        logFile = os.path.join(self.tmpDir, 'log.txt')
+        backend.prepareRun(['/tmp/true'], logFile, {})
+        backend.run(['/tmp/true', 'x'], logFile, {})
+        self.waitForReaper()
+        created = self.callsNamed('create_container')
+        self.assertEqual([c[1] for c in created], [['/tmp/true'], ['/tmp/true', 'x']])
+        self.assertEqual(len(self.callsNamed('remove_container')), 2)
+
+    def testLeakedContainersSwept(self):
+        deadPid = 2**22 + 1
+        FakeAPIClient.existingContainers = [
+            {'Id': 'leaked', 'Labels': {Docker.CONTAINER_PID_LABEL: str(deadPid),
+                                        Docker.CONTAINER_HOST_LABEL: socket.gethostname()}},
+            {'Id': 'live', 'Labels': {Docker.CONTAINER_PID_LABEL: str(os.getpid()),
+                                      Docker.CONTAINER_HOST_LABEL: socket.gethostname()}},
+            {'Id': 'other-host', 'Labels': {Docker.CONTAINER_PID_LABEL: str(deadPid),
+                                            Docker.CONTAINER_HOST_LABEL: 'elsewhere'}},
+        ]
+        self.createBackend()
+        self.waitForReaper()
+        self.assertEqual(self.callsNamed('remove_container'), [('remove_container', 'leaked')])
+
+    def testUnclaimedContainersAreRemoved(self):
+        backend = self.createBackend(precreate_containers=True)
+        backend.prepareRun(['/tmp/true'], os.path.join(self.tmpDir, 'log.txt'), {})
+        pool, _ = self.ctx.get_object('DockerBackend.ResourcePool')
+        pool.remove_precreated_containers()
+        self.assertEqual(len(self.callsNamed('remove_container')), 1)
+        # The runner can no longer claim it
+        backend.run(['/tmp/true'], os.path.join(self.tmpDir, 'log.txt'), {})
+        self.assertEqual(len(self.callsNamed('create_container')), 2)
+
+    def testMemoryPinnedToNodeOfCpus(self):
+        sysfsRoot = os.path.join(self.tmpDir, 'sys')
+        makeFakeSysfs(sysfsRoot, CORES, NODES)
+        pool = Docker.ResourcePool(1, set(range(8)), 3, True, sysfs_root=sysfsRoot)
+        self.ctx.add_object('DockerBackend.ResourcePool', pool)
+        backend = self.createBackend(resource_pinning={
+            'cpu_ids': list(range(8)), 'cpus_per_job': 3, 'use_memset_of_nearest_node': True})
+        backend.run(['/tmp/true'], os.path.join(self.tmpDir, 'log.txt'), {})
+        hostConfig = self.callsNamed('create_container')[0][3]
+        self.assertEqual(hostConfig['cpuset_cpus'], '0-1,4')
+        self.assertEqual(hostConfig['cpuset_mems'], '0')
+        # The CPUs were returned
+        self.assertEqual(pool.get_cpus(), {(0, 0), (1, 0), (4, 0)})
+
+    def testLogCappedAndCompressed(self):
+        backend = self.createBackend(log_max_size=40, log_compression=True)
+        logFile = os.path.join(self.tmpDir, 'log.txt')
+        result = backend.run(['/tmp/true'], logFile, {})
+        self.assertEqual(result.logFilePath, logFile + '.gz')
+        self.assertTrue(result.logTruncated)
+        with LogCapture.openLogFile(result.logFilePath) as f:
+            lines = f.readlines()
+        self.assertEqual(lines[0], 'log\n')
+        self.assertIn('360 bytes of output truncated', ''.join(lines))
+
+
+@mock.patch.object(Docker.docker, 'APIClient', FakeAPIClient)
+class PersistentContainerTests(unittest.TestCase):
+    def setUp(self):
+        FakeAPIClient.calls = []
+        FakeAPIClient.existingContainers = []
+        FakeAPIClient.execExitCode = 0
+        FakeAPIClient.killed = threading.Event()
+        FakeAPIClient.eventQueue = None
+        FakeAPIClient.oomKillCounts = []
+        self.tmpDir = tempfile.mkdtemp()
+        self.program = os.path.join(self.tmpDir, 'program')
+        self.logFile = os.path.join(self.tmpDir, 'log.txt')
+        with open(self.program, 'w'):
+            pass
+        self.ctx = RunnerContext(1)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def createBackend(self, timeLimit=0, memoryLimit=0, mounts=None, maxJobs=2,
+                      scratchDirs=None):
+        # The default scratch directories would overlap self.tmpDir
+        return Docker.DockerBackend(self.program, self.tmpDir, timeLimit, memoryLimit, None,
+                                    self.ctx, image='klee:latest',
+                                    persistent_containers={
+                                        'mounts': mounts or [self.tmpDir],
+                                        'max_jobs': maxJobs,
+                                        'scratch_dirs': scratchDirs or ['/scratch']})
+
+    def callsNamed(self, name):
+        return [c for c in FakeAPIClient.calls if c[0] == name]
+
+    def removeWorkersAndWaitForReaper(self):
+        pool, _ = self.ctx.get_object('DockerBackend.ResourcePool')
+        pool.remove_worker_containers()
+        pool.reaper.shutdown()
+
+    def testContainerReusedThenRecycled(self):
+        backend = self.createBackend()
+        self.assertEqual(backend.programPath(), self.program)
+        self.assertEqual(backend.workingDirectoryInternal, self.tmpDir)
+        for _ in range(3):
+            result = backend.run([self.program, 'arg'], self.logFile, {'A': '1'})
+            self.assertEqual(result.exitCode, 0)
+            self.assertFalse(result.outOfMemory)
+        self.removeWorkersAndWaitForReaper()
+        created = self.callsNamed('create_container')
+        self.assertEqual(len(created), 2)
+        # The first container is recycled after two jobs
+        self.assertEqual(self.callsNamed('remove_container'),
+                         [('remove_container', created[0][2]), ('remove_container', created[1][2])])
+        execs = self.callsNamed('exec_create')
+        self.assertEqual([c[1] for c in execs],
+                         [created[0][2]] * 3 + [created[1][2]] * 2)
+        self.assertEqual(execs[0][2][-4:], [self.tmpDir, 'A=1', self.program, 'arg'])
+        # The container is cleaned up after the first job
+        self.assertIn('kill -9 -1', execs[1][2][2])
+        with open(self.logFile, 'r') as f:
+            self.assertEqual(f.read(), 'log\n')
+
+    def testOutOfMemoryFromOomKillCount(self):
+        FakeAPIClient.oomKillCounts = [2, 3, 3, 3]
+        backend = self.createBackend(memoryLimit=100)
+        result = backend.run([self.program], self.logFile, {})
+        self.assertTrue(result.outOfMemory)
+        # Only a job that increases the count ran out of memory
+        FakeAPIClient.execExitCode = 137
+        result = backend.run([self.program], self.logFile, {})
+        self.assertFalse(result.outOfMemory)
+        self.removeWorkersAndWaitForReaper()
+        self.assertEqual(len(self.callsNamed('remove_container')), 2)
+
+    def testKilledBySigkillIsOutOfMemoryIfCountUnreadable(self):
+        FakeAPIClient.execExitCode = 137
+        backend = self.createBackend(memoryLimit=100)
+        result = backend.run([self.program], self.logFile, {})
+        self.assertTrue(result.outOfMemory)
+        self.removeWorkersAndWaitForReaper()
+        self.assertEqual(len(self.callsNamed('remove_container')), 1)
+
+    def testTimeout(self):
+        FakeAPIClient.execExitCode = None
+        backend = self.createBackend(timeLimit=1)
+        # The time limit is enforced by the pool's timer wheel rather than a
+        # timer thread per job
+        with mock.patch.object(Docker.threading, 'Timer', side_effect=AssertionError):
+            result = backend.run([self.program], self.logFile, {})
+        self.assertTrue(result.outOfTime)
+        self.assertIsNone(result.exitCode)
+        self.assertLess(result.runTime, 5.0)
+        self.removeWorkersAndWaitForReaper()
+        created = self.callsNamed('create_container')
+        self.assertEqual(self.callsNamed('kill'), [('kill', created[0][2])])
+        self.assertEqual(self.callsNamed('remove_container'), [('remove_container', created[0][2])])
+
+    def testUnmountedJobUsesNewContainer(self):
+        otherDir = os.path.join(self.tmpDir, 'other')
+        os.mkdir(otherDir)
+        backend = self.createBackend(mounts=[otherDir])
+        result = backend.run([self.program], self.logFile, {})
+        self.removeWorkersAndWaitForReaper()
+        self.assertEqual(result.exitCode, 0)
+        self.assertEqual(len(self.callsNamed('exec_create')), 0)
+        self.assertEqual([c[1] for c in self.callsNamed('create_container')], [[self.program]])
+
+    def testMountCannotOverlapImageWorkDir(self):
+        with self.assertRaises(Docker.DockerBackendException):
+            self.createBackend(mounts=['/mnt/data'])
+
+    def testMountCannotOverlapScratchDir(self):
+        with self.assertRaises(Docker.DockerBackendException):
+            self.createBackend(scratchDirs=[os.path.dirname(self.tmpDir)])
+
+    def testJobsAreIsolated(self):
+        backend = self.createBackend()
+        for _ in range(2):
+            backend.run([self.program], self.logFile, {})
+        self.removeWorkersAndWaitForReaper()
+        # Only the mounts and the scratch directories are writable
+        hostConfig = self.callsNamed('create_container')[0][3]
+        self.assertTrue(hostConfig['read_only'])
+        self.assertEqual(sorted(hostConfig['tmpfs'].keys()), ['/mnt/', '/scratch'])
+        cleanUp = self.callsNamed('exec_create')[1][2]
+        self.assertEqual(cleanUp[-2:], ['/mnt/', '/scratch'])
+        # Run the clean up on the host (without killing every process) to
+        # check that it empties the scratch directories
+        scratchDirs = [os.path.join(self.tmpDir, name) for name in ('a', 'b')]
+        for scratchDir in scratchDirs:
+            for name in ('file', '.hidden', '..dots', os.path.join('dir', 'file')):
+                path = os.path.join(scratchDir, name)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'w'):
+                    pass
+        self.assertIn('kill -9 -1 ', cleanUp[2])
+        subprocess.check_call(cleanUp[:2] + [cleanUp[2].replace('kill -9 -1 ', 'true '), 'sh'] +
+                              scratchDirs)
+        for scratchDir in scratchDirs:
+            self.assertEqual(os.listdir(scratchDir), [])
+
+
+class TimerWheelTests(unittest.TestCase):
+    def testTimersFireInOrder(self):
+        wheel = Docker.TimerWheel(tick=0.01, num_slots=4)
+        fired = queue.Queue()
+        # Longer than a turn of the wheel
+        wheel.schedule(0.15, lambda: fired.put('late'))
+        wheel.schedule(0.02, lambda: fired.put('early'))
+        cancelled = wheel.schedule(0.05, lambda: fired.put('cancelled'))
+        self.assertTrue(wheel.cancel(cancelled))
+        self.assertEqual(fired.get(timeout=5), 'early')
+        self.assertEqual(fired.get(timeout=5), 'late')
+        self.assertFalse(wheel.cancel(cancelled))
+        self.assertTrue(fired.empty())
+
+
+@mock.patch.object(Docker.docker, 'APIClient', FakeAPIClient)
+class CompletionWatcherTests(unittest.TestCase):
+    def setUp(self):
+        FakeAPIClient.calls = []
+        FakeAPIClient.existingContainers = []
+        FakeAPIClient.eventQueue = queue.Queue()
+        self.tmpDirs = []
+        self.ctx = RunnerContext(2)
+
+    def tearDown(self):
+        pool, success = self.ctx.get_object('DockerBackend.ResourcePool')
+        if success:
+            pool.completion_watcher.stop()
+            pool.reaper.shutdown()
+        FakeAPIClient.eventQueue.put(None)
+        for tmpDir in self.tmpDirs:
+            shutil.rmtree(tmpDir)
+
+    def createBackend(self, timeLimit=0):
+        tmpDir = tempfile.mkdtemp()
+        self.tmpDirs.append(tmpDir)
+        return Docker.DockerBackend('/bin/true', tmpDir, timeLimit, 0, None, self.ctx,
+                                    image='klee:latest', wait_using_events=True,
+                                    docker_clients=1)
+
+    def runInThread(self, backend, cmdLine):
+        results = queue.Queue()
+        logFile = os.path.join(backend.workingDirectory, 'log.txt')
+        thread = threading.Thread(target=lambda: results.put(backend.run(cmdLine, logFile, {})))
+        thread.start()
+        return thread, results
+
+    def testExitCodeFromEvent(self):
+        backend = self.createBackend()
+        thread, results = self.runInThread(backend, ['/tmp/true'])
+        thread.join(10)
+        result = results.get_nowait()
+        self.assertEqual(result.exitCode, 0)
+        self.assertFalse(result.outOfTime)
+        self.assertEqual(len([c for c in FakeAPIClient.calls if c[0] == 'events']), 1)
+
+    def testClientNotHeldWhilstWaiting(self):
+        hanging = self.createBackend(timeLimit=2)
+        hangingThread, hangingResults = self.runInThread(hanging, ['/tmp/true', 'hang'])
+        # There is only one client so this finishes only if the hanging
+        # job released it.
+        thread, results = self.runInThread(self.createBackend(), ['/tmp/true'])
+        thread.join(10)
+        self.assertEqual(results.get_nowait().exitCode, 0)
+        self.assertTrue(hangingThread.is_alive())
+        hangingThread.join(10)
+        result = hangingResults.get_nowait()
+        self.assertTrue(result.outOfTime)
+        self.assertIsNone(result.exitCode)
+        self.assertLess(result.runTime, 5.0)
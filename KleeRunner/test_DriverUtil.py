@@ -0,0 +1,23 @@
+# vim: set sw=4 ts=4 softtabstop=4 expandtab:
+import unittest
+
+from . import DriverUtil
+
+
+class CheckRepeatSupportedTests(unittest.TestCase):
+    def setUp(self):
+        self.cachedConfig = {
+            'runner': 'NativeReplay',
+            'runner_config': {'result_cache': {'directory': '/tmp/cache'}},
+        }
+
+    def testResultCacheRejected(self):
+        with self.assertLogs(DriverUtil._logger, level='ERROR'):
+            self.assertFalse(DriverUtil.checkRepeatSupported(self.cachedConfig, 2))
+
+    def testSingleRunWithResultCache(self):
+        self.assertTrue(DriverUtil.checkRepeatSupported(self.cachedConfig, 1))
+
+    def testRepeatWithoutResultCache(self):
+        config = {'runner': 'NativeReplay', 'runner_config': {}}
+        self.assertTrue(DriverUtil.checkRepeatSupported(config, 3))
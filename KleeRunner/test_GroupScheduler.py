@@ -0,0 +1,56 @@
+# vim: set sw=4 ts=4 softtabstop=4 expandtab:
+import unittest
+
+from . import Dispatcher
+from . import GroupScheduler
+
+
+class ValidateDependenciesTests(unittest.TestCase):
+    def testValid(self):
+        GroupScheduler.validateDependencies([[], [0], [0, 1]], 3)
+
+    def testWrongLength(self):
+        with self.assertRaises(GroupScheduler.GroupSchedulerException):
+            GroupScheduler.validateDependencies([[], []], 3)
+
+    def testInvalidGroup(self):
+        for deps in ([[], [2]], [[], [-1]], [[], ['0']], [[], 0]):
+            with self.assertRaises(GroupScheduler.GroupSchedulerException):
+                GroupScheduler.validateDependencies(deps, 2)
+
+    def testCycle(self):
+        with self.assertRaises(GroupScheduler.GroupSchedulerException) as cm:
+            GroupScheduler.validateDependencies([[], [2], [1]], 3)
+        self.assertIn('[1, 2]', str(cm.exception))
+
+
+class TopologicalOrderTests(unittest.TestCase):
+    def testPriorityWithinDependencies(self):
+        # Group 1 has the highest priority but must wait for group 2
+        order = GroupScheduler.topologicalOrder([1, 10, 5, 1], [[], [2], [], []])
+        self.assertEqual(order, [2, 1, 0, 3])
+
+
+class GroupSchedulerTests(unittest.TestCase):
+    def testDependentsWaitForTheirDependencies(self):
+        scheduler = GroupScheduler.GroupScheduler(
+            [[0], [1, 2], [3]], [1, 2, 3], [[], [], [0, 1]])
+        self.assertEqual(next(scheduler), 1)
+        self.assertEqual(next(scheduler), 0)
+        self.assertIs(next(scheduler), Dispatcher.NOT_READY)
+        scheduler.taskFinished(0)
+        self.assertIs(next(scheduler), Dispatcher.NOT_READY)
+        self.assertEqual(scheduler.unscheduledTasks(), [2])
+        scheduler.taskFinished(1)
+        self.assertEqual(next(scheduler), 2)
+        self.assertEqual(list(scheduler), [])
+
+    def testEmptyGroupsAreFinished(self):
+        # E.g. when resuming and every job in group 0 already ran
+        scheduler = GroupScheduler.GroupScheduler(
+            [[], [1], []], [0, 0, 0], [[], [0], [1]])
+        self.assertEqual(next(scheduler), 1)
+        self.assertIs(next(scheduler), Dispatcher.NOT_READY)
+        scheduler.taskFinished(1)
+        self.assertEqual(list(scheduler), [])
+        self.assertEqual(scheduler.unscheduledTasks(), [])
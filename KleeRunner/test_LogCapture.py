@@ -0,0 +1,58 @@
+# vim: set sw=4 ts=4 softtabstop=4 expandtab:
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+from . import LogCapture
+
+
+class CappedLogWriterTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.logFile = os.path.join(self.tmpDir, 'log.txt')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def writeChunks(self, chunks, maxSize=None, compress=False):
+        with LogCapture.CappedLogWriter(self.logFile, maxSize, compress) as writer:
+            for chunk in chunks:
+                writer.write(chunk)
+        return writer
+
+    def readLog(self, compressed=False):
+        opener = gzip.open if compressed else open
+        with opener(self.logFile, 'rb') as f:
+            return f.read()
+
+    def testUnlimited(self):
+        writer = self.writeChunks([b'hello ', b'world'])
+        self.assertFalse(writer.truncated)
+        self.assertEqual(writer.bytesSeen, 11)
+        self.assertEqual(self.readLog(), b'hello world')
+
+    def testBelowLimit(self):
+        writer = self.writeChunks([b'abc', b'def'], maxSize=6)
+        self.assertFalse(writer.truncated)
+        self.assertEqual(self.readLog(), b'abcdef')
+
+    def testHeadAndTailKept(self):
+        chunks = [bytes([ord('a') + i]) * 10 for i in range(26)]
+        writer = self.writeChunks(chunks, maxSize=20)
+        self.assertTrue(writer.truncated)
+        self.assertEqual(self.readLog(),
+                         b'a' * 10 +
+                         LogCapture.TRUNCATION_MARKER.format(240).encode() +
+                         b'z' * 10)
+
+    def testCompressed(self):
+        self.logFile += '.gz'
+        self.writeChunks([b'x' * 100, b'y\n' * 50], maxSize=50, compress=True)
+        data = self.readLog(compressed=True)
+        self.assertTrue(data.startswith(b'x' * 25))
+        self.assertTrue(data.endswith(b'y\n' * 12))
+        with LogCapture.openLogFile(self.logFile) as f:
+            lines = f.readlines()
+        self.assertEqual(lines[-1], 'y\n')
@@ -0,0 +1,69 @@
+# vim: set sw=4 ts=4 softtabstop=4 expandtab:
+import threading
+import unittest
+
+from . import MemoryAdmission
+
+
+class MemoryAdmissionTests(unittest.TestCase):
+    def _acquireInThread(self, admission, declared, usageFn=None):
+        result = []
+        thread = threading.Thread(
+            target=lambda: result.append(admission.acquire(declared, usageFn)))
+        thread.start()
+        return thread, result
+
+    def testBlocksUntilMemoryReleased(self):
+        admission = MemoryAdmission.MemoryAdmission(100)
+        first = admission.acquire(60)
+        thread, result = self._acquireInThread(admission, 60)
+        thread.join(0.1)
+        self.assertTrue(thread.is_alive())
+        admission.release(first)
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(admission.reserved, 60)
+        admission.release(result[0])
+        stats = admission.stats()
+        self.assertEqual(stats['jobs_admitted'], 2)
+        self.assertEqual(stats['jobs_delayed'], 1)
+        self.assertEqual(stats['peak_reserved'], 60)
+        self.assertGreater(stats['total_queueing_delay'], 0.0)
+
+    def testOversizedAndUnlimitedJobsRunAlone(self):
+        admission = MemoryAdmission.MemoryAdmission(100)
+        big = admission.acquire(500)
+        self.assertIsNotNone(big)
+        admission.release(big)
+        unlimited = admission.acquire(0)
+        self.assertEqual(unlimited.charge, 100)
+        thread, _ = self._acquireInThread(admission, 1)
+        thread.join(0.1)
+        self.assertTrue(thread.is_alive())
+        admission.release(unlimited)
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+
+    def testStopReleasesWaiters(self):
+        admission = MemoryAdmission.MemoryAdmission(100)
+        admission.acquire(100)
+        thread, result = self._acquireInThread(admission, 50)
+        admission.stop()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(result, [None])
+
+    def testAdaptToMeasuredUsage(self):
+        admission = MemoryAdmission.MemoryAdmission(
+            100, adaptMargin=0.5, settleTime=0.0)
+        reservation = admission.acquire(80, lambda: 20)
+        admission.updateFromUsage()
+        self.assertEqual(reservation.charge, 30)
+        self.assertEqual(admission.reserved, 30)
+        # Now fits because the first job uses less than it declared
+        second = admission.acquire(60)
+        self.assertIsNotNone(second)
+        # Usage can never raise a reservation above what was declared
+        reservation.usageFn = lambda: 1000
+        admission.updateFromUsage()
+        self.assertEqual(reservation.charge, 80)
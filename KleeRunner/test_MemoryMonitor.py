@@ -0,0 +1,60 @@
+# vim: set sw=4 ts=4 softtabstop=4 expandtab:
+import os
+import shutil
+import tempfile
+import unittest
+
+from . import MemoryMonitor
+
+_MiB = 2**20
+
+
+class MemoryMonitorTests(unittest.TestCase):
+    def setUp(self):
+        self.procRoot = tempfile.mkdtemp()
+        self.monitor = MemoryMonitor.MemoryMonitor(procRoot=self.procRoot)
+
+    def tearDown(self):
+        self.monitor.stop()
+        shutil.rmtree(self.procRoot)
+
+    def addProcess(self, pid, ppid, virtualMiB, comm='prog'):
+        os.mkdir(os.path.join(self.procRoot, str(pid)))
+        # Fields 3 onwards with ppid (4), vsize (23) and rss (24) filled in
+        fields = ['S', str(ppid)] + ['0'] * 18 + [str(virtualMiB * _MiB), '1']
+        with open(os.path.join(self.procRoot, str(pid), 'stat'), 'w') as f:
+            f.write('{} ({}) {}\n'.format(pid, comm, ' '.join(fields)))
+
+    def testReadProcessTable(self):
+        self.addProcess(10, 1, 3, comm='a (b) c')
+        os.mkdir(os.path.join(self.procRoot, 'self'))
+        table = MemoryMonitor.readProcessTable(self.procRoot)
+        self.assertEqual(list(table.keys()), [10])
+        self.assertEqual(table[10][0:2], (1, 3 * _MiB))
+
+    def testTreeAttributionAndLimit(self):
+        # Job 10 has children 11 and 12 (a grandchild). Job 20 is separate.
+        self.addProcess(10, 1, 50)
+        self.addProcess(11, 10, 30)
+        self.addProcess(12, 11, 30)
+        self.addProcess(20, 1, 40)
+        exceeded = []
+        job1 = self.monitor.register(10, 100, exceeded.append)
+        job2 = self.monitor.register(20, 100, exceeded.append)
+        self.monitor.sweep()
+        self.assertEqual(job1.virtualMiB, 110)
+        self.assertEqual(job1.numProcesses, 3)
+        self.assertEqual(job2.virtualMiB, 40)
+        self.assertEqual(exceeded, [job1])
+        # Only reported once
+        self.monitor.sweep()
+        self.assertEqual(exceeded, [job1])
+        self.monitor.unregister(job1)
+        self.assertEqual(self.monitor.stats()['sweeps'], 2)
+        self.assertEqual(self.monitor.stats()['monitored_jobs'], 1)
+
+    def testExitedProcess(self):
+        tree = self.monitor.register(30, 100, lambda _: self.fail('Not running'))
+        self.monitor.sweep()
+        self.assertEqual(tree.virtualMiB, 0)
+        self.assertEqual(tree.numProcesses, 0)
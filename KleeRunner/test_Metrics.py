@@ -0,0 +1,99 @@
+# vim: set sw=4 ts=4 softtabstop=4 expandtab:
+import os
+import shutil
+import tempfile
+import unittest
+import urllib.request
+
+from . import Metrics
+
+
+def _result(wallclockTime, timeout=False, oom=False):
+    return {
+        'exit_code': 0,
+        'wallclock_time': wallclockTime,
+        'backend_timeout': timeout,
+        'out_of_memory': oom,
+    }
+
+
+class BatchMetricsTests(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Metrics.BatchMetrics(10, 4, 'PythonPsUtil')
+        for wallclockTime in range(1, 8):
+            self.metrics.recordResult(_result(float(wallclockTime)))
+        self.metrics.recordResult(_result(100.0, timeout=True))
+        self.metrics.recordResult({'error': 'failed'})
+        self.metrics.jobStarted()
+
+    def testSnapshot(self):
+        s = self.metrics.snapshot()
+        self.assertEqual(s['jobs_completed'], 8)
+        self.assertEqual(s['jobs_failed'], 1)
+        self.assertEqual(s['jobs_timeout'], 1)
+        self.assertEqual(s['jobs_out_of_memory'], 0)
+        self.assertEqual(s['busy_slots'], 1)
+        self.assertEqual(s['queue_depth'], 0)
+        # Estimated from the histogram buckets: 2 of the 8 times are <= 2.5s
+        # and 3 more are <= 5s.
+        self.assertAlmostEqual(s['job_wallclock_p50'], 2.5 + 2.5 * 2 / 3)
+        # Clamped to the largest time
+        self.assertEqual(s['job_wallclock_p95'], 100.0)
+        self.assertEqual(s['job_wallclock_sum'], 128.0)
+        self.assertGreater(s['jobs_per_second'], 0.0)
+        self.assertIsNotNone(s['eta_seconds'])
+
+    def testPrometheusFormat(self):
+        text = self.metrics.renderPrometheus()
+        self.assertIn('batch_runner_jobs_completed_total 8\n', text)
+        self.assertIn('batch_runner_busy_slots{backend="PythonPsUtil"} 1\n', text)
+        self.assertIn('batch_runner_job_wallclock_seconds_bucket{le="5.0"} 5\n', text)
+        self.assertIn('batch_runner_job_wallclock_seconds_bucket{le="+Inf"} 8\n', text)
+        self.assertIn('batch_runner_job_wallclock_p95_seconds 100.0\n', text)
+        self.assertIn('batch_runner_job_wallclock_seconds_count 8\n', text)
+        for line in text.splitlines():
+            if not line.startswith('#'):
+                # Every sample is a name (with optional labels) and a value
+                self.assertEqual(len(line.rsplit(' ', 1)), 2)
+
+    def testQuantileOfOneBucket(self):
+        metrics = Metrics.BatchMetrics(3, 1, 'PythonPsUtil')
+        for wallclockTime in [0.2, 0.3, 0.4]:
+            metrics.recordResult(_result(wallclockTime))
+        s = metrics.snapshot()
+        self.assertAlmostEqual(s['job_wallclock_p50'], 0.3)
+        self.assertEqual(s['job_wallclock_p95'], 0.4)
+        metrics.recordResult(_result(10 ** 6))
+        self.assertEqual(metrics.snapshot()['job_wallclock_p95'], 10 ** 6)
+
+    def testUntrackedSlotsOmitted(self):
+        metrics = Metrics.BatchMetrics(1, None, 'PythonPsUtil')
+        text = metrics.renderPrometheus()
+        self.assertNotIn('busy_slots', text)
+        self.assertNotIn('queue_depth', text)
+
+
+class MetricsReporterTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def testFileAndHTTP(self):
+        path = os.path.join(self.tmpDir, 'metrics.prom')
+        metrics = Metrics.BatchMetrics(2, 1, 'Docker')
+        reporter = Metrics.MetricsReporter(metrics, path=path, period=60.0, port=0)
+        reporter.start()
+        try:
+            metrics.recordResult(_result(1.0))
+            url = 'http://127.0.0.1:{}/metrics'.format(reporter.port)
+            with urllib.request.urlopen(url) as response:
+                body = response.read().decode('utf-8')
+            self.assertIn('batch_runner_jobs_completed_total 1\n', body)
+        finally:
+            reporter.stop()
+        # The final values are written when the reporter stops
+        with open(path, 'r') as f:
+            self.assertIn('batch_runner_jobs_completed_total 1\n', f.read())
+        self.assertFalse(os.path.exists(path + '.tmp'))
@@ -0,0 +1,118 @@
+# vim: set sw=4 ts=4 softtabstop=4 expandtab:
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from .InvocationInfo import InvocationInfo
+from .Backends.BackendBase import BackendResult
+from .Runners.NativeReplay import NativeReplayRunner
+from .RunnerContext import RunnerContext
+
+
+class ResultCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.ctx = RunnerContext(1)
+        self.ktestFile = os.path.join(self.tmpDir, 'test.ktest')
+        with open(self.ktestFile, 'wb') as f:
+            f.write(b'ktest')
+        self.rc = {
+            'backend': {'name': 'PythonPsUtil'},
+            'result_cache': {'directory': os.path.join(self.tmpDir, 'cache')},
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def createRunner(self, name, program='/bin/true', coverageDir=None):
+        workDir = os.path.join(self.tmpDir, name)
+        os.mkdir(workDir)
+        invocationInfo = InvocationInfo({
+            'program': program,
+            'command_line_arguments': [],
+            'environment_variables': {},
+            'ktest_file': self.ktestFile,
+            'coverage_dir': coverageDir,
+        })
+        return NativeReplayRunner(invocationInfo, workDir, self.rc, self.ctx)
+
+    def runJob(self, runner, exitCode=0):
+        # Drive the runner as the backend would without running anything.
+        # Returns True if the tool would have been run.
+        invocations = runner.toolInvocations()
+        try:
+            next(invocations)
+        except StopIteration:
+            return False
+        with open(runner.logFile, 'w') as f:
+            f.write('replayed\n')
+        try:
+            invocations.send(BackendResult(exitCode, 1.0, False, False, 0.5, 0.1))
+        except StopIteration:
+            pass
+        return True
+
+    def testCachedResultUsed(self):
+        self.assertTrue(self.runJob(self.createRunner('first'), exitCode=2))
+        runner = self.createRunner('second')
+        self.assertFalse(self.runJob(runner))
+        self.assertEqual(runner.getResults()['cache_hit'], True)
+        self.assertEqual(runner.exitCode, 2)
+        with open(runner.logFile, 'r') as f:
+            self.assertEqual(f.read(), 'replayed\n')
+
+    def testRunIfCachedFilesAreMissing(self):
+        self.assertTrue(self.runJob(self.createRunner('first')))
+        for dirpath, _, filenames in os.walk(os.path.join(self.tmpDir, 'cache')):
+            if 'log.txt' in filenames:
+                os.remove(os.path.join(dirpath, 'log.txt'))
+        runner = self.createRunner('second')
+        self.assertTrue(self.runJob(runner))
+        self.assertEqual(runner.getResults()['cache_hit'], False)
+
+    @unittest.skipIf(any(shutil.which(tool) is None for tool in ('gcc', 'gcov-tool', 'gcov-dump')),
+                     'gcc, gcov-tool and gcov-dump are needed')
+    def testConcurrentJobsShareCoverageDir(self):
+        source = os.path.join(self.tmpDir, 'program.c')
+        with open(source, 'w') as f:
+            f.write('int main() { return 0; }\n')
+        program = os.path.join(self.tmpDir, 'program')
+        subprocess.check_call(['gcc', '--coverage', '-o', program, source], cwd=self.tmpDir)
+        coverageDir = os.path.join(self.tmpDir, 'coverage')
+        os.mkdir(coverageDir)
+
+        def numRuns():
+            gcdaFiles = []
+            for dirpath, _, filenames in os.walk(coverageDir):
+                gcdaFiles.extend(os.path.join(dirpath, name) for name in filenames)
+            self.assertEqual(len(gcdaFiles), 1)
+            output = subprocess.check_output(['gcov-dump', gcdaFiles[0]]).decode()
+            for line in output.splitlines():
+                if 'OBJECT_SUMMARY' in line:
+                    return int(line.split('runs=')[1].split(',')[0])
+
+        # Both jobs are running at the same time
+        jobs = []
+        for name in ('first', 'second'):
+            runner = self.createRunner(name, program, coverageDir)
+            invocations = runner.toolInvocations()
+            cmdLine, env = next(invocations)
+            self.assertNotEqual(env['GCOV_PREFIX'], coverageDir)
+            jobs.append((runner, invocations, cmdLine, env))
+        for runner, _, cmdLine, env in jobs:
+            with open(runner.logFile, 'w') as f:
+                subprocess.check_call(cmdLine, env=dict(os.environ, **env), stdout=f)
+        for _, invocations, _, _ in jobs:
+            try:
+                invocations.send(BackendResult(0, 1.0, False, False, 0.5, 0.1))
+            except StopIteration:
+                pass
+        self.assertEqual(numRuns(), 2)
+
+        # The cached coverage is that of one job only
+        runner = self.createRunner('third', program, coverageDir)
+        self.assertFalse(self.runJob(runner))
+        self.assertEqual(runner.getResults()['cache_hit'], True)
+        self.assertEqual(numRuns(), 3)
@@ -0,0 +1,110 @@
+# vim: set sw=4 ts=4 softtabstop=4 expandtab:
+import os
+import psutil
+import shutil
+import signal
+import subprocess
+import tempfile
+import unittest
+from unittest import mock
+
+from .Backends import PythonPsUtil
+from .Backends.BackendBase import RESOURCE_USAGE_KEYS
+from .RunnerContext import RunnerContext
+
+
+class WaitForProcessTests(unittest.TestCase):
+    def testExitCodeAndResourceUsage(self):
+        # The CPU time of the child that the shell waits for is included
+        popen = subprocess.Popen(['/bin/sh', '-c',
+            "/bin/sh -c 'i=0; while [ $i -lt 100000 ]; do i=$((i+1)); done'; exit 3"])
+        exitCode, rusage = PythonPsUtil.waitForProcess(popen, 60)
+        self.assertEqual(exitCode, 3)
+        self.assertEqual(popen.returncode, 3)
+        self.assertGreater(rusage.ru_utime + rusage.ru_stime, 0.0)
+        resourceUsage = PythonPsUtil.resourceUsageFromRusage(rusage)
+        self.assertEqual(sorted(resourceUsage.keys()), sorted(RESOURCE_USAGE_KEYS))
+        self.assertGreater(resourceUsage['max_rss'], 0.0)
+
+    def testTimeoutThenReap(self):
+        popen = subprocess.Popen(['/bin/sleep', '30'])
+        with self.assertRaises(subprocess.TimeoutExpired):
+            PythonPsUtil.waitForProcess(popen, 0.2)
+        popen.kill()
+        exitCode, _ = PythonPsUtil.waitForProcess(popen)
+        self.assertEqual(exitCode, -9)
+
+
+class LiveProcessesInGroupTests(unittest.TestCase):
+    def setUp(self):
+        self.procRoot = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.procRoot)
+
+    def addProcess(self, pid, state, pgid, comm='prog'):
+        os.mkdir(os.path.join(self.procRoot, str(pid)))
+        with open(os.path.join(self.procRoot, str(pid), 'stat'), 'w') as f:
+            f.write('{} ({}) {} 1 {} 0\n'.format(pid, comm, state, pgid))
+
+    def testZombiesIgnored(self):
+        self.addProcess(10, 'S', 10)
+        self.addProcess(11, 'Z', 10)
+        self.addProcess(12, 'R', 10, comm='a ) b')
+        self.addProcess(20, 'S', 20)
+        pids = PythonPsUtil.liveProcessesInGroup(10, self.procRoot)
+        self.assertEqual(sorted(pids), [10, 12])
+
+
+class ProcessGroupKillTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.logFile = os.path.join(self.tmpDir, 'log.txt')
+        self.pidFile = os.path.join(self.tmpDir, 'pid')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def runBackend(self, script, timeLimit):
+        backend = PythonPsUtil.PythonPsUtilBackend(
+            '/bin/sh', self.tmpDir, timeLimit, 0, None, RunnerContext(1),
+            kill_grace_period=0.5)
+        return backend.run(['/bin/sh', '-c', script], self.logFile, {})
+
+    def assertNotRunning(self, pid):
+        # Killed orphans may be left as zombies if init is slow to reap them
+        try:
+            self.assertEqual(psutil.Process(pid).status(), psutil.STATUS_ZOMBIE)
+        except psutil.NoSuchProcess:
+            pass
+
+    def readPid(self):
+        with open(self.pidFile, 'r') as f:
+            return int(f.read())
+
+    def testStragglerKilled(self):
+        # The tool exits leaving a descendant running
+        result = self.runBackend('sleep 30 & echo $! > {}'.format(self.pidFile), 10)
+        self.assertEqual(result.exitCode, 0)
+        self.assertFalse(result.outOfTime)
+        self.assertLess(result.teardownTime, 1.0)
+        self.assertNotRunning(self.readPid())
+
+    def testTimeLimitKillsGroup(self):
+        # The tool ignores SIGTERM so SIGKILL is needed
+        result = self.runBackend(
+            "trap '' TERM; sleep 30 & echo $! > {}; wait".format(self.pidFile), 1)
+        self.assertTrue(result.outOfTime)
+        self.assertIsNone(result.exitCode)
+        self.assertLess(result.runTime, 10.0)
+        self.assertNotRunning(self.readPid())
+
+    def testReapedGroupNotSignalled(self):
+        popen = subprocess.Popen(['/bin/true'], start_new_session=True)
+        processGroup = PythonPsUtil.ProcessGroup(popen.pid)
+        self.assertTrue(processGroup.signal(0))
+        PythonPsUtil.waitForProcess(popen, beforeReap=processGroup.markReaped)
+        # The PGID may be reused from now on
+        with mock.patch.object(PythonPsUtil.os, 'killpg') as killpg:
+            self.assertFalse(processGroup.signal(signal.SIGKILL))
+            self.assertFalse(killpg.called)
@@ -0,0 +1,66 @@
+# vim: set sw=4 ts=4 softtabstop=4 expandtab:
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from . import ResultCache
+
+
+class ResultCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.cache = ResultCache.ResultCache(
+            os.path.join(self.tmpDir, 'cache'), 1)
+        self.logFile = self.writeFile('log.txt', b'hello\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def writeFile(self, name, data):
+        path = os.path.join(self.tmpDir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def testKeyDependsOnContents(self):
+        a = self.writeFile('a.ktest', b'a')
+        b = self.writeFile('b.ktest', b'a')
+        data = {'env': {'X': '1'}, 'args': ['-v']}
+        key = self.cache.computeKey([a], data)
+        # Same contents at a different path
+        self.assertEqual(key, self.cache.computeKey([b], data))
+        self.assertNotEqual(key, self.cache.computeKey([a], {'env': {}, 'args': ['-v']}))
+        time.sleep(0.01)
+        self.writeFile('b.ktest', b'b')
+        self.assertNotEqual(key, self.cache.computeKey([b], data))
+
+    def testStoreAndLookup(self):
+        self.assertIsNone(self.cache.lookup('ab' * 32))
+        self.writeFile('cov/tmp/prog.gcda', b'counters')
+        self.cache.store('ab' * 32, {'exit_code': 1}, self.logFile,
+                         os.path.join(self.tmpDir, 'cov'))
+        entry = self.cache.lookup('ab' * 32)
+        self.assertEqual(entry.result, {'exit_code': 1})
+        with open(entry.logFile, 'rb') as f:
+            self.assertEqual(f.read(), b'hello\n')
+        dest = os.path.join(self.tmpDir, 'dest')
+        ResultCache.copyTree(entry.coverageDir, dest)
+        self.assertTrue(os.path.exists(os.path.join(dest, 'tmp', 'prog.gcda')))
+
+    def testLeastRecentlyUsedEvicted(self):
+        self.writeFile('big.txt', b'x' * (400 * 1024))
+        bigLog = os.path.join(self.tmpDir, 'big.txt')
+        keys = [str(i) * 64 for i in range(0, 3)]
+        self.cache.store(keys[0], {}, bigLog)
+        self.cache.store(keys[1], {}, bigLog)
+        # Make entry 0 the most recently used
+        resultFile = os.path.join(self.cache.lookup(keys[1]).path, 'result.json')
+        os.utime(resultFile, (time.time() - 60, time.time() - 60))
+        self.cache.lookup(keys[0])
+        self.cache.store(keys[2], {}, bigLog)
+        self.assertIsNotNone(self.cache.lookup(keys[0]))
+        self.assertIsNone(self.cache.lookup(keys[1]))
+        self.assertIsNotNone(self.cache.lookup(keys[2]))
@@ -0,0 +1,54 @@
+# vim: set sw=4 ts=4 softtabstop=4 expandtab:
+import unittest
+
+from . import ResultInfo
+from . import ResultInfoUtil
+
+
+def _makeResult(repetition, **kwargs):
+    result = {
+        'exit_code': 0,
+        'out_of_memory': False,
+        'backend_timeout': False,
+        'wallclock_time': 1.0 + repetition,
+        'working_directory': '/tmp/workdir-{}'.format(repetition),
+        'log_file': '/tmp/workdir-{}/log.txt'.format(repetition),
+        'invocation_info': {'program': '/bin/prog'},
+    }
+    result.update(kwargs)
+    return result
+
+
+class MergeRepeatedResultsTests(unittest.TestCase):
+    def assertValid(self, result):
+        ResultInfo.validateResultInfos({
+            'results': [result],
+            'schema_version': ResultInfo.getSchema()['__version__'],
+        })
+
+    def testMerged(self):
+        merged = ResultInfoUtil.merge_repeated_results(
+            [_makeResult(0), _makeResult(1)])
+        self.assertTrue(merged['merged_result'])
+        self.assertEqual(merged['invocation_info'], {'program': '/bin/prog'})
+        self.assertEqual(merged['wallclock_time'], [1.0, 2.0])
+        self.assertEqual(merged['exit_code'], [0, 0])
+        self.assertValid(merged)
+
+    def testOptionalKeyMissingFromSomeRepetitions(self):
+        merged = ResultInfoUtil.merge_repeated_results([
+            _makeResult(0, log_truncated=False, max_rss=32.9),
+            _makeResult(1)])
+        self.assertEqual(merged['log_truncated'], [False, None])
+        self.assertEqual(merged['max_rss'], [32.9, None])
+        self.assertValid(merged)
+
+    def testErrors(self):
+        merged = ResultInfoUtil.merge_repeated_results([
+            _makeResult(0),
+            None,
+            {'invocation_info': {'program': '/bin/prog'}, 'error': 'failed'}])
+        self.assertNotIn('merged_result', merged)
+        self.assertEqual(merged['error'],
+                         'Repetition 1: no result\nRepetition 2: failed')
+        self.assertValid(merged)
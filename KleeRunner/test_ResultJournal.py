@@ -0,0 +1,118 @@
+# vim: set sw=4 ts=4 softtabstop=4 expandtab:
+import os
+import shutil
+import tempfile
+import unittest
+
+from . import ResultJournal
+from . import util
+
+
+def _makeResult(index, exitCode=0):
+    return {
+        'exit_code': exitCode,
+        'wallclock_time': 1.0 + index,
+        'working_directory': '/tmp/workdir-{}'.format(index),
+        'invocation_info': {'program': '/bin/prog{}'.format(index)},
+    }
+
+
+class ResultJournalTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.journalPath = os.path.join(self.tmpDir, 'out.yml.journal')
+        self.outputPath = os.path.join(self.tmpDir, 'out.yml')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def _loadOutput(self):
+        with open(self.outputPath, 'r') as f:
+            return util.loadYaml(f)
+
+    def testRoundTrip(self):
+        with ResultJournal.ResultJournal(self.journalPath) as journal:
+            for index in [2, 0, 1]:
+                journal.append(index, _makeResult(index))
+            self.assertEqual(journal.numRecords, 3)
+        records = list(ResultJournal.iterJournal(self.journalPath))
+        self.assertEqual([i for i, _ in records], [2, 0, 1])
+        self.assertEqual(records[0][1], _makeResult(2))
+
+    def testTruncatedLastRecordIgnored(self):
+        with ResultJournal.ResultJournal(self.journalPath) as journal:
+            journal.append(0, _makeResult(0))
+        with open(self.journalPath, 'a') as f:
+            f.write('{"index":1,"res')
+        records = list(ResultJournal.iterJournal(self.journalPath))
+        self.assertEqual(len(records), 1)
+
+    def testReopenDiscardsTruncatedRecord(self):
+        with ResultJournal.ResultJournal(self.journalPath) as journal:
+            journal.append(0, _makeResult(0))
+        with open(self.journalPath, 'a') as f:
+            f.write('{"index":1,"res')
+        with ResultJournal.ResultJournal(self.journalPath) as journal:
+            journal.append(1, _makeResult(1))
+        records = list(ResultJournal.iterJournal(self.journalPath))
+        self.assertEqual([i for i, _ in records], [0, 1])
+
+    def testCorruptRecordRaises(self):
+        with open(self.journalPath, 'w') as f:
+            f.write('not json\n')
+        with ResultJournal.ResultJournal(self.journalPath) as journal:
+            journal.append(0, _makeResult(0))
+        with self.assertRaises(ResultJournal.ResultJournalException):
+            list(ResultJournal.iterJournal(self.journalPath))
+
+    def testFinalize(self):
+        with ResultJournal.ResultJournal(self.journalPath) as journal:
+            journal.append(0, _makeResult(0, exitCode=1))
+            journal.append(1, _makeResult(1))
+            # Supersedes the first record for index 0
+            journal.append(0, _makeResult(0, exitCode=0))
+        numResults = ResultJournal.finalizeJournal(
+            self.journalPath, self.outputPath, 1, {'runner': 'Klee'})
+        self.assertEqual(numResults, 2)
+        data = self._loadOutput()
+        self.assertEqual(data['schema_version'], 1)
+        self.assertEqual(data['misc'], {'runner': 'Klee'})
+        self.assertEqual(data['results'], [_makeResult(1), _makeResult(0)])
+        self.assertFalse(os.path.exists(self.outputPath + '.tmp'))
+
+    def testFinalizeEmpty(self):
+        ResultJournal.ResultJournal(self.journalPath).close()
+        ResultJournal.finalizeJournal(
+            self.journalPath, self.outputPath, 1, None)
+        data = self._loadOutput()
+        self.assertEqual(data['results'], [])
+        self.assertNotIn('misc', data)
+
+    def testFinalizeRepeated(self):
+        def result(index, repetition, exitCode=0):
+            r = _makeResult(index, exitCode)
+            r['working_directory'] = '/tmp/workdir-{}'.format(repetition * 2 + index)
+            return r
+
+        with ResultJournal.ResultJournal(self.journalPath) as journal:
+            # Two invocations repeated twice
+            journal.append(3, result(1, 1))
+            journal.append(0, result(0, 0))
+            journal.append(2, result(0, 1, exitCode=1))
+            journal.append(1, result(1, 0))
+            journal.append(3, {'error': 'failed',
+                               'invocation_info': {'program': '/bin/prog1'}})
+        numResults = ResultJournal.finalizeJournal(
+            self.journalPath, self.outputPath, 1, None, numInvocations=2,
+            repeat=2)
+        self.assertEqual(numResults, 2)
+        data = self._loadOutput()
+        merged = data['results'][0]
+        self.assertTrue(merged['merged_result'])
+        self.assertEqual(merged['exit_code'], [0, 1])
+        self.assertEqual(merged['working_directory'],
+                         ['/tmp/workdir-0', '/tmp/workdir-2'])
+        self.assertEqual(merged['invocation_info'], {'program': '/bin/prog0'})
+        # The latest record for the second repetition is an error
+        self.assertEqual(data['results'][1]['error'], 'Repetition 1: failed')
+        self.assertNotIn('merged_result', data['results'][1])
@@ -0,0 +1,83 @@
+# vim: set sw=4 ts=4 softtabstop=4 expandtab:
+import os
+import shutil
+import tempfile
+import unittest
+
+from . import WorkDirLayout
+
+
+class RelativePathTests(unittest.TestCase):
+    def testFlat(self):
+        self.assertEqual(WorkDirLayout.relativePath('flat', 7), 'workdir-7')
+
+    def testBucketed(self):
+        self.assertEqual(WorkDirLayout.relativePath('bucketed', 1234567),
+                         os.path.join('001', '234', 'workdir-1234567'))
+
+    def testHashed(self):
+        path = WorkDirLayout.relativePath('hashed', 3)
+        parts = path.split(os.sep)
+        self.assertEqual(len(parts), 3)
+        self.assertEqual(parts[2], 'workdir-3')
+        self.assertEqual(path, WorkDirLayout.relativePath('hashed', 3))
+
+    def testUnknown(self):
+        with self.assertRaises(WorkDirLayout.WorkDirLayoutException):
+            WorkDirLayout.relativePath('nested', 0)
+
+
+class WorkDirLayoutTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def testCreateRecordsIndex(self):
+        layout = WorkDirLayout.WorkDirLayout(self.tmpDir, 'hashed')
+        layout.initIndex()
+        for index in range(0, 3):
+            self.assertTrue(os.path.isdir(layout.create(index)))
+        indexLayout, indexToPath = WorkDirLayout.readIndex(self.tmpDir)
+        self.assertEqual(indexLayout, 'hashed')
+        self.assertEqual(indexToPath[2], WorkDirLayout.relativePath('hashed', 2))
+        self.assertEqual(len(indexToPath), 3)
+
+    def testFlatHasNoIndex(self):
+        layout = WorkDirLayout.WorkDirLayout(self.tmpDir, 'flat')
+        layout.initIndex()
+        layout.create(0)
+        self.assertTrue(os.path.isdir(os.path.join(self.tmpDir, 'workdir-0')))
+        self.assertEqual(WorkDirLayout.readIndex(self.tmpDir), (None, None))
+
+    def testResumeWithDifferentLayout(self):
+        WorkDirLayout.WorkDirLayout(self.tmpDir, 'bucketed').initIndex()
+        # Same layout is fine
+        WorkDirLayout.WorkDirLayout(self.tmpDir, 'bucketed').initIndex()
+        for other in ['hashed', 'flat']:
+            with self.assertRaises(WorkDirLayout.WorkDirLayoutException):
+                WorkDirLayout.WorkDirLayout(self.tmpDir, other).initIndex()
+
+    def testRelocateResults(self):
+        layout = WorkDirLayout.WorkDirLayout(self.tmpDir, 'bucketed')
+        layout.initIndex()
+        layout.create(5)
+        results = [{
+            'working_directory': '/old/root/workdir-5',
+            'log_file': '/old/root/workdir-5/log.txt',
+            'klee_dir': ['/old/root/workdir-5/klee-out-0'],
+            'program': '/bin/true',
+        }]
+        WorkDirLayout.relocateResults(results, self.tmpDir)
+        workDir = layout.path(5)
+        self.assertEqual(results[0]['working_directory'], workDir)
+        self.assertEqual(results[0]['log_file'], os.path.join(workDir, 'log.txt'))
+        self.assertEqual(results[0]['klee_dir'], [os.path.join(workDir, 'klee-out-0')])
+        self.assertEqual(results[0]['program'], '/bin/true')
+
+    def testRelocateWithoutIndexAssumesFlat(self):
+        results = [{'working_directory': '/old/root/workdir-2'}]
+        WorkDirLayout.relocateResults(results, self.tmpDir)
+        self.assertEqual(results[0]['working_directory'],
+                         os.path.join(self.tmpDir, 'workdir-2'))
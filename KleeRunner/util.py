@@ -12,10 +12,18 @@ if hasattr(yaml, 'CLoader'):
 else:
     _loader = yaml.Loader
 
+if hasattr(yaml, 'CDumper'):
+    _dumper = yaml.CDumper
+else:
+    _dumper = yaml.Dumper
+
 
 def loadYaml(openFile):
     return yaml.load(openFile, Loader=_loader)
 
+def dumpYaml(data):
+    return yaml.dump(data, Dumper=_dumper, default_flow_style=False)
+
 def writeYaml(openFile, data):
     _logger.info('Writing "{}"'.format(openFile.name))
     as_yaml = yaml.dump(data, default_flow_style=False)
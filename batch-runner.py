@@ -4,29 +4,67 @@
     Script to run a Runner over a set of programs.
 """
 import argparse
+import copy
 import datetime
+import glob
+import json
 import logging
 import os
+import random
 import traceback
 import signal
+import subprocess
 import sys
+import threading
+from KleeRunner import Coordinator
+from KleeRunner import ConcurrencyController
+from KleeRunner import CostModel
 from KleeRunner import RunnerFactory
 from KleeRunner import InvocationInfo
+from KleeRunner import Dispatcher
 from KleeRunner import DriverUtil
+from KleeRunner import GroupScheduler
+from KleeRunner import JobPreparer
+from KleeRunner import MemoryAdmission
+from KleeRunner import MemoryMonitor
+from KleeRunner import Metrics
 from KleeRunner import ResultInfo
+from KleeRunner import ResultJournal
 from KleeRunner import RunnerContext
+from KleeRunner import WorkDirLayout
 
 _logger = None
 futureToRunners = None
+jobLookahead = None
+taskDispatcher = None
+memoryAdmission = None
+slotLimiter = None
+asyncEngine = None
 
 
 def handleInterrupt(signum, _):
     logging.info('Received signal {}'.format(signum))
+    if asyncEngine is not None:
+        asyncEngine.stop()
+        if jobLookahead is not None:
+            jobLookahead.stop()
     if futureToRunners != None:
-        cancel(futureToRunners)
+        cancel(futureToRunners, jobLookahead, taskDispatcher, memoryAdmission,
+               slotLimiter)
 
 
-def cancel(futureToRunnersMap):
+def cancel(futureToRunnersMap, lookahead=None, dispatcher=None, admission=None,
+           limiter=None):
+    # Stop new tasks being submitted
+    if dispatcher is not None:
+        dispatcher.stop()
+
+    # Release tasks waiting for a slot or memory so they do not start
+    if limiter is not None:
+        limiter.stop()
+    if admission is not None:
+        admission.stop()
+
     _logger.warning('Cancelling futures')
     # Cancel all futures first. If we tried
     # to kill the runner at the same time then
@@ -34,64 +72,660 @@ def cancel(futureToRunnersMap):
     for future in futureToRunnersMap.keys():
         future.cancel()
 
+    # Stop creating runners for tasks that will never run
+    if lookahead is not None:
+        lookahead.stop()
+
     # Then we can kill the runners if required
     _logger.warning('Killing runners')
-    for runner_list in futureToRunnersMap.values():
-        if isinstance(runner_list, list):
-            for runner in runner_list:
-                runner.kill()
-        else:
-            assert isinstance(runner_list, SequentialRunnerHolder)
-            runner_list.kill()
+    for task_holder in futureToRunnersMap.values():
+        assert isinstance(task_holder, TaskHolder)
+        task_holder.kill()
 
-class SequentialRunnerHolder:
+class TaskHolder:
     """
-    Convenient wrapper for doing force sequentialised execution
-    during a parallel run
+    Runs a task (a list of invocation indices that must be run
+    sequentially) in a pool thread. The runners for the task
+    are created just in time by a ``LookaheadPreparer``. If
+    ``limiter`` is not None each job waits for a slot from it and if
+    ``admission`` is not None each job waits for its memory to be
+    admitted before it is run. If ``metrics`` is not None it is told
+    when jobs start and stop running.
     """
-    def __init__(self, seq_runners):
-        assert isinstance(seq_runners, list)
-        self._seq_runners = seq_runners
-        assert len(self._seq_runners) > 0
-        self._completed_runs = []
+    def __init__(self, task_number, indices, lookahead, preparer, admission=None,
+                 metrics=None, limiter=None):
+        assert isinstance(indices, list)
+        assert len(indices) > 0
+        self._task_number = task_number
+        self._indices = indices
+        self._lookahead = lookahead
+        self._preparer = preparer
+        self._admission = admission
+        self._metrics = metrics
+        self._limiter = limiter
+        self._results = {}
+        self._running_runner = None
         self._killSequentialLoop = False
+        self._lock = threading.Lock()
+
+    @property
+    def indices(self):
+        return self._indices
+
+    @property
+    def task_number(self):
+        return self._task_number
 
     def run(self):
-        for index, r in enumerate(self._seq_runners):
-            if self._killSequentialLoop is True:
-                _logger.warning('Sequential loop killed')
+        jobs = self._lookahead.take(self._task_number)
+        if jobs is None:
+            _logger.warning('Runners for task {} were never created'.format(
+                self._task_number))
+            return
+        for position, job in enumerate(jobs):
+            with self._lock:
+                if self._killSequentialLoop is True:
+                    _logger.warning('Sequential loop killed')
+                    break
+                self._running_runner = job.runner
+            if job.error is not None:
+                self._results[job.index] = self._preparer.errorResult(
+                    job.index, job.error)
+                continue
+            r = job.runner
+            if self._limiter is not None and not self._limiter.acquire():
+                _logger.warning('Job {} was not given a slot'.format(job.index))
                 break
-            _logger.info('Doing sequential run {}/{} with runner "{}"'.format(
-                index+1,
-                len(self._seq_runners),
-                r.programPathArgument))
-            r.run()
-            self._completed_runs.append(r)
+            reservation = None
+            if self._admission is not None:
+                reservation = self._admission.acquire(
+                    r.maxMemoryInMiB, r.memoryUsage)
+                if reservation is None:
+                    _logger.warning('Job {} was not admitted'.format(job.index))
+                    if self._limiter is not None:
+                        self._limiter.release()
+                    break
+            if len(jobs) > 1:
+                _logger.info('Doing sequential run {}/{} with runner "{}"'.format(
+                    position+1,
+                    len(jobs),
+                    r.programPathArgument))
+            if self._metrics is not None:
+                self._metrics.jobStarted()
+            try:
+                r.run()
+                self._results[job.index] = r.getResults()
+            except BaseException:
+                self._results[job.index] = self._preparer.errorResult(
+                    job.index, traceback.format_exc())
+                raise
+            finally:
+                with self._lock:
+                    self._running_runner = None
+                if reservation is not None:
+                    self._admission.release(reservation)
+                if self._limiter is not None:
+                    self._limiter.release()
+                if self._metrics is not None:
+                    self._metrics.jobStopped()
         return
 
     def kill(self):
-        _logger.info('Killing SequentialRunnerHolder')
-        self._killSequentialLoop = True
-        for r in self._seq_runners:
-            r.kill()
+        _logger.info('Killing TaskHolder')
+        with self._lock:
+            self._killSequentialLoop = True
+            runner = self._running_runner
+        if runner is not None:
+            runner.kill()
+
+    def results(self):
+        """
+        Returns a dictionary mapping invocation index to raw ResultInfo
+        for the jobs that were attempted.
+        """
+        return self._results
+
+def recordTaskResults(journal, preparer, task_holder, excep, metrics=None):
+    """
+    Write the results of a task to the journal (and ``metrics`` if it is
+    not None). Jobs in the task that were not attempted are recorded as
+    errors using ``excep``.
+
+    Returns a tuple ``(numJobsFinished, hadError)``.
+    """
+    numJobsFinished = 0
+    hadError = False
+    results = task_holder.results()
+    for index in task_holder.indices:
+        if index in results:
+            result = results[index]
+            numJobsFinished += 1
+        else:
+            if excep is None:
+                error = 'Job was not run'
+            else:
+                error = "\n".join(traceback.format_exception(
+                    type(excep), excep, None))
+            result = preparer.errorResult(index, error)
+        if 'error' in result:
+            hadError = True
+        journal.append(index, result)
+        if metrics is not None:
+            metrics.recordResult(result)
+    return (numJobsFinished, hadError)
+
+def logProgress(numCompleted, numTotal, startTime):
+    """
+      Log how many of the jobs run in this invocation have completed and an
+      estimate of the time remaining.
+    """
+    elapsed = datetime.datetime.now() - startTime
+    eta = 'unknown'
+    if numCompleted > 0:
+        eta = str((elapsed / numCompleted) * (numTotal - numCompleted))
+    _logger.info('Completed {}/{} ({:.1f}%) ETA: {}'.format(
+        numCompleted,
+        numTotal,
+        100 * (float(numCompleted) / numTotal),
+        eta))
+
+
+def findCompletedIndices(journalFile, invocationInfoObjects):
+    """
+      Returns a tuple ``(completedIndices, success)`` where
+      ``completedIndices`` is the set of invocation indices that have a
+      result without an error in the journal at ``journalFile``.
+    """
+    completedIndices = set()
+    try:
+        for index, result in ResultJournal.iterJournal(journalFile):
+            if index < 0 or index >= len(invocationInfoObjects):
+                _logger.error('Journal refers to invalid index {}'.format(index))
+                return (None, False)
+            program = result['invocation_info']['program']
+            if program != invocationInfoObjects[index].Program:
+                _logger.error(
+                    'Journal entry for index {} is for program "{}" but the '
+                    'invocation info has "{}"'.format(
+                        index, program, invocationInfoObjects[index].Program))
+                return (None, False)
+            # Later records supersede earlier ones
+            if 'error' in result:
+                completedIndices.discard(index)
+            else:
+                completedIndices.add(index)
+    except Exception as e: # pylint: disable=broad-except
+        _logger.error('Failed to read journal "{}"'.format(journalFile))
+        _logger.error(e)
+        _logger.debug(traceback.format_exc())
+        return (None, False)
+    return (completedIndices, True)
+
+def shardJournalPath(journalFile, shardIndex):
+    return '{}.shard-{}'.format(journalFile, shardIndex)
+
+def findShardJournals(journalFile):
+    """
+      Returns a list of the shard journals belonging to ``journalFile``
+      left behind by worker processes.
+    """
+    prefix = journalFile + '.shard-'
+    return sorted(path for path in glob.glob(glob.escape(prefix) + '*')
+                  if path[len(prefix):].isdigit())
+
+def mergeShardJournals(journalFile, shardJournals, sync=False):
+    """
+      Append the records of each shard journal in ``shardJournals`` to
+      the journal at ``journalFile`` and then remove the shard journals.
+    """
+    with ResultJournal.ResultJournal(journalFile, sync=sync) as journal:
+        for shardJournal in shardJournals:
+            numRecords = 0
+            for index, result in ResultJournal.iterJournal(shardJournal):
+                journal.append(index, result)
+                numRecords += 1
+            _logger.debug('Merged {} records from "{}"'.format(
+                numRecords, shardJournal))
+    for shardJournal in shardJournals:
+        os.remove(shardJournal)
+
+class ShardProgress:
+    """
+      Counts the records written to shard journals without re-reading
+      what has already been counted. If ``metrics`` is not None each new
+      result is recorded in it.
+    """
+    def __init__(self, paths, metrics=None):
+        self._offsets = {path: 0 for path in paths}
+        self._metrics = metrics
+        self.numRecords = 0
+
+    def update(self):
+        for path, offset in self._offsets.items():
+            if not os.path.exists(path):
+                continue
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                data = f.read()
+            # Only count complete records
+            end = data.rfind(b'\n') + 1
+            self.numRecords += data.count(b'\n', 0, end)
+            self._offsets[path] = offset + end
+            if self._metrics is not None:
+                for line in data[:end].splitlines():
+                    self._metrics.recordResult(
+                        json.loads(line.decode('utf-8'))['result'])
+        return self.numRecords
+
+def runWorkerProcesses(pargs, tasks, numPendingJobs, journalFile, startTime,
+                       metrics=None):
+    """
+      Run ``tasks`` by sharding them across ``pargs.worker_processes``
+      child batch-runner processes. Each child has its own thread pool
+      and RunnerContext and writes its results to its own shard journal
+      which is merged into ``journalFile`` once the children exit.
+
+      Returns the exit code.
+    """
+    numProcesses = pargs.worker_processes
+    # Create the journal now so that the run can be resumed even if this
+    # process dies before the shard journals are merged.
+    ResultJournal.ResultJournal(journalFile).close()
+    children = []
+    taskFiles = []
+    shardJournals = []
+    for shardIndex in range(0, numProcesses):
+        # Round robin assignment preserves the task order (e.g. longest
+        # processing time first) within each shard.
+        shard = tasks[shardIndex::numProcesses]
+        if len(shard) == 0:
+            continue
+        taskFile = '{}.tasks-{}'.format(journalFile, shardIndex)
+        with open(taskFile, 'w') as f:
+            json.dump(shard, f)
+        taskFiles.append(taskFile)
+        shardJournal = shardJournalPath(journalFile, shardIndex)
+        shardJournals.append(shardJournal)
+        jobs = pargs.jobs // numProcesses
+        if shardIndex < pargs.jobs % numProcesses:
+            jobs += 1
+        cmdLine = [
+            sys.executable,
+            os.path.abspath(__file__),
+            '--log-level', pargs.log_level,
+            '--jobs', str(jobs),
+            '--in-flight-factor', str(pargs.in_flight_factor),
+            '--journal', shardJournal,
+            '--shard-tasks', taskFile,
+        ]
+        if pargs.log_file:
+            cmdLine.extend(['--log-file', '{}.shard-{}'.format(
+                pargs.log_file, shardIndex)])
+        if pargs.log_only_file:
+            cmdLine.append('--log-only-file')
+        if pargs.journal_fsync:
+            cmdLine.append('--journal-fsync')
+        # The tasks are already in the order they should run
+        cmdLine.extend(['--group-order', 'file'])
+        cmdLine.extend(['--repeat', str(pargs.repeat)])
+        cmdLine.extend(['--workdir-layout', pargs.workdir_layout])
+        if pargs.memory_budget is not None:
+            # Each worker gets a share of the budget proportional to its jobs
+            cmdLine.extend(['--memory-budget', str(max(1,
+                pargs.memory_budget * jobs // pargs.jobs))])
+            if pargs.memory_adapt_margin is not None:
+                cmdLine.extend(['--memory-adapt-margin',
+                                str(pargs.memory_adapt_margin)])
+        cmdLine.extend([
+            pargs.config_file,
+            pargs.invocation_info,
+            pargs.working_dirs_root,
+            pargs.yaml_output])
+        _logger.info('Starting worker process {} with {} tasks and {} jobs'.format(
+            shardIndex, len(shard), jobs))
+        _logger.debug('Worker process command line: {}'.format(cmdLine))
+        # Workers are put in their own session so that only this process
+        # receives signals from the terminal and forwards them once.
+        children.append(subprocess.Popen(cmdLine, start_new_session=True))
+
+    def forwardSignal(signum, _):
+        _logger.info('Received signal {}. Cancelling worker processes'.format(
+            signum))
+        # Workers handle SIGINT by cancelling their jobs and recording them
+        for child in children:
+            if child.poll() is None:
+                child.send_signal(signal.SIGINT)
+
+    # FIXME: Make windows compatible
+    signal.signal(signal.SIGINT, forwardSignal)
+    signal.signal(signal.SIGTERM, forwardSignal)
+    progress = ShardProgress(shardJournals, metrics)
+    try:
+        lastCompleted = 0
+        while True:
+            running = [child for child in children if child.poll() is None]
+            numCompleted = progress.update()
+            if numCompleted != lastCompleted:
+                logProgress(numCompleted, numPendingJobs, startTime)
+                lastCompleted = numCompleted
+            if len(running) == 0:
+                break
+            try:
+                running[0].wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                pass
+    finally:
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
 
-    def completed_runs(self):
-        return self._completed_runs
+    exitCode = 0
+    for child in children:
+        if child.returncode != 0:
+            _logger.error('Worker process {} exited with {}'.format(
+                child.pid, child.returncode))
+            exitCode = 1
+
+    mergeShardJournals(journalFile,
+                       [path for path in shardJournals if os.path.exists(path)],
+                       sync=pargs.journal_fsync)
+    for taskFile in taskFiles:
+        os.remove(taskFile)
+    return exitCode
+
+def runCoordinator(pargs, address, config, tasks, invocationInfoObjects,
+                   numPendingJobs, preparer, journalFile, startTime,
+                   metrics=None):
+    """
+      Serve ``tasks`` to batch-worker.py processes connecting to
+      ``address`` and write the results they send to the journal.
+
+      Returns a tuple ``(exitCode, coordinatorInfo)`` where
+      ``coordinatorInfo`` is a dictionary describing the run.
+    """
+    exitCode = 0
+    journal = ResultJournal.ResultJournal(journalFile, sync=pargs.journal_fsync)
+    _logger.info('Writing results to journal "{}"'.format(journalFile))
+
+    def onResult(index, result):
+        nonlocal exitCode
+        journal.append(index, result)
+        if metrics is not None:
+            metrics.recordResult(result)
+        if 'error' in result:
+            exitCode = 1
+
+    coordinator = Coordinator.JobCoordinator(
+        tasks, invocationInfoObjects, onResult, pargs.lease_timeout)
+    try:
+        server = Coordinator.CoordinatorServer(coordinator, address, config)
+    except OSError as e:
+        _logger.error('Failed to listen on {}'.format(address))
+        _logger.error(e)
+        journal.close()
+        return (1, None)
+    serverThread = threading.Thread(target=server.serve_forever,
+                                     name='coordinator_server', daemon=True)
+    serverThread.start()
+    _logger.info('Coordinator listening on {}:{}'.format(*server.server_address))
+
+    def handleCoordinatorInterrupt(signum, _):
+        _logger.info('Received signal {}. Stopping coordinator'.format(signum))
+        coordinator.stop()
+
+    # FIXME: Make windows compatible
+    signal.signal(signal.SIGINT, handleCoordinatorInterrupt)
+    signal.signal(signal.SIGTERM, handleCoordinatorInterrupt)
+    try:
+        lastCompleted = 0
+        # Expired leases are also detected when workers ask for work but
+        # that never happens if every worker is dead.
+        checkPeriod = min(5.0, pargs.lease_timeout / 4.0)
+        while not coordinator.waitUntilFinished(checkPeriod):
+            coordinator.expireLeases()
+            if coordinator.numResults != lastCompleted:
+                lastCompleted = coordinator.numResults
+                logProgress(lastCompleted, numPendingJobs, startTime)
+        logProgress(coordinator.numResults, numPendingJobs, startTime)
+        if not coordinator.waitForWorkers(min(60.0, pargs.lease_timeout)):
+            _logger.warning('Not every worker was told that the run finished')
+    finally:
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        coordinator.stop()
+        server.shutdown()
+        server.server_close()
+
+    unfinishedTasks = coordinator.unfinishedTasks()
+    if len(unfinishedTasks) > 0:
+        _logger.warning('Recording {} unfinished tasks as cancelled'.format(
+            len(unfinishedTasks)))
+        for indices in unfinishedTasks:
+            for index in indices:
+                result = preparer.errorResult(index, 'Job was cancelled')
+                journal.append(index, result)
+                if metrics is not None:
+                    metrics.recordResult(result)
+    journal.close()
+    coordinatorInfo = {
+        'workers': sorted(coordinator.workers),
+        'expired_leases': coordinator.numExpiredLeases,
+    }
+    _logger.info('{} workers took part. {} leases expired'.format(
+        len(coordinatorInfo['workers']), coordinatorInfo['expired_leases']))
+    return (exitCode, coordinatorInfo)
+
+def interleaveRepetitions(tasks, numInvocations, order, seed):
+    """
+    Returns ``tasks`` (lists of invocation indices where index
+    ``r * numInvocations + i`` is repetition ``r`` of invocation ``i``)
+    ordered so that repetitions of the same invocation do not run back to
+    back. ``round-robin`` runs every task of a repetition before starting
+    the next repetition (keeping the order of tasks within a repetition).
+    ``random`` uses a random permutation of all the tasks.
+    """
+    if order == 'random':
+        tasks = list(tasks)
+        random.Random(seed).shuffle(tasks)
+        return tasks
+    assert order == 'round-robin'
+    return sorted(tasks, key=lambda indices: indices[0] // numInvocations)
+
+def repetitionPriorities(priorities, numGroups, order, seed):
+    """
+    Like ``interleaveRepetitions()`` but for the priorities of groups given
+    to ``GroupScheduler`` where group ``r * numGroups + g`` is repetition
+    ``r`` of group ``g``.
+    """
+    if order == 'random':
+        positions = list(range(0, len(priorities)))
+        random.Random(seed).shuffle(positions)
+        return [-position for position in positions]
+    assert order == 'round-robin'
+    span = max(priorities) - min(priorities) + 1
+    return [priority - (group // numGroups) * span
+            for group, priority in enumerate(priorities)]
 
 def entryPoint(args):
     # pylint: disable=global-statement,too-many-branches,too-many-statements
     # pylint: disable=too-many-return-statements
-    global _logger, futureToRunners
+    global _logger, futureToRunners, jobLookahead, taskDispatcher, memoryAdmission
+    global slotLimiter, asyncEngine
     parser = argparse.ArgumentParser(description=__doc__)
     DriverUtil.parserAddLoggerArg(parser)
     parser.add_argument("--dry", action='store_true',
                         help="Stop after initialising runners")
+    parser.add_argument("--journal",
+                        dest="journal",
+                        default=None,
+                        help="Path to the result journal. Results are appended"
+                        " to it as jobs complete and it is used to build the"
+                        " yaml_output file at the end of the run"
+                        " (Default: <yaml_output>.journal)")
+    parser.add_argument("--journal-fsync",
+                        dest="journal_fsync",
+                        action='store_true',
+                        default=False,
+                        help="fsync() the journal after every result")
+    parser.add_argument("--resume",
+                        action='store_true',
+                        default=False,
+                        help="Resume a previous run using the same"
+                        " working_dirs_root and journal. Jobs that already have"
+                        " a result without an error are not run again.")
     parser.add_argument(
         "-j",
         "--jobs",
         type=int,
         default="1",
         help="Number of jobs to run in parallel (Default %(default)s)")
+    parser.add_argument("--prepare-lookahead",
+                        dest="prepare_lookahead",
+                        type=int,
+                        default=None,
+                        help="Number of tasks to create runners for ahead of"
+                        " them being run (Default: the number of jobs)")
+    parser.add_argument("--in-flight-factor",
+                        dest="in_flight_factor",
+                        type=int,
+                        default=2,
+                        help="When running jobs in parallel at most"
+                        " <in_flight_factor> * <jobs> tasks are submitted"
+                        " at any time (Default %(default)s)")
+    parser.add_argument("--schedule-history",
+                        dest="schedule_history",
+                        default=None,
+                        help="ResultInfo file from a previous run. If given,"
+                        " tasks are run longest predicted time first using"
+                        " the times in this file.")
+    parser.add_argument("--group-order",
+                        dest="group_order",
+                        choices=['largest-first', 'file'],
+                        default='largest-first',
+                        help="Order to run sequential_execution_indices groups in"
+                        " when there is no --schedule-history. largest-first"
+                        " runs the groups with the most jobs first"
+                        " (Default %(default)s)")
+    parser.add_argument("--repeat",
+                        type=int,
+                        default=1,
+                        help="Run every invocation this many times and write"
+                        " the repetitions of each invocation as a single merged"
+                        " result (Default %(default)s)")
+    parser.add_argument("--repeat-order",
+                        dest="repeat_order",
+                        choices=['round-robin', 'random'],
+                        default='round-robin',
+                        help="How to interleave repetitions with --repeat."
+                        " round-robin runs every invocation once before any"
+                        " invocation is repeated. random runs the repetitions"
+                        " in a random order (Default %(default)s)")
+    parser.add_argument("--repeat-seed",
+                        dest="repeat_seed",
+                        type=int,
+                        default=None,
+                        help="Seed for --repeat-order random (Default: random)")
+    parser.add_argument("--workdir-layout",
+                        dest="workdir_layout",
+                        choices=WorkDirLayout.LAYOUTS,
+                        default='flat',
+                        help="Layout of the working directories inside"
+                        " working_dirs_root. bucketed and hashed spread them over"
+                        " subdirectories and write an index file mapping"
+                        " invocation index to working directory"
+                        " (Default %(default)s)")
+    parser.add_argument("--engine",
+                        choices=['threads', 'asyncio'],
+                        default='threads',
+                        help="How jobs are run. threads runs each task in a pool"
+                        " thread. asyncio runs them from a single event loop which"
+                        " (with the Asyncio backend) scales to thousands of"
+                        " concurrent short jobs (Default %(default)s)")
+    parser.add_argument("--worker-processes",
+                        dest="worker_processes",
+                        type=int,
+                        default=1,
+                        help="Number of processes to shard tasks across. Each"
+                        " process runs its share of the jobs with its own"
+                        " thread pool (Default %(default)s)")
+    # Used internally by --worker-processes to give a worker its tasks
+    parser.add_argument("--shard-tasks",
+                        dest="shard_tasks",
+                        default=None,
+                        help=argparse.SUPPRESS)
+    parser.add_argument("--coordinator-listen",
+                        dest="coordinator_listen",
+                        default=None,
+                        help="Rather than running jobs, listen on HOST:PORT for"
+                        " batch-worker.py processes and give them the jobs to"
+                        " run")
+    parser.add_argument("--lease-timeout",
+                        dest="lease_timeout",
+                        type=float,
+                        default=300.0,
+                        help="Seconds a worker has to renew the lease on a task"
+                        " before it is given to another worker"
+                        " (Default %(default)s)")
+    parser.add_argument("--metrics-file",
+                        dest="metrics_file",
+                        default=None,
+                        help="Periodically write live metrics (throughput,"
+                        " job counts, busy slots, job times and ETA) to this"
+                        " file in the Prometheus text format")
+    parser.add_argument("--metrics-period",
+                        dest="metrics_period",
+                        type=float,
+                        default=5.0,
+                        help="Seconds between writes of --metrics-file"
+                        " (Default %(default)s)")
+    parser.add_argument("--metrics-port",
+                        dest="metrics_port",
+                        type=int,
+                        default=None,
+                        help="Serve live metrics from"
+                        " http://127.0.0.1:<port>/metrics")
+    parser.add_argument("--memory-budget",
+                        dest="memory_budget",
+                        default=None,
+                        help="Only start a job when the sum of the memory limits"
+                        " (max_memory) of the running jobs fits in this many MiB."
+                        " Use \"auto\" for the memory available on the host minus"
+                        " --memory-headroom. Jobs without a memory limit run on"
+                        " their own. --jobs still limits the number of jobs."
+                        " (Default: disabled)")
+    parser.add_argument("--memory-headroom",
+                        dest="memory_headroom",
+                        type=int,
+                        default=1024,
+                        help="MiB of available memory to leave unused when"
+                        " --memory-budget is \"auto\" (Default %(default)s)")
+    parser.add_argument("--memory-adapt-margin",
+                        dest="memory_adapt_margin",
+                        type=float,
+                        default=None,
+                        help="Reduce the memory reserved for a running job to its"
+                        " peak measured resident memory plus this fraction of it."
+                        " Only supported by backends that can measure memory"
+                        " usage (Default: disabled)")
+    parser.add_argument("--adaptive-jobs",
+                        dest="adaptive_jobs",
+                        default=False,
+                        action="store_true",
+                        help="Raise and lower the number of jobs that run in parallel"
+                        " between --min-jobs and --jobs depending on CPU and"
+                        " memory pressure on the host. Running jobs are never"
+                        " killed (Default: disabled)")
+    parser.add_argument("--min-jobs",
+                        dest="min_jobs",
+                        type=int,
+                        default=1,
+                        help="Fewest jobs to run in parallel with --adaptive-jobs"
+                        " (Default %(default)s)")
+    parser.add_argument("--adaptive-period",
+                        dest="adaptive_period",
+                        type=float,
+                        default=10.0,
+                        help="Seconds between adjustments with --adaptive-jobs"
+                        " (Default %(default)s)")
     parser.add_argument("config_file", help="YAML configuration file")
     parser.add_argument("invocation_info", help="Invocation info file")
     parser.add_argument("working_dirs_root",
@@ -107,10 +741,118 @@ def entryPoint(args):
         _logger.error('jobs must be <= 0')
         return 1
 
+    if pargs.prepare_lookahead is None:
+        pargs.prepare_lookahead = pargs.jobs
+    if pargs.prepare_lookahead <= 0:
+        _logger.error('--prepare-lookahead must be > 0')
+        return 1
+
+    if pargs.in_flight_factor <= 0:
+        _logger.error('--in-flight-factor must be > 0')
+        return 1
+
+    if pargs.worker_processes <= 0:
+        _logger.error('--worker-processes must be > 0')
+        return 1
+    if pargs.worker_processes > pargs.jobs:
+        _logger.error('--worker-processes cannot be greater than the number of jobs')
+        return 1
+    coordinatorAddress = None
+    if pargs.coordinator_listen is not None:
+        try:
+            coordinatorAddress = Coordinator.parseAddress(pargs.coordinator_listen)
+        except Coordinator.CoordinatorException as e:
+            _logger.error(e)
+            return 1
+        if pargs.worker_processes > 1 or pargs.dry:
+            _logger.error('--coordinator-listen cannot be used with --worker-processes or --dry')
+            return 1
+    if pargs.lease_timeout <= 0:
+        _logger.error('--lease-timeout must be > 0')
+        return 1
+
+    if pargs.metrics_period <= 0:
+        _logger.error('--metrics-period must be > 0')
+        return 1
+    if pargs.metrics_file is not None:
+        pargs.metrics_file = os.path.abspath(pargs.metrics_file)
+
+    if pargs.memory_budget is not None:
+        if pargs.memory_headroom < 0:
+            _logger.error('--memory-headroom must be >= 0')
+            return 1
+        if pargs.memory_budget == 'auto':
+            pargs.memory_budget = MemoryAdmission.defaultBudget(
+                pargs.memory_headroom)
+            _logger.info('Using memory budget of {} MiB'.format(
+                pargs.memory_budget))
+        else:
+            try:
+                pargs.memory_budget = int(pargs.memory_budget)
+            except ValueError:
+                _logger.error('--memory-budget must be an integer or "auto"')
+                return 1
+        if pargs.memory_budget <= 0:
+            _logger.error('--memory-budget must be > 0')
+            return 1
+    elif pargs.memory_adapt_margin is not None:
+        _logger.error('--memory-adapt-margin requires --memory-budget')
+        return 1
+    if pargs.memory_adapt_margin is not None and pargs.memory_adapt_margin < 0:
+        _logger.error('--memory-adapt-margin must be >= 0')
+        return 1
+
+    if pargs.adaptive_jobs:
+        if pargs.jobs <= 1:
+            _logger.error('--adaptive-jobs requires --jobs > 1')
+            return 1
+        if pargs.min_jobs <= 0 or pargs.min_jobs > pargs.jobs:
+            _logger.error('--min-jobs must be > 0 and <= --jobs')
+            return 1
+        if pargs.adaptive_period <= 0:
+            _logger.error('--adaptive-period must be > 0')
+            return 1
+        if pargs.worker_processes > 1 or pargs.coordinator_listen is not None:
+            _logger.error('--adaptive-jobs cannot be used with --worker-processes'
+                          ' or --coordinator-listen')
+            return 1
+
+    if pargs.engine == 'asyncio':
+        if sys.version_info < (3, 8):
+            _logger.error('--engine asyncio requires Python >= 3.8')
+            return 1
+        if (pargs.worker_processes > 1 or pargs.coordinator_listen is not None or
+                pargs.memory_budget is not None or pargs.adaptive_jobs):
+            _logger.error('--engine asyncio cannot be used with --worker-processes,'
+                          ' --coordinator-listen, --memory-budget or --adaptive-jobs')
+            return 1
+
+    if pargs.repeat <= 0:
+        _logger.error('--repeat must be > 0')
+        return 1
+    if (pargs.repeat > 1 and pargs.repeat_order == 'random' and
+            pargs.schedule_history is not None):
+        _logger.error('--repeat-order random cannot be used with --schedule-history')
+        return 1
+
+    if pargs.worker_processes > 1 and pargs.dry:
+        _logger.error('--dry cannot be used with --worker-processes')
+        return 1
+
+    shardTasks = None
+    if pargs.shard_tasks is not None:
+        if pargs.worker_processes > 1 or pargs.resume:
+            _logger.error('--shard-tasks cannot be used with --worker-processes or --resume')
+            return 1
+        with open(pargs.shard_tasks, 'r') as f:
+            shardTasks = json.load(f)
+
     # Load runner configuration
     config, success = DriverUtil.loadRunnerConfig(pargs.config_file)
     if not success:
         return 1
+    if not DriverUtil.checkRepeatSupported(config, pargs.repeat):
+        return 1
 
     # Get schema version that will be put into result info
     schemaVersion = ResultInfo.getSchema()['__version__']
@@ -132,6 +874,7 @@ def entryPoint(args):
     }
 
     sequential_execution_indices = None
+    groupDependencies = None
     if misc_data is not None:
         # Handle `sequential_execution_indices`
         if 'sequential_execution_indices' in misc_data:
@@ -159,24 +902,127 @@ def entryPoint(args):
             # All okay
             sequential_execution_indices = misc_data['sequential_execution_indices']
 
+            # Handle `sequential_execution_dependencies`
+            if 'sequential_execution_dependencies' in misc_data:
+                try:
+                    GroupScheduler.validateDependencies(
+                        misc_data['sequential_execution_dependencies'],
+                        len(sequential_execution_indices))
+                except GroupScheduler.GroupSchedulerException as e:
+                    _logger.error(e)
+                    return 1
+                groupDependencies = misc_data['sequential_execution_dependencies']
+                if (pargs.worker_processes > 1 or coordinatorAddress is not None or
+                        pargs.engine == 'asyncio'):
+                    _logger.error('sequential_execution_dependencies cannot be used with'
+                                  ' --worker-processes, --coordinator-listen or'
+                                  ' --engine asyncio')
+                    return 1
+        elif 'sequential_execution_dependencies' in misc_data:
+            _logger.error('sequential_execution_dependencies requires sequential_execution_indices')
+            return 1
+
         # copy misc data over
-        output_misc_data['invocation_info_misc'] = dict(filter(lambda kv_tup: kv_tup[0] != 'sequential_execution_indices', misc_data.items()))
+        output_misc_data['invocation_info_misc'] = dict(filter(
+            lambda kv_tup: kv_tup[0] not in ('sequential_execution_indices',
+                                             'sequential_execution_dependencies'),
+            misc_data.items()))
 
 
     if len(invocationInfoObjects) < 1:
         logging.error('List of jobs cannot be empty')
         return 1
 
+    numInvocations = len(invocationInfoObjects)
+    if pargs.repeat > 1:
+        # Repetition r of invocation i is given the index
+        # r * numInvocations + i so the rest of the run (journal, resume,
+        # working directories) treats repetitions like any other job.
+        invocationInfoObjects = [
+            InvocationInfo.InvocationInfo(copy.deepcopy(info.GetInternalRepr()))
+            for _ in range(0, pargs.repeat) for info in invocationInfoObjects]
+        if sequential_execution_indices:
+            numGroups = len(sequential_execution_indices)
+            sequential_execution_indices = [
+                [repetition * numInvocations + index for index in indices]
+                for repetition in range(0, pargs.repeat)
+                for indices in sequential_execution_indices]
+            if groupDependencies is not None:
+                groupDependencies = [
+                    [repetition * numGroups + group for group in deps]
+                    for repetition in range(0, pargs.repeat)
+                    for deps in groupDependencies]
+        if pargs.repeat_seed is None:
+            pargs.repeat_seed = random.SystemRandom().randrange(0, 2**32)
+        output_misc_data['repeat'] = {
+            'count': pargs.repeat,
+            'order': pargs.repeat_order,
+        }
+        if pargs.repeat_order == 'random':
+            output_misc_data['repeat']['seed'] = pargs.repeat_seed
+
     yamlOutputFile = os.path.abspath(pargs.yaml_output)
 
-    if os.path.exists(yamlOutputFile):
+    if (os.path.exists(yamlOutputFile) and not pargs.resume and
+            shardTasks is None):
         _logger.error(
             'yaml_output file ("{}") already exists'.format(yamlOutputFile))
         return 1
 
+    if pargs.journal is None:
+        journalFile = yamlOutputFile + '.journal'
+    else:
+        journalFile = os.path.abspath(pargs.journal)
+
     # Setup the directory to hold working directories
     workDirsRoot = os.path.abspath(pargs.working_dirs_root)
-    if os.path.exists(workDirsRoot):
+    completedIndices = set()
+    if shardTasks is None:
+        leftoverShardJournals = findShardJournals(journalFile)
+    else:
+        leftoverShardJournals = []
+    if shardTasks is not None:
+        # The parent process has already set up the working directory
+        if not os.path.isdir(workDirsRoot):
+            _logger.error('"{}" is not a directory'.format(workDirsRoot))
+            return 1
+        if os.path.exists(journalFile):
+            _logger.error(
+                'journal file ("{}") already exists'.format(journalFile))
+            return 1
+    elif pargs.resume:
+        if not os.path.isdir(workDirsRoot):
+            _logger.error(
+                'Cannot resume. "{}" is not a directory'.format(workDirsRoot))
+            return 1
+        if not os.path.exists(journalFile):
+            _logger.error(
+                'Cannot resume. journal file ("{}") does not exist'.format(
+                    journalFile))
+            return 1
+        if len(leftoverShardJournals) > 0:
+            # Results from worker processes of the previous run
+            _logger.info('Merging shard journals {} into "{}"'.format(
+                leftoverShardJournals, journalFile))
+            try:
+                mergeShardJournals(journalFile, leftoverShardJournals)
+            except Exception as e: # pylint: disable=broad-except
+                _logger.error('Failed to merge shard journals')
+                _logger.error(e)
+                _logger.debug(traceback.format_exc())
+                return 1
+        completedIndices, success = findCompletedIndices(
+            journalFile, invocationInfoObjects)
+        if not success:
+            return 1
+        _logger.info('Resuming. {} out of {} jobs already completed'.format(
+            len(completedIndices), len(invocationInfoObjects)))
+        output_misc_data['resumed_completed_jobs'] = len(completedIndices)
+    elif os.path.exists(journalFile) or len(leftoverShardJournals) > 0:
+        _logger.error(
+            'journal file ("{}") already exists'.format(journalFile))
+        return 1
+    elif os.path.exists(workDirsRoot):
         # Check its a directory and its empty
         if not os.path.isdir(workDirsRoot):
             _logger.error(
@@ -201,6 +1047,16 @@ def entryPoint(args):
             _logger.debug(traceback.format_exc())
             return 1
 
+    workDirLayout = WorkDirLayout.WorkDirLayout(workDirsRoot, pargs.workdir_layout)
+    try:
+        workDirLayout.initIndex()
+    except WorkDirLayout.WorkDirLayoutException as e:
+        _logger.error(e)
+        return 1
+    output_misc_data['working_dirs_root'] = workDirsRoot
+    output_misc_data['engine'] = pargs.engine
+    output_misc_data['workdir_layout'] = pargs.workdir_layout
+
     # Get Runner class to use
     RunnerClass = RunnerFactory.getRunnerClass(config['runner'])
     runner_ctx = RunnerContext.RunnerContext(num_parallel_jobs=pargs.jobs)
@@ -215,177 +1071,445 @@ def entryPoint(args):
 
     rc = config['runner_config']
 
-    # Create the runners
-    runners = []
-    for index, invocationInfo in enumerate(invocationInfoObjects):
-        _logger.info('Creating runner {} out of {} ({:.1f}%)'.format(
-            index + 1,
-            len(invocationInfoObjects),
-            100 * float(index + 1) / len(invocationInfoObjects)))
-        # Create working directory for this runner
-        workDir = os.path.join(workDirsRoot, 'workdir-{}'.format(index))
-        assert not os.path.exists(workDir)
+    if pargs.worker_processes > 1:
+        backendConfig = rc.get('backend', {}).get('config', {})
+        if 'resource_pinning' in backendConfig:
+            # Each worker process would pin to the same CPUs
+            _logger.error('resource_pinning cannot be used with --worker-processes')
+            return 1
+        output_misc_data['worker_processes'] = pargs.worker_processes
+
+    if shardTasks is not None:
+        # Ordering and grouping was decided by the parent process
+        pendingIndices = [index for indices in shardTasks for index in indices]
+        sequential_execution_indices = shardTasks
+        groupDependencies = None
+    else:
+        pendingIndices = [index for index in range(0, len(invocationInfoObjects))
+                          if index not in completedIndices]
+    if sequential_execution_indices and shardTasks is None:
+        # Drop jobs that have already completed from the sequential groups
+        sequential_execution_indices = [
+            [index for index in l if index not in completedIndices]
+            for l in sequential_execution_indices]
+        if groupDependencies is None:
+            sequential_execution_indices = [
+                l for l in sequential_execution_indices if len(l) > 0]
+        # Otherwise empty groups are kept so that dependencies still refer
+        # to the right groups.
 
+    orderedTasks = None
+    groupPriorities = None
+    if sequential_execution_indices:
+        unorderedTasks = sequential_execution_indices
+    else:
+        unorderedTasks = [[index] for index in pendingIndices]
+    taskCosts = None
+    scheduleInfo = None
+    if pargs.schedule_history is not None:
+        # Job time limit used by the runner. KLEE derives it from its
+        # exploration and test generation times.
+        timeLimit = rc.get('max_time',
+                           rc.get('explore_max_time', 0) +
+                           rc.get('generate_tests_max_time', 0))
         try:
-            os.mkdir(workDir)
+            costModel = CostModel.loadCostModel(pargs.schedule_history, timeLimit)
         except Exception as e: # pylint: disable=broad-except
-            _logger.error(
-                'Failed to create working directory "{}"'.format(workDir))
+            _logger.error('Failed to load schedule history "{}"'.format(
+                pargs.schedule_history))
             _logger.error(e)
             _logger.debug(traceback.format_exc())
             return 1
+        predictionSources = {'exact': 0, 'program': 0, 'fallback': 0}
+        taskCosts = []
+        for indices in unorderedTasks:
+            taskCost = 0.0
+            for index in indices:
+                cost, source = costModel.predict(
+                    invocationInfoObjects[index].GetInternalRepr())
+                predictionSources[source] += 1
+                taskCost += cost
+            taskCosts.append((indices, taskCost))
+        _logger.info('Job cost predictions: {}'.format(predictionSources))
+        scheduleInfo = {
+            'policy': 'longest_processing_time_first',
+            'history': os.path.abspath(pargs.schedule_history),
+            'prediction_sources': predictionSources,
+        }
+    elif sequential_execution_indices and pargs.group_order == 'largest-first':
+        # Without a history the number of jobs in a group is used as its cost
+        taskCosts = [(indices, float(len(indices))) for indices in unorderedTasks]
+        scheduleInfo = {'policy': 'largest_group_first'}
+
+    if groupDependencies is not None:
+        # Groups run as soon as the groups they depend on have finished.
+        # This order is only used when running jobs sequentially.
+        if taskCosts is not None:
+            groupPriorities = [cost for _, cost in taskCosts]
+        else:
+            groupPriorities = [-group for group in range(0, len(unorderedTasks))]
+        if pargs.repeat > 1:
+            groupPriorities = repetitionPriorities(
+                groupPriorities, len(unorderedTasks) // pargs.repeat,
+                pargs.repeat_order, pargs.repeat_seed)
+        orderedTasks = [
+            unorderedTasks[group] for group in
+            GroupScheduler.topologicalOrder(groupPriorities, groupDependencies)
+            if len(unorderedTasks[group]) > 0]
+        if scheduleInfo is None:
+            scheduleInfo = {'policy': 'file_order'}
+        scheduleInfo['group_dependencies'] = True
+    elif taskCosts is not None:
+        inOrderMakespan = CostModel.predictMakespan(
+            [cost for _, cost in taskCosts], pargs.jobs)
+        taskCosts = CostModel.longestProcessingTimeFirst(taskCosts)
+        predictedMakespan = CostModel.predictMakespan(
+            [cost for _, cost in taskCosts], pargs.jobs)
+        orderedTasks = [indices for indices, _ in taskCosts]
+        if pargs.schedule_history is not None:
+            _logger.info('Predicted makespan: {:.1f} seconds (in file order: {:.1f} seconds)'.format(
+                predictedMakespan, inOrderMakespan))
+            scheduleInfo['predicted_makespan'] = predictedMakespan
+            scheduleInfo['predicted_makespan_in_file_order'] = inOrderMakespan
+    del taskCosts
+    if pargs.repeat > 1 and groupDependencies is None and shardTasks is None:
+        if orderedTasks is None:
+            orderedTasks = unorderedTasks
+        orderedTasks = interleaveRepetitions(
+            orderedTasks, numInvocations, pargs.repeat_order, pargs.repeat_seed)
+    if scheduleInfo is not None:
+        output_misc_data['schedule'] = scheduleInfo
+
+    def iterTasks():
+        # Tasks are generated lazily so the number of jobs does not dictate
+        # memory usage. Each call returns a new iterator over the same tasks.
+        if orderedTasks is not None:
+            return iter(orderedTasks)
+        if sequential_execution_indices:
+            return iter(sequential_execution_indices)
+        return ([index] for index in pendingIndices)
+
+    # Runners are created just in time rather than all up front
+    preparer = JobPreparer.JobPreparer(
+        invocationInfoObjects,
+        workDirsRoot,
+        RunnerClass,
+        rc,
+        runner_ctx,
+        removeExisting=pargs.resume or shardTasks is not None,
+        layout=workDirLayout)
 
-        # Do coverage_dir subtitution if necessary
-        if invocationInfo.CoverageDir is not None:
-            coverage_dir = invocationInfo.CoverageDir
-            assert isinstance(coverage_dir, str)
-            new_coverage_dir = coverage_dir.replace('@global_work_dir@', workDirsRoot)
-            _logger.info('Replacing coverage dir "{}" with "{}"'.format(
-                coverage_dir,
-                new_coverage_dir)
-            )
-            invocationInfo.GetInternalRepr()['coverage_dir'] = new_coverage_dir
-            # Create the directory if necessary
-            if not os.path.exists(new_coverage_dir):
-                _logger.info('Creating coverage directory "{}"'.format(new_coverage_dir))
-                os.makedirs(new_coverage_dir)
-
-        # Pass in a copy of rc so that if a runner accidently modifies
-        # a config it won't affect other runners.
-        runners.append(RunnerClass(invocationInfo, workDir, rc.copy(), runner_ctx))
-
-    # Run the runners and build the report
-    reports = []
     exitCode = 0
 
     if pargs.dry:
+        for runnerNumber, index in enumerate(pendingIndices):
+            _logger.info('Creating runner {} out of {} ({:.1f}%)'.format(
+                runnerNumber + 1,
+                len(pendingIndices),
+                100 * float(runnerNumber + 1) / len(pendingIndices)))
+            if preparer.tryPrepare(index).error is not None:
+                return 1
         _logger.info('Not running runners')
         return exitCode
 
-    startTime = datetime.datetime.now()
-    _logger.info('Starting {}'.format(startTime.isoformat(' ')))
-    output_misc_data['start_time'] = str(startTime.isoformat(' '))
+    batchMetrics = None
+    metricsReporter = None
+    if pargs.metrics_file is not None or pargs.metrics_port is not None:
+        backendName = rc.get('backend', {}).get('name', 'PythonPsUtil')
+        # With worker processes or remote workers the slots are not
+        # visible to this process
+        batchMetrics = Metrics.BatchMetrics(
+            len(pendingIndices),
+            pargs.jobs if (pargs.worker_processes == 1 and
+                           coordinatorAddress is None) else None,
+            backendName)
+        try:
+            metricsReporter = Metrics.MetricsReporter(
+                batchMetrics,
+                path=pargs.metrics_file,
+                period=pargs.metrics_period,
+                port=pargs.metrics_port)
+        except OSError as e:
+            _logger.error('Failed to serve metrics on port {}'.format(
+                pargs.metrics_port))
+            _logger.error(e)
+            return 1
+        metricsReporter.start()
+
+    if coordinatorAddress is not None:
+        startTime = datetime.datetime.now()
+        _logger.info('Starting {}'.format(startTime.isoformat(' ')))
+        output_misc_data['start_time'] = str(startTime.isoformat(' '))
+        exitCode, coordinatorInfo = runCoordinator(
+            pargs, coordinatorAddress, config, iterTasks(),
+            invocationInfoObjects, len(pendingIndices), preparer, journalFile,
+            startTime, batchMetrics)
+        if coordinatorInfo is None:
+            return 1
+        output_misc_data['coordinator'] = coordinatorInfo
+    elif pargs.worker_processes > 1:
+        startTime = datetime.datetime.now()
+        _logger.info('Starting {}'.format(startTime.isoformat(' ')))
+        output_misc_data['start_time'] = str(startTime.isoformat(' '))
+        exitCode = runWorkerProcesses(pargs, list(iterTasks()),
+                                      len(pendingIndices), journalFile,
+                                      startTime, batchMetrics)
+    else:
+        # Create the first runner now so that configuration problems are
+        # reported before anything runs.
+        preparedJobs = {}
+        if len(pendingIndices) > 0:
+            firstJob = preparer.tryPrepare(next(iterTasks())[0])
+            if firstJob.error is not None:
+                return 1
+            preparedJobs[firstJob.index] = firstJob
 
-    if pargs.jobs == 1:
-        _logger.info('Running jobs sequentially')
-        for r in runners:
+        # Created by the backend of the first runner if it is used
+        memoryMonitor, _ = runner_ctx.get_object(MemoryMonitor.CONTEXT_OBJECT_NAME)
+        if memoryMonitor is not None and batchMetrics is not None:
+            batchMetrics.setMemoryMonitor(memoryMonitor)
+
+        # Results are streamed to the journal as they complete rather than
+        # being kept in memory.
+        journal = ResultJournal.ResultJournal(journalFile, sync=pargs.journal_fsync)
+        _logger.info('Writing results to journal "{}"'.format(journalFile))
+
+        startTime = datetime.datetime.now()
+        _logger.info('Starting {}'.format(startTime.isoformat(' ')))
+        output_misc_data['start_time'] = str(startTime.isoformat(' '))
+
+        groupScheduler = None
+        if groupDependencies is not None and pargs.jobs > 1:
+            # The order groups run in depends on when their dependencies
+            # finish so runners cannot be created ahead of time.
+            groupScheduler = GroupScheduler.GroupScheduler(
+                sequential_execution_indices, groupPriorities, groupDependencies)
+            jobLookahead = JobPreparer.InlinePreparer(
+                preparer, sequential_execution_indices, preparedJobs)
+        else:
+            jobLookahead = JobPreparer.LookaheadPreparer(
+                preparer, iterTasks(), pargs.prepare_lookahead, preparedJobs)
+        completedJobCounter = 0
+
+        if pargs.memory_budget is not None:
+            memoryAdmission = MemoryAdmission.MemoryAdmission(
+                pargs.memory_budget, pargs.memory_adapt_margin)
+            if pargs.memory_adapt_margin is not None:
+                memoryAdmission.startPolling(1.0)
+
+        if pargs.engine == 'asyncio':
+            import concurrent.futures
+            # Only imported when used because they need a newer Python
+            from KleeRunner import AsyncEngine
+            from KleeRunner import AsyncSupervisor
+
+            def onAsyncTaskComplete(task, excep):
+                nonlocal exitCode, completedJobCounter
+                numJobsFinished, hadError = recordTaskResults(
+                    journal, preparer, task, excep, batchMetrics)
+                if hadError:
+                    exitCode = 1
+                if numJobsFinished > 0:
+                    completedJobCounter += numJobsFinished
+                    logProgress(completedJobCounter, len(pendingIndices),
+                                startTime)
+
+            signal.signal(signal.SIGINT, handleInterrupt)
+            signal.signal(signal.SIGTERM, handleInterrupt)
+            _logger.info('Running up to {} jobs on an asyncio event loop'.format(
+                pargs.jobs))
+            asyncEngine = AsyncEngine.AsyncEngine(
+                AsyncSupervisor.fromContext(runner_ctx), pargs.jobs,
+                jobLookahead, preparer, batchMetrics)
+            unsubmittedTasks = None
             try:
-                r.run()
-                reports.append(r.getResults())
+                unsubmittedTasks = asyncEngine.run(iterTasks(), onAsyncTaskComplete)
+            finally:
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                jobLookahead.stop()
+            # Record the tasks that were never started due to cancellation
+            for task in unsubmittedTasks:
+                recordTaskResults(journal, preparer, task,
+                                  concurrent.futures.CancelledError(), batchMetrics)
+        elif pargs.jobs == 1:
+            _logger.info('Running jobs sequentially')
+            for task_number, indices in enumerate(iterTasks()):
+                task_holder = TaskHolder(task_number, indices, jobLookahead,
+                                         preparer, memoryAdmission,
+                                         batchMetrics)
+                excep = None
+                try:
+                    task_holder.run()
+                except KeyboardInterrupt as e:
+                    _logger.error('Keyboard interrupt')
+                    # This is slightly redundant because the runner
+                    # currently kills itself if KeyboardInterrupt is thrown
+                    task_holder.kill()
+                    recordTaskResults(journal, preparer, task_holder, e,
+                                      batchMetrics)
+                    break
+                except Exception as e: # pylint: disable=broad-except
+                    _logger.error("Error handling:{}".format(indices))
+                    _logger.error(traceback.format_exc())
+                    excep = e
+                numJobsFinished, hadError = recordTaskResults(
+                    journal, preparer, task_holder, excep, batchMetrics)
+                if hadError:
+                    exitCode = 1
+                completedJobCounter += numJobsFinished
+                logProgress(completedJobCounter, len(pendingIndices), startTime)
+            jobLookahead.stop()
+        else:
+
+            # FIXME: Make windows compatible
+            # Catch signals so we can clean up
+            signal.signal(signal.SIGINT, handleInterrupt)
+            signal.signal(signal.SIGTERM, handleInterrupt)
+
+            _logger.info('Running jobs in parallel')
+            import concurrent.futures
+
+            def scheduledGroups():
+                for group in groupScheduler:
+                    if group is Dispatcher.NOT_READY:
+                        yield (group, None)
+                    else:
+                        yield (group, sequential_execution_indices[group])
+
+            def createTaskHolders():
+                if groupScheduler is None:
+                    numberedTasks = enumerate(iterTasks())
+                else:
+                    numberedTasks = scheduledGroups()
+                for task_number, indices in numberedTasks:
+                    if task_number is Dispatcher.NOT_READY:
+                        yield task_number
+                        continue
+                    if len(indices) > 1:
+                        _logger.info('Forcing indicies "{}" to run sequentially'.format(indices))
+                    yield TaskHolder(task_number, indices, jobLookahead,
+                                     preparer, memoryAdmission, batchMetrics,
+                                     slotLimiter)
+
+            def onTaskComplete(future, task_holder):
+                nonlocal exitCode, completedJobCounter
+                if groupScheduler is not None:
+                    # Let the groups that depend on this one run
+                    groupScheduler.taskFinished(task_holder.task_number)
+                excep = None
+                try:
+                    if future.exception():
+                        excep = future.exception()
+                except concurrent.futures.CancelledError as e:
+                    excep = e
+
+                # Only emit messages about exceptions that aren't to do
+                # with cancellation
+                if excep != None and not isinstance(excep, concurrent.futures.CancelledError):
+                    _logger.error('Task {} hit exception:\n{}'.format(
+                        task_holder.indices,
+                        "\n".join(traceback.format_exception(
+                            type(excep), excep, None))))
+
+                numJobsFinished, hadError = recordTaskResults(
+                    journal, preparer, task_holder, excep, batchMetrics)
+                if hadError and not future.cancelled():
+                    exitCode = 1
+                if numJobsFinished > 0:
+                    completedJobCounter += numJobsFinished
+                    logProgress(completedJobCounter, len(pendingIndices),
+                                startTime)
+
+            concurrencyController = None
+            if pargs.adaptive_jobs:
+                # Start with a slot per CPU. The controller moves the limit
+                # from there.
+                initialSlots = min(pargs.jobs,
+                                   max(pargs.min_jobs, os.cpu_count() or 1))
+                _logger.info('Adapting number of parallel jobs between {} and {}'
+                             ' starting at {}'.format(
+                                 pargs.min_jobs, pargs.jobs, initialSlots))
+                slotLimiter = ConcurrencyController.SlotLimiter(initialSlots)
+                concurrencyController = ConcurrencyController.ConcurrencyController(
+                    slotLimiter, pargs.min_jobs, pargs.jobs, pargs.adaptive_period)
+                concurrencyController.start()
+
+            unsubmittedTasks = None
+            try:
+                with concurrent.futures.ThreadPoolExecutor(max_workers=pargs.jobs) as executor:
+                    # Only a bounded number of tasks are submitted at a time. More
+                    # are pulled from the lazy iterator as slots free up.
+                    taskDispatcher = Dispatcher.WindowedDispatcher(
+                        executor, pargs.in_flight_factor * pargs.jobs)
+                    futureToRunners = taskDispatcher.futureToTask
+                    unsubmittedTasks = taskDispatcher.run(
+                        createTaskHolders(), onTaskComplete)
             except KeyboardInterrupt:
+                # The executor should of been cleaned terminated.
+                # We'll then write what we can to the output YAML file
                 _logger.error('Keyboard interrupt')
-                # This is slightly redundant because the runner
-                # currently kills itself if KeyboardInterrupt is thrown
-                r.kill()
-                break
-            except Exception: # pylint: disable=broad-except
-                _logger.error("Error handling:{}".format(r.program))
-                _logger.error(traceback.format_exc())
-
-                # Attempt to add the error to the reports
-                errorLog = {}
-                errorLog['invocation_info'] = r.InvocationInfo
-                errorLog['error'] = traceback.format_exc()
-                reports.append(errorLog)
-                exitCode = 1
-    else:
+            finally:
+                # Stop catching signals and just use default handlers
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                jobLookahead.stop()
+                if concurrencyController is not None:
+                    concurrencyController.stop()
+                    output_misc_data['adaptive_jobs'] = concurrencyController.stats()
 
-        # FIXME: Make windows compatible
-        # Catch signals so we can clean up
-        signal.signal(signal.SIGINT, handleInterrupt)
-        signal.signal(signal.SIGTERM, handleInterrupt)
+            if unsubmittedTasks is not None and groupScheduler is not None:
+                unsubmittedTasks = (
+                    TaskHolder(group, sequential_execution_indices[group],
+                               jobLookahead, preparer)
+                    for group in groupScheduler.unscheduledTasks())
+            if unsubmittedTasks is not None:
+                # Record the tasks that were never submitted due to cancellation
+                for task_holder in unsubmittedTasks:
+                    recordTaskResults(journal, preparer, task_holder,
+                                      concurrent.futures.CancelledError(),
+                                      batchMetrics)
 
-        _logger.info('Running jobs in parallel')
-        completedFutureCounter = 0
-        import concurrent.futures
-        try:
-            with concurrent.futures.ThreadPoolExecutor(max_workers=pargs.jobs) as executor:
-                if sequential_execution_indices:
-                    # Force sequential execution of runners where appropriate
-                    futureToRunners = {}
-                    for l in sequential_execution_indices:
-                        # Create list of runners to run sequentially
-                        _logger.info('Forcing indicies "{}" to run sequentially'.format(l))
-                        seq_runners = []
-                        for runner_index in l:
-                            seq_runners.append(runners[runner_index])
-
-                        # Use wrapper to force sequential execution
-                        seq_runner = SequentialRunnerHolder(seq_runners)
-                        future = executor.submit(seq_runner.run)
-                        futureToRunners[future] = seq_runner
-                else:
-                    # Simple: One runner to one future mapping.
-                    futureToRunners = {executor.submit(r.run): [r] for r in runners}
-                for future in concurrent.futures.as_completed(futureToRunners):
-                    completed_runner_list = None
-                    if isinstance(futureToRunners[future], list):
-                        completed_runner_list = futureToRunners[future]
-                    else:
-                        assert isinstance(futureToRunners[future], SequentialRunnerHolder)
-                        completed_runner_list = futureToRunners[future].completed_runs()
-                    for r in completed_runner_list:
-                        _logger.debug('{} runner finished'.format(
-                            r.programPathArgument))
-
-                        if future.done() and not future.cancelled():
-                            completedFutureCounter += 1
-                            _logger.info('Completed {}/{} ({:.1f}%)'.format(
-                                completedFutureCounter,
-                                len(runners),
-                                100 * (float(completedFutureCounter) / len(runners))
-                                ))
-
-                        excep = None
-                        try:
-                            if future.exception():
-                                excep = future.exception()
-                        except concurrent.futures.CancelledError as e:
-                            excep = e
-
-                        if excep != None:
-                            # Attempt to log the error reports
-                            errorLog = {}
-                            r_work_dir = None
-                            try:
-                                r_work_dir = r.workingDirectory
-                            except Exception:
-                                pass
-                            errorLog['working_directory'] = r_work_dir
-                            errorLog['invocation_info'] = r.InvocationInfo.GetInternalRepr()
-                            errorLog['error'] = "\n".join(
-                                traceback.format_exception(
-                                    type(excep),
-                                    excep,
-                                    None))
-                            # Only emit messages about exceptions that aren't to do
-                            # with cancellation
-                            if not isinstance(excep, concurrent.futures.CancelledError):
-                                _logger.error('{} runner hit exception:\n{}'.format(
-                                    r.programPathArgument, errorLog['error']))
-                            reports.append(errorLog)
-                        else:
-                            reports.append(r.getResults())
-        except KeyboardInterrupt:
-            # The executor should of been cleaned terminated.
-            # We'll then write what we can to the output YAML file
-            _logger.error('Keyboard interrupt')
-        finally:
-            # Stop catching signals and just use default handlers
-            signal.signal(signal.SIGINT, signal.SIG_DFL)
-            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        journal.close()
+
+        if memoryMonitor is not None:
+            memoryMonitor.stop()
+            monitorStats = memoryMonitor.stats()
+            _logger.info('Memory monitor spent {:.3f} seconds in {} sweeps'.format(
+                monitorStats['total_sweep_time'], monitorStats['sweeps']))
+            output_misc_data['memory_monitor'] = monitorStats
+
+        if memoryAdmission is not None:
+            memoryAdmission.stop()
+            admissionStats = memoryAdmission.stats()
+            _logger.info('Memory admission delayed {} of {} jobs by {:.1f} seconds in total'
+                         ' (max {:.1f} seconds)'.format(
+                             admissionStats['jobs_delayed'],
+                             admissionStats['jobs_admitted'],
+                             admissionStats['total_queueing_delay'],
+                             admissionStats['max_queueing_delay']))
+            output_misc_data['memory_admission'] = admissionStats
+
+    if metricsReporter is not None:
+        metricsReporter.stop()
+
+    if shardTasks is not None:
+        # The parent process aggregates the results of all shards
+        return exitCode
 
     endTime = datetime.datetime.now()
     output_misc_data['end_time'] = str(endTime.isoformat(' '))
     output_misc_data['run_time'] = str(endTime- startTime)
+    if 'schedule' in output_misc_data:
+        actualMakespan = (endTime - startTime).total_seconds()
+        output_misc_data['schedule']['actual_makespan'] = actualMakespan
+        if 'predicted_makespan' in output_misc_data['schedule']:
+            _logger.info('Predicted makespan: {:.1f} seconds, actual makespan: {:.1f} seconds'.format(
+                output_misc_data['schedule']['predicted_makespan'], actualMakespan))
 
     # Write result to YAML file
-    outputData = {
-        'schema_version': schemaVersion,
-        'results': reports,
-        'misc': output_misc_data,
-    }
-    DriverUtil.writeYAMLOutputFile(yamlOutputFile, outputData)
+    ResultJournal.finalizeJournal(journalFile, yamlOutputFile, schemaVersion,
+                                  output_misc_data, numInvocations, pargs.repeat)
 
     _logger.info('Finished {}'.format(endTime.isoformat(' ')))
     _logger.info('Total run time: {}'.format(endTime - startTime))
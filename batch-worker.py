@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+# vim: set sw=4 ts=4 softtabstop=4 expandtab:
+"""
+    Script to run jobs leased from a batch-runner.py coordinator
+    (see ``--coordinator-listen``).
+"""
+import argparse
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+from KleeRunner import Coordinator
+from KleeRunner import DriverUtil
+from KleeRunner import InvocationInfo
+from KleeRunner import JobPreparer
+from KleeRunner import RunnerContext
+from KleeRunner import RunnerFactory
+from KleeRunner import WorkDirLayout
+
+_logger = None
+
+
+class Worker:
+    """
+    Runs ``numSlots`` jobs at a time that are leased from the coordinator
+    using ``client`` and keeps the leases alive whilst they run.
+    """
+    def __init__(self, client, preparer, invocationInfos, numSlots,
+                 leaseTimeout, pollPeriod):
+        assert numSlots > 0
+        self._client = client
+        self._preparer = preparer
+        self._invocationInfos = invocationInfos
+        self._numSlots = numSlots
+        self._leaseTimeout = leaseTimeout
+        self._pollPeriod = pollPeriod
+        self._lock = threading.Lock()
+        # Maps the id of each held lease to the runner currently running
+        # under it (or None)
+        self._active = {}
+        self._stopEvent = threading.Event()
+        self._lastContact = time.monotonic()
+        self.lostCoordinator = False
+        self.numJobs = 0
+
+    def _contacted(self):
+        with self._lock:
+            self._lastContact = time.monotonic()
+
+    def _checkCoordinatorLost(self, e):
+        _logger.warning('Failed to contact coordinator: {}'.format(e))
+        with self._lock:
+            lost = time.monotonic() - self._lastContact > self._leaseTimeout
+        if lost:
+            # Any leases we hold will have expired by now
+            _logger.error('Lost contact with the coordinator')
+            self.lostCoordinator = True
+            self.stop()
+
+    def _leaseIsValid(self, leaseId):
+        with self._lock:
+            return leaseId in self._active
+
+    def _runLease(self, lease):
+        leaseId = lease['lease']
+        for index, invocationInfoRepr in zip(lease['indices'],
+                                             lease['invocation_infos']):
+            if self._stopEvent.is_set() or not self._leaseIsValid(leaseId):
+                return
+            self._invocationInfos[index] = InvocationInfo.InvocationInfo(
+                invocationInfoRepr)
+            job = self._preparer.tryPrepare(index)
+            if job.error is not None:
+                result = self._preparer.errorResult(index, job.error)
+            else:
+                with self._lock:
+                    if leaseId not in self._active:
+                        return
+                    self._active[leaseId] = job.runner
+                try:
+                    job.runner.run()
+                    result = job.runner.getResults()
+                except Exception: # pylint: disable=broad-except
+                    _logger.error('Error running index {}:\n{}'.format(
+                        index, traceback.format_exc()))
+                    result = self._preparer.errorResult(
+                        index, traceback.format_exc())
+                finally:
+                    with self._lock:
+                        if self._active.get(leaseId, None) is job.runner:
+                            self._active[leaseId] = None
+            del self._invocationInfos[index]
+            if self._stopEvent.is_set():
+                # The job was killed. Let the lease expire so that the
+                # coordinator gives the job to another worker.
+                return
+            try:
+                accepted = self._client.sendResult(leaseId, index, result)
+                self._contacted()
+            except (OSError, Coordinator.CoordinatorException) as e:
+                self._checkCoordinatorLost(e)
+                return
+            with self._lock:
+                self.numJobs += 1
+            if not accepted:
+                _logger.warning('Coordinator rejected result for index {}'.format(
+                    index))
+                return
+
+    def _slot(self):
+        while not self._stopEvent.is_set():
+            try:
+                leases, finished = self._client.lease(1)
+                self._contacted()
+            except (OSError, Coordinator.CoordinatorException) as e:
+                self._checkCoordinatorLost(e)
+                self._stopEvent.wait(self._pollPeriod)
+                continue
+            if finished:
+                # No other slot can be running a job because the
+                # coordinator only finishes when it has every result.
+                _logger.info('Coordinator has no more work')
+                self._stopEvent.set()
+                return
+            if len(leases) == 0:
+                # Other workers hold the remaining work. Some of it might
+                # be requeued if they die.
+                self._stopEvent.wait(self._pollPeriod)
+                continue
+            for lease in leases:
+                with self._lock:
+                    self._active[lease['lease']] = None
+                try:
+                    self._runLease(lease)
+                finally:
+                    with self._lock:
+                        self._active.pop(lease['lease'], None)
+
+    def _renewLeases(self):
+        while not self._stopEvent.wait(self._leaseTimeout / 3.0):
+            with self._lock:
+                leaseIds = list(self._active.keys())
+            if len(leaseIds) == 0:
+                continue
+            try:
+                invalid = self._client.renew(leaseIds)
+                self._contacted()
+            except (OSError, Coordinator.CoordinatorException) as e:
+                self._checkCoordinatorLost(e)
+                continue
+            for leaseId in invalid:
+                _logger.warning('Lease {} is no longer valid'.format(leaseId))
+                with self._lock:
+                    runner = self._active.pop(leaseId, None)
+                if runner is not None:
+                    runner.kill()
+
+    def stop(self):
+        self._stopEvent.set()
+        with self._lock:
+            runners = [r for r in self._active.values() if r is not None]
+        for runner in runners:
+            runner.kill()
+
+    def run(self):
+        renewThread = threading.Thread(
+            target=self._renewLeases, name='lease_renewer', daemon=True)
+        renewThread.start()
+        slots = [threading.Thread(target=self._slot, name='slot-{}'.format(i))
+                 for i in range(0, self._numSlots)]
+        for slot in slots:
+            slot.start()
+        # Join with a timeout so that signals are handled
+        for slot in slots:
+            while slot.is_alive():
+                slot.join(1.0)
+        self._stopEvent.set()
+        renewThread.join()
+
+
+def entryPoint(args):
+    # pylint: disable=global-statement
+    global _logger
+    parser = argparse.ArgumentParser(description=__doc__)
+    DriverUtil.parserAddLoggerArg(parser)
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default="1",
+        help="Number of jobs to run in parallel (Default %(default)s)")
+    parser.add_argument("--poll-period",
+                        dest="poll_period",
+                        type=float,
+                        default=5.0,
+                        help="Seconds to wait before asking the coordinator for"
+                        " work again when none is available (Default %(default)s)")
+    parser.add_argument("--workdir-layout",
+                        dest="workdir_layout",
+                        choices=WorkDirLayout.LAYOUTS,
+                        default='flat',
+                        help="Layout of the working directories (see batch-runner.py)"
+                        " (Default %(default)s)")
+    parser.add_argument("coordinator", help="Address of the coordinator (HOST:PORT)")
+    parser.add_argument("working_dirs_root",
+                        help="Directory to create working directories inside")
+
+    pargs = parser.parse_args(args)
+
+    DriverUtil.handleLoggerArgs(pargs, parser)
+    _logger = logging.getLogger(__name__)
+
+    if pargs.jobs <= 0:
+        _logger.error('jobs must be > 0')
+        return 1
+
+    if pargs.poll_period <= 0:
+        _logger.error('--poll-period must be > 0')
+        return 1
+
+    try:
+        address = Coordinator.parseAddress(pargs.coordinator)
+    except Coordinator.CoordinatorException as e:
+        _logger.error(e)
+        return 1
+
+    workerId = '{}-{}'.format(socket.gethostname(), os.getpid())
+    client = Coordinator.CoordinatorClient(address, workerId)
+    try:
+        config, leaseTimeout = client.hello()
+    except (OSError, Coordinator.CoordinatorException) as e:
+        _logger.error('Failed to connect to coordinator at "{}"'.format(
+            pargs.coordinator))
+        _logger.error(e)
+        return 1
+    _logger.info('Connected to coordinator at "{}" as "{}"'.format(
+        pargs.coordinator, workerId))
+
+    workDirsRoot = os.path.abspath(pargs.working_dirs_root)
+    if os.path.exists(workDirsRoot) and not os.path.isdir(workDirsRoot):
+        _logger.error(
+            '"{}" exists but is not a directory'.format(workDirsRoot))
+        return 1
+    os.makedirs(workDirsRoot, exist_ok=True)
+    workDirLayout = WorkDirLayout.WorkDirLayout(workDirsRoot, pargs.workdir_layout)
+    try:
+        workDirLayout.initIndex()
+    except WorkDirLayout.WorkDirLayoutException as e:
+        _logger.error(e)
+        return 1
+
+    RunnerClass = RunnerFactory.getRunnerClass(config['runner'])
+    runner_ctx = RunnerContext.RunnerContext(num_parallel_jobs=pargs.jobs)
+    # Invocation infos are sent by the coordinator with each lease
+    invocationInfos = {}
+    # Working directories may be left over from jobs that this host ran
+    # before they were requeued.
+    preparer = JobPreparer.JobPreparer(
+        invocationInfos,
+        workDirsRoot,
+        RunnerClass,
+        config['runner_config'],
+        runner_ctx,
+        removeExisting=True,
+        layout=workDirLayout)
+
+    worker = Worker(client, preparer, invocationInfos, pargs.jobs,
+                    leaseTimeout, pargs.poll_period)
+
+    def handleInterrupt(signum, _):
+        _logger.info('Received signal {}. Stopping'.format(signum))
+        worker.stop()
+
+    # FIXME: Make windows compatible
+    signal.signal(signal.SIGINT, handleInterrupt)
+    signal.signal(signal.SIGTERM, handleInterrupt)
+    try:
+        worker.run()
+    finally:
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    _logger.info('Ran {} jobs'.format(worker.numJobs))
+    if worker.lostCoordinator:
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(entryPoint(sys.argv[1:]))
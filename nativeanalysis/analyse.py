@@ -3,6 +3,7 @@ from collections import namedtuple
 import logging
 import pprint
 import re
+from KleeRunner.LogCapture import openLogFile
 
 _logger = logging.getLogger(__name__)
 
@@ -47,7 +48,7 @@ def get_test_case_run_outcome(r):
     if r['exit_code'] == 1:
         log_file = r['log_file']
         _logger.debug('Opening log file "{}"'.format(log_file))
-        with open(log_file, 'r') as f:
+        with openLogFile(log_file) as f:
             for l in f:
                 libkleeruntest_error_match = LIB_KLEE_RUN_TEST_ERROR_MSG_RE.search(l)
                 if libkleeruntest_error_match:
@@ -64,7 +65,7 @@ def get_test_case_run_outcome(r):
         # FIXME: This only works when using PythonPsUtil as the backend
         log_file = r['log_file']
         _logger.debug('Opening log file "{}"'.format(log_file))
-        with open(log_file, 'r') as f:
+        with openLogFile(log_file) as f:
             for l in f:
                 assert_match = ASSERT_GDB_RE.search(l)
                 if assert_match:
@@ -182,7 +183,7 @@ def _get_outcome_attached_gdb(r):
     # For now assume we are looking for abort and assertion failures
     log_file = r['log_file']
     _logger.debug('Opening log file "{}"'.format(log_file))
-    with open(log_file, 'r') as f:
+    with openLogFile(log_file) as f:
         # Walk through the lines trying to find assertion message
         # e.g.
         # non_terminating_klee_bug.x86_64: /home/user/fp-bench/benchmarks/c/imperial/synthetic/non-terminating/non-terminating.c:65: main: Assertion `false' failed.
@@ -311,7 +312,7 @@ def _get_outcome_ubsan(r):
     # Look for runtime error
     log_file = r['log_file']
     _logger.debug('Opening log file "{}"'.format(log_file))
-    with open(log_file, 'r') as f:
+    with openLogFile(log_file) as f:
         for l in f:
             runtime_error_match = UBSAN_RUNTIME_ERROR_RE.search(l)
             if runtime_error_match:
@@ -406,7 +407,7 @@ def _get_outcome_asan(r):
     # AddressSanitizer: stack-buffer-overflow on address
     log_file = r['log_file']
     _logger.debug('Opening log file "{}"'.format(log_file))
-    with open(log_file, 'r') as f:
+    with openLogFile(log_file) as f:
         for l in f:
             asan_error_msg_match = ASAN_ERROR_MSG_RE.search(l)
             if asan_error_msg_match:
@@ -444,6 +444,20 @@ def same_values_or_list_of_values(l):
     return same_value
 
 
+# Keys of a result that are not always present
+OPTIONAL_KEYS = [
+    'log_truncated',
+    'peak_memory',
+    'teardown_time',
+    'max_rss',
+    'minor_page_faults',
+    'major_page_faults',
+    'voluntary_context_switches',
+    'involuntary_context_switches',
+    'block_input_operations',
+    'block_output_operations',
+]
+
 def merge_result_infos(result_infos):
     assert isinstance(result_infos, list)
     assert len(result_infos) > 1
@@ -505,6 +519,11 @@ def merge_result_infos(result_infos):
     wallclock_time_values = [r['wallclock_time'] for r in result_infos]
     merged_result_info['wallclock_time'] = wallclock_time_values
 
+    # merge the values that only some backends record
+    for key in OPTIONAL_KEYS:
+        if any(key in r for r in result_infos):
+            merged_result_info[key] = [r.get(key, None) for r in result_infos]
+
     # Add an attribute that hints that this is a merged result
     merged_result_info['merged_result'] = True
 
@@ -16,6 +16,7 @@ from load_klee_runner import add_KleeRunner_to_module_search_path
 add_kleeanalysis_to_module_search_path()
 add_KleeRunner_to_module_search_path()
 import KleeRunner.ResultInfo
+import KleeRunner.WorkDirLayout
 import KleeRunner.DriverUtil as DriverUtil
 import kleeanalysis.analyse
 import kleeanalysis.verificationtasks
@@ -71,6 +72,12 @@ def main(argv):
        help='Only analyse results where the bencmark belongs to all specified categories',
        default=[]
     )
+    parser.add_argument("--working-dirs-root",
+        dest="working_dirs_root",
+        default=None,
+        help="Find working directories in this directory (using its working"
+        " directory index) rather than where the result info says they are",
+    )
     DriverUtil.parserAddLoggerArg(parser)
 
     args = parser.parse_args(args=argv)
@@ -104,6 +111,9 @@ def main(argv):
     try:
         # FIXME: Don't use raw form
         resultInfos = KleeRunner.ResultInfo.loadRawResultInfos(args.result_info_file)
+        if args.working_dirs_root is not None:
+            KleeRunner.WorkDirLayout.relocateResults(
+                resultInfos["results"], os.path.abspath(args.working_dirs_root))
         for index, result in enumerate(resultInfos["results"]):
             if 'error' in result:
                 _logger.error('Found error result :{}'.format(pprint.pformat(result)))
@@ -12,6 +12,7 @@ add_KleeRunner_to_module_search_path()
 add_kleeanalysis_to_module_search_path()
 add_nativeanalysis_to_module_search_path()
 from KleeRunner import ResultInfo
+from KleeRunner import WorkDirLayout
 import KleeRunner.DriverUtil as DriverUtil
 import KleeRunner.InvocationInfo
 import KleeRunner.util
@@ -38,6 +39,11 @@ def main(args):
     parser.add_argument('--dump-timeouts',
         dest='dump_timeouts',
         action='store_true')
+    parser.add_argument('--working-dirs-root',
+        dest='working_dirs_root',
+        default=None,
+        help='Find working directories in this directory (using its working'
+        ' directory index) rather than where the result info says they are')
 
     DriverUtil.parserAddLoggerArg(parser)
     pargs = parser.parse_args()
@@ -46,6 +52,10 @@ def main(args):
     _logger.info('Loading "{}"...'.format(pargs.result_info_file.name))
     resultInfos, resultInfoMisc  = ResultInfo.loadResultInfos(pargs.result_info_file)
     _logger.info('Loading complete')
+    if pargs.working_dirs_root is not None:
+        WorkDirLayout.relocateResults(
+            [r.GetInternalRepr() for r in resultInfos],
+            os.path.abspath(pargs.working_dirs_root))
 
     # Check the misc data
     if resultInfoMisc is None:
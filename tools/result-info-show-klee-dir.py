@@ -15,6 +15,7 @@ from load_klee_runner import add_KleeRunner_to_module_search_path
 add_kleeanalysis_to_module_search_path()
 add_KleeRunner_to_module_search_path()
 import KleeRunner.ResultInfo
+import KleeRunner.WorkDirLayout
 import KleeRunner.DriverUtil as DriverUtil
 from kleeanalysis.kleedir.kleedir import KleeDir
 
@@ -40,12 +41,22 @@ def main(argv):
                         default=False,
                         action="store_true")
 
+    parser.add_argument("--working-dirs-root",
+                        dest="working_dirs_root",
+                        default=None,
+                        help="Find working directories in this directory (using its"
+                        " working directory index) rather than where the result"
+                        " info says they are")
+
     DriverUtil.parserAddLoggerArg(parser)
 
     args = parser.parse_args(args=argv)
     DriverUtil.handleLoggerArgs(args, parser)
 
     resultInfos = KleeRunner.ResultInfo.loadRawResultInfos(args.result_info_file)
+    if args.working_dirs_root is not None:
+        KleeRunner.WorkDirLayout.relocateResults(
+            resultInfos['results'], os.path.abspath(args.working_dirs_root))
     abort_errors = []
     assert_errors = []
     division_errors = []